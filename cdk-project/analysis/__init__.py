@@ -0,0 +1,4 @@
+"""
+@Description: offline analysis tools that run over exported job records, outside of AWS. They are not deployed as part
+of the CDK app and require the packages listed in requirements-dev.txt.
+"""
@@ -0,0 +1,234 @@
+"""
+@Description: instance packing analysis over exported job records. The jobs hydrated with the container instance they
+ran on are turned into running intervals, [RunningAt, StoppedAt], and a sweep line over the start and end of every
+interval rebuilds the number of jobs running concurrently on each instance. Usage:
+
+python -m analysis.packing --by InstanceType export-*.jsonl.gz
+
+For every group of instances it reports:
+
+- Instances, Jobs: number of instances and of jobs that ran on them
+- ObservedSeconds: sum of the time between the first job started and the last job stopped on every instance. The time
+  an instance was up before its first job and after its last one is not logged, and is not accounted for
+- BusySeconds, IdleSeconds: observed time with at least one job running, and without any
+- Utilization: percentage of the observed time the instances were busy
+- PeakConcurrentJobs: highest number of jobs that ran at the same time on a single instance
+- AvgConcurrentJobs: average number of jobs running on an instance over its observed time
+- AvgBusyConcurrentJobs: average number of jobs running on an instance while it was busy
+
+Intervals are kept in NumPy arrays of about 20 bytes per job, so millions of jobs are analysed in memory.
+"""
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from .records import read_chunks
+
+
+DEFAULT_GROUP_BY = ('InstanceType', 'AvailabilityZone')
+INSTANCE_FIELDS = ('InstanceType', 'AvailabilityZone', 'Architecture')
+
+
+def job_interval(record):
+    """
+    Returns the (start, end) epoch milliseconds a job was running, or None when the job didn't run or wasn't logged
+    with its end. RunningAt has second precision, so the start is derived from the duration when it's missing.
+    """
+
+    end = record.get('StoppedAt')
+
+    if not isinstance(end, (int, float)):
+        return None
+
+    start = record.get('RunningAt')
+
+    if not isinstance(start, (int, float)):
+        seconds = record.get('TotalRunningSeconds')
+
+        if not isinstance(seconds, (int, float)):
+            return None
+
+        start = end - seconds * 1000
+
+    return int(min(start, end)), int(end)
+
+
+class IntervalSet:
+    """
+    Running intervals of the jobs, by instance. Instances are numbered in the order they are found, and the attributes
+    of each one are kept from the first job that ran on it.
+    """
+
+    def __init__(self):
+        self.instance_ids = {}
+        self.instances = []
+
+        self._chunks = []
+        self.skipped = 0
+
+    def add_records(self, records):
+        instance_indices, starts, ends = [], [], []
+
+        for record in records:
+            instance_id = record.get('InstanceId')
+            interval = job_interval(record) if instance_id else None
+
+            if interval is None:
+                self.skipped += 1
+                continue
+
+            index = self.instance_ids.get(instance_id)
+
+            if index is None:
+                index = self.instance_ids[instance_id] = len(self.instances)
+                self.instances.append(dict({'InstanceId': instance_id},
+                                           **{field: record.get(field) for field in INSTANCE_FIELDS}))
+
+            instance_indices.append(index)
+            starts.append(interval[0])
+            ends.append(interval[1])
+
+        if instance_indices:
+            self._chunks.append((np.array(instance_indices, dtype=np.int32), np.array(starts, dtype=np.int64),
+                                 np.array(ends, dtype=np.int64)))
+
+    def arrays(self):
+        """
+        Returns the instance index, start and end of every interval as three arrays.
+        """
+
+        if not self._chunks:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        if len(self._chunks) > 1:
+            self._chunks = [tuple(np.concatenate(arrays) for arrays in zip(*self._chunks))]
+
+        return self._chunks[0]
+
+
+def sweep(instance_indices, starts, ends, n_instances):
+    """
+    Sweeps the start (+1) and end (-1) of every interval, ordered by instance and time, and returns per instance
+    arrays of (jobs, observed ms, busy ms, job ms, peak concurrent jobs). Ends are ordered before starts at the same
+    time, so that a job starting as another one stops is not counted as running alongside it.
+    """
+
+    n = len(starts)
+    jobs = np.bincount(instance_indices, minlength=n_instances)
+    observed = np.zeros(n_instances, dtype=np.int64)
+    busy = np.zeros(n_instances, dtype=np.int64)
+    job_ms = np.zeros(n_instances, dtype=np.int64)
+    peak = np.zeros(n_instances, dtype=np.int64)
+
+    if not n:
+        return jobs, observed, busy, job_ms, peak
+
+    points = np.concatenate([instance_indices, instance_indices])
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(n, dtype=np.int8), np.full(n, -1, dtype=np.int8)])
+
+    order = np.lexsort((deltas, times, points))
+    points, times, deltas = points[order], times[order], deltas[order]
+    del order
+
+    # Every instance opens and closes as many intervals as it has jobs, so a running sum over all the instances drops
+    # back to zero at the boundary between two instances
+    concurrency = np.cumsum(deltas, dtype=np.int32)
+    same_instance = points[1:] == points[:-1]
+    first_points = np.flatnonzero(np.concatenate([[True], ~same_instance]))
+    last_points = np.concatenate([first_points[1:], [len(points)]]) - 1
+    instances = points[first_points]
+
+    observed[instances] = times[last_points] - times[first_points]
+    peak[instances] = np.maximum.reduceat(concurrency, first_points)
+
+    # The concurrency after a point holds until the next point of the same instance
+    segment_ms = np.where(same_instance, np.diff(times), 0)
+    levels = concurrency[:-1]
+    busy[:] = np.bincount(points[:-1], weights=np.where(levels > 0, segment_ms, 0), minlength=n_instances)
+    job_ms[:] = np.bincount(points[:-1], weights=segment_ms * levels, minlength=n_instances)
+
+    return jobs, observed, busy, job_ms, peak
+
+
+def _group_stats(instances, jobs, observed, busy, job_ms, peak):
+    observed_seconds = float(observed.sum()) / 1000
+    busy_seconds = float(busy.sum()) / 1000
+    job_seconds = float(job_ms.sum()) / 1000
+
+    return {
+        'Instances': instances,
+        'Jobs': int(jobs.sum()),
+        'ObservedSeconds': round(observed_seconds, 3),
+        'BusySeconds': round(busy_seconds, 3),
+        'IdleSeconds': round(observed_seconds - busy_seconds, 3),
+        'Utilization': round(busy_seconds / observed_seconds * 100, 2) if observed_seconds else None,
+        'PeakConcurrentJobs': int(peak.max()) if instances else 0,
+        'AvgConcurrentJobs': round(job_seconds / observed_seconds, 3) if observed_seconds else None,
+        'AvgBusyConcurrentJobs': round(job_seconds / busy_seconds, 3) if busy_seconds else None
+    }
+
+
+def analyse(intervals, group_by=DEFAULT_GROUP_BY):
+    """
+    Returns the packing statistics of the instances grouped by the given instance fields, from the least utilized
+    group to the most. An empty group_by returns one row per instance.
+    """
+
+    instance_indices, starts, ends = intervals.arrays()
+    jobs, observed, busy, job_ms, peak = sweep(instance_indices, starts, ends, len(intervals.instances))
+
+    groups = {}
+
+    for index, instance in enumerate(intervals.instances):
+        key = tuple(instance.get(field) for field in group_by) if group_by else (instance['InstanceId'],)
+        groups.setdefault(key, []).append(index)
+
+    rows = []
+
+    for key, indices in groups.items():
+        indices = np.array(indices)
+        row = dict(zip(group_by or ('InstanceId',), key))
+        row.update(_group_stats(len(indices), jobs[indices], observed[indices], busy[indices], job_ms[indices],
+                                peak[indices]))
+        rows.append(row)
+
+    return sorted(rows, key=lambda row: (row['Utilization'] is None, row['Utilization'] or 0))
+
+
+def read_intervals(paths, chunk_size=100000):
+    intervals = IntervalSet()
+
+    for records in read_chunks(paths, chunk_size):
+        intervals.add_records(records)
+
+    return intervals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reports how densely jobs were packed on the instances')
+    parser.add_argument('paths', nargs='+', help='JSON lines files, optionally gzip-compressed')
+    parser.add_argument('--by', default=','.join(DEFAULT_GROUP_BY),
+                        help=f'Comma-separated instance fields to group by, among {", ".join(INSTANCE_FIELDS)}')
+    parser.add_argument('--per-instance', action='store_true', help='Reports every instance on its own')
+    args = parser.parse_args(argv)
+
+    group_by = () if args.per_instance else tuple(field.strip() for field in args.by.split(','))
+
+    if any(field not in INSTANCE_FIELDS for field in group_by):
+        parser.error(f'--by only accepts {", ".join(INSTANCE_FIELDS)}')
+
+    intervals = read_intervals(args.paths)
+
+    for row in analyse(intervals, group_by):
+        print(json.dumps(row))
+
+    if intervals.skipped:
+        print(f'{intervals.skipped} records without an instance or a running interval were skipped', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,365 @@
+"""
+@Description: price-performance comparison of CPU architectures over exported job records. The dashboard averages the
+durations of all the jobs per architecture, which mixes job definitions and instance sizes. This analysis compares the
+jobs of every job definition that ran on both architectures, and reports how long they ran and how much they cost on
+the candidate architecture relative to the baseline one. Usage:
+
+python -m analysis.price_performance --prices prices.json exports/*.jsonl.gz
+python -m analysis.price_performance --merge-revisions --replicates 2000 exports/*.jsonl.gz
+
+Prices are read from a JSON file of On-Demand, Spot or negotiated prices, as they depend on the Region and purchase
+option. Every instance type maps either to its hourly price or to {"HourlyPrice": <price>, "vCPUs": <count>}:
+
+{"c5.2xlarge": 0.34, "c6g.2xlarge": 0.272, "t3.large": {"HourlyPrice": 0.0832, "vCPUs": 2}}
+
+The vCPUs of an instance type are otherwise derived from its size (large = 2, xlarge = 4, 2xlarge = 8...), which
+doesn't hold for burstable and metal instances. The cost of a job is its RUNNING hours times the price of a vCPU of its
+instance type, i.e. the cost of each vCPU it requested: jobs of the same job definition request the same vCPUs, so the
+ratios don't depend on them, and jobs that ran on instances of different sizes are compared fairly. Only succeeded
+jobs are compared, as failed jobs stop early.
+
+For every job definition it reports:
+
+- BaselineJobs, CandidateJobs: number of jobs on each architecture
+- BaselineMeanRunningSeconds, CandidateMeanRunningSeconds: mean RUNNING duration on each architecture
+- RuntimeRatio: CandidateMeanRunningSeconds / BaselineMeanRunningSeconds, below 1 when the candidate is faster
+- BaselineMeanVcpuCost, CandidateMeanVcpuCost, CostRatio: the same for the cost per vCPU of the jobs, when prices are
+  given. A CostRatio below 1 means that moving the job definition to the candidate architecture saves money
+- RuntimeRatioLow, RuntimeRatioHigh, CostRatioLow, CostRatioHigh: bootstrap confidence interval of the ratios
+
+The bootstrap resamples the jobs of each architecture independently. Jobs with the same duration and cost are
+interchangeable, so when many jobs share the same values, each resample is drawn as one multinomial over the distinct
+(duration, cost) pairs instead of one draw per job. Past 10,000 jobs, the means of the resamples are normally
+distributed for all practical purposes, so they are drawn from that distribution directly and the ratios of millions of
+jobs are resampled in milliseconds.
+"""
+
+import argparse
+import json
+import re
+import sys
+
+import numpy as np
+
+from .records import read_chunks
+
+
+DEFAULT_BASELINE = 'x86_64'
+DEFAULT_CANDIDATE = 'arm64'
+DEFAULT_REPLICATES = 1000
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_MIN_JOBS = 30
+
+# vCPUs of the sizes that are the same across instance families. <n>xlarge sizes have 4 * n vCPUs
+SIZE_VCPUS = {'medium': 1, 'large': 2, 'xlarge': 4}
+
+# Upper bound of the draws made at once, as replicates * jobs or distinct (duration, cost) pairs
+MAX_DRAW_CELLS = 4 * 10 ** 6
+MULTINOMIAL_DRAW_COST = 16
+
+# Number of jobs of an architecture from which the means of its resamples are approximated as normally distributed
+NORMAL_APPROXIMATION_JOBS = 10000
+
+
+def instance_vcpus(instance_type):
+    """
+    Returns the vCPUs of an instance type derived from its size, or None when the size doesn't tell.
+    """
+
+    size = instance_type.rpartition('.')[2]
+
+    if size in SIZE_VCPUS:
+        return SIZE_VCPUS[size]
+
+    match = re.fullmatch(r'(\d+)xlarge', size)
+    return 4 * int(match.group(1)) if match else None
+
+
+def load_price_table(path):
+    """
+    Reads a price table and returns it as {instance type: (hourly price, vCPUs)}. vCPUs are None when they are neither
+    given nor derived from the size of the instance type.
+    """
+
+    with open(path, 'r', encoding='utf-8') as f:
+        table = json.load(f)
+
+    prices = {}
+
+    for instance_type, entry in table.items():
+        if not isinstance(entry, dict):
+            entry = {'HourlyPrice': entry}
+
+        prices[instance_type] = (float(entry['HourlyPrice']), entry.get('vCPUs') or instance_vcpus(instance_type))
+
+    return prices
+
+
+def job_definition_group(job_definition, merge_revisions=False):
+    return (job_definition.rpartition(':')[0] or job_definition) if merge_revisions else job_definition
+
+
+class JobSet:
+    """
+    Succeeded jobs of the baseline and candidate architectures. Job definitions and instance types are numbered in the
+    order they are found.
+    """
+
+    def __init__(self, architectures, merge_revisions=False):
+        self.architectures = {architecture: code for code, architecture in enumerate(architectures)}
+        self.merge_revisions = merge_revisions
+
+        self.group_indices = {}
+        self.groups = []
+        self.instance_type_indices = {}
+        self.instance_types = []
+
+        self._chunks = []
+        self.skipped = 0
+
+    @staticmethod
+    def __index(indices, values, value):
+        if value not in indices:
+            indices[value] = len(values)
+            values.append(value)
+
+        return indices[value]
+
+    def add_records(self, records):
+        group_indices, architectures, instance_type_indices, seconds = [], [], [], []
+
+        for record in records:
+            architecture = self.architectures.get(record.get('Architecture'))
+            duration = record.get('TotalRunningSeconds')
+
+            if architecture is None or record.get('Status') != 'SUCCEEDED' or not record.get('JobDefinition') \
+                    or not record.get('InstanceType') or not isinstance(duration, (int, float)):
+                self.skipped += 1
+                continue
+
+            group = job_definition_group(record['JobDefinition'], self.merge_revisions)
+            group_indices.append(self.__index(self.group_indices, self.groups, group))
+            architectures.append(architecture)
+            instance_type_indices.append(self.__index(self.instance_type_indices, self.instance_types,
+                                                      record['InstanceType']))
+            seconds.append(duration)
+
+        if group_indices:
+            self._chunks.append((np.array(group_indices, dtype=np.int32), np.array(architectures, dtype=np.int8),
+                                 np.array(instance_type_indices, dtype=np.int32), np.array(seconds, dtype=np.float64)))
+
+    def arrays(self):
+        """
+        Returns the job definition index, architecture code, instance type index and RUNNING seconds of every job as
+        four arrays.
+        """
+
+        if not self._chunks:
+            return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int32),
+                    np.empty(0, dtype=np.float64))
+
+        if len(self._chunks) > 1:
+            self._chunks = [tuple(np.concatenate(arrays) for arrays in zip(*self._chunks))]
+
+        return self._chunks[0]
+
+
+def vcpu_prices(instance_types, prices):
+    """
+    Returns the hourly price of a vCPU of every instance type, NaN for the instance types without a price or vCPUs.
+    """
+
+    vcpu_price = np.full(len(instance_types), np.nan)
+
+    for index, instance_type in enumerate(instance_types):
+        hourly_price, vcpus = prices.get(instance_type, (None, None))
+
+        if hourly_price is not None and vcpus:
+            vcpu_price[index] = hourly_price / vcpus
+
+    return vcpu_price
+
+
+def compress(values, segments):
+    """
+    Collapses the rows of a (rows, 2) array into the distinct rows of every segment, and returns them sorted by segment
+    with their number of occurrences and their segment.
+    """
+
+    order = np.lexsort((values[:, 1], values[:, 0], segments))
+    values, segments = values[order], segments[order]
+
+    changed = np.any(values[1:] != values[:-1], axis=1) | (segments[1:] != segments[:-1])
+    starts = np.flatnonzero(np.concatenate([[True], changed]))
+    counts = np.diff(np.concatenate([starts, [len(values)]]))
+
+    return values[starts], counts, segments[starts]
+
+
+def bootstrap_means(values, counts, replicates, rng):
+    """
+    Returns the means of the columns of values over `replicates` resamples of the jobs they count, as a (replicates,
+    columns) array. Beyond NORMAL_APPROXIMATION_JOBS jobs, the means are drawn from the normal distribution that the
+    means of the resamples converge to instead, with the covariance of the values divided by the number of jobs.
+    """
+
+    n = int(counts.sum())
+
+    if n > NORMAL_APPROXIMATION_JOBS:
+        mean = counts @ values / n
+        centered = values - mean
+        covariance = (centered.T * counts) @ centered / n / n
+        return rng.multivariate_normal(mean, covariance, size=replicates)
+
+    means = []
+
+    # A multinomial count costs about as much as drawing MULTINOMIAL_DRAW_COST jobs, so jobs are drawn one by one
+    # unless many of them share the same values
+    if len(counts) * MULTINOMIAL_DRAW_COST < n:
+        chunk = max(1, MAX_DRAW_CELLS // len(counts))
+
+        for i in range(0, replicates, chunk):
+            draws = rng.multinomial(n, counts / n, size=min(chunk, replicates - i))
+            means.append(draws @ values / n)
+    else:
+        columns = [np.repeat(column, counts) for column in values.T]
+        chunk = max(1, MAX_DRAW_CELLS // n)
+
+        for i in range(0, replicates, chunk):
+            draws = rng.integers(0, n, size=(min(chunk, replicates - i), n))
+            means.append(np.column_stack([column[draws].sum(axis=1) for column in columns]) / n)
+
+    return np.concatenate(means)
+
+
+def _interval(samples, confidence):
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(samples, [tail, 100 - tail])
+    return round(float(low), 4), round(float(high), 4)
+
+
+def compare(jobs, prices=None, replicates=DEFAULT_REPLICATES, confidence=DEFAULT_CONFIDENCE, min_jobs=DEFAULT_MIN_JOBS,
+            seed=0):
+    """
+    Returns the comparison of every job definition with at least min_jobs jobs on each architecture, from the best
+    candidate for a move to the worst: by CostRatio when prices are given, and by RuntimeRatio otherwise. Jobs on
+    instance types without a price are left out when prices are given, so that both ratios compare the same jobs.
+    """
+
+    group_indices, architectures, instance_type_indices, seconds = jobs.arrays()
+    (baseline, _), (candidate, _) = sorted(jobs.architectures.items(), key=lambda item: item[1])
+    rng = np.random.default_rng(seed)
+
+    if prices is None:
+        costs = np.zeros(len(seconds))
+    else:
+        costs = seconds / 3600 * vcpu_prices(jobs.instance_types, prices)[instance_type_indices]
+        priced = ~np.isnan(costs)
+        group_indices, architectures, seconds, costs = group_indices[priced], architectures[priced], \
+            seconds[priced], costs[priced]
+
+    if not len(seconds):
+        return []
+
+    # Every (job definition, architecture) is a segment, whose distinct (duration, cost) pairs are resampled
+    segments = group_indices.astype(np.int64) * 2 + architectures
+    values, counts, value_segments = compress(np.column_stack([seconds, costs]), segments)
+    bounds = np.concatenate([np.flatnonzero(np.concatenate([[True], value_segments[1:] != value_segments[:-1]])),
+                             [len(value_segments)]])
+    segment_slices = {int(value_segments[start]): slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])}
+
+    rows = []
+
+    for group_index, group in enumerate(jobs.groups):
+        arms = [segment_slices.get(group_index * 2 + code) for code in (0, 1)]
+
+        if any(arm is None or counts[arm].sum() < min_jobs for arm in arms):
+            continue
+
+        # Columns of (duration, cost) means, for the baseline then the candidate
+        means = [counts[arm] @ values[arm] / counts[arm].sum() for arm in arms]
+        resampled = [bootstrap_means(values[arm], counts[arm], replicates, rng) for arm in arms]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = resampled[1] / resampled[0]
+
+        row = {
+            'JobDefinition': group,
+            'Baseline': baseline,
+            'Candidate': candidate,
+            'BaselineJobs': int(counts[arms[0]].sum()),
+            'CandidateJobs': int(counts[arms[1]].sum()),
+            'BaselineMeanRunningSeconds': round(float(means[0][0]), 3),
+            'CandidateMeanRunningSeconds': round(float(means[1][0]), 3),
+            'RuntimeRatio': round(float(means[1][0] / means[0][0]), 4) if means[0][0] else None
+        }
+        row['RuntimeRatioLow'], row['RuntimeRatioHigh'] = _interval(ratios[:, 0], confidence)
+
+        if prices is not None:
+            row.update({
+                'BaselineMeanVcpuCost': round(float(means[0][1]), 6),
+                'CandidateMeanVcpuCost': round(float(means[1][1]), 6),
+                'CostRatio': round(float(means[1][1] / means[0][1]), 4) if means[0][1] else None
+            })
+            row['CostRatioLow'], row['CostRatioHigh'] = _interval(ratios[:, 1], confidence)
+
+        rows.append(row)
+
+    ratio = 'RuntimeRatio' if prices is None else 'CostRatio'
+    return sorted(rows, key=lambda row: (row[ratio] is None, row[ratio] or 0))
+
+
+def read_jobs(paths, architectures, merge_revisions=False, chunk_size=100000):
+    jobs = JobSet(architectures, merge_revisions)
+
+    for records in read_chunks(paths, chunk_size):
+        jobs.add_records(records)
+
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compares the runtime and cost of job definitions across architectures'
+    )
+    parser.add_argument('paths', nargs='+', help='JSON lines files, optionally gzip-compressed')
+    parser.add_argument('--prices', help='JSON file of the hourly price, and optionally vCPUs, of the instance types')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Architecture the candidate is compared to')
+    parser.add_argument('--candidate', default=DEFAULT_CANDIDATE, help='Architecture compared to the baseline')
+    parser.add_argument('--merge-revisions', action='store_true',
+                        help='Compares all the revisions of a job definition together')
+    parser.add_argument('--min-jobs', type=int, default=DEFAULT_MIN_JOBS,
+                        help='Minimum number of jobs of a job definition on each architecture')
+    parser.add_argument('--replicates', type=int, default=DEFAULT_REPLICATES, help='Number of bootstrap resamples')
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE,
+                        help='Confidence level of the intervals')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the bootstrap')
+    args = parser.parse_args(argv)
+
+    if args.baseline == args.candidate:
+        parser.error('--baseline and --candidate must be different architectures')
+
+    if not 0 < args.confidence < 1:
+        parser.error('--confidence must be between 0 and 1')
+
+    prices = load_price_table(args.prices) if args.prices else None
+    jobs = read_jobs(args.paths, (args.baseline, args.candidate), args.merge_revisions)
+
+    for row in compare(jobs, prices, args.replicates, args.confidence, args.min_jobs, args.seed):
+        print(json.dumps(row))
+
+    if jobs.skipped:
+        print(f'{jobs.skipped} records that are not succeeded jobs of the {args.baseline} or {args.candidate} '
+              f'architectures were skipped', file=sys.stderr)
+
+    if prices is not None:
+        unpriced = np.flatnonzero(np.isnan(vcpu_prices(jobs.instance_types, prices)))
+        left_out = int(np.isin(jobs.arrays()[2], unpriced).sum())
+
+        if left_out:
+            missing = ', '.join(sorted(jobs.instance_types[index] for index in unpriced))
+            print(f'{left_out} jobs were left out, as the price or vCPUs of {missing} are unknown', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
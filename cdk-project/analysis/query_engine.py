@@ -0,0 +1,895 @@
+"""
+@Description: local executor of the CloudWatch Logs Insights queries built in queries/log_queries.py. It supports the
+subset of the query syntax the dashboard uses:
+
+- fields <expr> [as <alias>], ...
+- filter <boolean expr>, including <field> in [<value>, ...]
+- stats <count|sum|avg|min|max>(<expr>) [as <alias>], ... [by <field>, ...]
+- sort <field> [asc|desc]
+- limit <n>
+
+Records are processed in chunks and every expression is evaluated column-wise with NumPy, so aggregations run in
+constant memory over any number of exported records. Usage:
+
+python -m analysis.query_engine --section JobQueue export-*.jsonl.gz
+"""
+
+import argparse
+import json
+import re
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from queries import log_queries
+
+from .records import read_chunks
+
+
+AGGREGATE_FUNCTIONS = {'count', 'sum', 'avg', 'min', 'max'}
+_NUMERIC_TYPES = {int, float, type(None)}
+DEFAULT_LIMIT = 10000
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<number>\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+)
+        |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+        |(?P<quoted>`[^`]+`)
+        |(?P<ident>[@A-Za-z_][\w.]*)
+        |(?P<op><=|>=|!=|==|=|<|>|\+|-|\*|/|\(|\)|\[|\]|,|\|)
+    )''', re.VERBOSE)
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+class UnknownFieldError(KeyError):
+    pass
+
+
+# -------------------- PARSING -------------------- #
+
+def tokenize(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+
+    while pos < len(query):
+        match = TOKEN_RE.match(query, pos)
+
+        if match is None or match.end() == pos:
+            raise QuerySyntaxError(f'Unexpected character at position {pos}: {query[pos:pos + 20]!r}')
+
+        pos = match.end()
+        kind = match.lastgroup
+
+        if kind == 'string':
+            tokens.append(('string', re.sub(r'\\(.)', r'\1', match.group(kind)[1:-1])))
+        elif kind == 'quoted':
+            tokens.append(('ident', match.group(kind)[1:-1]))
+        elif kind == 'number':
+            tokens.append(('number', float(match.group(kind))))
+        else:
+            tokens.append((kind, match.group(kind)))
+
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def peek_keyword(self, *keywords):
+        kind, value = self.peek()
+        return kind == 'ident' and value.lower() in keywords
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+
+        if token != value:
+            raise QuerySyntaxError(f'Expected {value!r} but found {token!r}')
+
+    def at_end(self):
+        return self.pos >= len(self.tokens)
+
+    # Precedence climbing, from the lowest to the highest precedence
+
+    def expression(self):
+        return self.or_expression()
+
+    def or_expression(self):
+        node = self.and_expression()
+
+        while self.peek_keyword('or'):
+            self.next()
+            node = ('bool', 'or', node, self.and_expression())
+
+        return node
+
+    def and_expression(self):
+        node = self.not_expression()
+
+        while self.peek_keyword('and'):
+            self.next()
+            node = ('bool', 'and', node, self.not_expression())
+
+        return node
+
+    def not_expression(self):
+        if self.peek_keyword('not'):
+            self.next()
+            return ('not', self.not_expression())
+
+        return self.comparison()
+
+    def comparison(self):
+        node = self.additive()
+
+        if self.peek() in (('op', '='), ('op', '=='), ('op', '!='), ('op', '<'), ('op', '<='), ('op', '>'),
+                           ('op', '>=')):
+            op = self.next()[1]
+            node = ('cmp', '=' if op == '==' else op, node, self.additive())
+        elif self.peek_keyword('in'):
+            self.next()
+            self.expect('[')
+            values = [self.additive()]
+
+            while self.peek() == ('op', ','):
+                self.next()
+                values.append(self.additive())
+
+            self.expect(']')
+            node = ('in', node, ('list',) + tuple(values))
+
+        return node
+
+    def additive(self):
+        node = self.multiplicative()
+
+        while self.peek() in (('op', '+'), ('op', '-')):
+            node = ('arith', self.next()[1], node, self.multiplicative())
+
+        return node
+
+    def multiplicative(self):
+        node = self.unary()
+
+        while self.peek() in (('op', '*'), ('op', '/')):
+            node = ('arith', self.next()[1], node, self.unary())
+
+        return node
+
+    def unary(self):
+        if self.peek() == ('op', '-'):
+            self.next()
+            return ('neg', self.unary())
+
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.next()
+
+        if kind == 'number':
+            return ('num', value)
+
+        if kind == 'string':
+            return ('str', value)
+
+        if (kind, value) == ('op', '('):
+            node = self.expression()
+            self.expect(')')
+            return node
+
+        if kind == 'ident':
+            if self.peek() == ('op', '('):
+                self.next()
+                args = []
+
+                if self.peek() == ('op', '*'):
+                    self.next()
+                    args.append(('star',))
+                elif self.peek() != ('op', ')'):
+                    args.append(self.expression())
+
+                    while self.peek() == ('op', ','):
+                        self.next()
+                        args.append(self.expression())
+
+                self.expect(')')
+                return ('call', value.lower(), tuple(args))
+
+            return ('field', value)
+
+        raise QuerySyntaxError(f'Unexpected token {value!r}')
+
+    def aliased_list(self):
+        items = []
+
+        while True:
+            expr = self.expression()
+            alias = unparse(expr)
+
+            if self.peek_keyword('as'):
+                self.next()
+                alias = self.next()[1]
+
+            items.append((expr, alias))
+
+            if self.peek() != ('op', ','):
+                return items
+
+            self.next()
+
+
+def unparse(node):
+    kind = node[0]
+
+    if kind == 'num':
+        return f'{node[1]:g}'
+    if kind == 'str':
+        return json.dumps(node[1])
+    if kind == 'field':
+        return node[1]
+    if kind == 'star':
+        return '*'
+    if kind == 'call':
+        return f'{node[1]}({",".join(unparse(arg) for arg in node[2])})'
+    if kind == 'not':
+        return f'not {unparse(node[1])}'
+    if kind == 'neg':
+        return f'-{unparse(node[1])}'
+    if kind == 'list':
+        return f'[{", ".join(unparse(value) for value in node[1:])}]'
+    if kind == 'in':
+        return f'{unparse(node[1])} in {unparse(node[2])}'
+
+    return f'{unparse(node[2])}{node[1] if kind != "bool" else f" {node[1]} "}{unparse(node[3])}'
+
+
+def parse(query):
+    """
+    Parses a query into a list of (command, arguments) tuples.
+    """
+
+    commands = []
+    tokens = tokenize(query)
+    start = 0
+
+    for i in range(len(tokens) + 1):
+        if i < len(tokens) and tokens[i] != ('op', '|'):
+            continue
+
+        command_tokens = tokens[start:i]
+        start = i + 1
+
+        if not command_tokens or command_tokens[0][0] != 'ident':
+            raise QuerySyntaxError('Expected a command name')
+
+        parser = _Parser(command_tokens[1:])
+        name = command_tokens[0][1].lower()
+
+        if name == 'fields':
+            args = parser.aliased_list()
+        elif name == 'filter':
+            args = parser.expression()
+        elif name == 'stats':
+            aggregations = parser.aliased_list()
+            by = []
+
+            if parser.peek_keyword('by'):
+                parser.next()
+                by = parser.aliased_list()
+
+            args = (aggregations, by)
+        elif name == 'sort':
+            args = []
+
+            while not parser.at_end():
+                expr = parser.expression()
+                descending = False
+
+                if parser.peek_keyword('asc', 'desc'):
+                    descending = parser.next()[1].lower() == 'desc'
+
+                args.append((expr, descending))
+
+                if parser.peek() == ('op', ','):
+                    parser.next()
+        elif name == 'limit':
+            args = int(parser.next()[1])
+        else:
+            raise QuerySyntaxError(f'Unsupported command "{name}"')
+
+        if not parser.at_end():
+            raise QuerySyntaxError(f'Unexpected token {parser.peek()[1]!r} in "{name}" command')
+
+        commands.append((name, args))
+
+    return commands
+
+
+def referenced_fields(node, fields=None):
+    fields = set() if fields is None else fields
+
+    if node[0] == 'field':
+        fields.add(node[1])
+    elif node[0] == 'call':
+        for arg in node[2]:
+            referenced_fields(arg, fields)
+    else:
+        for child in node[1:]:
+            if isinstance(child, tuple):
+                referenced_fields(child, fields)
+
+    return fields
+
+
+# -------------------- /PARSING -------------------- #
+
+# -------------------- EVALUATION -------------------- #
+
+def _is_numeric(values):
+    return isinstance(values, np.ndarray) and values.dtype != object
+
+
+def to_numeric(values):
+    if _is_numeric(values):
+        return values.astype(np.float64, copy=False)
+
+    if isinstance(values, np.ndarray):
+        return np.array([v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan for v in values],
+                        dtype=np.float64)
+
+    return float(values) if isinstance(values, (int, float)) else np.nan
+
+
+def to_bool(values):
+    if isinstance(values, np.ndarray):
+        if values.dtype == bool:
+            return values
+
+        if _is_numeric(values):
+            return ~np.isnan(values) & (values != 0)
+
+        return np.array([bool(v) for v in values], dtype=bool)
+
+    return bool(values)
+
+
+def not_null(values):
+    if _is_numeric(values):
+        return ~np.isnan(values)
+
+    return np.array([v is not None for v in values], dtype=bool)
+
+
+def _compare(op, left, right):
+    if (_is_numeric(left) or isinstance(left, float)) and (_is_numeric(right) or isinstance(right, float)):
+        with np.errstate(invalid='ignore'):
+            return {'=': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal, '>': np.greater,
+                    '>=': np.greater_equal}[op](left, right)
+
+    # Mixed or string operands are compared element by element, and null values never match
+    def compare(a, b):
+        if a is None or b is None or (isinstance(a, float) and np.isnan(a)) or (isinstance(b, float) and np.isnan(b)):
+            return op == '!='
+
+        if isinstance(a, str) != isinstance(b, str):
+            return op == '!='
+
+        return {'=': a == b, '!=': a != b, '<': a < b, '<=': a <= b, '>': a > b, '>=': a >= b}[op]
+
+    return np.frompyfunc(compare, 2, 1)(left, right).astype(bool)
+
+
+def evaluate(node, columns, size, aggregates=None):
+    kind = node[0]
+
+    if kind == 'num':
+        return node[1]
+
+    if kind == 'str':
+        return np.full(size, node[1], dtype=object)
+
+    if kind == 'field':
+        if node[1] in columns:
+            return columns[node[1]]
+
+        return np.full(size, np.nan)
+
+    if kind == 'call':
+        if aggregates is not None and node in aggregates:
+            return aggregates[node]
+
+        raise QuerySyntaxError(f'Function "{node[1]}" can only be used in a stats command')
+
+    if kind == 'not':
+        return ~to_bool(evaluate(node[1], columns, size, aggregates))
+
+    if kind == 'neg':
+        return -to_numeric(evaluate(node[1], columns, size, aggregates))
+
+    if kind == 'in':
+        values = evaluate(node[1], columns, size, aggregates)
+        matches = np.zeros(size, dtype=bool)
+
+        for value_node in node[2][1:]:
+            matches |= _compare('=', values, evaluate(value_node, columns, size, aggregates))
+
+        return matches
+
+    left = evaluate(node[2], columns, size, aggregates)
+    right = evaluate(node[3], columns, size, aggregates)
+
+    if kind == 'bool':
+        return (to_bool(left) & to_bool(right)) if node[1] == 'and' else (to_bool(left) | to_bool(right))
+
+    if kind == 'cmp':
+        return _compare(node[1], left, right)
+
+    left, right = to_numeric(left), to_numeric(right)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide}[node[1]](left, right)
+
+
+def _broadcast(values, size):
+    if isinstance(values, np.ndarray):
+        return values
+
+    return np.full(size, values, dtype=object if isinstance(values, str) else np.float64)
+
+
+def build_columns(records, fields):
+    """
+    Builds one NumPy array per field. Fields whose values are all numbers (or missing) become float64 arrays, where
+    missing values are NaN, and any other field becomes an object array.
+    """
+
+    columns = {}
+
+    for field in fields:
+        values = [record.get(field) for record in records]
+
+        if all(type(v) in _NUMERIC_TYPES for v in values):
+            column = np.array(values, dtype=np.float64)
+        else:
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+
+        columns[field] = column
+
+    return columns
+
+
+def _collect_aggregates(node, found):
+    if not isinstance(node, tuple) or not node:
+        return found
+
+    if node[0] == 'call' and node[1] in AGGREGATE_FUNCTIONS:
+        found.append(node)
+        return found
+
+    if node[0] == 'call':
+        raise QuerySyntaxError(f'Unsupported function "{node[1]}"')
+
+    for child in node[2:] if node[0] in ('bool', 'cmp', 'arith') else node[1:]:
+        if isinstance(child, tuple):
+            _collect_aggregates(child, found)
+
+    return found
+
+
+class _Aggregator:
+    """
+    Streaming state of a stats command. Groups are assigned global IDs as they are discovered, and the partial states
+    of every aggregate function (sums, counts, minimums and maximums) are kept as arrays indexed by group ID.
+    """
+
+    def __init__(self, aggregations, by):
+        self.aggregations = aggregations
+        self.by = by
+        self.functions = list(dict.fromkeys(f for expr, _ in aggregations for f in _collect_aggregates(expr, [])))
+
+        self.group_ids = {}
+        self.group_keys = []
+        self.sums = {f: np.zeros(0) for f in self.functions}
+        self.counts = {f: np.zeros(0) for f in self.functions}
+        self.minimums = {f: np.zeros(0) for f in self.functions}
+        self.maximums = {f: np.zeros(0) for f in self.functions}
+
+    def __grow(self, size):
+        for states, fill in ((self.sums, 0.0), (self.counts, 0.0), (self.minimums, np.inf), (self.maximums, -np.inf)):
+            for function, array in states.items():
+                if len(array) < size:
+                    states[function] = np.concatenate([array, np.full(max(size - len(array), len(array)), fill)])
+
+    def __group_ids(self, columns, size):
+        if not self.by:
+            if not self.group_keys:
+                self.group_ids[()] = 0
+                self.group_keys.append(())
+
+            return np.zeros(size, dtype=np.int64), np.ones(size, dtype=bool)
+
+        valid = np.ones(size, dtype=bool)
+        codes, uniques = [], []
+
+        for expr, _ in self.by:
+            values = _broadcast(evaluate(expr, columns, size), size)
+            valid &= not_null(values)
+            codes.append(values)
+
+        local_codes = []
+
+        for values in codes:
+            values = values[valid]
+
+            if _is_numeric(values):
+                unique, inverse = np.unique(values, return_inverse=True)
+            else:
+                _, first_indices, inverse = np.unique(values.astype(str), return_index=True, return_inverse=True)
+                unique = values[first_indices]
+
+            uniques.append(unique)
+            local_codes.append(inverse.reshape(-1))
+
+        if not local_codes[0].size:
+            return np.zeros(0, dtype=np.int64), valid
+
+        combined = np.ravel_multi_index(local_codes, [len(u) for u in uniques])
+        local_groups, inverse = np.unique(combined, return_inverse=True)
+        mapping = np.empty(len(local_groups), dtype=np.int64)
+
+        # Only distinct groups are looked up in Python, never individual records
+        for i, flat_index in enumerate(local_groups):
+            key = tuple(u[j].item() if hasattr(u[j], 'item') else u[j]
+                        for u, j in zip(uniques, np.unravel_index(flat_index, [len(u) for u in uniques])))
+
+            if key not in self.group_ids:
+                self.group_ids[key] = len(self.group_keys)
+                self.group_keys.append(key)
+
+            mapping[i] = self.group_ids[key]
+
+        return mapping[inverse.reshape(-1)], valid
+
+    def update(self, columns, size):
+        ids, valid = self.__group_ids(columns, size)
+        n_groups = len(self.group_keys)
+        self.__grow(n_groups)
+
+        for function in self.functions:
+            _, name, args = function
+
+            if args == (('star',),):
+                values = np.ones(int(valid.sum()))
+                present = np.ones(len(values), dtype=bool)
+            else:
+                raw = _broadcast(evaluate(args[0], columns, size), size)[valid]
+
+                if raw.dtype == bool:
+                    raw = raw.astype(np.float64)
+
+                present = not_null(raw)
+                values = to_numeric(raw)
+
+                if name != 'count':
+                    present &= ~np.isnan(values)
+
+            group_ids = ids[present]
+            values = values[present]
+
+            self.counts[function][:n_groups] += np.bincount(group_ids, minlength=n_groups)
+
+            if name in ('sum', 'avg'):
+                self.sums[function][:n_groups] += np.bincount(group_ids, weights=values, minlength=n_groups)
+            elif name == 'min':
+                np.minimum.at(self.minimums[function], group_ids, values)
+            elif name == 'max':
+                np.maximum.at(self.maximums[function], group_ids, values)
+
+    def merge(self, other):
+        """
+        Adds the partial states of another aggregator of the same stats command, e.g. one computed by another process.
+        """
+
+        mapping = np.empty(len(other.group_keys), dtype=np.int64)
+
+        for i, key in enumerate(other.group_keys):
+            if key not in self.group_ids:
+                self.group_ids[key] = len(self.group_keys)
+                self.group_keys.append(key)
+
+            mapping[i] = self.group_ids[key]
+
+        self.__grow(len(self.group_keys))
+        size = len(other.group_keys)
+
+        for function in self.functions:
+            np.add.at(self.sums[function], mapping, other.sums[function][:size])
+            np.add.at(self.counts[function], mapping, other.counts[function][:size])
+            np.minimum.at(self.minimums[function], mapping, other.minimums[function][:size])
+            np.maximum.at(self.maximums[function], mapping, other.maximums[function][:size])
+
+    def result(self):
+        n_groups = len(self.group_keys)
+        aggregates = {}
+
+        for function in self.functions:
+            name = function[1]
+            counts = self.counts[function][:n_groups]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if name == 'count':
+                    values = counts
+                elif name == 'sum':
+                    values = np.where(counts > 0, self.sums[function][:n_groups], np.nan)
+                elif name == 'avg':
+                    values = self.sums[function][:n_groups] / counts
+                elif name == 'min':
+                    values = np.where(counts > 0, self.minimums[function][:n_groups], np.nan)
+                else:
+                    values = np.where(counts > 0, self.maximums[function][:n_groups], np.nan)
+
+            aggregates[function] = values
+
+        columns = {}
+
+        for i, (_, alias) in enumerate(self.by):
+            column = np.empty(n_groups, dtype=object)
+            column[:] = [key[i] for key in self.group_keys]
+            columns[alias] = column
+
+        for expr, alias in self.aggregations:
+            columns[alias] = _broadcast(evaluate(expr, columns, n_groups, aggregates), n_groups)
+
+        return columns, [alias for _, alias in self.by] + [alias for _, alias in self.aggregations]
+
+
+def _sort_indices(columns, size, sort_keys):
+    indices = np.arange(size)
+
+    # Stable sorts applied from the last key to the first one give a multi-key sort. Null values always go last
+    for expr, descending in reversed(sort_keys):
+        values = _broadcast(evaluate(expr, columns, size), size)[indices]
+        present = not_null(values)
+
+        if _is_numeric(values):
+            order = np.argsort(-values if descending else values, kind='stable')
+        else:
+            order = np.array(sorted(range(len(values)), key=lambda i: (values[i] is None, str(values[i]))),
+                             dtype=np.int64)
+
+            if descending:
+                order = np.concatenate([order[present[order]][::-1], order[~present[order]]])
+
+        indices = indices[order]
+
+    return indices
+
+
+def _take(columns, indices):
+    return {name: values[indices] for name, values in columns.items()}
+
+
+# -------------------- /EVALUATION -------------------- #
+
+class QueryResult:
+    def __init__(self, columns, field_names):
+        self.columns = columns
+        self.field_names = field_names
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    @staticmethod
+    def __to_python(value):
+        if isinstance(value, (float, np.floating)):
+            return None if np.isnan(value) else float(value)
+
+        return value.item() if hasattr(value, 'item') else value
+
+    def rows(self):
+        return [
+            {name: self.__to_python(self.columns[name][i]) for name in self.field_names if name in self.columns}
+            for i in range(len(self))
+        ]
+
+
+class QueryEngine:
+    def __init__(self, query, strict=False):
+        self.query = query
+        self.strict = strict
+        self.commands = parse(query)
+
+        stats_indices = [i for i, (name, _) in enumerate(self.commands) if name == 'stats']
+
+        if len(stats_indices) > 1:
+            raise QuerySyntaxError('Only one stats command is supported')
+
+        self.stats_index = stats_indices[0] if stats_indices else None
+
+        # Only the fields referenced by the query are extracted from the records
+        self.fields = set()
+        self.aliases = set()
+
+        for name, args in self.commands[:self.stats_index]:
+            self.fields |= self.__command_fields(name, args)
+
+            if name == 'fields':
+                self.aliases |= {alias for expr, alias in args if expr != ('field', alias)}
+
+        if self.stats_index is not None:
+            aggregations, by = self.commands[self.stats_index][1]
+            self.fields |= self.__command_fields('fields', aggregations + by)
+
+        self.fields -= self.aliases
+
+    @staticmethod
+    def __command_fields(name, args):
+        if name in ('fields', 'sort'):
+            return set().union(*(referenced_fields(expr) for expr, _ in args)) if args else set()
+
+        if name == 'filter':
+            return referenced_fields(args)
+
+        return set()
+
+    def __apply(self, commands, columns, size, display):
+        limit = None
+
+        for name, args in commands:
+            if name == 'fields':
+                display = []
+
+                for expr, alias in args:
+                    columns[alias] = _broadcast(evaluate(expr, columns, size), size)
+                    display.append(alias)
+            elif name == 'filter':
+                mask = to_bool(_broadcast(evaluate(args, columns, size), size))
+                columns, size = _take(columns, mask), int(mask.sum())
+            elif name == 'sort':
+                columns = _take(columns, _sort_indices(columns, size, args))
+            elif name == 'limit':
+                limit = args if limit is None else min(limit, args)
+                columns, size = _take(columns, np.arange(min(size, limit))), min(size, limit)
+
+        return columns, size, display, limit
+
+    def _aggregate(self, paths, chunk_size):
+        seen_fields = set()
+        aggregator = _Aggregator(*self.commands[self.stats_index][1])
+
+        for records in read_chunks(paths, chunk_size):
+            if self.strict:
+                for record in records:
+                    seen_fields.update(record.keys())
+
+            columns, size, _, _ = self.__apply(self.commands[:self.stats_index], build_columns(records, self.fields),
+                                               len(records), None)
+            aggregator.update(columns, size)
+
+        return aggregator, seen_fields
+
+    def __check_fields(self, seen_fields):
+        missing = sorted(field for field in self.fields if field not in seen_fields)
+
+        if self.strict and missing:
+            raise UnknownFieldError(f'Fields not found in any record: {", ".join(missing)}')
+
+    def run(self, paths, chunk_size=100000, workers=1):
+        """
+        Runs the query over the records of the given files. Queries with a stats command can be split by file across
+        several processes, whose partial aggregations are merged at the end.
+        """
+
+        if self.stats_index is not None:
+            if workers > 1 and len(paths) > 1:
+                with ProcessPoolExecutor(workers) as executor:
+                    partials = list(executor.map(self._aggregate, [paths[i::workers] for i in range(workers)],
+                                                 [chunk_size] * workers))
+
+                aggregator, seen_fields = partials[0]
+
+                for other, other_seen_fields in partials[1:]:
+                    aggregator.merge(other)
+                    seen_fields |= other_seen_fields
+            else:
+                aggregator, seen_fields = self._aggregate(paths, chunk_size)
+
+            self.__check_fields(seen_fields)
+
+            columns, field_names = aggregator.result()
+            columns, _, _, _ = self.__apply(self.commands[self.stats_index + 1:], columns, len(aggregator.group_keys),
+                                            field_names)
+
+            return QueryResult(columns, field_names)
+
+        return self.__select(paths, chunk_size)
+
+    def __select(self, paths, chunk_size):
+        seen_fields = set()
+
+        # Without stats, only the best rows are kept between chunks: the ones selected by sort and limit
+        results, display = None, None
+        row_commands = [(n, a) for n, a in self.commands if n not in ('sort', 'limit')]
+        sort_commands = [(n, a) for n, a in self.commands if n == 'sort']
+        limit = min([a for n, a in self.commands if n == 'limit'] or [DEFAULT_LIMIT])
+
+        for records in read_chunks(paths, chunk_size):
+            if self.strict:
+                for record in records:
+                    seen_fields.update(record.keys())
+
+            columns = build_columns(records, self.fields)
+            size = len(records)
+            columns, size, display, _ = self.__apply(row_commands, columns, size, sorted(self.fields))
+
+            if results is not None:
+                columns = {name: np.concatenate([results[name], columns[name]]) for name in columns}
+                size = len(next(iter(columns.values()))) if columns else 0
+
+            results, _, _, _ = self.__apply(sort_commands + [('limit', limit)], columns, size, display)
+
+        self.__check_fields(seen_fields)
+
+        return QueryResult(results or {}, display or sorted(self.fields))
+
+
+def run_query(query, paths, strict=False, chunk_size=100000, workers=1):
+    return QueryEngine(query, strict).run(list(paths), chunk_size, workers).rows()
+
+
+def main(argv=None):
+    # {name: (query builder, whether it takes the --by field)}
+    builders = {
+        'JOB_LOG_HISTORY': (lambda by: log_queries.JOB_LOG_HISTORY, False),
+        'build_count_query': (log_queries.build_count_query, True)
+    }
+
+    parser = argparse.ArgumentParser(description='Runs a Logs Insights query over exported job records')
+    parser.add_argument('paths', nargs='+', help='JSON lines files, optionally gzip-compressed')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--query', help='Query string')
+    group.add_argument('--builder', choices=sorted(builders), help='Query of queries/log_queries.py')
+    group.add_argument('--section', help='Dimension of a dashboard analysis section, e.g. JobQueue')
+    parser.add_argument('--by', help='Field passed to the query builder')
+    parser.add_argument('--strict', action='store_true', help='Fail when the query references unknown fields')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to aggregate the files')
+    args = parser.parse_args(argv)
+
+    if args.query:
+        query = args.query
+    elif args.section:
+        try:
+            query = log_queries.compile_section_query(log_queries.find_section(args.section))
+        except KeyError as e:
+            parser.error(e.args[0])
+    else:
+        builder, takes_field = builders[args.builder]
+
+        if takes_field and not args.by:
+            parser.error(f'--builder {args.builder} requires --by')
+
+        query = builder(args.by)
+
+    for row in run_query(query, args.paths, args.strict, workers=args.workers):
+        print(json.dumps(row))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
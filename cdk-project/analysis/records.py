@@ -0,0 +1,73 @@
+"""
+@Description: readers of exported job records. Each line of an export is either a job record as logged by the
+application, a {"timestamp": ..., "message": "..."} log event (as returned by the CloudWatch Logs APIs) or a
+"<ISO timestamp> <message>" line (as written by CloudWatch Logs exports to S3). Gzip-compressed files are supported.
+"""
+
+import datetime
+import gzip
+import json
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+def _open(path):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+
+    return open(path, 'r', encoding='utf-8')
+
+
+def _parse_iso_timestamp(value):
+    return int(datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def parse_line(line):
+    line = line.strip()
+
+    if not line:
+        return None
+
+    if line[0] != '{':
+        timestamp, _, message = line.partition(' ')
+        record = _loads(message)
+        record['@timestamp'] = _parse_iso_timestamp(timestamp)
+        return record
+
+    record = _loads(line)
+
+    if isinstance(record.get('message'), str) and 'timestamp' in record:
+        timestamp = record['timestamp']
+        record = _loads(record['message'])
+        record['@timestamp'] = timestamp
+
+    return record
+
+
+def read_records(paths):
+    for path in paths:
+        with _open(path) as f:
+            for line in f:
+                record = parse_line(line)
+
+                if record is not None:
+                    yield record
+
+
+def read_chunks(paths, chunk_size=100000):
+    chunk = []
+
+    for record in read_records(paths):
+        chunk.append(record)
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
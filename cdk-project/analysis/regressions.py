@@ -0,0 +1,277 @@
+"""
+@Description: backtest of the runtime regression detector over exported job records. The jobs are replayed through the
+same baselines as the processBatchEvents function (see batch_insights.regressions), in the order they completed, and
+every regression the detector would have reported is printed as a JSON line. Usage:
+
+python -m analysis.regressions export-*.jsonl.gz
+python -m analysis.regressions --z-threshold 4 --min-slowdown 0.2 export-*.jsonl.gz
+
+Thresholds and smoothing factors can be tuned on past jobs before they are changed in the function. The samples are
+kept in NumPy arrays of about 24 bytes per job and duration, sorted by baseline and time, and the baselines are updated
+together: the n-th sample of every baseline is applied in a single vectorized step, so the backtest runs one step per
+sample of the busiest baseline rather than one per job.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from .records import read_chunks
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIR = os.path.join(PROJECT_DIR, 'assets', 'lambda', 'layer_common', 'python')
+
+if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+
+from batch_insights.regressions import (ALERT_INTERVAL_SECONDS, CLIP_SIGMAS, DRIFT, FAST_ALPHA, MIN_SLOWDOWN,
+                                        REVISION, SLOW_ALPHA, WARMUP_SAMPLES, Z_THRESHOLD, job_samples)
+
+
+def record_timestamp(record):
+    # Jobs are logged at the time they stopped, which the detector uses as the time of their samples
+    timestamp = record.get('StoppedAt', record.get('@timestamp'))
+    return int(timestamp) if isinstance(timestamp, (int, float)) else None
+
+
+class SampleSet:
+    """
+    Samples of the baselines. Baselines are numbered in the order they are found.
+    """
+
+    def __init__(self):
+        self.key_indices = {}
+        self.keys = []
+
+        self._chunks = []
+        self.skipped = 0
+
+    def add_records(self, records):
+        key_indices, revisions, values, timestamps = [], [], [], []
+
+        for record in records:
+            timestamp = record_timestamp(record)
+            samples = job_samples(record) if timestamp is not None else []
+
+            if not samples:
+                self.skipped += 1
+                continue
+
+            for key, revision, x in samples:
+                if key not in self.key_indices:
+                    self.key_indices[key] = len(self.keys)
+                    self.keys.append(key)
+
+                key_indices.append(self.key_indices[key])
+                revisions.append(revision)
+                values.append(x)
+                timestamps.append(timestamp)
+
+        if key_indices:
+            self._chunks.append((np.array(key_indices, dtype=np.int32), np.array(revisions, dtype=np.int32),
+                                 np.array(values, dtype=np.float64), np.array(timestamps, dtype=np.int64)))
+
+    def arrays(self):
+        """
+        Returns the baseline index, revision, log duration and epoch milliseconds of every sample as four arrays.
+        """
+
+        if not self._chunks:
+            return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64),
+                    np.empty(0, dtype=np.int64))
+
+        if len(self._chunks) > 1:
+            self._chunks = [tuple(np.concatenate(arrays) for arrays in zip(*self._chunks))]
+
+        return self._chunks[0]
+
+
+class _Tracks:
+    """
+    The N, Mean, Var and Fast of a track of every baseline, like the dictionaries of batch_insights.regressions.
+    """
+
+    def __init__(self, n_keys):
+        self.n = np.zeros(n_keys, dtype=np.int64)
+        self.mean = np.zeros(n_keys)
+        self.var = np.zeros(n_keys)
+        self.fast = np.zeros(n_keys)
+
+    def copy_to(self, other, indices):
+        for name in ('n', 'mean', 'var', 'fast'):
+            getattr(other, name)[indices] = getattr(self, name)[indices]
+
+    def reset(self, indices):
+        for name in ('n', 'mean', 'var', 'fast'):
+            getattr(self, name)[indices] = 0
+
+    def update(self, indices, x, fast_alpha, slow_alpha):
+        n = self.n[indices] + 1
+        mean, var = self.mean[indices], self.var[indices]
+
+        clip = (n > WARMUP_SAMPLES) & (var > 0)
+        limit = CLIP_SIGMAS * np.sqrt(var)
+        x = np.where(clip, np.minimum(np.maximum(x, mean - limit), mean + limit), x)
+
+        alpha = np.maximum(1.0 / n, slow_alpha)
+        delta = x - mean
+        self.n[indices] = n
+        self.mean[indices] = mean + alpha * delta
+        self.var[indices] = (1 - alpha) * (var + alpha * delta * delta)
+        self.fast[indices] += np.maximum(1.0 / n, fast_alpha) * (x - self.fast[indices])
+
+
+def _z_scores(delta, variance):
+    # Baselines without any variance have no z-score, like in batch_insights.regressions
+    safe = np.where(variance > 0, variance, 1.0)
+    return np.where(variance > 0, delta / np.sqrt(safe), -np.inf)
+
+
+def backtest(samples, fast_alpha=FAST_ALPHA, slow_alpha=SLOW_ALPHA, min_slowdown=MIN_SLOWDOWN,
+             z_threshold=Z_THRESHOLD):
+    """
+    Replays the samples through the baselines and returns the regressions detected, in the order they were.
+    """
+
+    key_indices, revisions, values, timestamps = samples.arrays()
+    n_keys = len(samples.keys)
+    found = []
+
+    if not len(key_indices):
+        return []
+
+    # Baselines are renumbered from the one with the most samples, so that the baselines with an n-th sample are the
+    # first ones. Their samples are sorted by time like in RegressionDetector.flush
+    counts = np.bincount(key_indices, minlength=n_keys)
+    by_count = np.argsort(-counts, kind='stable')
+    ranks = np.empty(n_keys, dtype=np.int64)
+    ranks[by_count] = np.arange(n_keys)
+    ranked = ranks[key_indices]
+
+    order = np.lexsort((values, revisions, timestamps, ranked))
+    ranked, revisions, values, timestamps = ranked[order], revisions[order], values[order], timestamps[order]
+    del order
+
+    counts = counts[by_count]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    descending_counts = -counts
+
+    revision = np.full(n_keys, -1, dtype=np.int64)
+    previous_revision = np.full(n_keys, -1, dtype=np.int64)
+    current, previous = _Tracks(n_keys), _Tracks(n_keys)
+    alerted_at = {REVISION: np.zeros(n_keys, dtype=np.int64), DRIFT: np.zeros(n_keys, dtype=np.int64)}
+
+    fast_variance = fast_alpha / (2 - fast_alpha)
+    max_samples = 2 / slow_alpha - 1
+    interval_ms = ALERT_INTERVAL_SECONDS * 1000
+
+    for step in range(int(counts[0])):
+        active = np.arange(np.searchsorted(descending_counts, -step, side='left'))
+        positions = starts[active] + step
+        sample_revisions, x, now_ms = revisions[positions], values[positions], timestamps[positions]
+
+        # A later revision becomes the one tracked, and the statistics of the one it replaces are frozen
+        newer = sample_revisions > revision[active]
+        shifted = active[newer & (revision[active] >= 0)]
+        current.copy_to(previous, shifted)
+        previous_revision[shifted] = revision[shifted]
+        current.reset(active[newer])
+        revision[active[newer]] = sample_revisions[newer]
+
+        is_current = sample_revisions == revision[active]
+        is_previous = ~is_current & (sample_revisions == previous_revision[active])
+        current.update(active[is_current], x[is_current], fast_alpha, slow_alpha)
+        previous.update(active[is_previous], x[is_previous], fast_alpha, slow_alpha)
+
+        warm = current.n[active] >= WARMUP_SAMPLES
+        mean, var, n = current.mean[active], current.var[active], current.n[active]
+
+        delta = mean - previous.mean[active]
+        variance = var / np.minimum(n, max_samples) + \
+            previous.var[active] / np.minimum(np.maximum(previous.n[active], 1), max_samples)
+        z = _z_scores(delta, variance)
+        checks = [(REVISION, warm & (previous_revision[active] >= 0) & (previous.n[active] >= WARMUP_SAMPLES),
+                   previous_revision[active], previous.mean[active], mean, delta, z)]
+
+        delta = current.fast[active] - mean
+        z = _z_scores(delta, var * fast_variance)
+        checks.append((DRIFT, warm, revision[active], mean, current.fast[active], delta, z))
+
+        for kind, eligible, baseline_revisions, baseline_means, current_means, delta, z in checks:
+            significant = eligible & (z >= z_threshold) & (np.exp(delta) - 1 >= min_slowdown)
+            reported = significant & (now_ms - alerted_at[kind][active] >= interval_ms)
+
+            if not reported.any():
+                continue
+
+            alerted_at[kind][active[reported]] = now_ms[reported]
+
+            for i in np.flatnonzero(reported):
+                key = samples.keys[by_count[active[i]]]
+                found.append(_regression(key, int(now_ms[i]), kind, int(revision[active[i]]),
+                                         int(baseline_revisions[i]), float(baseline_means[i]),
+                                         float(current_means[i]), float(z[i]), int(n[i])))
+
+    # Regressions of the same baseline and time are kept in the order they were checked
+    return sorted(found, key=lambda regression: (regression['DetectedAt'], regression['JobDefinition'],
+                                                 regression['InstanceType'], regression['Status']))
+
+
+def _regression(key, now_ms, kind, revision, baseline_revision, baseline_mean, current_mean, z, jobs):
+    name, instance_type, status = key.rsplit('#', 2)
+
+    return {
+        'DetectedAt': now_ms,
+        'Kind': kind,
+        'JobDefinition': f'{name}:{revision}',
+        'BaselineJobDefinition': f'{name}:{baseline_revision}',
+        'InstanceType': instance_type,
+        'Status': status,
+        'BaselineSeconds': round(float(np.exp(baseline_mean)), 3),
+        'CurrentSeconds': round(float(np.exp(current_mean)), 3),
+        'SlowdownPercent': round((float(np.exp(current_mean - baseline_mean)) - 1) * 100, 2),
+        'ZScore': round(z, 2),
+        'Jobs': jobs
+    }
+
+
+def read_samples(paths, chunk_size=100000):
+    samples = SampleSet()
+
+    for records in read_chunks(paths, chunk_size):
+        samples.add_records(records)
+
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reports the runtime regressions detected over past jobs')
+    parser.add_argument('paths', nargs='+', help='JSON lines files, optionally gzip-compressed')
+    parser.add_argument('--fast-alpha', type=float, default=FAST_ALPHA, help='Smoothing factor of the fast EWMA')
+    parser.add_argument('--slow-alpha', type=float, default=SLOW_ALPHA, help='Smoothing factor of the baselines')
+    parser.add_argument('--min-slowdown', type=float, default=MIN_SLOWDOWN,
+                        help='Smallest slowdown reported, as a fraction of the baseline duration')
+    parser.add_argument('--z-threshold', type=float, default=Z_THRESHOLD, help='Smallest z-score reported')
+    args = parser.parse_args(argv)
+
+    if not 0 < args.slow_alpha <= args.fast_alpha < 1:
+        parser.error('The smoothing factors must satisfy 0 < --slow-alpha <= --fast-alpha < 1')
+
+    samples = read_samples(args.paths)
+
+    for regression in backtest(samples, args.fast_alpha, args.slow_alpha, args.min_slowdown, args.z_threshold):
+        print(json.dumps(regression))
+
+    print(f'{len(samples.keys)} baselines were replayed', file=sys.stderr)
+
+    if samples.skipped:
+        print(f'{samples.skipped} records without a job definition, instance type, duration or time were skipped',
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
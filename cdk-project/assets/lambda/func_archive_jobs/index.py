@@ -0,0 +1,63 @@
+"""
+@Description: this script is meant to be executed once a day by the archiveJobs state machine. It archives the jobs that
+completed the previous day (UTC) in S3 as Parquet files partitioned by date and job queue, one hour of the day per
+invocation so that neither the memory nor the duration of an invocation grows with the number of jobs of the day:
+
+- Invoked without an hour, it returns the windows of the day to archive, {"date": "YYYY-MM-DD", "hours": [0, ..., 23]}.
+- Invoked with a {"date": "YYYY-MM-DD", "hour": H} payload, it reads the jobs that completed during that hour from the
+  jobs log group and streams them to one file per job queue.
+
+A specific day can be archived again by starting the state machine with a {"date": "YYYY-MM-DD"} input.
+"""
+
+import os
+import json
+import datetime
+
+from batch_insights import runtime
+from batch_insights.archive import ArchiveWriter, S3Backend
+
+
+JOBS_LOG_GROUP = os.environ['JOBS_LOG_GROUP']
+ARCHIVE_BUCKET = os.environ['ARCHIVE_BUCKET']
+
+HOURS_PER_DAY = 24
+HOUR_MS = 60 * 60 * 1000
+
+
+def read_logged_jobs(start_ms, end_ms):
+    paginator = runtime.client('logs').get_paginator('filter_log_events')
+
+    for page in paginator.paginate(logGroupName=JOBS_LOG_GROUP, startTime=start_ms, endTime=end_ms - 1):
+        for event in page['events']:
+            job = json.loads(event['message'])
+            job['Timestamp'] = event['timestamp']
+
+            yield job
+
+
+def archive_hour(day, hour):
+    start = datetime.datetime.combine(day, datetime.time(hour), datetime.timezone.utc)
+    start_ms = int(start.timestamp() * 1000)
+
+    # Files are named after the hour, so archiving the same hour twice overwrites its files
+    writer = ArchiveWriter(S3Backend(runtime.client('s3'), ARCHIVE_BUCKET))
+
+    return writer.write(read_logged_jobs(start_ms, start_ms + HOUR_MS), part_name=f'jobs-{day.isoformat()}-{hour:02d}')
+
+
+def handler(event, context):
+    if event.get('date'):
+        day = datetime.date.fromisoformat(event['date'])
+    else:
+        day = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+
+    if event.get('hour') is None:
+        return {'date': day.isoformat(), 'hours': list(range(HOURS_PER_DAY))}
+
+    hour = int(event['hour'])
+
+    if not 0 <= hour < HOURS_PER_DAY:
+        raise ValueError(f'Invalid hour {hour}, expected a value between 0 and {HOURS_PER_DAY - 1}')
+
+    return {'date': day.isoformat(), 'hour': hour, 'files': archive_hour(day, hour)}
@@ -1,51 +1,248 @@
+"""
+@Description: generates synthetic job records to load test the dashboards. Jobs are generated lazily and
+deterministically from a seed: the same seed, number of jobs and time window always generate the same records, whatever
+the number of workers. The completion times of the jobs are spread evenly across the time window, and the job queues,
+job definitions, instance types and durations follow the distributions of a profile (see DEFAULT_PROFILE). Records are
+either written to the jobs log stream or to local JSON lines or Parquet files, in constant memory. Usage:
+
+python index.py --jobs 1000000 --start 2024-05-01T00:00:00Z --end 2024-05-08T00:00:00Z --workers 4
+python index.py --jobs 1000000 --output parquet --path sample-data --profile profile.json
+"""
+
+import io
 import os
-import boto3
-import time
+import sys
+import gzip
 import json
-import uuid
+import boto3
 import random
+import argparse
+import datetime
+import itertools
 
+from concurrent.futures import ProcessPoolExecutor
 
-JOBS_LOG_GROUP = os.environ['JOBS_LOG_GROUP']
-JOBS_LOG_STREAM = os.environ['JOBS_LOG_STREAM']
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layer_common', 'python'))
 
-N_SAMPLES = 100
-QUEUES = ['Stitching', 'Rendering']
-STATUSES = ['SUCCEEDED', 'FAILED']
-JOB_DEFS = ['StitchingDef:1', 'RenderingDef:1', 'RenderingDef:2']
-AZS = ['eu-west-1a', 'eu-west-1b', 'eu-west-1c']
-ARCHS = ['x86_64', 'arm64']
-INSTANCES = ['c5.8xlarge', 'm4.large', 'c6g.4xlarge', 'c6g.2xlarge', 'm7g.16xlarge']
+from batch_insights.logs_writer import ShardedLogsWriter, shard_stream_names
 
 
-if __name__ == '__main__':
-    job_events = []
-    client = boto3.client('logs')
+OUTPUTS = ['logs', 'jsonl', 'parquet']
+DEFAULT_BLOCK_SIZE = 100000
+DEFAULT_INSTANCES = 200
+
+# CloudWatch Logs rejects events older than 14 days or more than 2 hours in the future
+MAX_LOG_EVENT_AGE_MS = 14 * 24 * 60 * 60 * 1000
+MAX_LOG_EVENT_FUTURE_MS = 2 * 60 * 60 * 1000
+
+# Weights are relative. Durations follow log-normal distributions with the given medians: RUNNABLE durations depend on
+# the job queue, STARTING and RUNNING durations on the job definition, and RUNNING durations are scaled by the
+# DurationFactor of the instance type
+DEFAULT_PROFILE = {
+    'AvailabilityZones': {'eu-west-1a': 1, 'eu-west-1b': 1, 'eu-west-1c': 1},
+    'InstanceTypes': {
+        'c5.8xlarge': {'Weight': 2, 'Architecture': 'x86_64', 'DurationFactor': 1.0},
+        'm4.large': {'Weight': 1, 'Architecture': 'x86_64', 'DurationFactor': 1.4},
+        'c6g.4xlarge': {'Weight': 2, 'Architecture': 'arm64', 'DurationFactor': 0.8},
+        'c6g.2xlarge': {'Weight': 2, 'Architecture': 'arm64', 'DurationFactor': 0.9},
+        'm7g.16xlarge': {'Weight': 1, 'Architecture': 'arm64', 'DurationFactor': 0.6}
+    },
+    'JobQueues': {
+        'Stitching': {'Weight': 1, 'FailureRate': 0.02, 'MedianRunnableSeconds': 120, 'Sigma': 1.0,
+                      'JobDefinitions': {'StitchingDef:1': 1}},
+        'Rendering': {'Weight': 2, 'FailureRate': 0.08, 'MedianRunnableSeconds': 900, 'Sigma': 1.2,
+                      'JobDefinitions': {'RenderingDef:1': 1, 'RenderingDef:2': 3}}
+    },
+    'JobDefinitions': {
+        'StitchingDef:1': {'MedianStartingSeconds': 20, 'MedianRunningSeconds': 300, 'Sigma': 0.6},
+        'RenderingDef:1': {'MedianStartingSeconds': 40, 'MedianRunningSeconds': 2400, 'Sigma': 0.8},
+        'RenderingDef:2': {'MedianStartingSeconds': 35, 'MedianRunningSeconds': 1800, 'Sigma': 0.7}
+    }
+}
+
+
+def parse_time(value):
+    return int(datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def load_profile(path=None):
+    if path is None:
+        return DEFAULT_PROFILE
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def weighted(options):
+    """
+    Returns a (population, cumulative weights) tuple for random.choices. Options are either {name: weight} or
+    {name: {'Weight': weight, ...}}.
+    """
+
+    population = list(options)
+    weights = [w['Weight'] if isinstance(w, dict) else w for w in options.values()]
+
+    return population, list(itertools.accumulate(weights))
+
+
+def build_fleet(profile, n_instances, seed):
+    """
+    Returns the instances the jobs run on as (InstanceId, InstanceType, AvailabilityZone) tuples. Jobs are placed on
+    the fleet uniformly, so the instance types are distributed following their weights.
+    """
+
+    rng = random.Random(f'{seed}-fleet')
+    instance_types, instance_weights = weighted(profile['InstanceTypes'])
+    azs, az_weights = weighted(profile['AvailabilityZones'])
+
+    return [
+        (
+            f'i-{rng.getrandbits(68):017x}',
+            rng.choices(instance_types, cum_weights=instance_weights)[0],
+            rng.choices(azs, cum_weights=az_weights)[0]
+        )
+        for _ in range(n_instances)
+    ]
+
+
+def generate_jobs(profile, fleet, seed, start_ms, end_ms, n_jobs, first, count):
+    """
+    Lazily generates the jobs first to first + count - 1 of a dataset of n_jobs jobs, as (timestamp, job) tuples in
+    chronological order. Each block of jobs has its own random generator, so blocks can be generated independently.
+    """
+
+    rng = random.Random(f'{seed}-{first}')
+    queues, queue_weights = weighted(profile['JobQueues'])
+    definitions = {queue: weighted(options['JobDefinitions']) for queue, options in profile['JobQueues'].items()}
+    step_ms = (end_ms - start_ms) / n_jobs
+
+    for i in range(first, first + count):
+        queue = rng.choices(queues, cum_weights=queue_weights)[0]
+        queue_profile = profile['JobQueues'][queue]
+        definition = rng.choices(*definitions[queue])[0]
+        definition_profile = profile['JobDefinitions'][definition]
+        instance_id, instance_type, az = fleet[rng.randrange(len(fleet))]
+        instance_profile = profile['InstanceTypes'][instance_type]
 
-    for i in range(N_SAMPLES):
         job = {
-            'JobName': f'Job-{i}',
-            'JobId': str(uuid.uuid4()),
-            'InstanceId': str(uuid.uuid4()),
-            'JobQueue': random.choice(QUEUES),
-            'Status': random.choice(STATUSES),
-            'JobDefinition': random.choice(JOB_DEFS),
-            'AvailabilityZone': random.choice(AZS),
-            'Architecture': random.choice(ARCHS),
-            'InstanceType': random.choice(INSTANCES)
+            'JobName': f'{queue}-{i}',
+            'JobId': f'{rng.getrandbits(128):032x}',
+            'InstanceId': instance_id,
+            'JobQueue': queue,
+            'Status': 'FAILED' if rng.random() < queue_profile['FailureRate'] else 'SUCCEEDED',
+            'JobDefinition': definition,
+            'AvailabilityZone': az,
+            'Architecture': instance_profile['Architecture'],
+            'InstanceType': instance_type,
+            'TotalRunnableSeconds': round(
+                queue_profile['MedianRunnableSeconds'] * rng.lognormvariate(0, queue_profile['Sigma'])
+            ),
+            'TotalStartingSeconds': round(
+                definition_profile['MedianStartingSeconds'] * rng.lognormvariate(0, definition_profile['Sigma'])
+            ),
+            'TotalRunningSeconds': round(
+                definition_profile['MedianRunningSeconds'] * instance_profile['DurationFactor'] *
+                rng.lognormvariate(0, definition_profile['Sigma'])
+            )
         }
 
-        job['TotalRunnableSeconds'] = random.randint(1, 3600 if job['Architecture'] == 'x86_64' else 2600)
-        job['TotalStartingSeconds'] = random.randint(5, 100 if job['Architecture'] == 'x86_64' else 80)
-        job['TotalRunningSeconds'] = random.randint(60, 7200 if job['Architecture'] == 'x86_64' else 5200)
+        # Completion times are stratified: one random time within each slot of the window. The rest of the timeline is
+        # derived backwards from the durations
+        timestamp = int(start_ms + (i + rng.random()) * step_ms)
+
+        job['StoppedAt'] = timestamp
+        job['RunningAt'] = job['StoppedAt'] - job['TotalRunningSeconds'] * 1000
+        job['StartingAt'] = job['RunningAt'] - job['TotalStartingSeconds'] * 1000
+        job['RunnableAt'] = job['StartingAt'] - job['TotalRunnableSeconds'] * 1000
 
-        job_events.append({
-            'timestamp': int(time.time()) * 1000,
-            'message': json.dumps(job)
-        })
+        yield timestamp, job
 
-    client.put_log_events(
-        logGroupName=JOBS_LOG_GROUP,
-        logStreamName=JOBS_LOG_STREAM,
-        logEvents=job_events
-    )
+
+def write_block(args, first, count):
+    profile = load_profile(args.profile)
+    fleet = build_fleet(profile, args.instances, args.seed)
+    jobs = generate_jobs(profile, fleet, args.seed, args.start_ms, args.end_ms, args.jobs, first, count)
+    part_name = f'part-{first:012d}'
+
+    if args.output == 'logs':
+        log_streams = shard_stream_names(args.log_stream, args.log_stream_shards)
+
+        with ShardedLogsWriter(boto3.client('logs'), args.log_group, log_streams) as logs_writer:
+            for timestamp, job in jobs:
+                logs_writer.add(job, timestamp, key=job['JobId'])
+    elif args.output == 'jsonl':
+        os.makedirs(args.path, exist_ok=True)
+
+        # Same format as the events returned by the CloudWatch Logs APIs, so that files can be read by the analysis
+        # tools. The gzip header has no modification time, so that generating the same data gives identical files
+        path = os.path.join(args.path, f'{part_name}.jsonl.gz')
+
+        with gzip.GzipFile(path, 'wb', mtime=0) as compressed, io.TextIOWrapper(compressed, encoding='utf-8') as f:
+            for timestamp, job in jobs:
+                f.write(json.dumps({'timestamp': timestamp, 'message': json.dumps(job)}) + '\n')
+    else:
+        from batch_insights.archive import ArchiveWriter, LocalBackend
+
+        ArchiveWriter(LocalBackend(args.path)).write(
+            (dict(job, Timestamp=timestamp) for timestamp, job in jobs), part_name=part_name
+        )
+
+    return count
+
+
+def parse_args(argv=None):
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    parser = argparse.ArgumentParser(description='Generates synthetic job records')
+    parser.add_argument('--jobs', type=int, default=100, help='Number of jobs to generate')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generators')
+    parser.add_argument('--start', default=(now - datetime.timedelta(days=1)).isoformat(),
+                        help='Start of the time window (ISO 8601), defaults to 24 hours ago')
+    parser.add_argument('--end', default=now.isoformat(), help='End of the time window (ISO 8601), defaults to now')
+    parser.add_argument('--profile', help='JSON file with the distributions of the jobs, see DEFAULT_PROFILE')
+    parser.add_argument('--instances', type=int, default=DEFAULT_INSTANCES, help='Number of instances of the fleet')
+    parser.add_argument('--output', choices=OUTPUTS, default='logs', help='Where the records are written')
+    parser.add_argument('--path', default='sample-data', help='Output directory of the jsonl and parquet outputs')
+    parser.add_argument('--log-group', default=os.environ.get('JOBS_LOG_GROUP'), help='Defaults to $JOBS_LOG_GROUP')
+    parser.add_argument('--log-stream', default=os.environ.get('JOBS_LOG_STREAM'), help='Defaults to $JOBS_LOG_STREAM')
+    parser.add_argument('--log-stream-shards', type=int, default=int(os.environ.get('JOBS_LOG_STREAM_SHARDS', 1)),
+                        help='Number of shards of the jobs log stream, defaults to $JOBS_LOG_STREAM_SHARDS or 1')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes generating blocks of jobs')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Number of jobs of each block')
+    args = parser.parse_args(argv)
+
+    args.start_ms, args.end_ms = parse_time(args.start), parse_time(args.end)
+
+    if args.jobs <= 0 or args.block_size <= 0 or args.log_stream_shards <= 0:
+        parser.error('--jobs, --block-size and --log-stream-shards must be positive')
+
+    if args.start_ms >= args.end_ms:
+        parser.error('--start must be earlier than --end')
+
+    if args.output == 'logs':
+        if not args.log_group or not args.log_stream:
+            parser.error('--log-group and --log-stream are required to write to CloudWatch Logs')
+
+        now_ms = int(now.timestamp() * 1000)
+
+        if args.start_ms < now_ms - MAX_LOG_EVENT_AGE_MS or args.end_ms > now_ms + MAX_LOG_EVENT_FUTURE_MS:
+            parser.error('CloudWatch Logs only accepts events from the last 14 days')
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    blocks = [(first, min(args.block_size, args.jobs - first)) for first in range(0, args.jobs, args.block_size)]
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers) as executor:
+            written = sum(executor.map(write_block, itertools.repeat(args), *zip(*blocks)))
+    else:
+        written = sum(write_block(args, first, count) for first, count in blocks)
+
+    print(f'Generated {written} jobs between {args.start} and {args.end}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,97 +2,494 @@
 @Author: Borja Pérez Guasch <bpguasch@amazon.es>
 @Description: this is script is meant to be automatically executed when there is a status change in an AWS Batch job.
 It 1) tracks the job status change in a DynamoDB table and 2) logs all the job information to CloudWatch when the job
-has completed its execution.
+has completed its execution. Events can either be received directly from EventBridge or in batches from an SQS queue,
+in which case the events of different jobs are processed by up to PIPELINE_CONCURRENCY threads and the completed jobs
+are logged together. The children of array jobs are folded into a summary logged with their parent, and are only
+tracked and logged on their own when ARRAY_CHILD_DETAIL is enabled. When STATE_GAUGES_TABLE is set, the number of jobs
+in each status of every job queue is kept up to date in it. Every job status is processed once: duplicated events are
+dropped before any other request, across warm invocations and, when EVENT_LEDGER_TABLE is set, across all the
+execution environments. When RUNTIME_BASELINES_TABLE is set, the durations of every completed job update the baselines
+of its job definition, and the runtime regressions they reveal are published as metrics. When DURATION_SKETCHES_TABLE is
+set, the durations of every completed job are added to quantile sketches of its dimensions.
 """
 
 import os
-import boto3
-import time
 import json
-import datetime
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_insights import arrays, gauges, idempotency, instrumentation, jobs, metrics, runtime
+from batch_insights.logs_writer import ShardedLogsWriter, shard_stream_names
+from batch_insights.regressions import RegressionDetector
+from batch_insights.sketches import SketchStore
 
 
 JOBS_LOG_GROUP = os.environ['JOBS_LOG_GROUP']
 JOBS_LOG_STREAM = os.environ['JOBS_LOG_STREAM']
+JOBS_LOG_STREAM_SHARDS = int(os.environ.get('JOBS_LOG_STREAM_SHARDS', 1))
+EMIT_JOB_METRICS = os.environ.get('EMIT_JOB_METRICS', 'false') == 'true'
+ARRAY_CHILD_DETAIL = os.environ.get('ARRAY_CHILD_DETAIL', 'false') == 'true'
+PIPELINE_CONCURRENCY = int(os.environ.get('PIPELINE_CONCURRENCY', 1))
 
-COMPLETION_STATUSES = {'SUCCEEDED', 'FAILED'}
-TRANSITION_STATUSES = {'RUNNABLE', 'STARTING', 'RUNNING'}
+JOBS_TRACKING_TABLE = os.environ['JOBS_TRACKING_TABLE']
+DURATION_SKETCHES_TABLE = os.environ.get('DURATION_SKETCHES_TABLE')
+STATE_GAUGES_TABLE = os.environ.get('STATE_GAUGES_TABLE')
+STATE_GAUGE_SHARDS = int(os.environ.get('STATE_GAUGE_SHARDS', gauges.DEFAULT_SHARDS))
+EVENT_LEDGER_TABLE = os.environ.get('EVENT_LEDGER_TABLE')
+EVENT_LEASE_SECONDS = int(os.environ.get('EVENT_LEASE_SECONDS', idempotency.DEFAULT_LEASE_SECONDS))
+RUNTIME_BASELINES_TABLE = os.environ.get('RUNTIME_BASELINES_TABLE')
 
-DT_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Keys of the events processed by the execution environment, kept across warm invocations
+PROCESSED_EVENTS = idempotency.create_window()
 
-LOGS_CLIENT = boto3.client('logs')
-JOBS_TRACKING_TABLE = boto3.resource('dynamodb').Table(os.environ['JOBS_TRACKING_TABLE'])
+# The pool is created on first use and reused by the invocations of the execution environment
+_executor = None
+_executor_lock = threading.Lock()
 
 
 def track_job_status_transition(event, job):
-    JOBS_TRACKING_TABLE.update_item(
-        Key={'JobId': job['JobId']},
-        UpdateExpression='SET #s = :v',
-        ExpressionAttributeValues={':v': event['time']},
-        ExpressionAttributeNames={'#s': job['Status']}
-    )
+    """
+    Tracks the time a job reached a status and returns its tracking data from before the update, or None when the
+    status was already tracked at an earlier time.
+    """
+
+    # Only the earliest occurrence of each status is kept, so duplicated or late events never move a transition forward.
+    # Transitions arriving after the job has completed are dropped by its tombstone, as they can no longer be logged.
+    # Every new transition postpones the expiration of the tracking item
+    ddb_client = runtime.client('dynamodb')
+    update_expression = 'SET #s = :v, #e = :e'
+    attr_names = {'#s': job['Status'], '#e': jobs.EXPIRES_AT_ATTRIBUTE, '#c': jobs.COMPLETED_STATUS_ATTRIBUTE}
+    attr_values = {
+        ':v': {'N': str(jobs.parse_event_time(event['time']))},
+        ':e': {'N': str(jobs.expiration())}
+    }
+
+    # Jobs tracked with their job queue are counted in its gauges, see gauges.transition
+    if STATE_GAUGES_TABLE:
+        update_expression += ', #q = :q'
+        attr_names['#q'] = gauges.JOB_QUEUE_ATTRIBUTE
+        attr_values[':q'] = {'S': job['JobQueue']}
+
+    try:
+        response = ddb_client.update_item(
+            TableName=JOBS_TRACKING_TABLE,
+            Key={'JobId': {'S': job['JobId']}},
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_not_exists(#c) AND (attribute_not_exists(#s) OR #s > :v)',
+            ExpressionAttributeValues=attr_values,
+            ExpressionAttributeNames=attr_names,
+            ReturnValues='ALL_OLD'
+        )
+    except ddb_client.exceptions.ConditionalCheckFailedException:
+        return None
 
+    return runtime.deserialize_item(response.get('Attributes', {}))
 
-def retrieve_job_tracking_data(job_id):
-    return JOBS_TRACKING_TABLE.get_item(Key={'JobId': job_id})['Item']
 
+def pop_job_tracking_data(job_id, status):
+    """
+    Replaces the tracking data of a completed job with its tombstone and returns it in a single round trip. Jobs without
+    tracking data (e.g. when the completion event arrives before any transition) return an empty dictionary, and jobs
+    that have already been logged return None.
+    """
 
-def delete_job_tracking_data(job_id):
-    JOBS_TRACKING_TABLE.delete_item(Key={'JobId': job_id})
+    ddb_client = runtime.client('dynamodb')
 
+    try:
+        response = ddb_client.put_item(
+            TableName=JOBS_TRACKING_TABLE,
+            Item=jobs.tombstone(job_id, status),
+            ConditionExpression='attribute_not_exists(#c)',
+            ExpressionAttributeNames={'#c': jobs.COMPLETED_STATUS_ATTRIBUTE},
+            ReturnValues='ALL_OLD'
+        )
+    except ddb_client.exceptions.ConditionalCheckFailedException:
+        return None
 
-def calculate_job_status_durations(event, tracking_data):
-    # Calculate job duration
-    if 'startedAt' in event['detail'] and 'stoppedAt' in event['detail']:
-        dt1 = datetime.datetime.fromtimestamp(event['detail']['startedAt'] // 1000)
-        dt2 = datetime.datetime.fromtimestamp(event['detail']['stoppedAt'] // 1000)
-        total_running_seconds = (dt2 - dt1).seconds
+    return runtime.deserialize_item(response.get('Attributes', {}))
+
+
+def restore_job_tracking_data(job_id, tracking_data):
+    # The tombstone of a job that wasn't tracked is deleted, so that the completion can be processed again
+    if tracking_data:
+        runtime.client('dynamodb').put_item(TableName=JOBS_TRACKING_TABLE, Item=runtime.serialize_item(tracking_data))
     else:
-        total_running_seconds = 0
-
-    # Convert status timestamps to date objects
-    dt_runnable = datetime.datetime.strptime(tracking_data['RUNNABLE'], DT_FORMAT)
-    dt_starting = datetime.datetime.strptime(tracking_data['STARTING'], DT_FORMAT)
-    dt_running = datetime.datetime.strptime(tracking_data['RUNNING'], DT_FORMAT)
-
-    tracking_data.update({
-        'TotalRunnableSeconds': (dt_starting - dt_runnable).seconds,
-        'TotalStartingSeconds': (dt_running - dt_starting).seconds,
-        'TotalRunningSeconds': total_running_seconds
-    })
-
-    del tracking_data['RUNNABLE']
-    del tracking_data['STARTING']
-    del tracking_data['RUNNING']
-
-
-def log_job(job):
-    LOGS_CLIENT.put_log_events(
-        logGroupName=JOBS_LOG_GROUP,
-        logStreamName=JOBS_LOG_STREAM,
-        logEvents=[
-            {
-                'timestamp': int(time.time()) * 1000,
-                'message': json.dumps(job)
-            },
-        ],
+        runtime.client('dynamodb').delete_item(TableName=JOBS_TRACKING_TABLE, Key={'JobId': {'S': job_id}})
+
+
+def create_logs_writer():
+    # Jobs are spread across the shards of the jobs log stream by JobId
+    return ShardedLogsWriter(
+        runtime.client('logs'), JOBS_LOG_GROUP, shard_stream_names(JOBS_LOG_STREAM, JOBS_LOG_STREAM_SHARDS)
     )
 
 
+def create_child_aggregator():
+    return arrays.ChildAggregator(runtime.client('dynamodb'), JOBS_TRACKING_TABLE)
+
+
+def create_event_ledger():
+    return idempotency.EventLedger(runtime.client('dynamodb'), EVENT_LEDGER_TABLE, PROCESSED_EVENTS,
+                                   EVENT_LEASE_SECONDS)
+
+
+def event_key(event):
+    # Only the earliest occurrence of each status is tracked, so any later event of a job with the same status is a
+    # duplicate, whether it was delivered twice or emitted again
+    detail = event['detail']
+    return f'job#{detail["jobId"]}#{detail["status"]}'
+
+
+def create_state_gauges():
+    if not STATE_GAUGES_TABLE:
+        return None
+
+    return gauges.StateGauges(runtime.client('dynamodb'), STATE_GAUGES_TABLE, STATE_GAUGE_SHARDS)
+
+
+def flush_state_gauges(state_gauges):
+    if state_gauges is None:
+        return
+
+    try:
+        with instrumentation.span('FlushStateGauges'):
+            state_gauges.flush()
+    except Exception:
+        traceback.print_exc()
+
+
+def log_job(completed_job, logs_writer):
+    job, timestamp, tracking_data = completed_job
+
+    try:
+        logs_writer.add(job, timestamp, key=job['JobId'])
+    except Exception:
+        restore_job_tracking_data(job['JobId'], tracking_data)
+        raise
+
+
+def aggregate_logged_jobs(logged_jobs, state_gauges):
+    """
+    Publishes the aggregated views of jobs that have already been logged, given as (job, timestamp, original tracking
+    data) tuples, and takes them out of the gauge of their last status. Failures are not propagated, as retrying the
+    events would log the jobs twice.
+    """
+
+    duration_sketches = SketchStore(runtime.client('dynamodb'), DURATION_SKETCHES_TABLE) \
+        if DURATION_SKETCHES_TABLE else None
+    regression_detector = RegressionDetector(runtime.client('dynamodb'), RUNTIME_BASELINES_TABLE) \
+        if RUNTIME_BASELINES_TABLE else None
+
+    for job, timestamp, tracking_data in logged_jobs:
+        if EMIT_JOB_METRICS:
+            with instrumentation.span('EmitJobMetrics'):
+                metrics.emit(metrics.build_job_metrics(job, timestamp))
+
+        if duration_sketches is not None:
+            duration_sketches.record(job, timestamp)
+
+        if regression_detector is not None:
+            regression_detector.record(job, timestamp)
+
+        if state_gauges is not None and gauges.is_counted(tracking_data):
+            state_gauges.move(job['JobQueue'], job['JobId'], gauges.tracked_status(tracking_data), None)
+
+    if duration_sketches is not None:
+        try:
+            with instrumentation.span('FlushDurationSketches'):
+                duration_sketches.flush()
+        except Exception:
+            traceback.print_exc()
+
+    if regression_detector is not None:
+        try:
+            with instrumentation.span('FlushRuntimeBaselines'):
+                for regression in regression_detector.flush():
+                    metrics.emit(metrics.build_runtime_regression_metrics(regression))
+        except Exception:
+            traceback.print_exc()
+
+    flush_state_gauges(state_gauges)
+
+
+def process_event(event, child_aggregator, state_gauges):
+    """
+    Processes a single job state change event. When the job has completed, a (job, timestamp, original tracking data)
+    tuple is returned to be logged, so that the tracking data can be restored if the job can't be logged. The
+    completions of array children are buffered in the child aggregator, and the transitions that move a job to a later
+    status in the state gauges.
+    """
+
+    detail = event['detail']
+    job = jobs.build_job(detail)
+
+    if arrays.parent_job_id(job['JobId']) is not None:
+        if job['Status'] in jobs.COMPLETION_STATUSES:
+            child_aggregator.record_completion(detail)
+
+        if not ARRAY_CHILD_DETAIL:
+            return None
+
+    if job['Status'] in jobs.TRANSITION_STATUSES:
+        with instrumentation.span('TrackJobStatusTransition'):
+            old_tracking_data = track_job_status_transition(event, job)
+
+        moved = gauges.transition(old_tracking_data, job['Status']) if old_tracking_data is not None else None
+
+        if state_gauges is not None and moved is not None:
+            state_gauges.move(job['JobQueue'], job['JobId'], *moved)
+    elif job['Status'] in jobs.COMPLETION_STATUSES:
+        with instrumentation.span('PopJobTrackingData'):
+            tracking_data = pop_job_tracking_data(job['JobId'], job['Status'])
+
+        # The completion was delivered again after the job was logged
+        if tracking_data is None:
+            return None
+
+        # The last children of an array may complete in the same batch as their parent
+        child_aggregator.merge_into(job['JobId'], tracking_data)
+
+        original_tracking_data = dict(tracking_data)
+        timestamp = jobs.job_log_timestamp(detail)
+
+        try:
+            with instrumentation.span('CalculateJobStatusDurations'):
+                jobs.calculate_job_status_durations(detail, tracking_data)
+                tracking_data.update(arrays.summarize_array(detail, tracking_data))
+
+            job.update(tracking_data)
+        except Exception:
+            restore_job_tracking_data(job['JobId'], original_tracking_data)
+            raise
+
+        return job, timestamp, original_tracking_data
+
+    return None
+
+
+def event_sort_key(event):
+    status = event['detail']['status']
+    return event['time'], jobs.STATUS_ORDER.index(status) if status in jobs.STATUS_ORDER else len(jobs.STATUS_ORDER)
+
+
+def event_group_key(event):
+    # The children of an array job are processed with their parent, as they are aggregated in its tracking item
+    job_id = event['detail']['jobId']
+    return arrays.parent_job_id(job_id) or job_id
+
+
+def process_event_group(events, child_aggregator, state_gauges):
+    """
+    Processes the sorted events of a group in order and returns a (message ID, event, completed job, succeeded) tuple
+    per event. Once an event fails, the remaining events of the same job are failed too so that they are retried in
+    order.
+    """
+
+    results = []
+    failed_job_ids = set()
+
+    for message_id, event in events:
+        job_id = event['detail']['jobId']
+
+        if job_id in failed_job_ids:
+            results.append((message_id, event, None, False))
+            continue
+
+        try:
+            results.append((message_id, event, process_event(event, child_aggregator, state_gauges), True))
+        except Exception:
+            traceback.print_exc()
+            failed_job_ids.add(job_id)
+            results.append((message_id, event, None, False))
+
+    return results
+
+
+def executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(PIPELINE_CONCURRENCY)
+
+        return _executor
+
+
+def process_event_groups(groups, child_aggregator, state_gauges):
+    """
+    Processes the groups of events, concurrently when PIPELINE_CONCURRENCY allows it. Groups are independent, so the
+    DynamoDB calls of an invocation overlap and its latency follows the slowest group instead of the sum of all calls.
+    """
+
+    if PIPELINE_CONCURRENCY <= 1 or len(groups) <= 1:
+        return [process_event_group(events, child_aggregator, state_gauges) for events in groups]
+
+    return list(executor().map(lambda events: process_event_group(events, child_aggregator, state_gauges), groups))
+
+
+def process_sqs_records(records):
+    logs_writer = create_logs_writer()
+    child_aggregator = create_child_aggregator()
+    state_gauges = create_state_gauges()
+    failed_message_ids = []
+    completed_jobs = []
+    child_message_ids = {}
+    events = []
+
+    with instrumentation.span('ParseRecords'):
+        for record in records:
+            try:
+                event = json.loads(record['body'])
+                events.append((event_sort_key(event), event_group_key(event), record['messageId'], event,
+                               event_key(event)))
+            except (ValueError, KeyError, TypeError):
+                traceback.print_exc()
+                failed_message_ids.append(record['messageId'])
+
+    # Standard queues don't preserve ordering, so the transitions of every job are replayed in the order they happened
+    events.sort(key=lambda e: e[0])
+    event_ledger = create_event_ledger()
+
+    with instrumentation.span('ClaimEvents'):
+        outcomes = event_ledger.claim([key for *_, key in events])
+
+    # Duplicates are dropped as processed, whereas the events still being processed by another invocation are retried
+    # later in case it fails
+    claimed_keys = {}
+    seen_keys = set()
+    groups = {}
+
+    for _, group_key, message_id, event, key in events:
+        if outcomes[key] == idempotency.IN_PROGRESS:
+            failed_message_ids.append(message_id)
+        elif outcomes[key] == idempotency.CLAIMED and key not in seen_keys:
+            seen_keys.add(key)
+            claimed_keys[message_id] = key
+            groups.setdefault(group_key, []).append((message_id, event))
+
+    with instrumentation.span('ProcessEvents'):
+        results = process_event_groups(list(groups.values()), child_aggregator, state_gauges)
+
+    # The completed jobs are buffered in one logs writer, by a single thread
+    for message_id, event, completed_job, succeeded in (result for group in results for result in group):
+        if succeeded and completed_job is not None:
+            try:
+                log_job(completed_job, logs_writer)
+            except Exception:
+                traceback.print_exc()
+                succeeded = False
+
+        if not succeeded:
+            failed_message_ids.append(message_id)
+            continue
+
+        parent_id = arrays.parent_job_id(event['detail']['jobId'])
+
+        # Children logged on their own are not retried when their parent can't be updated, as they would be logged twice
+        if parent_id is not None and completed_job is None and event['detail']['status'] in jobs.COMPLETION_STATUSES:
+            child_message_ids.setdefault(parent_id, []).append(message_id)
+
+        if completed_job is not None:
+            completed_jobs.append((message_id, completed_job))
+
+    # All the completed jobs are logged together. The jobs that couldn't be logged get their tracking data restored so
+    # that they can be retried, whereas the ones written to the shards that succeeded are kept
+    try:
+        with instrumentation.span('FlushLogs'):
+            logs_writer.flush()
+
+        pending_job_ids = set()
+    except Exception:
+        traceback.print_exc()
+        pending_job_ids = logs_writer.pending_keys()
+
+    # The children of the parents that didn't complete in this batch are added to their tracking items, and retried when
+    # that fails
+    with instrumentation.span('FlushChildAggregates'):
+        failed_parent_ids = child_aggregator.flush()
+
+    for parent_id in failed_parent_ids:
+        failed_message_ids.extend(child_message_ids.get(parent_id, []))
+
+    logged_jobs = []
+
+    for message_id, (job, timestamp, tracking_data) in completed_jobs:
+        if job['JobId'] not in pending_job_ids:
+            logged_jobs.append((job, timestamp, tracking_data))
+            continue
+
+        failed_message_ids.append(message_id)
+        restore_job_tracking_data(job['JobId'], tracking_data)
+
+    aggregate_logged_jobs(logged_jobs, state_gauges)
+
+    # The claims of the failed events are released for their retries
+    failed = set(failed_message_ids)
+
+    with instrumentation.span('SettleEvents'):
+        event_ledger.complete(key for message_id, key in claimed_keys.items() if message_id not in failed)
+        event_ledger.release(key for message_id, key in claimed_keys.items() if message_id in failed)
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+
+
+def process_direct_event(event):
+    logs_writer = create_logs_writer()
+    child_aggregator = create_child_aggregator()
+    state_gauges = create_state_gauges()
+    completed_job = process_event(event, child_aggregator, state_gauges)
+
+    with instrumentation.span('FlushChildAggregates'):
+        failed_parent_ids = child_aggregator.flush()
+
+    if completed_job is None:
+        flush_state_gauges(state_gauges)
+
+        if failed_parent_ids:
+            raise RuntimeError(f'Could not add the array child {event["detail"]["jobId"]} to its parent')
+
+        return
+
+    log_job(completed_job, logs_writer)
+    job, timestamp, tracking_data = completed_job
+
+    try:
+        with instrumentation.span('FlushLogs'):
+            logs_writer.flush()
+    except Exception:
+        restore_job_tracking_data(job['JobId'], tracking_data)
+        raise
+
+    aggregate_logged_jobs([completed_job], state_gauges)
+
+
+@instrumentation.instrument_handler('processBatchEvents')
 def handler(event, context):
-    job = {
-        'JobName': event['detail']['jobName'],
-        'JobId': event['detail']['jobId'],
-        'JobQueue': event['detail']['jobQueue'].split('/')[-1],
-        'Status': event['detail']['status'],
-        'JobDefinition': event['detail']['jobDefinition'].split('/')[-1],
-    }
+    # Events are either delivered by EventBridge one at a time or buffered by SQS in batches of records
+    if 'Records' in event:
+        return process_sqs_records(event['Records'])
+
+    key = event_key(event)
+    event_ledger = create_event_ledger()
+
+    with instrumentation.span('ClaimEvents'):
+        outcome = event_ledger.claim([key])[key]
+
+    # Events still being processed by another invocation fail, so that Lambda retries them once its claim is completed
+    # or taken over
+    if outcome == idempotency.IN_PROGRESS:
+        raise RuntimeError(f'The event {key} is being processed by another invocation')
+
+    if outcome != idempotency.CLAIMED:
+        print(f'Dropping the duplicated event {key} ({outcome})')
+        return
+
+    try:
+        process_direct_event(event)
+    except Exception:
+        event_ledger.release([key])
+        raise
 
-    if job['Status'] in TRANSITION_STATUSES:
-        track_job_status_transition(event, job)
-    elif job['Status'] in COMPLETION_STATUSES:
-        tracking_data = retrieve_job_tracking_data(job['JobId'])
-        calculate_job_status_durations(event, tracking_data)
-        job.update(tracking_data)
-        log_job(job)
-        delete_job_tracking_data(job['JobId'])
+    event_ledger.complete([key])
@@ -1,14 +1,28 @@
 """
 @Author: Borja Pérez Guasch <bpguasch@amazon.es>
 @Description: this script is meant to be automatically executed when a container instance is registered / deregistered.
-It either tracks in DynamoDB some container instance's attributes or deletes the tracked information.
+It either tracks in DynamoDB some container instance's attributes or deletes the tracked information. Every event is
+processed once: the copies of an event are dropped before any other request, across warm invocations and, when
+EVENT_LEDGER_TABLE is set, across all the execution environments.
 """
 
-import boto3
 import os
 
+from batch_insights import idempotency, instrumentation, jobs, runtime
 
-CONTAINER_INSTANCE_TRACKING_TABLE = boto3.resource('dynamodb').Table(os.environ['CONTAINER_INSTANCE_TRACKING_TABLE'])
+
+CONTAINER_INSTANCE_TRACKING_TABLE = os.environ['CONTAINER_INSTANCE_TRACKING_TABLE']
+EVENT_LEDGER_TABLE = os.environ.get('EVENT_LEDGER_TABLE')
+EVENT_LEASE_SECONDS = int(os.environ.get('EVENT_LEASE_SECONDS', idempotency.DEFAULT_LEASE_SECONDS))
+
+# Keys of the events processed by the execution environment, kept across warm invocations. Every state change of an
+# instance refreshes its expiration, so only the copies of an event are duplicates
+PROCESSED_EVENTS = idempotency.create_window()
+
+
+def create_event_ledger():
+    return idempotency.EventLedger(runtime.client('dynamodb'), EVENT_LEDGER_TABLE, PROCESSED_EVENTS,
+                                   EVENT_LEASE_SECONDS)
 
 
 def extract_container_instance_attributes(container_instance):
@@ -29,17 +43,59 @@ def extract_container_instance_attributes(container_instance):
 
 
 def track_container_instance(container_instance):
-    CONTAINER_INSTANCE_TRACKING_TABLE.put_item(Item=container_instance)
+    # Instances that disappear without a deregistration event expire once they stop receiving state change events
+    runtime.client('dynamodb').put_item(
+        TableName=CONTAINER_INSTANCE_TRACKING_TABLE,
+        Item=runtime.serialize_item(dict(container_instance, **{jobs.EXPIRES_AT_ATTRIBUTE: jobs.expiration()}))
+    )
 
 
 def delete_container_instance(arn):
-    CONTAINER_INSTANCE_TRACKING_TABLE.delete_item(Key={'ContainerInstanceArn': arn})
+    runtime.client('dynamodb').delete_item(
+        TableName=CONTAINER_INSTANCE_TRACKING_TABLE,
+        Key={'ContainerInstanceArn': {'S': arn}}
+    )
 
 
-def handler(event, context):
+def process_event(event):
     if event['detail']['status'] == 'ACTIVE':
         container_instance = extract_container_instance_attributes(event['detail'])
-        track_container_instance(container_instance)
+
+        with instrumentation.span('TrackContainerInstance'):
+            track_container_instance(container_instance)
     else:
         container_instance_arn = event['detail']['containerInstanceArn']
-        delete_container_instance(container_instance_arn)
+
+        with instrumentation.span('DeleteContainerInstance'):
+            delete_container_instance(container_instance_arn)
+
+
+@instrumentation.instrument_handler('processContainerInstanceEvents')
+def handler(event, context):
+    key = idempotency.event_id_key(event)
+
+    if key is None:
+        process_event(event)
+        return
+
+    event_ledger = create_event_ledger()
+
+    with instrumentation.span('ClaimEvents'):
+        outcome = event_ledger.claim([key])[key]
+
+    # Events still being processed by another invocation fail, so that Lambda retries them once its claim is completed
+    # or taken over
+    if outcome == idempotency.IN_PROGRESS:
+        raise RuntimeError(f'The event {key} is being processed by another invocation')
+
+    if outcome != idempotency.CLAIMED:
+        print(f'Dropping the duplicated event {key} ({outcome})')
+        return
+
+    try:
+        process_event(event)
+    except Exception:
+        event_ledger.release([key])
+        raise
+
+    event_ledger.complete([key])
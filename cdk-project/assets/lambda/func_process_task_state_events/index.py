@@ -1,15 +1,39 @@
 """
 @Author: Borja Pérez Guasch <bpguasch@amazon.es>
 @Description: this script is meant to be automatically executed when there is a task state change.
-It associates an AWS Batch job with its container instance.
+It associates an AWS Batch job with its container instance. Events can either be received directly from EventBridge or
+in batches from an SQS queue. The instance types of array children are counted in the tracking item of their parent, and
+children are only hydrated on their own when ARRAY_CHILD_DETAIL is enabled. Every task is processed once: duplicated
+events are dropped before any other request, across warm invocations and, when EVENT_LEDGER_TABLE is set, across all
+the execution environments.
 """
 
-import boto3
 import os
+import json
+import time
+import traceback
 
-DDB_RESOURCE = boto3.resource('dynamodb')
-CONTAINER_INSTANCE_TRACKING_TABLE = DDB_RESOURCE.Table(os.environ['CONTAINER_INSTANCE_TRACKING_TABLE'])
-JOBS_TRACKING_TABLE = DDB_RESOURCE.Table(os.environ['JOBS_TRACKING_TABLE'])
+from batch_insights import arrays, idempotency, instrumentation, jobs, runtime
+from batch_insights.cache import TTLCache
+
+CONTAINER_INSTANCE_TRACKING_TABLE = os.environ['CONTAINER_INSTANCE_TRACKING_TABLE']
+JOBS_TRACKING_TABLE = os.environ['JOBS_TRACKING_TABLE']
+ARRAY_CHILD_DETAIL = os.environ.get('ARRAY_CHILD_DETAIL', 'false') == 'true'
+EVENT_LEDGER_TABLE = os.environ.get('EVENT_LEDGER_TABLE')
+EVENT_LEASE_SECONDS = int(os.environ.get('EVENT_LEASE_SECONDS', idempotency.DEFAULT_LEASE_SECONDS))
+
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = 5
+
+# Container instance ARNs are unique per registration, so the cached attributes of an ARN never change. Deregistered
+# instances stop being referenced by new tasks and their entries are evicted once they expire or are least recently used
+CONTAINER_INSTANCE_CACHE = TTLCache(
+    max_size=int(os.environ.get('CONTAINER_INSTANCE_CACHE_SIZE', 1024)),
+    ttl_seconds=int(os.environ.get('CONTAINER_INSTANCE_CACHE_TTL_SECONDS', 900))
+)
+
+# Keys of the events processed by the execution environment, kept across warm invocations
+PROCESSED_EVENTS = idempotency.create_window()
 
 
 def extract_job_id(event):
@@ -20,32 +44,260 @@ def extract_job_id(event):
     return None
 
 
+def event_key(event):
+    # Every attempt of a job starts a new task, so a task is associated with its container instance once. Events
+    # without a task ARN are only recognized by their ID
+    task_arn = event['detail'].get('taskArn')
+    return f'task#{task_arn}' if task_arn else idempotency.event_id_key(event)
+
+
+def create_event_ledger():
+    return idempotency.EventLedger(runtime.client('dynamodb'), EVENT_LEDGER_TABLE, PROCESSED_EVENTS,
+                                   EVENT_LEASE_SECONDS)
+
+
+def batch_get_container_instances(arns):
+    table_name = CONTAINER_INSTANCE_TRACKING_TABLE
+    container_instances = {}
+
+    for i in range(0, len(arns), BATCH_GET_MAX_KEYS):
+        request_items = {table_name: {
+            'Keys': [{'ContainerInstanceArn': {'S': arn}} for arn in arns[i:i + BATCH_GET_MAX_KEYS]]
+        }}
+        attempt = 0
+
+        while request_items:
+            response = runtime.client('dynamodb').batch_get_item(RequestItems=request_items)
+
+            for item in response['Responses'].get(table_name, []):
+                container_instance = runtime.deserialize_item(item)
+
+                # The expiration of the container instance is not copied to the jobs that ran on it
+                container_instance.pop(jobs.EXPIRES_AT_ATTRIBUTE, None)
+                container_instances[container_instance['ContainerInstanceArn']] = container_instance
+
+            request_items = response.get('UnprocessedKeys')
+
+            if request_items:
+                if attempt >= BATCH_GET_MAX_RETRIES:
+                    break
+
+                instrumentation.increment('Retries')
+                time.sleep(0.05 * 2 ** attempt)
+                attempt += 1
+
+    return container_instances
+
+
+def retrieve_container_instances(arns):
+    """
+    Returns the tracked attributes of the given container instances. Cached instances are served from memory and the
+    rest are fetched with a single BatchGetItem per 100 distinct ARNs. Instances that aren't tracked are not returned.
+    """
+
+    container_instances = {}
+    missing_arns = []
+
+    for arn in set(arns):
+        container_instance = CONTAINER_INSTANCE_CACHE.get(arn)
+
+        if container_instance is None:
+            missing_arns.append(arn)
+        else:
+            container_instances[arn] = container_instance
+
+    if missing_arns:
+        with instrumentation.span('BatchGetContainerInstances'):
+            fetched = batch_get_container_instances(missing_arns)
+
+        for arn, container_instance in fetched.items():
+            CONTAINER_INSTANCE_CACHE.put(arn, container_instance)
+            container_instances[arn] = container_instance
+
+    return container_instances
+
+
 def retrieve_container_instance(arn):
-    return CONTAINER_INSTANCE_TRACKING_TABLE.get_item(Key={'ContainerInstanceArn': arn})['Item']
+    container_instances = retrieve_container_instances([arn])
+
+    if arn not in container_instances:
+        raise KeyError(f'Container instance {arn} is not being tracked')
+
+    return container_instances[arn]
 
 
 def hydrate_job_with_container_instance(job_id, container_instance):
+    # Tasks may be reported before the first transition of their job, which creates its tracking item, but never after
+    # the job has been logged
+    ddb_client = runtime.client('dynamodb')
     update_expressions = []
-    attr_names = {}
+    attr_names = {'#c': jobs.COMPLETED_STATUS_ATTRIBUTE}
     attr_values = {}
 
-    for i, element in enumerate(container_instance.items()):
+    # Hydrating the job postpones the expiration of its tracking item
+    attributes = dict(container_instance, **{jobs.EXPIRES_AT_ATTRIBUTE: jobs.expiration()})
+
+    for i, element in enumerate(attributes.items()):
         update_expressions.append(f'#n{i} = :v{i}')
         attr_names[f'#n{i}'] = element[0]
-        attr_values[f':v{i}'] = element[1]
+        attr_values[f':v{i}'] = runtime.serialize(element[1])
 
-    JOBS_TRACKING_TABLE.update_item(
-        Key={'JobId': job_id},
-        UpdateExpression=f'SET {",".join(update_expressions)}',
-        ExpressionAttributeValues=attr_values,
-        ExpressionAttributeNames=attr_names
-    )
+    try:
+        ddb_client.update_item(
+            TableName=JOBS_TRACKING_TABLE,
+            Key={'JobId': {'S': job_id}},
+            UpdateExpression=f'SET {",".join(update_expressions)}',
+            ConditionExpression='attribute_not_exists(#c)',
+            ExpressionAttributeValues=attr_values,
+            ExpressionAttributeNames=attr_names
+        )
+    except ddb_client.exceptions.ConditionalCheckFailedException:
+        print(f'Job {job_id} has already been logged, its container instance is dropped')
 
 
-def handler(event, context):
-    container_instance_arn = event['detail']['containerInstanceArn']
-    job_id = extract_job_id(event)
+def process_task(job_id, container_instance, child_aggregator):
+    # Every attempt of a child starts a task, so retried children are counted once per instance type they ran on
+    if arrays.parent_job_id(job_id) is not None:
+        child_aggregator.record_instance_type(job_id, container_instance['InstanceType'])
 
-    if job_id is not None:
-        container_instance = retrieve_container_instance(container_instance_arn)
+        if not ARRAY_CHILD_DETAIL:
+            return
+
+    with instrumentation.span('HydrateJobWithContainerInstance'):
         hydrate_job_with_container_instance(job_id, container_instance)
+
+
+def annotate_cache_stats():
+    # Published with the instrumentation record of the invocation, rather than as a log line of its own
+    instrumentation.annotate('ContainerInstanceCache', CONTAINER_INSTANCE_CACHE.stats())
+
+
+def process_sqs_records(records):
+    failed_message_ids = []
+    tasks = []
+
+    with instrumentation.span('ParseRecords'):
+        for record in records:
+            try:
+                event = json.loads(record['body'])
+                job_id = extract_job_id(event)
+
+                if job_id is not None:
+                    tasks.append((record['messageId'], job_id, event['detail']['containerInstanceArn'],
+                                  event_key(event)))
+            except (ValueError, KeyError, IndexError, TypeError):
+                traceback.print_exc()
+                failed_message_ids.append(record['messageId'])
+
+    event_ledger = create_event_ledger()
+
+    with instrumentation.span('ClaimEvents'):
+        outcomes = event_ledger.claim([key for *_, key in tasks if key])
+
+    # Duplicates are dropped as processed, whereas the tasks still being processed by another invocation are retried
+    # later in case it fails. Events without a key are always processed
+    claimed_keys = {}
+    seen_keys = set()
+    claimed_tasks = []
+
+    for message_id, job_id, arn, key in tasks:
+        outcome = outcomes[key] if key else idempotency.CLAIMED
+
+        if outcome == idempotency.IN_PROGRESS:
+            failed_message_ids.append(message_id)
+        elif outcome == idempotency.CLAIMED and key not in seen_keys:
+            if key:
+                seen_keys.add(key)
+                claimed_keys[message_id] = key
+
+            claimed_tasks.append((message_id, job_id, arn))
+
+    tasks = claimed_tasks
+
+    # The container instances of all the tasks in the batch are joined with one lookup
+    container_instances = retrieve_container_instances([arn for _, _, arn in tasks])
+    child_aggregator = arrays.ChildAggregator(runtime.client('dynamodb'), JOBS_TRACKING_TABLE)
+    child_message_ids = {}
+
+    for message_id, job_id, arn in tasks:
+        try:
+            if arn not in container_instances:
+                raise KeyError(f'Container instance {arn} is not being tracked')
+
+            process_task(job_id, container_instances[arn], child_aggregator)
+        except Exception:
+            traceback.print_exc()
+            failed_message_ids.append(message_id)
+            continue
+
+        # Children hydrated on their own are not retried when their parent can't be updated
+        parent_id = arrays.parent_job_id(job_id)
+
+        if parent_id is not None and not ARRAY_CHILD_DETAIL:
+            child_message_ids.setdefault(parent_id, []).append(message_id)
+
+    # The instance types of the children of each parent are counted with one write
+    with instrumentation.span('FlushChildAggregates'):
+        failed_parent_ids = child_aggregator.flush()
+
+    for parent_id in failed_parent_ids:
+        failed_message_ids.extend(child_message_ids.get(parent_id, []))
+
+    # The claims of the failed tasks are released for their retries
+    failed = set(failed_message_ids)
+
+    with instrumentation.span('SettleEvents'):
+        event_ledger.complete(key for message_id, key in claimed_keys.items() if message_id not in failed)
+        event_ledger.release(key for message_id, key in claimed_keys.items() if message_id in failed)
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+
+
+@instrumentation.instrument_handler('processTaskStateEvents')
+def handler(event, context):
+    try:
+        # Events are either delivered by EventBridge one at a time or buffered by SQS in batches of records
+        if 'Records' in event:
+            return process_sqs_records(event['Records'])
+
+        container_instance_arn = event['detail']['containerInstanceArn']
+        job_id = extract_job_id(event)
+        key = event_key(event)
+
+        if job_id is None:
+            return
+
+        event_ledger = create_event_ledger()
+
+        if key:
+            with instrumentation.span('ClaimEvents'):
+                outcome = event_ledger.claim([key])[key]
+
+            # Events still being processed by another invocation fail, so that Lambda retries them once its claim is
+            # completed or taken over
+            if outcome == idempotency.IN_PROGRESS:
+                raise RuntimeError(f'The event {key} is being processed by another invocation')
+
+            if outcome != idempotency.CLAIMED:
+                print(f'Dropping the duplicated event {key} ({outcome})')
+                return
+
+        try:
+            container_instance = retrieve_container_instance(container_instance_arn)
+            child_aggregator = arrays.ChildAggregator(runtime.client('dynamodb'), JOBS_TRACKING_TABLE)
+
+            process_task(job_id, container_instance, child_aggregator)
+
+            with instrumentation.span('FlushChildAggregates'):
+                if child_aggregator.flush() and not ARRAY_CHILD_DETAIL:
+                    raise RuntimeError(f'Could not add the instance type of the array child {job_id} to its parent')
+        except Exception:
+            if key:
+                event_ledger.release([key])
+
+            raise
+
+        if key:
+            event_ledger.complete([key])
+    finally:
+        annotate_cache_stats()
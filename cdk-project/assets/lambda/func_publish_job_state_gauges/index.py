@@ -0,0 +1,49 @@
+"""
+@Description: this script is meant to be automatically executed every minute. It reads the counters of jobs in each
+status of every job queue, maintained by processBatchEvents in the STATE_GAUGES_TABLE, and publishes them as gauges in
+the Embedded Metric Format: one RunnableJobs, RunningJobs, etc. metric per job queue, with a one-minute resolution.
+"""
+
+import os
+import json
+import time
+
+from batch_insights import gauges, instrumentation, metrics, runtime
+
+
+STATE_GAUGES_TABLE = os.environ['STATE_GAUGES_TABLE']
+STATE_GAUGE_SHARDS = int(os.environ.get('STATE_GAUGE_SHARDS', gauges.DEFAULT_SHARDS))
+
+
+def list_job_queues():
+    job_queues = []
+    kwargs = {}
+
+    while True:
+        response = runtime.client('batch').describe_job_queues(**kwargs)
+        job_queues.extend(job_queue['jobQueueName'] for job_queue in response['jobQueues'])
+
+        if 'nextToken' not in response:
+            return job_queues
+
+        kwargs['nextToken'] = response['nextToken']
+
+
+@instrumentation.instrument_handler('publishJobStateGauges')
+def handler(event, context):
+    # All the gauges of a run are published with the same timestamp
+    timestamp = int(time.time() * 1000)
+
+    with instrumentation.span('ListJobQueues'):
+        job_queues = list_job_queues()
+
+    with instrumentation.span('ReadStateGauges'):
+        state_gauges = gauges.read_gauges(runtime.client('dynamodb'), STATE_GAUGES_TABLE, job_queues,
+                                          STATE_GAUGE_SHARDS)
+
+    for job_queue, counts in state_gauges.items():
+        metrics.emit(metrics.build_state_gauge_metrics(job_queue, counts, timestamp))
+
+    print(json.dumps({'PublishedJobQueues': len(state_gauges)}))
+
+    return state_gauges
@@ -0,0 +1,213 @@
+"""
+@Description: this script is meant to be automatically executed every hour. It reconciles the jobs that have been
+tracked in DynamoDB without any update for longer than STALE_AFTER_HOURS, which happens when their completion event was
+lost or sent to a dead-letter queue. The current state of the stale jobs is resolved in batches with a job status
+source (AWS Batch by default): completed jobs are logged as processBatchEvents would have logged them, jobs the source
+no longer knows about are logged with the ABANDONED status, and both are then replaced by their tombstone in bulk, like
+processBatchEvents does on completion. Jobs that are still running have their expiration postponed. When
+STATE_GAUGES_TABLE is set, the jobs that are logged are also taken out of the gauge of their last status, which keeps
+the gauges from counting jobs that are no longer tracked.
+
+EventBridge retries the delivery of events for up to 24 hours, so with the default threshold a completion event can
+only arrive after a job has been reconciled if it is replayed from a dead-letter queue. A different threshold can be
+used by invoking the function with a {"staleAfterHours": 1} payload.
+"""
+
+import os
+import json
+import time
+import traceback
+
+from batch_insights import arrays, gauges, instrumentation, jobs, runtime
+from batch_insights.logs_writer import ShardedLogsWriter, shard_stream_names
+
+
+JOBS_LOG_GROUP = os.environ['JOBS_LOG_GROUP']
+JOBS_LOG_STREAM = os.environ['JOBS_LOG_STREAM']
+JOBS_LOG_STREAM_SHARDS = int(os.environ.get('JOBS_LOG_STREAM_SHARDS', 1))
+JOBS_TRACKING_TABLE = os.environ['JOBS_TRACKING_TABLE']
+STALE_AFTER_HOURS = float(os.environ.get('STALE_AFTER_HOURS', 24))
+STATE_GAUGES_TABLE = os.environ.get('STATE_GAUGES_TABLE')
+STATE_GAUGE_SHARDS = int(os.environ.get('STATE_GAUGE_SHARDS', gauges.DEFAULT_SHARDS))
+
+SCAN_PAGE_SIZE = 500
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_MAX_RETRIES = 5
+
+# The reconciliation stops before a new page is scanned when the function has less time left than this. The remaining
+# stale jobs are reconciled on the next run
+MIN_REMAINING_TIME_MS = 60000
+
+
+def create_job_status_source():
+    return jobs.BatchJobStatusSource(runtime.client('batch'))
+
+
+def release_state_gauges(tracking_items):
+    state_gauges = gauges.StateGauges(runtime.client('dynamodb'), STATE_GAUGES_TABLE, STATE_GAUGE_SHARDS)
+
+    for tracking_data in tracking_items:
+        if gauges.is_counted(tracking_data):
+            state_gauges.move(tracking_data[gauges.JOB_QUEUE_ATTRIBUTE], tracking_data['JobId'],
+                              gauges.tracked_status(tracking_data), None)
+
+    try:
+        with instrumentation.span('FlushStateGauges'):
+            state_gauges.flush()
+    except Exception:
+        traceback.print_exc()
+
+
+def scan_stale_jobs(stale_after_seconds):
+    """
+    Yields pages of tracking items that have not been updated for stale_after_seconds. Every update sets the
+    expiration of the item TRACKING_TTL_SECONDS ahead, so stale items are the ones expiring before that minus the
+    threshold. Items tracked before expirations were set have none and are always stale. The tombstones of the jobs
+    that have been logged are never stale.
+    """
+
+    expires_before = jobs.expiration() - int(stale_after_seconds)
+    scan_kwargs = {
+        'TableName': JOBS_TRACKING_TABLE,
+        'FilterExpression': 'attribute_not_exists(#c) AND (attribute_not_exists(#e) OR #e <= :t)',
+        'ExpressionAttributeNames': {'#c': jobs.COMPLETED_STATUS_ATTRIBUTE, '#e': jobs.EXPIRES_AT_ATTRIBUTE},
+        'ExpressionAttributeValues': {':t': {'N': str(expires_before)}},
+        'Limit': SCAN_PAGE_SIZE
+    }
+
+    while True:
+        response = runtime.client('dynamodb').scan(**scan_kwargs)
+
+        if response['Items']:
+            yield [runtime.deserialize_item(item) for item in response['Items']]
+
+        if 'LastEvaluatedKey' not in response:
+            return
+
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def build_completed_job(detail, tracking_data):
+    job = jobs.build_job(detail)
+    job.update(tracking_data)
+    jobs.calculate_job_status_durations(detail, job)
+    job.update(arrays.summarize_array(detail, job))
+
+    return job, jobs.job_log_timestamp(detail)
+
+
+def build_abandoned_job(tracking_data):
+    # Only the tracked data is known about the job, which is logged at the time it was found abandoned
+    job = dict(tracking_data, Status=jobs.ABANDONED_STATUS)
+    jobs.calculate_job_status_durations({}, job)
+    job.pop('TotalRunningSeconds')
+    job.update(arrays.summarize_array({}, job))
+
+    return job, int(time.time() * 1000)
+
+
+def postpone_expiration(job_id):
+    # The job may have completed since the table was scanned, in which case its tombstone keeps its own expiration
+    ddb_client = runtime.client('dynamodb')
+
+    try:
+        ddb_client.update_item(
+            TableName=JOBS_TRACKING_TABLE,
+            Key={'JobId': {'S': job_id}},
+            UpdateExpression='SET #e = :e',
+            ConditionExpression='attribute_exists(JobId) AND attribute_not_exists(#c)',
+            ExpressionAttributeNames={'#c': jobs.COMPLETED_STATUS_ATTRIBUTE, '#e': jobs.EXPIRES_AT_ATTRIBUTE},
+            ExpressionAttributeValues={':e': {'N': str(jobs.expiration())}}
+        )
+    except ddb_client.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+def tombstone_jobs(logged_jobs):
+    # Replacing the items rather than deleting them keeps the events replayed later from tracking the jobs again
+    for i in range(0, len(logged_jobs), BATCH_WRITE_MAX_ITEMS):
+        request_items = {JOBS_TRACKING_TABLE: [
+            {'PutRequest': {'Item': jobs.tombstone(job['JobId'], job['Status'])}}
+            for job in logged_jobs[i:i + BATCH_WRITE_MAX_ITEMS]
+        ]}
+        attempt = 0
+
+        while request_items:
+            response = runtime.client('dynamodb').batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems')
+
+            if request_items:
+                if attempt >= BATCH_WRITE_MAX_RETRIES:
+                    raise RuntimeError(f'Could not tombstone {len(request_items[JOBS_TRACKING_TABLE])} stale jobs')
+
+                instrumentation.increment('Retries')
+                time.sleep(0.05 * 2 ** attempt)
+                attempt += 1
+
+
+def reconcile_page(tracking_items, job_status_source, counts):
+    with instrumentation.span('DescribeJobs'):
+        details = job_status_source.describe([item['JobId'] for item in tracking_items])
+
+    logs_writer = ShardedLogsWriter(
+        runtime.client('logs'), JOBS_LOG_GROUP, shard_stream_names(JOBS_LOG_STREAM, JOBS_LOG_STREAM_SHARDS)
+    )
+
+    logged_jobs = []
+
+    for tracking_data in tracking_items:
+        detail = details.get(tracking_data['JobId'])
+
+        if detail is None:
+            job, timestamp = build_abandoned_job(tracking_data)
+            counts['Abandoned'] += 1
+        elif detail['status'] in jobs.COMPLETION_STATUSES:
+            job, timestamp = build_completed_job(detail, tracking_data)
+            counts['Completed'] += 1
+        else:
+            with instrumentation.span('PostponeExpiration'):
+                postpone_expiration(tracking_data['JobId'])
+
+            counts['Active'] += 1
+            continue
+
+        logs_writer.add(job, timestamp, key=job['JobId'])
+        logged_jobs.append(job)
+
+    # Only the jobs that were logged are tombstoned, the rest are reconciled again on the next run
+    try:
+        with instrumentation.span('FlushLogs'):
+            logs_writer.flush()
+
+        pending_job_ids = set()
+    except Exception:
+        traceback.print_exc()
+        pending_job_ids = logs_writer.pending_keys()
+        counts['Failed'] += len(pending_job_ids)
+
+    logged_jobs = [job for job in logged_jobs if job['JobId'] not in pending_job_ids]
+
+    with instrumentation.span('TombstoneJobs'):
+        tombstone_jobs(logged_jobs)
+
+    if STATE_GAUGES_TABLE:
+        logged_job_ids = {job['JobId'] for job in logged_jobs}
+        release_state_gauges([item for item in tracking_items if item['JobId'] in logged_job_ids])
+
+
+@instrumentation.instrument_handler('reconcileStaleJobs')
+def handler(event, context):
+    stale_after_hours = float((event or {}).get('staleAfterHours', STALE_AFTER_HOURS))
+    job_status_source = create_job_status_source()
+    counts = {'Completed': 0, 'Abandoned': 0, 'Active': 0, 'Failed': 0}
+
+    for tracking_items in scan_stale_jobs(stale_after_hours * 3600):
+        reconcile_page(tracking_items, job_status_source, counts)
+
+        if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_TIME_MS:
+            print('Stopping before the function times out, the remaining stale jobs will be reconciled on the next run')
+            break
+
+    print(json.dumps({'ReconciledJobs': counts}))
+
+    return counts
@@ -0,0 +1,228 @@
+"""
+@Description: this script is meant to be automatically executed every few minutes. It runs the aggregation queries of
+the dashboards, given in a {"Snapshots": [...]} payload, against the jobs log group and stores their results per day in
+the DASHBOARD_SNAPSHOTS_TABLE, from which the custom widgets of the dashboards are rendered. Only the days since the
+previous refresh are queried again, along with the SNAPSHOT_LOOKBACK_DAYS before it for the jobs logged late. Snapshots
+that were never refreshed, or whose query changed, are rebuilt over SNAPSHOT_RETENTION_DAYS with one query per chunk of
+days, up to MAX_CONCURRENT_QUERIES at a time.
+
+Every snapshot is written as soon as all its queries have completed. When the function runs low on time, no new query
+is started and the snapshots whose queries were not all started are left for the next refresh, which queries the same
+days again.
+"""
+
+import os
+import json
+import time
+import datetime
+import traceback
+
+from collections import deque
+
+from batch_insights import instrumentation, runtime
+from batch_insights.snapshots import DAY_SECONDS, SnapshotStore, day_start, fingerprint
+
+
+JOBS_LOG_GROUP = os.environ['JOBS_LOG_GROUP']
+DASHBOARD_SNAPSHOTS_TABLE = os.environ['DASHBOARD_SNAPSHOTS_TABLE']
+SNAPSHOT_RETENTION_DAYS = int(os.environ.get('SNAPSHOT_RETENTION_DAYS', 366))
+SNAPSHOT_LOOKBACK_DAYS = int(os.environ.get('SNAPSHOT_LOOKBACK_DAYS', 1))
+MAX_CONCURRENT_QUERIES = int(os.environ.get('MAX_CONCURRENT_QUERIES', 10))
+
+CHUNK_DAYS = 30
+QUERY_RESULTS_LIMIT = 10000
+POLL_SECONDS = 1
+QUERY_RUNNING_STATUSES = {'Scheduled', 'Running'}
+
+# No new query is started when the function has less time left than this, so that the running ones can complete and
+# their snapshots be written before it times out
+MIN_REMAINING_TIME_MS = 60000
+
+
+def refresh_start(snapshot, state, now_ms):
+    """
+    Returns the first day to query again for a snapshot, in epoch seconds.
+    """
+
+    first_day = day_start(now_ms) - (SNAPSHOT_RETENTION_DAYS - 1) * DAY_SECONDS
+
+    if state is None or state.get('Fingerprint') != fingerprint(snapshot):
+        return first_day
+
+    return max(day_start(state['RefreshedAt']) - SNAPSHOT_LOOKBACK_DAYS * DAY_SECONDS, first_day)
+
+
+def split_days(start, end, chunk_days=CHUNK_DAYS):
+    # Chunks start at midnight, so that no day is split across queries
+    return [(s, min(s + chunk_days * DAY_SECONDS, end)) for s in range(start, end, chunk_days * DAY_SECONDS)]
+
+
+def parse_bin(value):
+    # Bins are returned as UTC dates, e.g. 2024-01-15 00:00:00.000
+    day = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f').replace(tzinfo=datetime.timezone.utc)
+    return int(day.timestamp())
+
+
+def parse_number(value):
+    number = float(value or 0)
+    return int(number) if number.is_integer() else number
+
+
+def parse_results(snapshot, results):
+    """
+    Returns the rows of every day in query results, {day: [[value, partial, ...], ...]}. Jobs without a value of the
+    dimension are grouped under an empty value.
+    """
+
+    days = {}
+
+    for result in results:
+        fields = {field['field']: field['value'] for field in result}
+        bin_field = next(name for name in fields if name.startswith('bin('))
+
+        days.setdefault(parse_bin(fields[bin_field]), []).append(
+            [fields.get(snapshot['Dimension'], '')] + [parse_number(fields.get(p)) for p in snapshot['Partials']]
+        )
+
+    return days
+
+
+def run_queries(queries, on_complete, context=None):
+    """
+    Runs (snapshot ID, query string, start, end) queries with up to MAX_CONCURRENT_QUERIES in flight, and calls
+    on_complete with the ID and results of every snapshot once all its queries have succeeded. Queries that reach the
+    results limit may have been truncated, so they are run again on each half of their days. Returns the IDs of the
+    snapshots that had a query fail, and of the ones whose queries were not all started before the function ran low
+    on time.
+    """
+
+    logs_client = runtime.client('logs')
+    pending = deque(queries)
+    running = {}
+    results = {}
+    failed = set()
+    deferred = set()
+
+    # Number of queries of every snapshot that haven't completed yet
+    remaining = {}
+
+    for snapshot_id, *_ in queries:
+        remaining[snapshot_id] = remaining.get(snapshot_id, 0) + 1
+
+    while pending or running:
+        if pending and context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_TIME_MS:
+            deferred |= {snapshot_id for snapshot_id, *_ in pending} - failed
+            pending.clear()
+
+        while pending and len(running) < MAX_CONCURRENT_QUERIES:
+            snapshot_id, query_string, start, end = pending[0]
+
+            # The other queries of a snapshot that failed are not run
+            if snapshot_id in failed:
+                pending.popleft()
+                continue
+
+            try:
+                response = logs_client.start_query(
+                    logGroupName=JOBS_LOG_GROUP,
+                    startTime=start,
+                    endTime=end - 1,
+                    queryString=query_string,
+                    limit=QUERY_RESULTS_LIMIT
+                )
+            except logs_client.exceptions.LimitExceededException:
+                # Queries of other users count towards the concurrency limit of the account
+                instrumentation.increment('Throttles')
+                break
+
+            running[response['queryId']] = pending.popleft()
+
+        if not pending and not running:
+            break
+
+        time.sleep(POLL_SECONDS)
+
+        for query_id, query in list(running.items()):
+            response = logs_client.get_query_results(queryId=query_id)
+
+            if response['status'] in QUERY_RUNNING_STATUSES:
+                continue
+
+            del running[query_id]
+            snapshot_id, query_string, start, end = query
+
+            if response['status'] != 'Complete':
+                print(f'The query of the snapshot {snapshot_id} from {start} to {end} ended as {response["status"]}')
+                failed.add(snapshot_id)
+            elif len(response['results']) < QUERY_RESULTS_LIMIT:
+                results.setdefault(snapshot_id, []).extend(response['results'])
+                remaining[snapshot_id] -= 1
+
+                if not remaining[snapshot_id] and snapshot_id not in failed | deferred:
+                    on_complete(snapshot_id, results.pop(snapshot_id, []))
+            elif end - start > DAY_SECONDS:
+                # The halves are run next, so that the snapshot completes as soon as possible
+                middle = start + (end - start) // DAY_SECONDS // 2 * DAY_SECONDS
+                pending.extendleft([(snapshot_id, query_string, middle, end),
+                                    (snapshot_id, query_string, start, middle)])
+                remaining[snapshot_id] += 1
+            else:
+                print(f'The snapshot {snapshot_id} has more than {QUERY_RESULTS_LIMIT} rows on day {start}')
+                failed.add(snapshot_id)
+
+            if snapshot_id in failed:
+                results.pop(snapshot_id, None)
+
+    return failed, deferred
+
+
+@instrumentation.instrument_handler('refreshDashboardSnapshots')
+def handler(event, context):
+    now_ms = int(time.time() * 1000)
+    end = now_ms // 1000 + 1
+    store = SnapshotStore(runtime.client('dynamodb'), DASHBOARD_SNAPSHOTS_TABLE, SNAPSHOT_RETENTION_DAYS)
+    snapshots = {snapshot['Id']: snapshot for snapshot in event['Snapshots']}
+    starts = {}
+    queries = []
+
+    with instrumentation.span('ReadSnapshotStates'):
+        for snapshot_id, snapshot in snapshots.items():
+            starts[snapshot_id] = refresh_start(snapshot, store.read_state(snapshot_id), now_ms)
+
+            for chunk_start, chunk_end in split_days(starts[snapshot_id], end):
+                queries.append((snapshot_id, snapshot['Query'], chunk_start, chunk_end))
+
+    refreshed = {}
+    write_failed = set()
+
+    # A snapshot is only updated when all its queries succeeded, so that its next refresh queries the same days again
+    def write_snapshot(snapshot_id, results):
+        days = dict.fromkeys(range(starts[snapshot_id], day_start(now_ms) + 1, DAY_SECONDS), [])
+        days.update(parse_results(snapshots[snapshot_id], results))
+
+        try:
+            with instrumentation.span('WriteSnapshot'):
+                store.write_days(snapshot_id, days)
+                store.write_state(snapshots[snapshot_id], now_ms)
+        except Exception:
+            traceback.print_exc()
+            write_failed.add(snapshot_id)
+            return
+
+        refreshed[snapshot_id] = len(days)
+
+    with instrumentation.span('RunQueries'):
+        failed, deferred = run_queries(queries, write_snapshot, context)
+
+    failed |= write_failed
+
+    print(json.dumps({'RefreshedDays': refreshed, 'FailedSnapshots': sorted(failed),
+                      'DeferredSnapshots': sorted(deferred)}))
+
+    if deferred:
+        print('Stopping before the function times out, the deferred snapshots will be refreshed on the next run')
+
+    if failed:
+        raise RuntimeError(f'Could not refresh the snapshots {sorted(failed)}')
+
+    return refreshed
@@ -0,0 +1,110 @@
+"""
+@Description: this script is meant to be invoked by the custom widgets of the dashboards. It renders the snapshot named
+by the "snapshot" parameter of the widget as an HTML table, merging the days stored in the DASHBOARD_SNAPSHOTS_TABLE
+over the time range of the dashboard, and shows how long ago the snapshot was refreshed. Snapshots that haven't been
+refreshed for SNAPSHOT_STALE_AFTER_MINUTES are flagged as stale.
+"""
+
+import os
+import html
+import time
+import datetime
+
+from batch_insights import instrumentation, runtime
+from batch_insights.snapshots import SnapshotStore, compute_metrics, merge_days
+
+
+DASHBOARD_SNAPSHOTS_TABLE = os.environ['DASHBOARD_SNAPSHOTS_TABLE']
+SNAPSHOT_STALE_AFTER_MINUTES = int(os.environ.get('SNAPSHOT_STALE_AFTER_MINUTES', 60))
+
+DOCUMENTATION = '''
+## Dashboard snapshot
+
+Renders the precomputed results of a dashboard query, refreshed by the refreshDashboardSnapshots function, over the
+time range of the dashboard at day granularity.
+
+```
+{"snapshot": "Section-JobQueue"}
+```
+'''
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+
+    return f'{value:,}' if isinstance(value, int) else f'{value:,.2f}'
+
+
+def format_age(age_ms):
+    minutes = int(age_ms // 60000)
+
+    if minutes < 60:
+        return f'{minutes} minutes'
+
+    if minutes < 48 * 60:
+        return f'{minutes // 60} hours'
+
+    return f'{minutes // (24 * 60)} days'
+
+
+def render_status(state, now_ms):
+    refreshed_at = datetime.datetime.fromtimestamp(state['RefreshedAt'] / 1000, datetime.timezone.utc)
+    age_ms = now_ms - state['RefreshedAt']
+    status = f'Refreshed {format_age(age_ms)} ago ({refreshed_at:%Y-%m-%d %H:%M} UTC).'
+
+    if age_ms > SNAPSHOT_STALE_AFTER_MINUTES * 60000:
+        status = f'<b>Stale:</b> {status} Check the logs of the refreshDashboardSnapshots function.'
+
+    return f'<p><small>{status} Days are included whole.</small></p>'
+
+
+def render_table(snapshot, rows):
+    # Values are listed from the most common, with their share of the jobs
+    metric_names = list(snapshot['Metrics'])
+    total = sum(metrics[metric_names[0]] or 0 for _, metrics in rows)
+    rows = sorted(rows, key=lambda row: row[1][metric_names[0]] or 0, reverse=True)
+
+    header = ''.join(f'<th>{html.escape(name)}</th>' for name in [snapshot['Dimension']] + metric_names + ['Share'])
+    body = ''.join(
+        '<tr>' +
+        f'<td>{html.escape(str(value)) or "-"}</td>' +
+        ''.join(f'<td>{format_value(metrics[name])}</td>' for name in metric_names) +
+        f'<td>{format_value((metrics[metric_names[0]] or 0) / total * 100 if total else None)}%</td>' +
+        '</tr>'
+        for value, metrics in rows
+    )
+
+    return f'<table><thead><tr>{header}</tr></thead><tbody>{body}</tbody></table>'
+
+
+@instrumentation.instrument_handler('renderDashboardSnapshot')
+def handler(event, context):
+    if event.get('describe'):
+        return DOCUMENTATION
+
+    now_ms = int(time.time() * 1000)
+    time_range = event.get('widgetContext', {}).get('timeRange', {})
+    start_ms = time_range.get('start', now_ms - 365 * 24 * 60 * 60 * 1000)
+    end_ms = time_range.get('end', now_ms)
+
+    store = SnapshotStore(runtime.client('dynamodb'), DASHBOARD_SNAPSHOTS_TABLE)
+
+    with instrumentation.span('ReadSnapshotState'):
+        state = store.read_state(event['snapshot'])
+
+    if state is None:
+        return '<p>This snapshot hasn\'t been refreshed yet, it will show up after the next run of the ' \
+               'refreshDashboardSnapshots function.</p>'
+
+    snapshot = state['Definition']
+
+    with instrumentation.span('ReadSnapshotDays'):
+        merged = merge_days(store.read_days(snapshot['Id'], start_ms, end_ms), len(snapshot['Partials']))
+
+    rows = [(value, compute_metrics(partials, snapshot)) for value, partials in merged.items()]
+
+    if not rows:
+        return render_status(state, now_ms) + '<p>No jobs were logged in this time range.</p>'
+
+    return render_status(state, now_ms) + render_table(snapshot, rows)
@@ -0,0 +1,4 @@
+"""
+@Description: code shared by the Batch Insights Lambda functions. It is deployed as a Lambda layer, so the package is
+importable from every function that has the layer attached.
+"""
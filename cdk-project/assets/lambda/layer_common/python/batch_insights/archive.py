@@ -0,0 +1,363 @@
+"""
+@Description: columnar archive of completed job records. Records are written as compressed Parquet files partitioned by
+completion date and job queue:
+
+<prefix>/date=YYYY-MM-DD/queue=<JobQueue>/<part>.parquet
+
+so that reading a date range for one queue only touches the files of those partitions. Files are stored through a
+backend, either S3 or the local filesystem, which streams them as their row groups are written: S3 files are uploaded in
+parts, so only the part being filled is kept in memory. pyarrow is imported lazily, as only the functions that use the
+archive need it.
+"""
+
+import datetime
+import io
+import os
+import urllib.parse
+import uuid
+
+
+DEFAULT_PREFIX = 'jobs'
+DEFAULT_ROW_GROUP_SIZE = 128 * 1024
+DEFAULT_COMPRESSION = 'zstd'
+
+# Every part of a multipart upload but the last must be at least 5 MiB
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# (field, pyarrow type name). Fields missing in a record are stored as nulls and unknown fields are dropped
+ARCHIVE_SCHEMA = [
+    ('JobId', 'string'),
+    ('JobName', 'string'),
+    ('JobQueue', 'string'),
+    ('JobDefinition', 'string'),
+    ('Status', 'string'),
+    ('InstanceId', 'string'),
+    ('InstanceType', 'string'),
+    ('AvailabilityZone', 'string'),
+    ('Architecture', 'string'),
+    ('ContainerInstanceArn', 'string'),
+    ('SubmittedAt', 'int64'),
+    ('PendingAt', 'int64'),
+    ('RunnableAt', 'int64'),
+    ('StartingAt', 'int64'),
+    ('RunningAt', 'int64'),
+    ('StoppedAt', 'int64'),
+    ('TotalSubmittedSeconds', 'int64'),
+    ('TotalPendingSeconds', 'int64'),
+    ('TotalRunnableSeconds', 'int64'),
+    ('TotalStartingSeconds', 'int64'),
+    ('TotalRunningSeconds', 'int64'),
+    ('ArraySize', 'int64'),
+    ('ChildJobs', 'int64'),
+    ('ChildSucceeded', 'int64'),
+    ('ChildFailed', 'int64'),
+    ('ChildSuccessRate', 'float64'),
+    ('ChildMinQueuedSeconds', 'float64'),
+    ('ChildP50QueuedSeconds', 'float64'),
+    ('ChildP90QueuedSeconds', 'float64'),
+    ('ChildP99QueuedSeconds', 'float64'),
+    ('ChildMaxQueuedSeconds', 'float64'),
+    ('ChildMinRunningSeconds', 'float64'),
+    ('ChildP50RunningSeconds', 'float64'),
+    ('ChildP90RunningSeconds', 'float64'),
+    ('ChildP99RunningSeconds', 'float64'),
+    ('ChildMaxRunningSeconds', 'float64'),
+    ('Timestamp', 'int64')
+]
+
+
+def _pyarrow():
+    import pyarrow
+    import pyarrow.parquet
+
+    return pyarrow
+
+
+def build_schema():
+    pa = _pyarrow()
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in ARCHIVE_SCHEMA])
+
+
+class _LocalFile(io.FileIO):
+    def abort(self):
+        self.close()
+        os.remove(self.name)
+
+
+class LocalBackend:
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, key):
+        """
+        Returns a writable file that is stored under the key as it is written, and dropped by its abort method.
+        """
+
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        return _LocalFile(path, 'wb')
+
+    def write(self, key, data):
+        with self.open(key) as f:
+            f.write(data)
+
+    def read(self, key):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        os.remove(os.path.join(self.root, key))
+
+    def list(self, prefix):
+        base = os.path.join(self.root, prefix)
+
+        if not os.path.isdir(base):
+            return []
+
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+            for directory, _, names in os.walk(base) for name in names if name.endswith('.parquet')
+        )
+
+
+class _MultipartUpload(io.RawIOBase):
+    """
+    Writable file uploaded to S3 in parts of part_size bytes as it is written. Files smaller than a part are uploaded
+    with a single PutObject when they are closed.
+    """
+
+    def __init__(self, client, bucket, key, part_size):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+
+        while len(self._buffer) >= self.part_size:
+            self.__upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+        return len(data)
+
+    def __upload_part(self, data):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                           PartNumber=part_number, Body=data)
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self._upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+        else:
+            if self._buffer:
+                self.__upload_part(bytes(self._buffer))
+
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                  MultipartUpload={'Parts': self._parts})
+
+        self._buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        # The parts of an upload that is never completed are billed until it is aborted
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+        self._buffer = bytearray()
+        super().close()
+
+
+class S3Backend:
+    def __init__(self, client, bucket, part_size=MULTIPART_PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.part_size = part_size
+
+    def open(self, key):
+        """
+        Returns a writable file that is uploaded under the key as it is written, and dropped by its abort method.
+        """
+
+        return _MultipartUpload(self.client, self.bucket, key, self.part_size)
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, prefix):
+        keys = []
+
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith('.parquet'))
+
+        return sorted(keys)
+
+
+def partition_date(timestamp_ms):
+    return datetime.datetime.fromtimestamp(timestamp_ms / 1000, datetime.timezone.utc).strftime('%Y-%m-%d')
+
+
+def partition_prefix(date, queue=None, prefix=DEFAULT_PREFIX):
+    path = f'{prefix}/date={date}/'
+
+    if queue is not None:
+        path += f'queue={urllib.parse.quote(queue, safe="")}/'
+
+    return path
+
+
+class ArchiveWriter:
+    def __init__(self, backend, prefix=DEFAULT_PREFIX, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 compression=DEFAULT_COMPRESSION):
+        self.backend = backend
+        self.prefix = prefix
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def __write_row_group(self, parquet_writer, pending, schema):
+        pa = _pyarrow()
+        pending.sort(key=lambda r: r['Timestamp'])
+
+        parquet_writer.write_table(
+            pa.Table.from_pydict(
+                {name: [record.get(name) for record in pending] for name in schema.names}, schema=schema
+            ),
+            row_group_size=self.row_group_size
+        )
+
+        pending.clear()
+
+    def write(self, records, part_name=None):
+        """
+        Writes job records, which must contain their completion time in the Timestamp field (milliseconds since
+        epoch). Records can be any iterable: they are buffered per partition until a row group is complete, which is
+        then streamed to the file of the partition, so memory only grows with the number of partitions. One file is
+        written per partition, named after part_name, so that writing the same records with the same part name again
+        overwrites the files instead of duplicating them. When the records can't all be written, the files that were
+        not completed are dropped. Returns the keys of the written files.
+        """
+
+        pa = _pyarrow()
+        schema = build_schema()
+        part_name = part_name or uuid.uuid4().hex
+
+        # {(date, queue): (file, parquet writer, pending records)}
+        partitions = {}
+
+        try:
+            for record in records:
+                key = (partition_date(record['Timestamp']), record['JobQueue'])
+
+                if key not in partitions:
+                    f = self.backend.open(f'{partition_prefix(*key, self.prefix)}{part_name}.parquet')
+                    partitions[key] = (f, pa.parquet.ParquetWriter(f, schema, compression=self.compression), [])
+
+                _, parquet_writer, pending = partitions[key]
+                pending.append(record)
+
+                if len(pending) >= self.row_group_size:
+                    self.__write_row_group(parquet_writer, pending, schema)
+
+            for f, parquet_writer, pending in partitions.values():
+                if pending:
+                    self.__write_row_group(parquet_writer, pending, schema)
+
+                parquet_writer.close()
+                f.close()
+        except Exception:
+            for f, parquet_writer, _ in partitions.values():
+                if not f.closed:
+                    # The Parquet writer is closed first, or it writes its footer to the aborted file when collected
+                    try:
+                        parquet_writer.close()
+                    except Exception:
+                        pass
+
+                    f.abort()
+
+            raise
+
+        return [f'{partition_prefix(*key, self.prefix)}{part_name}.parquet' for key in sorted(partitions)]
+
+    def compact(self, date, queue, part_name='compacted'):
+        """
+        Merges all the files of a partition into a single file with full row groups.
+        """
+
+        pa = _pyarrow()
+        keys = self.backend.list(partition_prefix(date, queue, self.prefix))
+        target = f'{partition_prefix(date, queue, self.prefix)}{part_name}.parquet'
+
+        if len(keys) <= 1:
+            return keys
+
+        table = pa.concat_tables([read_file(self.backend, key) for key in keys]).sort_by('Timestamp')
+        buffer = io.BytesIO()
+        pa.parquet.write_table(table, buffer, row_group_size=self.row_group_size, compression=self.compression)
+        self.backend.write(target, buffer.getvalue())
+
+        for key in keys:
+            if key != target:
+                self.backend.delete(key)
+
+        return [target]
+
+
+def read_file(backend, key, columns=None):
+    pa = _pyarrow()
+    return pa.parquet.read_table(pa.BufferReader(backend.read(key)), columns=columns, schema=build_schema())
+
+
+def list_files(backend, start_date, end_date, queues=None, prefix=DEFAULT_PREFIX):
+    """
+    Lists the files of the partitions between two dates (both included, as datetime.date objects), optionally
+    restricted to some job queues. Only the prefixes of the selected partitions are listed.
+    """
+
+    keys = []
+    date = start_date
+
+    while date <= end_date:
+        for queue in (queues or [None]):
+            keys.extend(backend.list(partition_prefix(date.isoformat(), queue, prefix)))
+
+        date += datetime.timedelta(days=1)
+
+    return keys
+
+
+def read_partitions(backend, start_date, end_date, queues=None, columns=None, prefix=DEFAULT_PREFIX):
+    pa = _pyarrow()
+    keys = list_files(backend, start_date, end_date, queues, prefix)
+
+    if not keys:
+        return build_schema().empty_table() if columns is None else build_schema().empty_table().select(columns)
+
+    return pa.concat_tables([read_file(backend, key, columns) for key in keys])
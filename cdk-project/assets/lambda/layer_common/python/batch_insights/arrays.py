@@ -0,0 +1,291 @@
+"""
+@Description: aggregation of the children of AWS Batch array jobs. AWS Batch splits an array job into as many child
+jobs as its size, with IDs <parent ID>:<index>. Instead of tracking and logging every child, their completions are
+folded into the tracking item of the parent: the number of children that succeeded and failed, sketches of how long
+they were queued and running, and the number of children started on each instance type. When the parent completes,
+the aggregate is logged as part of its record:
+
+{"JobId": "...", "ArraySize": 1000, "ChildJobs": 1000, "ChildSucceeded": 990, "ChildFailed": 10,
+"ChildSuccessRate": 99.0, "ChildMinRunningSeconds": 58.9, "ChildP50RunningSeconds": 121.4, ...,
+"ChildInstanceTypes": {"c5.xlarge": 600, "m5.2xlarge": 400}}
+
+so the writes and the logged records grow with the number of parents rather than children. Like the duration sketches,
+every counter is a top level attribute updated with atomic ADD operations, and the percentiles, minimum and maximum
+durations are estimated within the relative accuracy of the sketch.
+"""
+
+import threading
+import traceback
+
+from . import jobs
+from .runtime import deserialize_item
+from .sketches import DDSketch, DEFAULT_RELATIVE_ACCURACY, MAX_OPERANDS_PER_UPDATE, MIN_INDEXABLE_VALUE, ZERO_BIN
+
+
+CHILD_COUNT_ATTRIBUTES = {'SUCCEEDED': 'ChildSucceeded', 'FAILED': 'ChildFailed'}
+
+# Attribute name prefix of the bins of each child duration, by the name used in the logged fields
+CHILD_DURATION_PREFIXES = {'Queued': 'cq#', 'Running': 'cr#'}
+INSTANCE_TYPE_PREFIX = 'ci#'
+
+# Number set of the indices of the children already counted
+CHILD_INDICES_ATTRIBUTE = 'ChildIndices'
+
+# Every child adds a condition to the update of its parent, and condition expressions are limited to 4 KB
+MAX_CHILDREN_PER_UPDATE = 25
+
+# Logged estimates of every child duration, e.g. ChildP90RunningSeconds
+SUMMARY_QUANTILES = {'Min': 0, 'P50': 0.5, 'P90': 0.9, 'P99': 0.99, 'Max': 1}
+
+
+def parent_job_id(job_id):
+    """
+    Returns the ID of the array job a child belongs to, or None when the job is not an array child.
+    """
+
+    parent_id, separator, index = job_id.rpartition(':')
+
+    return parent_id if separator and index.isdigit() else None
+
+
+def array_size(detail):
+    # Parents carry the size of the array, children their index in it
+    return detail.get('arrayProperties', {}).get('size')
+
+
+def child_durations(detail):
+    """
+    Returns the seconds a child waited from its creation until it started (Queued) and spent running (Running). Only
+    the completion event is needed, so children don't have to be tracked to be summarised.
+    """
+
+    durations = {}
+
+    if 'startedAt' in detail and 'createdAt' in detail:
+        durations['Queued'] = max(detail['startedAt'] - detail['createdAt'], 0) / 1000
+
+    if 'startedAt' in detail and 'stoppedAt' in detail:
+        durations['Running'] = max(detail['stoppedAt'] - detail['startedAt'], 0) / 1000
+
+    return durations
+
+
+class ChildAggregator:
+    """
+    Buffers what children add to the tracking items of their parents until flush is called, so the children of a
+    parent that are processed together cost a single write.
+
+    EventBridge may deliver a completion more than once, so the indices of the children already counted are kept in a
+    number set of the parent, and every update is conditioned on none of its children being in it. Instance types are
+    counted per task started and are not deduplicated. Children can be recorded from several threads, but flush must
+    only be called once they are done.
+    """
+
+    def __init__(self, client, table_name, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.client = client
+        self.table_name = table_name
+
+        # {parent ID: ({child index: {attribute name: count}}, {attribute name: count})}
+        self._pending = {}
+        self._sketch = DDSketch(relative_accuracy)
+        self._lock = threading.Lock()
+
+    def __parent(self, job_id):
+        return self._pending.setdefault(parent_job_id(job_id), ({}, {}))
+
+    def record_completion(self, detail):
+        index = int(detail['jobId'].rpartition(':')[2])
+        counts = {CHILD_COUNT_ATTRIBUTES[detail['status']]: 1}
+
+        for duration, value in child_durations(detail).items():
+            key = ZERO_BIN if value < MIN_INDEXABLE_VALUE else str(self._sketch.key(value))
+            counts[CHILD_DURATION_PREFIXES[duration] + key] = 1
+
+        with self._lock:
+            # Duplicates within the same batch are dropped here, the rest when the parent is updated
+            self.__parent(detail['jobId'])[0].setdefault(index, counts)
+
+    def record_instance_type(self, job_id, instance_type):
+        name = INSTANCE_TYPE_PREFIX + instance_type
+
+        with self._lock:
+            _, counts = self.__parent(job_id)
+            counts[name] = counts.get(name, 0) + 1
+
+    def merge_into(self, parent_id, tracking_data):
+        """
+        Folds the buffered children of a parent into its popped tracking data, so that a parent completing in the same
+        batch as its last children logs them without writing them first.
+        """
+
+        with self._lock:
+            children, counts = self._pending.pop(parent_id, ({}, {}))
+
+        counted = tracking_data.setdefault(CHILD_INDICES_ATTRIBUTE, set())
+
+        for index, child_counts in children.items():
+            if index not in counted:
+                counted.add(index)
+                _merge_counts(tracking_data, child_counts)
+
+        _merge_counts(tracking_data, counts)
+
+        if not counted:
+            tracking_data.pop(CHILD_INDICES_ATTRIBUTE)
+
+    def flush(self):
+        """
+        Adds the buffered counts to the tracking items of the parents. Parents that are no longer tracked, or replaced
+        by their tombstone, have already been logged, and the counts of their late children are dropped rather than
+        creating an item that would never be logged. Returns the IDs of the parents whose counts could not be written.
+        """
+
+        pending, self._pending = self._pending, {}
+        failed_parent_ids = set()
+
+        for parent_id, (children, counts) in pending.items():
+            try:
+                tracked = self.__add_children(parent_id, children) and self.__add_counts(parent_id, counts)
+            except Exception:
+                traceback.print_exc()
+                failed_parent_ids.add(parent_id)
+                continue
+
+            if not tracked:
+                print(f'Array job {parent_id} is no longer tracked, the counts of its children are dropped')
+
+        return failed_parent_ids
+
+    def __add_children(self, parent_id, children):
+        indices = sorted(children)
+
+        for i in range(0, len(indices), MAX_CHILDREN_PER_UPDATE):
+            remaining = {index: children[index] for index in indices[i:i + MAX_CHILDREN_PER_UPDATE]}
+
+            while remaining:
+                counts = {}
+
+                for child_counts in remaining.values():
+                    _merge_counts(counts, child_counts)
+
+                try:
+                    self.__update(parent_id, counts, set(remaining))
+                    break
+                except self.client.exceptions.ConditionalCheckFailedException:
+                    pass
+
+                # Either the parent is gone or some children were already counted, which are left out of the retry
+                item = self.client.get_item(
+                    TableName=self.table_name,
+                    Key={'JobId': {'S': parent_id}},
+                    ProjectionExpression='JobId, #i, #c',
+                    ExpressionAttributeNames={'#i': CHILD_INDICES_ATTRIBUTE, '#c': jobs.COMPLETED_STATUS_ATTRIBUTE},
+                    ConsistentRead=True
+                ).get('Item')
+
+                if item is None or jobs.COMPLETED_STATUS_ATTRIBUTE in item:
+                    return False
+
+                counted = deserialize_item(item).get(CHILD_INDICES_ATTRIBUTE, set())
+                remaining = {index: c for index, c in remaining.items() if index not in counted}
+
+        return True
+
+    def __add_counts(self, parent_id, counts):
+        items = list(counts.items())
+
+        try:
+            for i in range(0, len(items), MAX_OPERANDS_PER_UPDATE):
+                self.__update(parent_id, dict(items[i:i + MAX_OPERANDS_PER_UPDATE]))
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    def __update(self, parent_id, counts, indices=None):
+        names = {f'#a{j}': name for j, name in enumerate(counts)}
+        values = {f':c{j}': {'N': str(count)} for j, count in enumerate(counts.values())}
+        actions = [f'#a{j} :c{j}' for j in range(len(counts))]
+        names['#c'] = jobs.COMPLETED_STATUS_ATTRIBUTE
+        conditions = ['attribute_exists(JobId)', 'attribute_not_exists(#c)']
+
+        if indices:
+            names['#i'] = CHILD_INDICES_ATTRIBUTE
+            values[':i'] = {'NS': [str(index) for index in indices]}
+            actions.append('#i :i')
+
+            for j, index in enumerate(indices):
+                values[f':i{j}'] = {'N': str(index)}
+                conditions.append(f'NOT contains(#i, :i{j})')
+
+        # Child counts postpone the expiration of the parent like its own transitions
+        names['#e'] = jobs.EXPIRES_AT_ATTRIBUTE
+        values[':e'] = {'N': str(jobs.expiration())}
+
+        self.client.update_item(
+            TableName=self.table_name,
+            Key={'JobId': {'S': parent_id}},
+            UpdateExpression=f'ADD {", ".join(actions)} SET #e = :e',
+            ConditionExpression=' AND '.join(conditions),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+
+
+def _merge_counts(target, counts):
+    for name, count in counts.items():
+        target[name] = target.get(name, 0) + count
+
+
+def summarize_array(detail, tracking_data, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+    """
+    Removes the aggregated children from the tracking data of a parent and returns the fields of its summary. Jobs that
+    are not array parents return an empty dictionary.
+    """
+
+    summary = {}
+    size = array_size(detail)
+
+    if size is not None:
+        summary['ArraySize'] = size
+
+    tracking_data.pop(CHILD_INDICES_ATTRIBUTE, None)
+    counts = {status: int(tracking_data.pop(name, 0)) for status, name in CHILD_COUNT_ATTRIBUTES.items()}
+    sketches = {duration: DDSketch(relative_accuracy) for duration in CHILD_DURATION_PREFIXES}
+    instance_types = {}
+
+    for name in [name for name in tracking_data if '#' in name]:
+        for duration, prefix in CHILD_DURATION_PREFIXES.items():
+            if name.startswith(prefix):
+                count = int(tracking_data.pop(name))
+
+                if name[len(prefix):] == ZERO_BIN:
+                    sketches[duration].zero_count += count
+                    sketches[duration].count += count
+                else:
+                    sketches[duration].add_bin(int(name[len(prefix):]), count)
+
+                break
+        else:
+            if name.startswith(INSTANCE_TYPE_PREFIX):
+                instance_types[name[len(INSTANCE_TYPE_PREFIX):]] = int(tracking_data.pop(name))
+
+    child_jobs = sum(counts.values())
+
+    if child_jobs:
+        summary.update({
+            'ChildJobs': child_jobs,
+            'ChildSucceeded': counts['SUCCEEDED'],
+            'ChildFailed': counts['FAILED'],
+            'ChildSuccessRate': round(counts['SUCCEEDED'] / child_jobs * 100, 2)
+        })
+
+    for duration, sketch in sketches.items():
+        if sketch.count:
+            for label, q in SUMMARY_QUANTILES.items():
+                summary[f'Child{label}{duration}Seconds'] = round(sketch.quantile(q), 3)
+
+    if instance_types:
+        summary['ChildInstanceTypes'] = instance_types
+
+    return summary
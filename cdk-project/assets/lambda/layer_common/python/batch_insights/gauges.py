@@ -0,0 +1,164 @@
+"""
+@Description: live counters of the jobs in each status of every job queue. When a job moves forward in its timeline, the
+counter of its previous status is decremented and the one of its new status incremented, and completed jobs leave the
+counter of their last status. The counters of a job queue are split across shards, one DynamoDB item per shard:
+
+{"Gauge": "<job queue>#<shard>", "RUNNABLE": 12, "RUNNING": 40, ...}
+
+A job always updates the same shard, chosen from its ID, so that every move is a single atomic update and a busy job
+queue spreads its writes across as many partitions as it has shards. The gauge of a status is the sum of its counters
+over all the shards of the job queue.
+
+Jobs are counted from the first transition tracked with their job queue, in the JobQueue attribute of their tracking
+item, so that the jobs tracked before the gauges were enabled are never taken out of them. Counters are best effort:
+moves are buffered in memory and written once per invocation, and the moves that can't be written are dropped, as
+replaying the events wouldn't move the jobs again.
+"""
+
+import threading
+import time
+import zlib
+
+from . import jobs
+from .runtime import deserialize_item
+
+
+GAUGE_STATUSES = jobs.TIMELINE_STATUSES
+JOB_QUEUE_ATTRIBUTE = 'JobQueue'
+DEFAULT_SHARDS = 10
+
+BATCH_GET_ITEM_MAX_KEYS = 100
+BATCH_GET_ITEM_MAX_RETRIES = 5
+
+
+def gauge_key(job_queue, shard):
+    return f'{job_queue}#{shard}'
+
+
+def job_shard(job_id, shards):
+    # A stable hash, as the shard of a job must be the same in every execution environment
+    return zlib.crc32(job_id.encode('utf-8')) % shards
+
+
+def latest_status(statuses):
+    """
+    Returns the status of a job from the statuses it has gone through, which is the latest of them in the timeline, or
+    None when it hasn't gone through any.
+    """
+
+    indices = [GAUGE_STATUSES.index(status) for status in statuses if status in GAUGE_STATUSES]
+
+    return GAUGE_STATUSES[max(indices)] if indices else None
+
+
+def tracked_status(tracking_data):
+    # Tracking items hold the time of every status the job has gone through
+    return latest_status(tracking_data)
+
+
+def is_counted(tracking_data):
+    return JOB_QUEUE_ATTRIBUTE in tracking_data
+
+
+def transition(old_tracking_data, status):
+    """
+    Returns the (from, to) statuses a transition moves a job between, given its tracking item before the transition,
+    or None when the job doesn't move: the status was already tracked, or the job had already gone past it. Jobs that
+    weren't counted yet move from None.
+    """
+
+    if status in old_tracking_data:
+        return None
+
+    old_status = tracked_status(old_tracking_data)
+
+    if old_status is not None and GAUGE_STATUSES.index(old_status) > GAUGE_STATUSES.index(status):
+        return None
+
+    return old_status if is_counted(old_tracking_data) else None, status
+
+
+class StateGauges:
+    """
+    Buffers the moves of jobs between statuses until flush is called, so the jobs of a queue that are processed
+    together cost one write per shard. Moves can be recorded from several threads.
+    """
+
+    def __init__(self, client, table_name, shards=DEFAULT_SHARDS):
+        self.client = client
+        self.table_name = table_name
+        self.shards = shards
+
+        # {gauge key: {status: delta}}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def move(self, job_queue, job_id, from_status, to_status):
+        """
+        Moves a job from one status to another. Either status may be None, for jobs that weren't counted yet and for
+        jobs that completed.
+        """
+
+        if from_status == to_status:
+            return
+
+        key = gauge_key(job_queue, job_shard(job_id, self.shards))
+
+        with self._lock:
+            deltas = self._pending.setdefault(key, {})
+
+            for status, delta in [(from_status, -1), (to_status, 1)]:
+                if status is not None:
+                    deltas[status] = deltas.get(status, 0) + delta
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+
+        for key, deltas in pending.items():
+            deltas = [(status, delta) for status, delta in deltas.items() if delta]
+
+            if not deltas:
+                continue
+
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'Gauge': {'S': key}},
+                UpdateExpression='ADD ' + ', '.join(f'#s{j} :d{j}' for j in range(len(deltas))),
+                ExpressionAttributeNames={f'#s{j}': status for j, (status, _) in enumerate(deltas)},
+                ExpressionAttributeValues={f':d{j}': {'N': str(delta)} for j, (_, delta) in enumerate(deltas)}
+            )
+
+
+def read_gauges(client, table_name, job_queues, shards=DEFAULT_SHARDS):
+    """
+    Reads the counters of every shard of the given job queues with BatchGetItem, and returns the number of jobs in each
+    status by job queue. Job queues without any counter report zero jobs in every status.
+    """
+
+    gauges = {job_queue: dict.fromkeys(GAUGE_STATUSES, 0) for job_queue in job_queues}
+    keys = [{'Gauge': {'S': gauge_key(job_queue, shard)}} for job_queue in job_queues for shard in range(shards)]
+
+    for i in range(0, len(keys), BATCH_GET_ITEM_MAX_KEYS):
+        request_items = {table_name: {'Keys': keys[i:i + BATCH_GET_ITEM_MAX_KEYS]}}
+        attempt = 0
+
+        while request_items:
+            response = client.batch_get_item(RequestItems=request_items)
+
+            for item in response['Responses'].get(table_name, []):
+                item = deserialize_item(item)
+                counts = gauges[item.pop('Gauge').rpartition('#')[0]]
+
+                for status in GAUGE_STATUSES:
+                    counts[status] += int(item.get(status, 0))
+
+            request_items = response.get('UnprocessedKeys')
+
+            if request_items:
+                if attempt >= BATCH_GET_ITEM_MAX_RETRIES:
+                    raise RuntimeError(f'Could not read {len(request_items[table_name]["Keys"])} gauge shards')
+
+                time.sleep(0.05 * 2 ** attempt)
+                attempt += 1
+
+    return gauges
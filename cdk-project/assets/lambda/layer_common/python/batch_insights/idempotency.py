@@ -0,0 +1,215 @@
+"""
+@Description: idempotent processing of events delivered at least once. EventBridge and SQS may deliver an event more
+than once, and AWS Batch and Amazon ECS may emit events that repeat one already processed, so every event is given a
+key that identifies what it means (e.g. job#<job ID>#SUCCEEDED) and is only processed by the first invocation that
+claims its key.
+
+Keys are claimed at two levels, before any other I/O:
+
+- A window of the keys processed by the execution environment, kept in memory across warm invocations. Duplicates that
+  reach the same environment, like the copies of an event in an SQS batch, are dropped without any request.
+- Optionally, a DynamoDB ledger shared by all the environments. Keys are claimed with conditional writes, as IN_PROGRESS
+  with a lease, and marked COMPLETED once the event has been processed or deleted if it failed, so that its retries can
+  claim it again. The claims of an invocation that crashed are taken over once their lease expires. Ledger items expire
+  with the ExpiresAt attribute after the time EventBridge keeps retrying an event.
+
+Claims report every key as CLAIMED, COMPLETED (a duplicate, to be dropped) or IN_PROGRESS (being processed by another
+invocation, to be retried later).
+"""
+
+import time
+import traceback
+
+from .cache import TTLCache
+
+
+CLAIMED = 'CLAIMED'
+COMPLETED = 'COMPLETED'
+IN_PROGRESS = 'IN_PROGRESS'
+
+DEFAULT_WINDOW_SIZE = 10000
+DEFAULT_WINDOW_SECONDS = 3600
+DEFAULT_LEASE_SECONDS = 120
+DEFAULT_TTL_SECONDS = 48 * 60 * 60
+
+TRANSACT_WRITE_MAX_ITEMS = 100
+BATCH_WRITE_MAX_ITEMS = 25
+MAX_RETRIES = 5
+
+
+def create_window(max_size=DEFAULT_WINDOW_SIZE, window_seconds=DEFAULT_WINDOW_SECONDS):
+    # Created at module level by the handlers, so that it survives across warm invocations
+    return TTLCache(max_size, window_seconds)
+
+
+def event_id_key(event):
+    # EventBridge gives the copies of a delivered event the same ID
+    return f'event#{event["id"]}' if event.get('id') else None
+
+
+class EventLedger:
+    def __init__(self, client, table_name, window, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 ttl_seconds=DEFAULT_TTL_SECONDS):
+        """
+        Without a table name, keys are only claimed in the window of the execution environment.
+        """
+
+        self.client = client
+        self.table_name = table_name
+        self.window = window
+        self.lease_seconds = lease_seconds
+        self.ttl_seconds = ttl_seconds
+
+    def claim(self, keys):
+        """
+        Claims the given keys and returns the outcome of each one. A key given several times has a single outcome, for
+        its first occurrence. When the ledger can't be reached, the remaining keys are only claimed in the window, so
+        that their events are processed like they would be without a ledger.
+        """
+
+        outcomes = {}
+
+        for key in keys:
+            if key not in outcomes:
+                outcomes[key] = COMPLETED if key in self.window else CLAIMED
+
+        candidates = [key for key, outcome in outcomes.items() if outcome == CLAIMED]
+
+        if self.table_name:
+            try:
+                for i in range(0, len(candidates), TRANSACT_WRITE_MAX_ITEMS):
+                    chunk = candidates[i:i + TRANSACT_WRITE_MAX_ITEMS]
+
+                    if len(chunk) == 1:
+                        outcomes.update(self.__claim_one(chunk[0]))
+                    else:
+                        outcomes.update(self.__claim_many(chunk))
+            except Exception:
+                traceback.print_exc()
+
+        return outcomes
+
+    def complete(self, keys):
+        """
+        Records the keys whose events have been processed. Failures are not propagated, as the events have already
+        been processed: their claims are then taken over once their lease expires, like the claims of a crashed
+        invocation.
+        """
+
+        keys = list(dict.fromkeys(keys))
+
+        for key in keys:
+            self.window.put(key, True)
+
+        if self.table_name and keys:
+            expires_at = self.__now() + self.ttl_seconds
+            self.__write([
+                {'PutRequest': {'Item': {
+                    'EventKey': {'S': key},
+                    'Status': {'S': COMPLETED},
+                    'ExpiresAt': {'N': str(expires_at)}
+                }}}
+                for key in keys
+            ])
+
+    def release(self, keys):
+        """
+        Deletes the claims of the keys whose events failed, so that their retries can claim them again.
+        """
+
+        keys = list(dict.fromkeys(keys))
+
+        if self.table_name and keys:
+            self.__write([{'DeleteRequest': {'Key': {'EventKey': {'S': key}}}} for key in keys])
+
+    @staticmethod
+    def __now():
+        return int(time.time())
+
+    def __claim_request(self, key, now):
+        return {
+            'TableName': self.table_name,
+            'Item': {
+                'EventKey': {'S': key},
+                'Status': {'S': IN_PROGRESS},
+                'LeaseExpiresAt': {'N': str(now + self.lease_seconds)},
+                'ExpiresAt': {'N': str(now + self.ttl_seconds)}
+            },
+            'ConditionExpression': 'attribute_not_exists(EventKey) OR (#s = :p AND #l < :n)',
+            'ExpressionAttributeNames': {'#s': 'Status', '#l': 'LeaseExpiresAt'},
+            'ExpressionAttributeValues': {':p': {'S': IN_PROGRESS}, ':n': {'N': str(now)}},
+            'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+        }
+
+    @staticmethod
+    def __outcome(item):
+        # The key was claimed by another invocation, which has either processed its event or is still on it
+        return COMPLETED if item.get('Status', {}).get('S') == COMPLETED else IN_PROGRESS
+
+    def __claim_one(self, key):
+        try:
+            self.client.put_item(**self.__claim_request(key, self.__now()))
+        except self.client.exceptions.ConditionalCheckFailedException as e:
+            return {key: self.__outcome(e.response.get('Item', {}))}
+
+        return {key: CLAIMED}
+
+    def __claim_many(self, keys):
+        """
+        Claims up to TRANSACT_WRITE_MAX_ITEMS keys in a single transaction. A transaction fails as a whole when any of
+        its conditions does, so the keys claimed elsewhere are taken out and the rest are claimed again.
+        """
+
+        outcomes = {}
+        attempt = 0
+
+        while keys:
+            now = self.__now()
+
+            try:
+                self.client.transact_write_items(
+                    TransactItems=[{'Put': self.__claim_request(key, now)} for key in keys]
+                )
+            except self.client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get('CancellationReasons', [])
+                remaining = []
+
+                for key, reason in zip(keys, reasons):
+                    if reason.get('Code') == 'ConditionalCheckFailed':
+                        outcomes[key] = self.__outcome(reason.get('Item', {}))
+                    else:
+                        remaining.append(key)
+
+                # Transactions are also cancelled by conflicts with concurrent requests on the same keys
+                if len(remaining) == len(keys):
+                    if attempt >= MAX_RETRIES:
+                        raise
+
+                    time.sleep(0.05 * 2 ** attempt)
+                    attempt += 1
+
+                keys = remaining
+                continue
+
+            outcomes.update(dict.fromkeys(keys, CLAIMED))
+            break
+
+        return outcomes
+
+    def __write(self, requests):
+        try:
+            for i in range(0, len(requests), BATCH_WRITE_MAX_ITEMS):
+                request_items = {self.table_name: requests[i:i + BATCH_WRITE_MAX_ITEMS]}
+                attempt = 0
+
+                while request_items:
+                    request_items = self.client.batch_write_item(RequestItems=request_items).get('UnprocessedItems')
+
+                    if request_items:
+                        if attempt >= MAX_RETRIES:
+                            raise RuntimeError(f'Could not write {len(request_items[self.table_name])} ledger items')
+
+                        time.sleep(0.05 * 2 ** attempt)
+                        attempt += 1
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,272 @@
+"""
+@Description: per-invocation instrumentation of the Lambda functions. Handlers are wrapped with instrument_handler and
+their processing stages with span, and every AWS API call made through the runtime clients is timed automatically.
+Spans are aggregated in memory during the invocation, together with the number of API calls, retries and throttles,
+and published as a single record when the invocation ends:
+
+{"Handler": "processBatchEvents", "DurationMs": 41.2, "Spans": {"dynamodb.UpdateItem": {"Count": 3, "TotalMs": 12.4,
+"MaxMs": 5.1}, ...}, "ApiCalls": 4, "Retries": 0, "Throttles": 0}
+
+Handlers can attach other values to the record with annotate, like the statistics of their caches.
+
+The record is published to the sink selected by the INSTRUMENTATION_SINK environment variable: "stdout" (one JSON
+line), "emf" (CloudWatch metrics in the Embedded Metric Format) or "none" (default). When no sink is set, spans are
+no-ops that don't read the clock.
+"""
+
+import json
+import os
+import threading
+import time
+
+from . import metrics, runtime
+
+
+SINKS = {'none', 'stdout', 'emf'}
+
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+    'LimitExceededException'
+}
+
+# EMF documents are limited to 100 metrics, the slowest spans are published first
+MAX_EMF_SPANS = 90
+
+
+class StdoutSink:
+    def publish(self, record):
+        print(json.dumps(record))
+
+
+class EmfSink:
+    def __init__(self, namespace=metrics.NAMESPACE):
+        self.namespace = namespace
+
+    def publish(self, record):
+        emf_metrics = {
+            'DurationMs': (record['DurationMs'], 'Milliseconds'),
+            'ApiCalls': (record['ApiCalls'], 'Count'),
+            'Retries': (record['Retries'], 'Count'),
+            'Throttles': (record['Throttles'], 'Count')
+        }
+
+        spans = sorted(record['Spans'].items(), key=lambda span: span[1]['TotalMs'], reverse=True)
+
+        for name, span in spans[:MAX_EMF_SPANS]:
+            emf_metrics[f'{name}.Ms'] = (span['TotalMs'], 'Milliseconds')
+
+        # Spans and annotations are kept as properties of the log event
+        properties = {name: value for name, value in record.items() if name != 'Handler' and name not in emf_metrics}
+
+        metrics.emit(metrics.build_document(
+            emf_metrics, {'Handler': record['Handler']}, properties=properties, namespace=self.namespace
+        ))
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def publish(self, record):
+        self.records.append(record)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Invocation:
+    def __init__(self, handler_name):
+        self.handler_name = handler_name
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.counters = {'ApiCalls': 0, 'Retries': 0, 'Throttles': 0}
+        self.annotations = {}
+        self.lock = threading.Lock()
+
+    def add_span(self, name, duration_ms):
+        with self.lock:
+            span = self.spans.get(name)
+
+            if span is None:
+                self.spans[name] = {'Count': 1, 'TotalMs': duration_ms, 'MaxMs': duration_ms}
+            else:
+                span['Count'] += 1
+                span['TotalMs'] += duration_ms
+                span['MaxMs'] = max(span['MaxMs'], duration_ms)
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def record(self):
+        return dict(
+            {
+                'Handler': self.handler_name,
+                'DurationMs': round((time.perf_counter() - self.start) * 1000, 3),
+                'Spans': {
+                    name: {
+                        'Count': span['Count'],
+                        'TotalMs': round(span['TotalMs'], 3),
+                        'MaxMs': round(span['MaxMs'], 3)
+                    }
+                    for name, span in self.spans.items()
+                }
+            },
+            **self.counters,
+            **self.annotations
+        )
+
+
+class _Span:
+    __slots__ = ('invocation', 'name', 'start')
+
+    def __init__(self, invocation, name):
+        self.invocation = invocation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.invocation.add_span(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+_sink = None
+_invocation = None
+_hooks_registered = False
+
+
+def span(name):
+    """
+    Times a block of code as a span of the current invocation. Spans with the same name are aggregated.
+    """
+
+    invocation = _invocation
+
+    if invocation is None:
+        return _NOOP_SPAN
+
+    return _Span(invocation, name)
+
+
+def increment(counter, value=1):
+    invocation = _invocation
+
+    if invocation is not None:
+        invocation.increment(counter, value)
+
+
+def annotate(name, value):
+    """
+    Attaches a JSON serializable value to the record of the current invocation, replacing the previous one.
+    """
+
+    invocation = _invocation
+
+    if invocation is not None:
+        with invocation.lock:
+            invocation.annotations[name] = value
+
+
+def _before_call(model, context, **kwargs):
+    context['instrumentation_start'] = time.perf_counter()
+
+
+def _after_call(model, context, **kwargs):
+    invocation = _invocation
+
+    if invocation is not None and 'instrumentation_start' in context:
+        name = f'{model.service_model.endpoint_prefix}.{model.name}'
+        invocation.add_span(name, (time.perf_counter() - context['instrumentation_start']) * 1000)
+        invocation.increment('ApiCalls')
+
+
+def _needs_retry(response=None, attempts=None, **kwargs):
+    invocation = _invocation
+
+    if invocation is None or response is None:
+        return None
+
+    # Every attempt that got a response goes through this event, the ones after the first are retries
+    if attempts > 1:
+        invocation.increment('Retries')
+
+    if response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        invocation.increment('Throttles')
+
+    return None
+
+
+def set_sink(sink):
+    """
+    Enables the instrumentation with the given sink, or disables it with None.
+    """
+
+    global _sink, _hooks_registered
+
+    _sink = sink
+
+    if sink is not None and not _hooks_registered:
+        runtime.register_session_handler('before-call', _before_call)
+        runtime.register_session_handler('after-call', _after_call)
+        runtime.register_session_handler('needs-retry', _needs_retry)
+        _hooks_registered = True
+
+
+def sink_from_environment():
+    name = os.environ.get('INSTRUMENTATION_SINK', 'none').lower()
+
+    if name not in SINKS:
+        raise ValueError(f'Invalid INSTRUMENTATION_SINK "{name}", expected one of {sorted(SINKS)}')
+
+    if name == 'stdout':
+        return StdoutSink()
+    elif name == 'emf':
+        return EmfSink()
+
+    return None
+
+
+def instrument_handler(handler_name):
+    """
+    Decorator of Lambda handlers that publishes the instrumentation record of every invocation, including the failed
+    ones.
+    """
+
+    def decorator(handler):
+        def wrapper(event, context):
+            global _invocation
+
+            if _sink is None:
+                return handler(event, context)
+
+            _invocation = _Invocation(handler_name)
+
+            try:
+                return handler(event, context)
+            finally:
+                invocation, _invocation = _invocation, None
+
+                try:
+                    _sink.publish(invocation.record())
+                except Exception as e:
+                    print(f'Could not publish the instrumentation record: {e}')
+
+        wrapper.__wrapped__ = handler
+        return wrapper
+
+    return decorator
+
+
+set_sink(sink_from_environment())
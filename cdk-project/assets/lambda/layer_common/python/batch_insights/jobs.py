@@ -0,0 +1,136 @@
+"""
+@Description: records of completed AWS Batch jobs, as logged to the jobs log group. A record is built from the detail
+of a job, either received in a "Batch Job State Change" event or returned by the DescribeJobs API, joined with the data
+tracked in DynamoDB while the job was running: the time each status was reached and the container instance it ran on.
+
+Tracking items expire on their own after TRACKING_TTL_SECONDS without updates, through the ExpiresAt attribute, so that
+jobs whose completion is never received don't stay in the table forever. Once a job has been logged, its tracking item
+is replaced by a tombstone that expires after TOMBSTONE_TTL_SECONDS, so that the transitions that arrive after the
+completion (late, or replayed from a dead-letter queue) don't track the job again.
+"""
+
+import datetime
+import time
+
+
+COMPLETION_STATUSES = {'SUCCEEDED', 'FAILED'}
+STATUS_ORDER = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING', 'SUCCEEDED', 'FAILED']
+
+# Statuses a job goes through before completing, in order. The logged job includes the time each of them was reached
+# (e.g. RunnableAt) and the time spent in them (e.g. TotalRunnableSeconds)
+TIMELINE_STATUSES = STATUS_ORDER[:5]
+TRANSITION_STATUSES = set(TIMELINE_STATUSES)
+
+# Status of the jobs that are no longer tracked without having been seen completing
+ABANDONED_STATUS = 'ABANDONED'
+
+EXPIRES_AT_ATTRIBUTE = 'ExpiresAt'
+TRACKING_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Tombstones hold the status the job was logged with. They outlive the retries of EventBridge (24 hours) and the
+# messages of the dead-letter queues (4 days)
+COMPLETED_STATUS_ATTRIBUTE = 'CompletedStatus'
+TOMBSTONE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+DESCRIBE_JOBS_MAX_IDS = 100
+
+
+def parse_event_time(value):
+    # EventBridge event times are ISO 8601 strings in UTC with second precision
+    return int(datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()) * 1000
+
+
+def to_epoch_ms(value):
+    # Transitions tracked before they were stored as numbers are ISO 8601 strings
+    return parse_event_time(value) if isinstance(value, str) else int(value)
+
+
+def expiration(ttl_seconds=TRACKING_TTL_SECONDS, now=None):
+    """
+    Returns the value of the ExpiresAt attribute of a tracking item updated now. DynamoDB TTL expects epoch seconds.
+    """
+
+    return int(now if now is not None else time.time()) + ttl_seconds
+
+
+def tombstone(job_id, status):
+    """
+    Returns the tombstone item of a job logged with the given status, in the attribute value format.
+    """
+
+    return {
+        'JobId': {'S': job_id},
+        COMPLETED_STATUS_ATTRIBUTE: {'S': status},
+        EXPIRES_AT_ATTRIBUTE: {'N': str(expiration(TOMBSTONE_TTL_SECONDS))}
+    }
+
+
+def build_job(detail):
+    return {
+        'JobName': detail['jobName'],
+        'JobId': detail['jobId'],
+        'JobQueue': detail['jobQueue'].split('/')[-1],
+        'Status': detail['status'],
+        'JobDefinition': detail['jobDefinition'].split('/')[-1],
+    }
+
+
+def calculate_job_status_durations(detail, tracking_data):
+    """
+    Replaces the tracked transitions with the timeline of the job in epoch milliseconds and the seconds it spent in
+    each status. Transitions may be missing when events are lost or arrive out of order, in which case the durations
+    that depend on them are not reported.
+    """
+
+    tracking_data.pop(EXPIRES_AT_ATTRIBUTE, None)
+
+    timeline = {
+        status: to_epoch_ms(tracking_data.pop(status))
+        for status in TIMELINE_STATUSES if status in tracking_data
+    }
+
+    for status in TIMELINE_STATUSES:
+        if status in timeline:
+            tracking_data[f'{status.capitalize()}At'] = timeline[status]
+
+    if 'stoppedAt' in detail:
+        tracking_data['StoppedAt'] = detail['stoppedAt']
+
+    for status, next_status in zip(TIMELINE_STATUSES, TIMELINE_STATUSES[1:]):
+        if status in timeline and next_status in timeline:
+            tracking_data[f'Total{status.capitalize()}Seconds'] = (timeline[next_status] - timeline[status]) // 1000
+
+    # The RUNNING duration is reported by AWS Batch with millisecond precision
+    if 'startedAt' in detail and 'stoppedAt' in detail:
+        total_running_seconds = (detail['stoppedAt'] - detail['startedAt']) // 1000
+    else:
+        total_running_seconds = 0
+
+    tracking_data['TotalRunningSeconds'] = total_running_seconds
+
+
+def job_log_timestamp(detail):
+    # Jobs are logged at the time they completed, not at the time they were processed
+    if 'stoppedAt' in detail:
+        return detail['stoppedAt']
+
+    return int(time.time() * 1000)
+
+
+class BatchJobStatusSource:
+    """
+    Resolves the current detail of jobs with the DescribeJobs API of AWS Batch, which returns the same detail as the
+    job state change events. Jobs that AWS Batch no longer knows about are not returned.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def describe(self, job_ids):
+        details = {}
+
+        for i in range(0, len(job_ids), DESCRIBE_JOBS_MAX_IDS):
+            for detail in self.client.describe_jobs(jobs=job_ids[i:i + DESCRIBE_JOBS_MAX_IDS])['jobs']:
+                details[detail['jobId']] = detail
+
+        return details
@@ -0,0 +1,206 @@
+"""
+@Description: buffered CloudWatch Logs writer. Events are accumulated in memory and sent with the minimum number of
+PutLogEvents calls that the service quotas allow, in chronological order. Throttled calls are retried by the adaptive
+retries of the client (see batch_insights.runtime), so the writer doesn't retry them on top of those.
+
+Writes to a single log stream are limited in throughput, so ShardedLogsWriter spreads events across several streams of
+the same log group, picking the stream of each event from a stable hash of its key.
+"""
+
+import json
+import time
+import zlib
+
+from botocore.exceptions import ClientError
+
+
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
+MAX_EVENT_BYTES = 256 * 1024
+EVENT_OVERHEAD_BYTES = 26
+
+
+def shard_stream_names(log_stream, shards):
+    """
+    Returns the names of the streams of a sharded log stream. A single shard keeps the name of the stream, so that
+    unsharded deployments write to the same stream as before.
+    """
+
+    if shards == 1:
+        return [log_stream]
+
+    return [f'{log_stream}-{i:03d}' for i in range(shards)]
+
+
+class LogsWriter:
+    def __init__(self, client, log_group, log_stream, create_log_stream=False):
+        self.client = client
+        self.log_group = log_group
+        self.log_stream = log_stream
+        self.create_log_stream = create_log_stream
+
+        self._events = []
+        self._buffered_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, message, timestamp=None, key=None):
+        """
+        Buffers a log event. The message can be either a string or a JSON-serializable object, and the timestamp is
+        expressed in milliseconds since epoch (defaults to the current time). The key identifies the events that are
+        still buffered after a failed flush, see pending_keys.
+        """
+
+        if not isinstance(message, str):
+            message = json.dumps(message)
+
+        size = len(message.encode('utf-8')) + EVENT_OVERHEAD_BYTES
+
+        if size > MAX_EVENT_BYTES:
+            raise ValueError(f'Log event of {size} bytes exceeds the maximum size of {MAX_EVENT_BYTES} bytes')
+
+        if len(self._events) >= MAX_BATCH_EVENTS or self._buffered_bytes + size > MAX_BATCH_BYTES:
+            self.flush()
+
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+
+        self._events.append((int(timestamp), size, message, key))
+        self._buffered_bytes += size
+
+    def flush(self):
+        """
+        Sends all the buffered events and returns the number of events written. If a batch can't be sent, the events
+        that were not written remain buffered.
+        """
+
+        if not self._events:
+            return 0
+
+        # A stable sort keeps the insertion order of events that share the same timestamp
+        events = sorted(self._events, key=lambda e: e[0])
+        written = 0
+
+        try:
+            for batch in self.__split_batches(events):
+                self.__put_log_events(batch)
+                written += len(batch)
+        finally:
+            self._events = events[written:]
+            self._buffered_bytes = sum(e[1] for e in self._events)
+
+        return written
+
+    def pending_keys(self):
+        return {e[3] for e in self._events}
+
+    @staticmethod
+    def __split_batches(events):
+        batch, batch_bytes = [], 0
+
+        for timestamp, size, message, _ in events:
+            if batch and (len(batch) >= MAX_BATCH_EVENTS or
+                          batch_bytes + size > MAX_BATCH_BYTES or
+                          timestamp - batch[0]['timestamp'] > MAX_BATCH_SPAN_MS):
+                yield batch
+                batch, batch_bytes = [], 0
+
+            batch.append({'timestamp': timestamp, 'message': message})
+            batch_bytes += size
+
+        if batch:
+            yield batch
+
+    def __create_log_stream(self):
+        try:
+            self.client.create_log_stream(logGroupName=self.log_group, logStreamName=self.log_stream)
+        except ClientError as e:
+            # Another writer may have created it concurrently
+            if e.response['Error']['Code'] != 'ResourceAlreadyExistsException':
+                raise
+
+    def __put_log_events(self, batch):
+        try:
+            response = self.client.put_log_events(
+                logGroupName=self.log_group,
+                logStreamName=self.log_stream,
+                logEvents=batch
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException' or not self.create_log_stream:
+                raise
+
+            self.__create_log_stream()
+            response = self.client.put_log_events(
+                logGroupName=self.log_group,
+                logStreamName=self.log_stream,
+                logEvents=batch
+            )
+
+        if 'rejectedLogEventsInfo' in response:
+            print(f'Some log events were rejected by CloudWatch Logs: {json.dumps(response["rejectedLogEventsInfo"])}')
+
+
+class ShardedLogsWriter:
+    """
+    Writes events to several streams of a log group with one LogsWriter per stream. Events with the same key always go
+    to the same stream, and streams that don't exist are created when they are first written to.
+    """
+
+    def __init__(self, client, log_group, log_streams, **kwargs):
+        kwargs.setdefault('create_log_stream', True)
+
+        self.log_streams = list(log_streams)
+        self._writers = [LogsWriter(client, log_group, log_stream, **kwargs) for log_stream in self.log_streams]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return sum(len(writer) for writer in self._writers)
+
+    def stream_index(self, key):
+        # crc32 is stable across processes, unlike the built-in hash of strings
+        return zlib.crc32(str(key).encode('utf-8')) % len(self._writers) if key is not None else 0
+
+    def add(self, message, timestamp=None, key=None):
+        self._writers[self.stream_index(key)].add(message, timestamp, key)
+
+    def flush(self):
+        """
+        Flushes all the streams, even when some of them fail, and returns the number of events written. The first
+        error is raised once all the streams have been flushed, and the events that were not written remain buffered.
+        """
+
+        written = 0
+        error = None
+
+        for writer in self._writers:
+            if not len(writer):
+                continue
+
+            try:
+                written += writer.flush()
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+
+        return written
+
+    def pending_keys(self):
+        return set().union(*(writer.pending_keys() for writer in self._writers))
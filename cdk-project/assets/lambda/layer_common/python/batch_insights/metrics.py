@@ -0,0 +1,84 @@
+"""
+@Description: helpers to publish metrics using the CloudWatch Embedded Metric Format (EMF). Documents are written to
+stdout, and CloudWatch extracts the metrics from the Lambda function's log group asynchronously.
+"""
+
+import json
+import time
+
+
+NAMESPACE = 'AWSBatchInsights'
+
+# Each dimension is published as an independent dimension set, so that widgets can aggregate by any of them
+JOB_DIMENSIONS = ['JobQueue', 'JobDefinition', 'InstanceType', 'AvailabilityZone', 'Architecture']
+
+JOB_DURATION_METRICS = {
+    'RunnableSeconds': 'TotalRunnableSeconds',
+    'StartingSeconds': 'TotalStartingSeconds',
+    'RunningSeconds': 'TotalRunningSeconds'
+}
+
+
+def build_document(metrics, dimensions, properties=None, timestamp=None, namespace=NAMESPACE):
+    """
+    Builds an EMF document. Metrics are given as a {name: (value, unit)} dictionary and dimensions as a {name: value}
+    dictionary, where every dimension is published as its own dimension set.
+    """
+
+    document = {
+        '_aws': {
+            'Timestamp': int(timestamp if timestamp is not None else time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': namespace,
+                    'Dimensions': [[name] for name in dimensions],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }
+            ]
+        }
+    }
+
+    document.update(properties or {})
+    document.update(dimensions)
+    document.update({name: value for name, (value, _) in metrics.items()})
+
+    return document
+
+
+def build_job_metrics(job, timestamp=None):
+    dimensions = {name: job[name] for name in JOB_DIMENSIONS if job.get(name)}
+
+    metrics = {
+        'Jobs': (1, 'Count'),
+        'Succeeded': (1 if job['Status'] == 'SUCCEEDED' else 0, 'Count')
+    }
+
+    for metric_name, field in JOB_DURATION_METRICS.items():
+        if field in job:
+            metrics[metric_name] = (job[field], 'Seconds')
+
+    return build_document(metrics, dimensions, properties={'JobId': job['JobId']}, timestamp=timestamp)
+
+
+def build_state_gauge_metrics(job_queue, counts, timestamp=None):
+    # Gauges are published as RunnableJobs, RunningJobs, etc. Counters that drifted below zero are reported as empty
+    metrics = {f'{status.capitalize()}Jobs': (max(count, 0), 'Count') for status, count in counts.items()}
+
+    return build_document(metrics, {'JobQueue': job_queue}, timestamp=timestamp)
+
+
+def build_runtime_regression_metrics(regression):
+    # Regressions are counted per job definition at the time they were detected, with the details as properties
+    metrics = {
+        'RuntimeRegressions': (1, 'Count'),
+        'RuntimeSlowdownPercent': (regression['SlowdownPercent'], 'Percent')
+    }
+    properties = {name: value for name, value in regression.items()
+                  if name not in ('DetectedAt', 'JobDefinition', 'SlowdownPercent')}
+
+    return build_document(metrics, {'JobDefinition': regression['JobDefinition']}, properties,
+                          timestamp=regression['DetectedAt'])
+
+
+def emit(document):
+    print(json.dumps(document))
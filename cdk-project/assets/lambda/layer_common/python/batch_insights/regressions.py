@@ -0,0 +1,336 @@
+"""
+@Description: online detection of runtime regressions. Every job definition keeps a baseline of its RUNNING and
+RUNNABLE durations per instance type, in constant memory: exponentially weighted moving averages (EWMA) of the log of
+the durations, so that a regression is measured as a ratio of geometric means whatever the scale of the jobs. Durations
+further than CLIP_SIGMAS standard deviations from the baseline are clipped before updating it, so that a few outliers
+don't move it.
+
+A baseline tracks the latest revision of its job definition, and keeps the statistics of the previous revision frozen
+when a new one shows up. Two regressions are detected:
+
+- Revision: the new revision is slower than the previous one, with a Welch z-test over the effective number of samples
+  of both.
+- Drift: a fast EWMA of the latest revision moved away from its slow one, like in an EWMA control chart.
+
+Both are only reported when they are significant (Z_THRESHOLD) and large enough to matter (MIN_SLOWDOWN), at most once
+every ALERT_INTERVAL_SECONDS per baseline. Baselines are persisted in DynamoDB, one item per job definition name,
+instance type and status, and updated with optimistic locking as concurrent invocations may update the same one.
+"""
+
+import math
+import time
+
+from .runtime import deserialize_item
+
+
+# {status: duration field}. RUNNING durations of failed jobs are cut short, so only succeeded jobs are measured
+DURATION_FIELDS = {
+    'RUNNING': 'TotalRunningSeconds',
+    'RUNNABLE': 'TotalRunnableSeconds'
+}
+RUNNING_STATUSES = {'RUNNING'}
+
+FAST_ALPHA = 0.05
+SLOW_ALPHA = 0.01
+CLIP_SIGMAS = 3.0
+WARMUP_SAMPLES = 30
+MIN_SLOWDOWN = 0.1
+Z_THRESHOLD = 3.0
+ALERT_INTERVAL_SECONDS = 6 * 60 * 60
+
+REVISION = 'Revision'
+DRIFT = 'Drift'
+
+BATCH_GET_ITEM_MAX_KEYS = 100
+MAX_RETRIES = 5
+
+# Attributes of a baseline item, besides its key and version
+_TRACK_ATTRIBUTES = ('N', 'Mean', 'Var', 'Fast')
+
+
+def parse_job_definition(job_definition):
+    """
+    Splits a job definition into its name and revision, e.g. Render:2 into ('Render', 2). Job definitions without a
+    revision are revision 0.
+    """
+
+    name, _, revision = job_definition.rpartition(':')
+
+    if not name or not revision.isdigit():
+        return job_definition, 0
+
+    return name, int(revision)
+
+
+def baseline_key(name, instance_type, status):
+    return f'{name}#{instance_type}#{status}'
+
+
+def log_duration(seconds):
+    # Jobs shorter than a second are measured as one second
+    return math.log(max(float(seconds), 1.0))
+
+
+def job_samples(job):
+    """
+    Returns the (baseline key, revision, log duration) samples of a completed job.
+    """
+
+    if not job.get('JobDefinition') or not job.get('InstanceType'):
+        return []
+
+    name, revision = parse_job_definition(job['JobDefinition'])
+    samples = []
+
+    for status, field in DURATION_FIELDS.items():
+        if job.get(field) is None or (status in RUNNING_STATUSES and job.get('Status') != 'SUCCEEDED'):
+            continue
+
+        samples.append((baseline_key(name, job['InstanceType'], status), revision, log_duration(job[field])))
+
+    return samples
+
+
+def effective_samples(n, alpha=SLOW_ALPHA):
+    # An EWMA weighs about as many samples as a mean over 2 / alpha - 1 of them
+    return min(n, 2 / alpha - 1)
+
+
+class Baseline:
+    """
+    Statistics of a job definition name, instance type and status. Tracks hold the number of samples (N), the slow EWMA
+    (Mean) and variance (Var) and the fast EWMA (Fast) of the log durations, for the latest and previous revisions.
+    """
+
+    def __init__(self, key, fast_alpha=FAST_ALPHA, slow_alpha=SLOW_ALPHA, min_slowdown=MIN_SLOWDOWN,
+                 z_threshold=Z_THRESHOLD):
+        self.key = key
+        self.fast_alpha = fast_alpha
+        self.slow_alpha = slow_alpha
+        self.min_slowdown = min_slowdown
+        self.z_threshold = z_threshold
+
+        self.revision = None
+        self.track = dict.fromkeys(_TRACK_ATTRIBUTES, 0)
+        self.previous_revision = None
+        self.previous = None
+        self.alerted_at = {}
+        self.version = 0
+
+    @classmethod
+    def from_item(cls, item, **kwargs):
+        item = deserialize_item(item)
+        baseline = cls(item['Baseline'], **kwargs)
+
+        baseline.revision = int(item['Revision'])
+        baseline.track = {name: float(item[name]) for name in _TRACK_ATTRIBUTES}
+
+        if 'PreviousRevision' in item:
+            baseline.previous_revision = int(item['PreviousRevision'])
+            baseline.previous = {name: float(item[f'Previous{name}']) for name in _TRACK_ATTRIBUTES}
+
+        baseline.alerted_at = {kind: int(item[f'{kind}AlertedAt']) for kind in (REVISION, DRIFT)
+                               if f'{kind}AlertedAt' in item}
+        baseline.version = int(item['Version'])
+
+        return baseline
+
+    def to_item(self):
+        item = {
+            'Baseline': {'S': self.key},
+            'Revision': {'N': str(self.revision)},
+            'Version': {'N': str(self.version + 1)}
+        }
+
+        for name in _TRACK_ATTRIBUTES:
+            item[name] = {'N': repr(float(self.track[name]))}
+
+        if self.previous is not None:
+            item['PreviousRevision'] = {'N': str(self.previous_revision)}
+
+            for name in _TRACK_ATTRIBUTES:
+                item[f'Previous{name}'] = {'N': repr(float(self.previous[name]))}
+
+        for kind, alerted_at in self.alerted_at.items():
+            item[f'{kind}AlertedAt'] = {'N': str(alerted_at)}
+
+        return item
+
+    def __update(self, track, x):
+        n = track['N'] = track['N'] + 1
+
+        # Outliers are clipped once the baseline has enough samples to tell them apart
+        if n > WARMUP_SAMPLES and track['Var'] > 0:
+            limit = CLIP_SIGMAS * math.sqrt(track['Var'])
+            x = min(max(x, track['Mean'] - limit), track['Mean'] + limit)
+
+        # Plain averages until the EWMAs weigh as many samples as their window, so the first samples aren't
+        # overweighted. The first sample sets the averages and a zero variance
+        alpha = max(1 / n, self.slow_alpha)
+        delta = x - track['Mean']
+        track['Mean'] += alpha * delta
+        track['Var'] = (1 - alpha) * (track['Var'] + alpha * delta * delta)
+        track['Fast'] += max(1 / n, self.fast_alpha) * (x - track['Fast'])
+
+    def add(self, revision, x):
+        """
+        Adds a log duration. A later revision becomes the one tracked, samples of the previous revision keep updating
+        its frozen statistics and samples of older revisions are ignored.
+        """
+
+        if self.revision is None or revision > self.revision:
+            if self.revision is not None:
+                self.previous_revision, self.previous = self.revision, self.track
+
+            self.revision = revision
+            self.track = dict.fromkeys(_TRACK_ATTRIBUTES, 0)
+
+        if revision == self.revision:
+            self.__update(self.track, x)
+        elif revision == self.previous_revision:
+            self.__update(self.previous, x)
+
+    def __regression(self, kind, baseline_revision, baseline_mean, current_mean, z, now_ms):
+        name, instance_type, status = self.key.rsplit('#', 2)
+
+        return {
+            'DetectedAt': now_ms,
+            'Kind': kind,
+            'JobDefinition': f'{name}:{self.revision}',
+            'BaselineJobDefinition': f'{name}:{baseline_revision}',
+            'InstanceType': instance_type,
+            'Status': status,
+            'BaselineSeconds': round(math.exp(baseline_mean), 3),
+            'CurrentSeconds': round(math.exp(current_mean), 3),
+            'SlowdownPercent': round((math.exp(current_mean - baseline_mean) - 1) * 100, 2),
+            'ZScore': round(z, 2),
+            'Jobs': int(self.track['N'])
+        }
+
+    def __is_significant(self, delta, z):
+        return z >= self.z_threshold and math.exp(delta) - 1 >= self.min_slowdown
+
+    def detect(self, now_ms):
+        """
+        Returns the regressions of the latest revision that are significant, and weren't reported in the
+        ALERT_INTERVAL_SECONDS before now_ms, the epoch milliseconds of the last job added.
+        """
+
+        regressions = []
+        track, previous = self.track, self.previous
+
+        if track['N'] < WARMUP_SAMPLES:
+            return regressions
+
+        if previous is not None and previous['N'] >= WARMUP_SAMPLES:
+            delta = track['Mean'] - previous['Mean']
+            variance = track['Var'] / effective_samples(track['N'], self.slow_alpha) + \
+                previous['Var'] / effective_samples(previous['N'], self.slow_alpha)
+
+            if variance > 0 and self.__is_significant(delta, delta / math.sqrt(variance)):
+                regressions.append(self.__regression(REVISION, self.previous_revision, previous['Mean'], track['Mean'],
+                                                     delta / math.sqrt(variance), now_ms))
+
+        # The fast EWMA of stable durations varies around the slow one by sd * sqrt(alpha / (2 - alpha))
+        delta = track['Fast'] - track['Mean']
+        variance = track['Var'] * self.fast_alpha / (2 - self.fast_alpha)
+
+        if variance > 0 and self.__is_significant(delta, delta / math.sqrt(variance)):
+            regressions.append(self.__regression(DRIFT, self.revision, track['Mean'], track['Fast'],
+                                                 delta / math.sqrt(variance), now_ms))
+
+        reported = []
+
+        for regression in regressions:
+            if now_ms - self.alerted_at.get(regression['Kind'], 0) >= ALERT_INTERVAL_SECONDS * 1000:
+                self.alerted_at[regression['Kind']] = now_ms
+                reported.append(regression)
+
+        return reported
+
+
+class RegressionDetector:
+    """
+    Buffers the samples of completed jobs until flush is called, so the jobs processed together cost one read and one
+    write per baseline.
+    """
+
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+
+        # {baseline key: [(epoch milliseconds, revision, log duration), ...]}
+        self._pending = {}
+
+    def record(self, job, timestamp_ms):
+        for key, revision, x in job_samples(job):
+            self._pending.setdefault(key, []).append((int(timestamp_ms), revision, x))
+
+    def flush(self):
+        """
+        Updates the baselines with the buffered samples, in the order the jobs completed, and returns the regressions
+        found. Baselines updated concurrently by another invocation are read again and updated on top of its changes.
+        """
+
+        pending, self._pending = self._pending, {}
+        keys = sorted(pending)
+        regressions = []
+
+        for i in range(0, len(keys), BATCH_GET_ITEM_MAX_KEYS):
+            baselines = self.__read(keys[i:i + BATCH_GET_ITEM_MAX_KEYS])
+
+            for key in keys[i:i + BATCH_GET_ITEM_MAX_KEYS]:
+                regressions.extend(self.__update(baselines.get(key) or Baseline(key), sorted(pending[key])))
+
+        return regressions
+
+    def __read(self, keys):
+        baselines = {}
+        request_items = {self.table_name: {'Keys': [{'Baseline': {'S': key}} for key in keys]}}
+        attempt = 0
+
+        while request_items:
+            response = self.client.batch_get_item(RequestItems=request_items)
+
+            for item in response['Responses'].get(self.table_name, []):
+                baseline = Baseline.from_item(item)
+                baselines[baseline.key] = baseline
+
+            request_items = response.get('UnprocessedKeys')
+
+            if request_items:
+                if attempt >= MAX_RETRIES:
+                    raise RuntimeError(f'Could not read {len(request_items[self.table_name]["Keys"])} baselines')
+
+                time.sleep(0.05 * 2 ** attempt)
+                attempt += 1
+
+        return baselines
+
+    def __update(self, baseline, samples):
+        for attempt in range(MAX_RETRIES + 1):
+            regressions = []
+
+            for timestamp_ms, revision, x in samples:
+                baseline.add(revision, x)
+                regressions.extend(baseline.detect(timestamp_ms))
+
+            condition = {'ConditionExpression': 'attribute_not_exists(Baseline)'}
+
+            if baseline.version:
+                condition = {
+                    'ConditionExpression': '#v = :v',
+                    'ExpressionAttributeNames': {'#v': 'Version'},
+                    'ExpressionAttributeValues': {':v': {'N': str(baseline.version)}}
+                }
+
+            try:
+                self.client.put_item(TableName=self.table_name, Item=baseline.to_item(), **condition)
+                return regressions
+            except self.client.exceptions.ConditionalCheckFailedException:
+                if attempt >= MAX_RETRIES:
+                    raise
+
+                response = self.client.get_item(TableName=self.table_name, Key={'Baseline': {'S': baseline.key}},
+                                                ConsistentRead=True)
+                baseline = Baseline.from_item(response['Item']) if 'Item' in response else Baseline(baseline.key)
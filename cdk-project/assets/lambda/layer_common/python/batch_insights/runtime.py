@@ -0,0 +1,157 @@
+"""
+@Description: shared runtime of the Lambda functions. AWS clients are low-level botocore clients, created on first use
+and reused by all the invocations of the execution environment. Importing this module doesn't import boto3, and no
+client is created until a function actually calls the service, which keeps cold starts short.
+
+Clients share a configuration tuned for Lambda: a connection pool sized for the concurrent requests of a function,
+TCP keep-alive so that connections survive between invocations, and adaptive retries that rate limit the client when
+the service throttles it. The settings can be overridden with the AWS_MAX_POOL_CONNECTIONS, AWS_MAX_ATTEMPTS,
+AWS_CONNECT_TIMEOUT and AWS_READ_TIMEOUT environment variables.
+
+DynamoDB items are exchanged in the low-level attribute value format, converted with serialize_item and
+deserialize_item.
+"""
+
+import os
+import threading
+
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_CONNECT_TIMEOUT = 2
+DEFAULT_READ_TIMEOUT = 10
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_session_handlers = []
+
+
+def config():
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+        tcp_keepalive=True,
+        connect_timeout=float(os.environ.get('AWS_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+        read_timeout=float(os.environ.get('AWS_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+        retries={
+            'mode': 'adaptive',
+            'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS))
+        }
+    )
+
+
+def session():
+    global _session
+
+    with _lock:
+        if _session is None:
+            import botocore.session
+
+            _session = botocore.session.get_session()
+
+            for event_name, handler in _session_handlers:
+                _session.register(event_name, handler)
+
+        return _session
+
+
+def register_session_handler(event_name, handler):
+    """
+    Registers a botocore event handler on the clients of the runtime. Handlers registered before the session exists
+    are attached when it is created, so registering them doesn't import botocore.
+    """
+
+    with _lock:
+        _session_handlers.append((event_name, handler))
+
+        if _session is not None:
+            _session.register(event_name, handler)
+
+
+def client(service):
+    """
+    Returns the shared client of a service, creating it on first use. Clients are thread-safe, so they can be used by
+    several threads of the same invocation.
+    """
+
+    if service in _clients:
+        return _clients[service]
+
+    botocore_session = session()
+
+    with _lock:
+        if service not in _clients:
+            # Lambda sets AWS_REGION, which botocore doesn't read by itself
+            _clients[service] = botocore_session.create_client(
+                service, region_name=os.environ.get('AWS_REGION'), config=config()
+            )
+
+        return _clients[service]
+
+
+def set_client(service, service_client):
+    """
+    Replaces the client of a service, e.g. with an in-memory stand-in when running the functions locally.
+    """
+
+    with _lock:
+        _clients[service] = service_client
+
+
+def reset():
+    global _session
+
+    with _lock:
+        _session = None
+        _clients.clear()
+
+
+def serialize(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    elif isinstance(value, str):
+        return {'S': value}
+    elif isinstance(value, (int, float)):
+        return {'N': str(value)}
+    elif value is None:
+        return {'NULL': True}
+    elif isinstance(value, dict):
+        return {'M': serialize_item(value)}
+    elif isinstance(value, (list, tuple)):
+        return {'L': [serialize(v) for v in value]}
+    elif isinstance(value, (set, frozenset)):
+        return {'NS': [str(v) for v in value]}
+
+    # Decimals and other numeric types
+    return {'N': str(value)}
+
+
+def deserialize(attribute):
+    (kind, value), = attribute.items()
+
+    if kind == 'S':
+        return value
+    elif kind == 'N':
+        return int(value) if value.lstrip('-').isdigit() else float(value)
+    elif kind == 'BOOL':
+        return value
+    elif kind == 'NULL':
+        return None
+    elif kind == 'M':
+        return deserialize_item(value)
+    elif kind == 'L':
+        return [deserialize(v) for v in value]
+    elif kind == 'NS':
+        return {deserialize({'N': v}) for v in value}
+
+    raise TypeError(f'Unsupported attribute type {kind}')
+
+
+def serialize_item(item):
+    return {name: serialize(value) for name, value in item.items()}
+
+
+def deserialize_item(item):
+    return {name: deserialize(attribute) for name, attribute in item.items()}
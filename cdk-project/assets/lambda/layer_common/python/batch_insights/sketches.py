@@ -0,0 +1,228 @@
+"""
+@Description: mergeable quantile sketches of job status durations. Sketches follow the DDSketch algorithm: values are
+counted in logarithmically sized bins, so any quantile is estimated within a fixed relative error and two sketches are
+merged by adding their bin counts.
+
+Sketches are persisted in DynamoDB with one item per dimension value and time bucket. Every bin is stored as a top
+level numeric attribute, so that concurrent writers update them with atomic ADD operations instead of read-modify-write
+cycles.
+"""
+
+import math
+
+from .runtime import deserialize_item
+
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+DEFAULT_BUCKET_SECONDS = 3600
+
+SKETCH_DIMENSIONS = ['JobQueue', 'JobDefinition', 'InstanceType']
+
+# Attribute name prefix of the bins of each duration
+DURATION_FIELDS = {
+    'RUNNABLE': ('Q', 'TotalRunnableSeconds'),
+    'STARTING': ('S', 'TotalStartingSeconds'),
+    'RUNNING': ('R', 'TotalRunningSeconds')
+}
+
+ZERO_BIN = 'z'
+MIN_INDEXABLE_VALUE = 1e-9
+MAX_OPERANDS_PER_UPDATE = 100
+
+
+class DDSketch:
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def value(self, key):
+        # Midpoint of the bin that minimises the relative error
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value < 0:
+            raise ValueError(f'Only non-negative values can be added to the sketch, got {value}')
+
+        if value < MIN_INDEXABLE_VALUE:
+            self.zero_count += count
+        else:
+            key = self.key(value)
+            self.bins[key] = self.bins.get(key, 0) + count
+
+        self.count += count
+        self.__collapse()
+
+    def add_bin(self, key, count):
+        self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+        self.__collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('Sketches with different relative accuracies cannot be merged')
+
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.__collapse()
+
+    def quantile(self, q):
+        if not 0 <= q <= 1:
+            raise ValueError(f'Quantiles must be between 0 and 1, got {q}')
+
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+
+        if rank < self.zero_count:
+            return 0.0
+
+        accumulated = self.zero_count
+
+        for key in sorted(self.bins):
+            accumulated += self.bins[key]
+
+            if accumulated > rank:
+                return self.value(key)
+
+        return self.value(max(self.bins))
+
+    def __collapse(self):
+        # Memory is bounded by merging the lowest bins, which only degrades the accuracy of the lowest quantiles
+        if len(self.bins) <= self.max_bins:
+            return
+
+        keys = sorted(self.bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        collapsed = sum(self.bins.pop(key) for key in excess)
+        self.bins[excess[-1]] = self.bins.get(excess[-1], 0) + collapsed
+
+
+def bucket_start(timestamp_ms, bucket_seconds=DEFAULT_BUCKET_SECONDS):
+    return int(timestamp_ms // 1000) // bucket_seconds * bucket_seconds
+
+
+def sketch_key(dimension, value):
+    return f'{dimension}#{value}'
+
+
+class SketchStore:
+    def __init__(self, client, table_name, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 bucket_seconds=DEFAULT_BUCKET_SECONDS):
+        self.client = client
+        self.table_name = table_name
+        self.relative_accuracy = relative_accuracy
+        self.bucket_seconds = bucket_seconds
+
+        # {(sketch key, bucket): {attribute name: count}}
+        self._pending = {}
+        self._sketch = DDSketch(relative_accuracy)
+
+    def record(self, job, timestamp_ms):
+        """
+        Adds the durations of a completed job to the sketches of its dimensions. Updates are aggregated in memory until
+        flush is called, so a batch of jobs costs one write per dimension value and time bucket.
+        """
+
+        bucket = bucket_start(timestamp_ms, self.bucket_seconds)
+
+        for dimension in SKETCH_DIMENSIONS:
+            if not job.get(dimension):
+                continue
+
+            counts = self._pending.setdefault((sketch_key(dimension, job[dimension]), bucket), {})
+
+            for prefix, field in DURATION_FIELDS.values():
+                if field not in job:
+                    continue
+
+                value = float(job[field])
+                name = prefix + (ZERO_BIN if value < MIN_INDEXABLE_VALUE else str(self._sketch.key(value)))
+                counts[name] = counts.get(name, 0) + 1
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+
+        for (key, bucket), counts in pending.items():
+            items = list(counts.items())
+
+            for i in range(0, len(items), MAX_OPERANDS_PER_UPDATE):
+                chunk = items[i:i + MAX_OPERANDS_PER_UPDATE]
+
+                self.client.update_item(
+                    TableName=self.table_name,
+                    Key={'SketchKey': {'S': key}, 'Bucket': {'N': str(bucket)}},
+                    UpdateExpression='ADD ' + ', '.join(f'#a{j} :c{j}' for j in range(len(chunk))),
+                    ExpressionAttributeNames={f'#a{j}': name for j, (name, _) in enumerate(chunk)},
+                    ExpressionAttributeValues={f':c{j}': {'N': str(count)} for j, (_, count) in enumerate(chunk)}
+                )
+
+    def load(self, dimension, value, start_ms, end_ms):
+        """
+        Merges all the buckets of a dimension value between two timestamps into one sketch per duration. Only the
+        merged sketches are kept in memory, whatever the number of buckets.
+        """
+
+        sketches = {status: DDSketch(self.relative_accuracy) for status in DURATION_FIELDS}
+        prefixes = {prefix: status for status, (prefix, _) in DURATION_FIELDS.items()}
+
+        kwargs = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'SketchKey = :k AND #b BETWEEN :s AND :e',
+            'ExpressionAttributeNames': {'#b': 'Bucket'},
+            'ExpressionAttributeValues': {
+                ':k': {'S': sketch_key(dimension, value)},
+                ':s': {'N': str(bucket_start(start_ms, self.bucket_seconds))},
+                ':e': {'N': str(bucket_start(end_ms, self.bucket_seconds))}
+            }
+        }
+
+        while True:
+            response = self.client.query(**kwargs)
+
+            for item in response['Items']:
+                for name, count in deserialize_item(item).items():
+                    status = prefixes.get(name[:1])
+
+                    if status is None:
+                        continue
+
+                    if name[1:] == ZERO_BIN:
+                        sketches[status].zero_count += int(count)
+                        sketches[status].count += int(count)
+                    elif name[1:].lstrip('-').isdigit():
+                        sketches[status].add_bin(int(name[1:]), int(count))
+
+            if 'LastEvaluatedKey' not in response:
+                return sketches
+
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def percentiles(self, dimension, value, start_ms, end_ms, quantiles=(0.5, 0.95, 0.99)):
+        """
+        Returns the estimated percentiles of the RUNNABLE, STARTING and RUNNING durations (in seconds) of the jobs of a
+        dimension value that completed between two timestamps, e.g.:
+
+        {'RUNNING': {'Count': 120, 'p50': 61.2, 'p95': 340.1, 'p99': 601.9}, ...}
+        """
+
+        return {
+            status: dict(
+                {'Count': sketch.count},
+                **{f'p{round(q * 100, 1):g}': sketch.quantile(q) for q in quantiles}
+            )
+            for status, sketch in self.load(dimension, value, start_ms, end_ms).items()
+        }
@@ -0,0 +1,169 @@
+"""
+@Description: precomputed results of the dashboard queries. A snapshot holds the partial aggregations (sums and counts)
+of a query per day and dimension value, in one DynamoDB item per day:
+
+{"Snapshot": "<snapshot ID>", "Day": <epoch seconds>, "Rows": "[[\"<value>\", <partial>, ...], ...]"}
+
+Partials are merged over any range of days by adding them, and every metric is then computed as the ratio of two of
+them, so a widget renders a year of jobs from a few hundred small items instead of scanning the logs. Every snapshot
+also has a state item on day 0, with the definition it was computed with and the time it was last refreshed.
+"""
+
+import hashlib
+import json
+import time
+
+from .runtime import deserialize_item
+
+
+DAY_SECONDS = 24 * 60 * 60
+STATE_DAY = 0
+DEFAULT_RETENTION_DAYS = 366
+
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_MAX_RETRIES = 5
+
+
+def day_start(timestamp_ms):
+    return int(timestamp_ms // 1000) // DAY_SECONDS * DAY_SECONDS
+
+
+def fingerprint(snapshot):
+    # The days computed with another query or other partials must be computed again
+    definition = json.dumps([snapshot['Query'], snapshot['Partials']])
+    return hashlib.sha256(definition.encode('utf-8')).hexdigest()[:16]
+
+
+class SnapshotStore:
+    def __init__(self, client, table_name, retention_days=DEFAULT_RETENTION_DAYS):
+        self.client = client
+        self.table_name = table_name
+        self.retention_days = retention_days
+
+    def read_state(self, snapshot_id):
+        """
+        Returns the state of a snapshot, with its Definition, Fingerprint and RefreshedAt epoch milliseconds, or None
+        when it was never refreshed.
+        """
+
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={'Snapshot': {'S': snapshot_id}, 'Day': {'N': str(STATE_DAY)}}
+        )
+
+        if 'Item' not in response:
+            return None
+
+        state = deserialize_item(response['Item'])
+        state['Definition'] = json.loads(state['Definition'])
+        state['RefreshedAt'] = int(state['RefreshedAt'])
+
+        return state
+
+    def write_state(self, snapshot, refreshed_at_ms):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                'Snapshot': {'S': snapshot['Id']},
+                'Day': {'N': str(STATE_DAY)},
+                'Definition': {'S': json.dumps(snapshot)},
+                'Fingerprint': {'S': fingerprint(snapshot)},
+                'RefreshedAt': {'N': str(refreshed_at_ms)}
+            }
+        )
+
+    def write_days(self, snapshot_id, days):
+        """
+        Replaces the rows of the given days, {day: [[value, partial, ...], ...]}. Days without rows are written too, so
+        that the rows they held before are replaced. Days expire once they are older than the retention.
+        """
+
+        requests = [
+            {'PutRequest': {'Item': {
+                'Snapshot': {'S': snapshot_id},
+                'Day': {'N': str(day)},
+                'Rows': {'S': json.dumps(rows, separators=(',', ':'))},
+                'ExpiresAt': {'N': str(day + (self.retention_days + 1) * DAY_SECONDS)}
+            }}}
+            for day, rows in sorted(days.items())
+        ]
+
+        for i in range(0, len(requests), BATCH_WRITE_MAX_ITEMS):
+            request_items = {self.table_name: requests[i:i + BATCH_WRITE_MAX_ITEMS]}
+            attempt = 0
+
+            while request_items:
+                request_items = self.client.batch_write_item(RequestItems=request_items).get('UnprocessedItems')
+
+                if request_items:
+                    if attempt >= BATCH_WRITE_MAX_RETRIES:
+                        raise RuntimeError(f'Could not write {len(request_items[self.table_name])} days of the '
+                                           f'snapshot {snapshot_id}')
+
+                    time.sleep(0.05 * 2 ** attempt)
+                    attempt += 1
+
+    def read_days(self, snapshot_id, start_ms, end_ms):
+        """
+        Yields the (day, rows) of a snapshot for every day between two timestamps, including the days they fall in.
+        """
+
+        kwargs = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'Snapshot = :k AND #d BETWEEN :s AND :e',
+            'ExpressionAttributeNames': {'#d': 'Day'},
+            'ExpressionAttributeValues': {
+                ':k': {'S': snapshot_id},
+                ':s': {'N': str(max(day_start(start_ms), STATE_DAY + 1))},
+                ':e': {'N': str(day_start(end_ms))}
+            }
+        }
+
+        while True:
+            response = self.client.query(**kwargs)
+
+            for item in response['Items']:
+                item = deserialize_item(item)
+                yield int(item['Day']), json.loads(item['Rows'])
+
+            if 'LastEvaluatedKey' not in response:
+                return
+
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def merge_days(days, n_partials):
+    """
+    Adds the partials of every dimension value over the given days, and returns them as {value: [partial, ...]}.
+    """
+
+    merged = {}
+
+    for _, rows in days:
+        for value, *partials in rows:
+            totals = merged.setdefault(value, [0] * n_partials)
+
+            for i, partial in enumerate(partials):
+                totals[i] += partial
+
+    return merged
+
+
+def compute_metrics(partials, snapshot):
+    """
+    Computes the metrics of a snapshot from the merged partials of a dimension value. A metric whose denominator is zero
+    has no value.
+    """
+
+    by_name = dict(zip(snapshot['Partials'], partials))
+    metrics = {}
+
+    for name, (numerator, denominator, scale) in snapshot['Metrics'].items():
+        if denominator is None:
+            metrics[name] = by_name[numerator] * scale
+        elif by_name[denominator]:
+            metrics[name] = by_name[numerator] / by_name[denominator] * scale
+        else:
+            metrics[name] = None
+
+    return metrics
@@ -0,0 +1,5 @@
+"""
+@Description: benchmarks of the Lambda handlers. Event streams are replayed against in-memory stand-ins of DynamoDB and
+CloudWatch Logs, so they run locally without an AWS account. They are not deployed as part of the CDK app and require
+the packages listed in requirements-dev.txt.
+"""
@@ -0,0 +1,172 @@
+"""
+@Description: cold start benchmark of the event handlers. Every run starts a new Python process, as a new Lambda
+execution environment would, and measures the time to import the handler module, the time of its first invocation
+(which includes creating the AWS clients) and the time of a second, warm invocation. AWS API calls are sent to a local
+HTTP endpoint that answers with canned responses, so the measurements include the request serialization, signing and
+response parsing of the real clients without depending on the network. Usage:
+
+python -m benchmarks.cold_start --runs 10
+"""
+
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import uuid
+
+from .events import container_instance_event, job_state_event, task_state_event
+from .harness import ENVIRONMENT, HANDLERS, LAMBDA_DIR, LAYER_DIR
+
+
+START_MS = 1704067200000
+CONTAINER_INSTANCE_ARN = 'arn:aws:ecs:us-east-1:123456789012:container-instance/benchmark/0'
+
+
+def handler_events(sequence):
+    """
+    Returns an event of every handler. Events of different sequence numbers are of different jobs and have different
+    IDs, so that the second invocation isn't dropped as a duplicate of the first one.
+    """
+
+    job = {'JobName': 'benchmark', 'JobId': f'{sequence:032d}', 'JobQueue': 'Benchmark', 'JobDefinition': 'Benchmark'}
+    events = {
+        'processBatchEvents': job_state_event(START_MS + 60000, job, 'SUCCEEDED', started_at=START_MS,
+                                              stopped_at=START_MS + 60000),
+        'processTaskStateEvents': task_state_event(START_MS, job['JobId'], CONTAINER_INSTANCE_ARN),
+        'processContainerInstanceEvents': container_instance_event(START_MS, CONTAINER_INSTANCE_ARN, 'i-0',
+                                                                   'c6g.xlarge', 'arm64', 'us-east-1a')
+    }
+
+    for i, event in enumerate(events.values()):
+        event['id'] = str(uuid.UUID(int=(sequence << 8) | i))
+
+    return events
+
+
+# Events of the first and second invocations
+EVENTS = [handler_events(0), handler_events(1)]
+
+# Only the standard library is imported before the clock starts, so that the modules imported by the handler are
+# accounted for in its import time
+CHILD_SCRIPT = '''
+import json, sys, time, importlib.util
+
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+spec = importlib.util.spec_from_file_location('index', sys.argv[2])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+
+module.handler(json.loads(sys.argv[3]), None)
+first = time.perf_counter()
+module.handler(json.loads(sys.argv[4]), None)
+second = time.perf_counter()
+
+print(json.dumps({
+    'ImportMs': (imported - start) * 1000,
+    'FirstInvocationMs': (first - imported) * 1000,
+    'SecondInvocationMs': (second - first) * 1000
+}))
+'''
+
+
+class _CannedAwsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        operation = self.headers.get('X-Amz-Target', '').split('.')[-1]
+
+        if operation == 'BatchGetItem':
+            # Every requested container instance is returned as tracked
+            response = {
+                'Responses': {
+                    table: [dict(key, InstanceType={'S': 'c6g.xlarge'}) for key in request['Keys']]
+                    for table, request in body['RequestItems'].items()
+                },
+                'UnprocessedKeys': {}
+            }
+        elif operation == 'Query':
+            response = {'Items': [], 'Count': 0}
+        else:
+            response = {}
+
+        payload = json.dumps(response).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(name, directory, endpoint_url, environment=None):
+    env = dict(
+        os.environ,
+        AWS_ENDPOINT_URL=endpoint_url,
+        AWS_ACCESS_KEY_ID='benchmark',
+        AWS_SECRET_ACCESS_KEY='benchmark',
+        AWS_DEFAULT_REGION='us-east-1',
+        AWS_REGION='us-east-1',
+        AWS_MAX_ATTEMPTS='1',
+        **ENVIRONMENT,
+        **(environment or {})
+    )
+
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, LAYER_DIR, os.path.join(LAMBDA_DIR, directory, 'index.py'),
+         json.dumps(EVENTS[0][name]), json.dumps(EVENTS[1][name])],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+
+    # The handlers print their own logs, the measurements are on the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(runs=5, environment=None):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _CannedAwsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = f'http://127.0.0.1:{server.server_address[1]}'
+    results = {}
+
+    try:
+        for name, directory, _ in HANDLERS.values():
+            measurements = [measure(name, directory, endpoint_url, environment) for _ in range(runs)]
+
+            results[name] = {
+                key: round(statistics.median(m[key] for m in measurements), 2)
+                for key in ('ImportMs', 'FirstInvocationMs', 'SecondInvocationMs')
+            }
+            results[name]['ColdStartMs'] = round(results[name]['ImportMs'] + results[name]['FirstInvocationMs'], 2)
+    finally:
+        server.shutdown()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the cold start of the event handlers')
+    parser.add_argument('--runs', type=int, default=5, help='Number of processes per handler, the median is reported')
+    parser.add_argument('--output', help='Writes the results to a JSON file')
+    args = parser.parse_args(argv)
+
+    results = run(args.runs)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
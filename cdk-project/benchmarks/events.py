@@ -0,0 +1,302 @@
+"""
+@Description: generator of realistic EventBridge event streams. A fleet of container instances is registered, and every
+job then goes through SUBMITTED, PENDING, RUNNABLE, STARTING, RUNNING and SUCCEEDED or FAILED, with its ECS task
+reaching PENDING on one of the instances when the job starts. A fraction of the jobs can be array jobs, whose children
+run independently and are followed by the completion of their parent. Events are returned interleaved in delivery
+order, optionally duplicated, delayed or lost like EventBridge may deliver them.
+"""
+
+import datetime
+import heapq
+import random
+import uuid
+
+
+ACCOUNT_ARN = 'arn:aws:{service}:us-east-1:123456789012'
+
+DEFAULT_JOB_QUEUES = ['HighPriority', 'LowPriority', 'Spot']
+DEFAULT_JOB_DEFINITIONS = ['Render', 'Transcode', 'Simulate', 'Train']
+DEFAULT_INSTANCE_TYPES = [
+    ('c6g.xlarge', 'arm64'), ('m6g.2xlarge', 'arm64'), ('c5.xlarge', 'x86_64'), ('m5.2xlarge', 'x86_64')
+]
+DEFAULT_AVAILABILITY_ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c']
+
+# Jobs are submitted at most this long before they become RUNNABLE
+MAX_SUBMITTED_LEAD_MS = 30000
+
+# Mean number of seconds of each status
+DEFAULT_MEAN_PENDING_SECONDS = 2
+DEFAULT_MEAN_RUNNABLE_SECONDS = 120
+DEFAULT_MEAN_STARTING_SECONDS = 30
+DEFAULT_MEAN_RUNNING_SECONDS = 600
+
+DEFAULT_ARRAY_SIZE = 10
+
+# AWS Batch completes an array job shortly after its last child
+ARRAY_COMPLETION_DELAY_MS = 1000
+
+
+def _iso(timestamp_ms):
+    return datetime.datetime.fromtimestamp(timestamp_ms // 1000, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def container_instance_event(timestamp_ms, arn, instance_id, instance_type, architecture, availability_zone,
+                             status='ACTIVE'):
+    return {
+        'detail-type': 'ECS Container Instance State Change',
+        'source': 'aws.ecs',
+        'time': _iso(timestamp_ms),
+        'detail': {
+            'containerInstanceArn': arn,
+            'ec2InstanceId': instance_id,
+            'status': status,
+            'attributes': [
+                {'name': 'ecs.availability-zone', 'value': availability_zone},
+                {'name': 'ecs.cpu-architecture', 'value': architecture},
+                {'name': 'ecs.instance-type', 'value': instance_type}
+            ]
+        }
+    }
+
+
+def task_state_event(timestamp_ms, job_id, container_instance_arn):
+    return {
+        'detail-type': 'ECS Task State Change',
+        'source': 'aws.ecs',
+        'time': _iso(timestamp_ms),
+        'detail': {
+            'taskArn': f'{ACCOUNT_ARN.format(service="ecs")}:task/{job_id}',
+            'containerInstanceArn': container_instance_arn,
+            'launchType': 'EC2',
+            'lastStatus': 'PENDING',
+            'overrides': {
+                'containerOverrides': [{'environment': [{'name': 'AWS_BATCH_JOB_ID', 'value': job_id}]}]
+            }
+        }
+    }
+
+
+def job_state_event(timestamp_ms, job, status, started_at=None, stopped_at=None, created_at=None,
+                    array_properties=None):
+    detail = {
+        'jobName': job['JobName'],
+        'jobId': job['JobId'],
+        'jobQueue': f'{ACCOUNT_ARN.format(service="batch")}:job-queue/{job["JobQueue"]}',
+        'jobDefinition': f'{ACCOUNT_ARN.format(service="batch")}:job-definition/{job["JobDefinition"]}:1',
+        'status': status
+    }
+
+    if created_at is not None:
+        detail['createdAt'] = created_at
+
+    if array_properties is not None:
+        detail['arrayProperties'] = array_properties
+
+    if started_at is not None:
+        detail['startedAt'] = started_at
+
+    if stopped_at is not None:
+        detail['stoppedAt'] = stopped_at
+
+    return {
+        'detail-type': 'Batch Job State Change',
+        'source': 'aws.batch',
+        'time': _iso(timestamp_ms),
+        'detail': detail
+    }
+
+
+class EventStream:
+    """
+    Deterministic stream of events for a number of jobs submitted at a constant rate. Iterating the stream yields
+    (delivery time in milliseconds, event) tuples in delivery order, holding in memory only the jobs that are running.
+    """
+
+    def __init__(self, n_jobs, n_instances=50, jobs_per_second=10.0, failure_rate=0.05, duplicate_rate=0.0,
+                 max_delivery_delay_ms=0, lost_completion_rate=0.0, array_job_rate=0.0, array_size=DEFAULT_ARRAY_SIZE,
+                 seed=0, start_ms=1704067200000,
+                 job_queues=DEFAULT_JOB_QUEUES, job_definitions=DEFAULT_JOB_DEFINITIONS,
+                 instance_types=DEFAULT_INSTANCE_TYPES, availability_zones=DEFAULT_AVAILABILITY_ZONES,
+                 mean_pending_seconds=DEFAULT_MEAN_PENDING_SECONDS,
+                 mean_runnable_seconds=DEFAULT_MEAN_RUNNABLE_SECONDS,
+                 mean_starting_seconds=DEFAULT_MEAN_STARTING_SECONDS,
+                 mean_running_seconds=DEFAULT_MEAN_RUNNING_SECONDS):
+        self.n_jobs = n_jobs
+        self.n_instances = n_instances
+        self.jobs_per_second = jobs_per_second
+        self.failure_rate = failure_rate
+        self.duplicate_rate = duplicate_rate
+        self.max_delivery_delay_ms = max_delivery_delay_ms
+        self.lost_completion_rate = lost_completion_rate
+        self.array_job_rate = array_job_rate
+        self.array_size = array_size
+        self.seed = seed
+        self.start_ms = start_ms
+        self.job_queues = job_queues
+        self.job_definitions = job_definitions
+        self.instance_types = instance_types
+        self.availability_zones = availability_zones
+        self.mean_pending_seconds = mean_pending_seconds
+        self.mean_runnable_seconds = mean_runnable_seconds
+        self.mean_starting_seconds = mean_starting_seconds
+        self.mean_running_seconds = mean_running_seconds
+
+        # Final detail of every generated job, as AWS Batch would describe it
+        self.job_details = {}
+
+    def __instance_events(self, rng):
+        events = []
+
+        for i in range(self.n_instances):
+            instance_type, architecture = rng.choice(self.instance_types)
+            arn = f'{ACCOUNT_ARN.format(service="ecs")}:container-instance/benchmark/{i:032x}'
+
+            events.append(container_instance_event(
+                self.start_ms - 60000, arn, f'i-{i:017x}', instance_type, architecture,
+                rng.choice(self.availability_zones)
+            ))
+
+        return events
+
+    def __job_events(self, rng, i, instance_arns):
+        runnable_at = self.start_ms + int(i * 1000 / self.jobs_per_second)
+
+        job = {
+            'JobName': f'benchmark-{i}',
+            'JobId': f'{rng.getrandbits(128):032x}',
+            'JobQueue': rng.choice(self.job_queues),
+            'JobDefinition': rng.choice(self.job_definitions)
+        }
+
+        if self.array_job_rate and rng.random() < self.array_job_rate:
+            return self.__array_job_events(rng, job, runnable_at, instance_arns)
+
+        starting_at, running_at, stopped_at, status = self.__run(rng, runnable_at)
+        pending_at, submitted_at = self.__submission(rng, runnable_at)
+
+        completion_event = job_state_event(stopped_at, job, status, started_at=running_at, stopped_at=stopped_at)
+        self.job_details[job['JobId']] = completion_event['detail']
+
+        job_events = [
+            (submitted_at, job_state_event(submitted_at, job, 'SUBMITTED')),
+            (pending_at, job_state_event(pending_at, job, 'PENDING')),
+            (runnable_at, job_state_event(runnable_at, job, 'RUNNABLE')),
+            (starting_at, job_state_event(starting_at, job, 'STARTING')),
+            (starting_at, task_state_event(starting_at, job['JobId'], rng.choice(instance_arns))),
+            (running_at, job_state_event(running_at, job, 'RUNNING', started_at=running_at))
+        ]
+
+        # Lost completion events leave the job tracked until it is reconciled
+        if not self.lost_completion_rate or rng.random() >= self.lost_completion_rate:
+            job_events.append((stopped_at, completion_event))
+
+        return job_events
+
+    def __run(self, rng, runnable_at):
+        starting_at = runnable_at + int(rng.expovariate(1 / self.mean_runnable_seconds) * 1000)
+        running_at = starting_at + int(rng.expovariate(1 / self.mean_starting_seconds) * 1000)
+        stopped_at = running_at + int(rng.expovariate(1 / self.mean_running_seconds) * 1000)
+
+        return starting_at, running_at, stopped_at, 'FAILED' if rng.random() < self.failure_rate else 'SUCCEEDED'
+
+    def __submission(self, rng, runnable_at):
+        # Jobs are submitted and go through PENDING shortly before they become RUNNABLE
+        pending_at = runnable_at - min(int(rng.expovariate(1 / self.mean_pending_seconds) * 1000),
+                                       MAX_SUBMITTED_LEAD_MS - 1000)
+
+        return pending_at, pending_at - 1000
+
+    def __array_job_events(self, rng, job, runnable_at, instance_arns):
+        pending_at, submitted_at = self.__submission(rng, runnable_at)
+        array_properties = {'size': self.array_size}
+
+        job_events = [
+            (submitted_at, job_state_event(submitted_at, job, 'SUBMITTED', array_properties=array_properties)),
+            (pending_at, job_state_event(pending_at, job, 'PENDING', array_properties=array_properties)),
+            (runnable_at, job_state_event(runnable_at, job, 'RUNNABLE', array_properties=array_properties))
+        ]
+
+        # Children become RUNNABLE with their parent and run independently of each other
+        children = []
+
+        for index in range(self.array_size):
+            child = dict(job, JobId=f'{job["JobId"]}:{index}')
+            starting_at, running_at, stopped_at, status = self.__run(rng, runnable_at)
+            child_properties = {'index': index}
+
+            completion_event = job_state_event(stopped_at, child, status, started_at=running_at, stopped_at=stopped_at,
+                                               created_at=submitted_at, array_properties=child_properties)
+            self.job_details[child['JobId']] = completion_event['detail']
+            children.append((starting_at, running_at, stopped_at, status))
+
+            job_events.extend([
+                (runnable_at, job_state_event(runnable_at, child, 'RUNNABLE', array_properties=child_properties)),
+                (starting_at, job_state_event(starting_at, child, 'STARTING', array_properties=child_properties)),
+                (starting_at, task_state_event(starting_at, child['JobId'], rng.choice(instance_arns))),
+                (running_at, job_state_event(running_at, child, 'RUNNING', started_at=running_at,
+                                             array_properties=child_properties)),
+                (stopped_at, completion_event)
+            ])
+
+        # The parent runs from the start of its first child until its last child stops, and fails if any child failed
+        starting_at = min(c[0] for c in children)
+        running_at = min(c[1] for c in children)
+        stopped_at = max(c[2] for c in children) + ARRAY_COMPLETION_DELAY_MS
+        status = 'FAILED' if any(c[3] == 'FAILED' for c in children) else 'SUCCEEDED'
+
+        completion_event = job_state_event(stopped_at, job, status, started_at=running_at, stopped_at=stopped_at,
+                                           array_properties=array_properties)
+        self.job_details[job['JobId']] = completion_event['detail']
+
+        job_events.extend([
+            (starting_at, job_state_event(starting_at, job, 'STARTING', array_properties=array_properties)),
+            (running_at, job_state_event(running_at, job, 'RUNNING', started_at=running_at,
+                                         array_properties=array_properties))
+        ])
+
+        if not self.lost_completion_rate or rng.random() >= self.lost_completion_rate:
+            job_events.append((stopped_at, completion_event))
+
+        return job_events
+
+    def __event_id(self, sequence):
+        return str(uuid.UUID(int=(self.seed << 64) | sequence))
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        sequence = 0
+        self.job_details.clear()
+
+        instance_events = self.__instance_events(rng)
+        instance_arns = [event['detail']['containerInstanceArn'] for event in instance_events]
+
+        for event in instance_events:
+            event['id'] = self.__event_id(sequence)
+            sequence += 1
+            yield self.start_ms - 60000, event
+
+        # Events are scheduled by delivery time. A job's events are only generated once it is submitted, so the heap
+        # holds the events of the jobs in flight
+        pending = []
+
+        for i in range(self.n_jobs):
+            for occurred_at, event in self.__job_events(rng, i, instance_arns):
+                # The copies of a duplicated event share its ID, like the ones EventBridge delivers
+                event['id'] = self.__event_id(sequence)
+                copies = 2 if rng.random() < self.duplicate_rate else 1
+
+                for _ in range(copies):
+                    delivered_at = occurred_at + rng.randint(0, self.max_delivery_delay_ms)
+                    heapq.heappush(pending, (delivered_at, sequence, event))
+                    sequence += 1
+
+            # The jobs generated next can't have events earlier than this
+            released_at = self.start_ms + int(i * 1000 / self.jobs_per_second) - MAX_SUBMITTED_LEAD_MS
+
+            while pending and pending[0][0] <= released_at:
+                delivered_at, _, event = heapq.heappop(pending)
+                yield delivered_at, event
+
+        while pending:
+            delivered_at, _, event = heapq.heappop(pending)
+            yield delivered_at, event
@@ -0,0 +1,768 @@
+"""
+@Description: in-memory stand-ins of the DynamoDB, CloudWatch Logs, AWS Batch, SQS and S3 APIs used by the handlers and
+tools. They implement the subset of the request syntax the handlers use, enforce the same limits as the services and
+count every API call, so that a benchmark can report the calls made per job.
+"""
+
+import io
+import re
+import threading
+import time
+import types
+import uuid
+
+from collections import Counter, deque
+
+from botocore.exceptions import ClientError
+
+
+PUT_LOG_EVENTS_MAX_EVENTS = 10000
+PUT_LOG_EVENTS_MAX_BYTES = 1048576
+PUT_LOG_EVENTS_MAX_SPAN_MS = 24 * 60 * 60 * 1000
+LOG_EVENT_OVERHEAD_BYTES = 26
+BATCH_GET_ITEM_MAX_KEYS = 100
+BATCH_WRITE_ITEM_MAX_ITEMS = 25
+TRANSACT_WRITE_ITEMS_MAX_ITEMS = 100
+DESCRIBE_JOBS_MAX_IDS = 100
+SQS_MAX_MESSAGES_PER_REQUEST = 10
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+CONDITION_OPERATORS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b
+}
+
+
+def _client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class ConditionalCheckFailedException(ClientError):
+    pass
+
+
+class TransactionCanceledException(ClientError):
+    pass
+
+
+class ResourceNotFoundException(ClientError):
+    pass
+
+
+class ResourceAlreadyExistsException(ClientError):
+    pass
+
+
+class QueueDoesNotExist(ClientError):
+    pass
+
+
+class ApiCalls:
+    """
+    Counter of API calls shared by the fakes, with an optional latency added to every call to model the network round
+    trip. Calls made from several threads wait concurrently, like requests on separate connections.
+    """
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, service, operation):
+        with self.lock:
+            self.counts[f'{service}.{operation}'] += 1
+
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def _split_top_level(expression, separator=','):
+    parts, depth, current = [], 0, ''
+
+    for char in expression:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+
+        if char == separator and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+
+    if current.strip():
+        parts.append(current.strip())
+
+    return parts
+
+
+def _closing_parenthesis(expression, start):
+    depth = 0
+
+    for i in range(start, len(expression)):
+        if expression[i] == '(':
+            depth += 1
+        elif expression[i] == ')':
+            depth -= 1
+
+            if depth == 0:
+                return i
+
+    raise ValueError(f'Unbalanced parentheses: {expression}')
+
+
+def _split_top_level_operator(expression, operator):
+    # Splits a condition on the given logical operator, outside of any parentheses
+    depths, depth = [], 0
+
+    for char in expression:
+        depth += char == '('
+        depth -= char == ')'
+        depths.append(depth)
+
+    parts, start = [], 0
+
+    for match in re.finditer(rf'\s+{operator}\s+', expression):
+        if depths[match.start()] == 0:
+            parts.append(expression[start:match.start()].strip())
+            start = match.end()
+
+    parts.append(expression[start:].strip())
+
+    return parts
+
+
+class _Expression:
+    def __init__(self, names=None, values=None):
+        self.names = names or {}
+        self.values = values or {}
+
+    def name(self, token):
+        return self.names[token] if token.startswith('#') else token
+
+    def operand(self, item, token):
+        token = token.strip()
+
+        if token.startswith(':'):
+            return self.values[token]
+
+        match = re.fullmatch(r'if_not_exists\((.+),(.+)\)', token)
+
+        if match:
+            name = self.name(match.group(1).strip())
+            return item[name] if name in item else self.operand(item, match.group(2))
+
+        for operator in ('+', '-'):
+            left, found, right = token.partition(f' {operator} ')
+
+            if found:
+                a, b = self.operand(item, left), self.operand(item, right)
+                return a + b if operator == '+' else a - b
+
+        return item.get(self.name(token))
+
+    def condition(self, item, expression):
+        if expression is None:
+            return True
+
+        expression = expression.strip()
+
+        # AND binds tighter than OR, and parentheses group either
+        for operator, combine in (('OR', any), ('AND', all)):
+            operands = _split_top_level_operator(expression, operator)
+
+            if len(operands) > 1:
+                return combine(self.condition(item, operand) for operand in operands)
+
+        if expression.startswith('(') and _closing_parenthesis(expression, 0) == len(expression) - 1:
+            return self.condition(item, expression[1:-1])
+
+        return self.__term(item, expression)
+
+    def __term(self, item, term):
+        match = re.fullmatch(r'attribute_(not_)?exists\((.+)\)', term)
+
+        if match:
+            return (self.name(match.group(2).strip()) in item) != bool(match.group(1))
+
+        match = re.fullmatch(r'(NOT\s+)?contains\((.+),(.+)\)', term)
+
+        if match:
+            container = item.get(self.name(match.group(2).strip()))
+            found = container is not None and self.operand(item, match.group(3)) in container
+            return found != bool(match.group(1))
+
+        match = re.fullmatch(r'(.+?)\s*(<>|<=|>=|=|<|>)\s*(.+)', term)
+
+        if match is None:
+            raise NotImplementedError(f'Unsupported condition: {term}')
+
+        left, right = self.operand(item, match.group(1)), self.operand(item, match.group(3))
+
+        # Like in DynamoDB, values of different types never match
+        if left is None or right is None or isinstance(left, str) != isinstance(right, str):
+            return False
+
+        return CONDITION_OPERATORS[match.group(2)](left, right)
+
+    def update(self, item, expression):
+        updated = set()
+
+        for action, clause in re.findall(r'\b(SET|ADD|REMOVE)\s+(.+?)(?=\s+\b(?:SET|ADD|REMOVE)\b|$)', expression):
+            for part in _split_top_level(clause):
+                if action == 'SET':
+                    path, _, value = part.partition('=')
+                    name = self.name(path.strip())
+                    item[name] = self.operand(item, value)
+                elif action == 'ADD':
+                    path, value = part.split(None, 1)
+                    name = self.name(path.strip())
+                    operand = self.operand(item, value)
+
+                    # Sets are added as a union, like in DynamoDB
+                    if isinstance(operand, set):
+                        item[name] = item.get(name, set()) | operand
+                    else:
+                        item[name] = item.get(name, 0) + operand
+                else:
+                    name = self.name(part)
+                    item.pop(name, None)
+
+                updated.add(name)
+
+        return updated
+
+
+def _to_python(attribute):
+    (kind, value), = attribute.items()
+
+    if kind == 'N':
+        return int(value) if value.lstrip('-').isdigit() else float(value)
+    elif kind == 'M':
+        return {name: _to_python(v) for name, v in value.items()}
+    elif kind == 'L':
+        return [_to_python(v) for v in value]
+    elif kind == 'NS':
+        return {_to_python({'N': v}) for v in value}
+    elif kind == 'NULL':
+        return None
+
+    return value
+
+
+def _to_attribute(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    elif isinstance(value, (int, float)):
+        return {'N': str(value)}
+    elif isinstance(value, dict):
+        return {'M': {name: _to_attribute(v) for name, v in value.items()}}
+    elif isinstance(value, list):
+        return {'L': [_to_attribute(v) for v in value]}
+    elif isinstance(value, set):
+        return {'NS': [str(v) for v in value]}
+    elif value is None:
+        return {'NULL': True}
+
+    return {'S': value}
+
+
+def _to_python_item(item):
+    return {name: _to_python(attribute) for name, attribute in (item or {}).items()}
+
+
+def _to_attribute_item(item):
+    return {name: _to_attribute(value) for name, value in item.items()}
+
+
+class FakeTable:
+    def __init__(self, name, key_names):
+        self.name = name
+        self.key_names = key_names
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def key(self, key):
+        return tuple(key[name] for name in self.key_names)
+
+
+class FakeDynamoDB:
+    """
+    Stand-in of the low-level DynamoDB client. Tables are declared with their key attribute names, and items are
+    exchanged in the attribute value format like with the real client.
+    """
+
+    def __init__(self, calls, tables):
+        self.calls = calls
+        self.tables = {name: FakeTable(name, key_names) for name, key_names in tables.items()}
+
+        self.exceptions = types.SimpleNamespace(
+            ConditionalCheckFailedException=ConditionalCheckFailedException,
+            TransactionCanceledException=TransactionCanceledException,
+            ResourceNotFoundException=ResourceNotFoundException
+        )
+
+    def __table(self, name, operation):
+        if name not in self.tables:
+            raise ResourceNotFoundException({'Error': {'Code': 'ResourceNotFoundException', 'Message': name}},
+                                            operation)
+
+        return self.tables[name]
+
+    @staticmethod
+    def __expression(names, values):
+        return _Expression(names, _to_python_item(values))
+
+    @staticmethod
+    def __check(expression, old, condition, operation, return_values='NONE'):
+        if not expression.condition(old or {}, condition):
+            response = {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}
+
+            if return_values == 'ALL_OLD' and old:
+                response['Item'] = _to_attribute_item(old)
+
+            raise ConditionalCheckFailedException(response, operation)
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.calls.record('dynamodb', 'GetItem')
+        table = self.__table(TableName, 'GetItem')
+        item = table.items.get(table.key(_to_python_item(Key)))
+
+        return {'Item': _to_attribute_item(item)} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues='NONE', ReturnValuesOnConditionCheckFailure='NONE',
+                 **kwargs):
+        self.calls.record('dynamodb', 'PutItem')
+        table = self.__table(TableName, 'PutItem')
+        item = _to_python_item(Item)
+        key = table.key(item)
+        old = table.items.get(key)
+
+        self.__check(self.__expression(ExpressionAttributeNames, ExpressionAttributeValues), old, ConditionExpression,
+                     'PutItem', ReturnValuesOnConditionCheckFailure)
+        table.items[key] = item
+
+        return {'Attributes': _to_attribute_item(old)} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self.calls.record('dynamodb', 'UpdateItem')
+        table = self.__table(TableName, 'UpdateItem')
+        key_item = _to_python_item(Key)
+        key = table.key(key_item)
+        old = table.items.get(key)
+        expression = self.__expression(ExpressionAttributeNames, ExpressionAttributeValues)
+
+        self.__check(expression, old, ConditionExpression, 'UpdateItem')
+
+        item = dict(old) if old else key_item
+        updated = expression.update(item, UpdateExpression)
+        table.items[key] = item
+
+        if ReturnValues == 'ALL_OLD':
+            attributes = old or {}
+        elif ReturnValues == 'ALL_NEW':
+            attributes = item
+        elif ReturnValues == 'UPDATED_OLD':
+            attributes = {name: old[name] for name in updated if old and name in old}
+        elif ReturnValues == 'UPDATED_NEW':
+            attributes = {name: item[name] for name in updated if name in item}
+        else:
+            attributes = {}
+
+        return {'Attributes': _to_attribute_item(attributes)} if attributes else {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self.calls.record('dynamodb', 'DeleteItem')
+        table = self.__table(TableName, 'DeleteItem')
+        key = table.key(_to_python_item(Key))
+        old = table.items.get(key)
+
+        self.__check(self.__expression(ExpressionAttributeNames, ExpressionAttributeValues), old, ConditionExpression,
+                     'DeleteItem')
+        table.items.pop(key, None)
+
+        return {'Attributes': _to_attribute_item(old)} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.calls.record('dynamodb', 'BatchGetItem')
+        responses = {}
+
+        if sum(len(request['Keys']) for request in RequestItems.values()) > BATCH_GET_ITEM_MAX_KEYS:
+            raise _client_error('ValidationException', 'BatchGetItem', 'Too many items requested')
+
+        for name, request in RequestItems.items():
+            table = self.__table(name, 'BatchGetItem')
+            keys = [table.key(_to_python_item(key)) for key in request['Keys']]
+            responses[name] = [_to_attribute_item(table.items[key]) for key in keys if key in table.items]
+
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.calls.record('dynamodb', 'BatchWriteItem')
+
+        if sum(len(requests) for requests in RequestItems.values()) > BATCH_WRITE_ITEM_MAX_ITEMS:
+            raise _client_error('ValidationException', 'BatchWriteItem', 'Too many items requested')
+
+        for name, requests in RequestItems.items():
+            table = self.__table(name, 'BatchWriteItem')
+
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = _to_python_item(request['PutRequest']['Item'])
+                    table.items[table.key(item)] = item
+                else:
+                    table.items.pop(table.key(_to_python_item(request['DeleteRequest']['Key'])), None)
+
+        return {'UnprocessedItems': {}}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        """
+        Supports Put actions. Like in DynamoDB, every condition is checked before any item is written, and the
+        transaction is cancelled with a reason per action when any of them fails.
+        """
+
+        self.calls.record('dynamodb', 'TransactWriteItems')
+
+        if len(TransactItems) > TRANSACT_WRITE_ITEMS_MAX_ITEMS:
+            raise _client_error('ValidationException', 'TransactWriteItems', 'Too many items requested')
+
+        writes, reasons = [], []
+
+        for action in TransactItems:
+            if set(action) != {'Put'}:
+                raise NotImplementedError(f'Unsupported transaction action: {", ".join(action)}')
+
+            put = action['Put']
+            table = self.__table(put['TableName'], 'TransactWriteItems')
+            item = _to_python_item(put['Item'])
+            key = table.key(item)
+            old = table.items.get(key)
+            expression = self.__expression(put.get('ExpressionAttributeNames'), put.get('ExpressionAttributeValues'))
+
+            if expression.condition(old or {}, put.get('ConditionExpression')):
+                reasons.append({'Code': 'None'})
+            else:
+                reason = {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+
+                if put.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and old:
+                    reason['Item'] = _to_attribute_item(old)
+
+                reasons.append(reason)
+
+            writes.append((table, key, item))
+
+        if any(reason['Code'] != 'None' for reason in reasons):
+            raise TransactionCanceledException(
+                {'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                 'CancellationReasons': reasons}, 'TransactWriteItems'
+            )
+
+        for table, key, item in writes:
+            table.items[key] = item
+
+        return {}
+
+    def scan(self, TableName, FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+             Limit=None, ExclusiveStartKey=None, **kwargs):
+        """
+        Scans the items of a table in key order. Like in DynamoDB, Limit is the number of items evaluated before the
+        filter, so pages may have fewer items or none at all.
+        """
+
+        self.calls.record('dynamodb', 'Scan')
+        table = self.__table(TableName, 'Scan')
+        expression = self.__expression(ExpressionAttributeNames, ExpressionAttributeValues)
+        keys = sorted(table.items)
+
+        if ExclusiveStartKey is not None:
+            start_key = table.key(_to_python_item(ExclusiveStartKey))
+            keys = [key for key in keys if key > start_key]
+
+        evaluated = keys[:Limit] if Limit else keys
+        items = [table.items[key] for key in evaluated if expression.condition(table.items[key], FilterExpression)]
+        response = {'Items': [_to_attribute_item(item) for item in items], 'Count': len(items)}
+
+        if len(evaluated) < len(keys):
+            response['LastEvaluatedKey'] = _to_attribute_item(dict(zip(table.key_names, evaluated[-1])))
+
+        return response
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+              ExclusiveStartKey=None, **kwargs):
+        """
+        Queries a table by scanning all its items, with the key condition evaluated as a condition expression. Only
+        the "a = :v AND b BETWEEN :s AND :e" form of key conditions is supported.
+        """
+
+        self.calls.record('dynamodb', 'Query')
+        table = self.__table(TableName, 'Query')
+        condition = re.sub(r'(\S+) BETWEEN (\S+) AND (\S+)', r'\1 >= \2 AND \1 <= \3', KeyConditionExpression)
+        expression = self.__expression(ExpressionAttributeNames, ExpressionAttributeValues)
+        items = [item for _, item in sorted(table.items.items()) if expression.condition(item, condition)]
+
+        return {'Items': [_to_attribute_item(item) for item in items], 'Count': len(items)}
+
+
+class FakeLogs:
+    """
+    Stand-in of the boto3 CloudWatch Logs client. PutLogEvents requests are validated against the service quotas and
+    the written events are kept per log stream.
+    """
+
+    def __init__(self, calls, streams=()):
+        self.calls = calls
+        self.events = {stream: [] for stream in streams}
+
+        self.exceptions = types.SimpleNamespace(
+            ResourceNotFoundException=ResourceNotFoundException,
+            ResourceAlreadyExistsException=ResourceAlreadyExistsException
+        )
+
+    def create_log_stream(self, logGroupName, logStreamName):
+        self.calls.record('logs', 'CreateLogStream')
+
+        if (logGroupName, logStreamName) in self.events:
+            raise ResourceAlreadyExistsException(
+                {'Error': {'Code': 'ResourceAlreadyExistsException', 'Message': logStreamName}}, 'CreateLogStream'
+            )
+
+        self.events[(logGroupName, logStreamName)] = []
+        return {}
+
+    def put_log_events(self, logGroupName, logStreamName, logEvents, **kwargs):
+        self.calls.record('logs', 'PutLogEvents')
+        stream = (logGroupName, logStreamName)
+
+        if stream not in self.events:
+            raise ResourceNotFoundException(
+                {'Error': {'Code': 'ResourceNotFoundException', 'Message': logStreamName}}, 'PutLogEvents'
+            )
+
+        timestamps = [event['timestamp'] for event in logEvents]
+        size = sum(len(event['message'].encode('utf-8')) + LOG_EVENT_OVERHEAD_BYTES for event in logEvents)
+
+        if not logEvents or len(logEvents) > PUT_LOG_EVENTS_MAX_EVENTS:
+            raise _client_error('InvalidParameterException', 'PutLogEvents', f'{len(logEvents)} events in batch')
+        elif size > PUT_LOG_EVENTS_MAX_BYTES:
+            raise _client_error('InvalidParameterException', 'PutLogEvents', f'Batch of {size} bytes')
+        elif timestamps != sorted(timestamps):
+            raise _client_error('InvalidParameterException', 'PutLogEvents', 'Events are not in chronological order')
+        elif timestamps[-1] - timestamps[0] > PUT_LOG_EVENTS_MAX_SPAN_MS:
+            raise _client_error('InvalidParameterException', 'PutLogEvents', 'Batch spans more than 24 hours')
+
+        self.events[stream].extend(logEvents)
+        return {}
+
+    def logged_messages(self):
+        return [event['message'] for events in self.events.values() for event in events]
+
+
+class FakeBatch:
+    """
+    Stand-in of the AWS Batch client, answering DescribeJobs from a {job ID: job detail} dictionary. Jobs missing from
+    the dictionary are unknown to AWS Batch, like the jobs it has already forgotten.
+    """
+
+    def __init__(self, calls, jobs=None):
+        self.calls = calls
+        self.jobs = jobs if jobs is not None else {}
+
+    def describe_jobs(self, jobs):
+        self.calls.record('batch', 'DescribeJobs')
+
+        if len(jobs) > DESCRIBE_JOBS_MAX_IDS:
+            raise _client_error('ClientException', 'DescribeJobs', 'Too many jobs requested')
+
+        return {'jobs': [self.jobs[job_id] for job_id in jobs if job_id in self.jobs]}
+
+
+class FakeSQS:
+    """
+    Stand-in of the boto3 SQS client. Received messages stay hidden until they are deleted or their visibility timeout
+    expires, like in SQS, and are received again in the order they became visible. Requests are serialised with a lock,
+    so the fake can be shared by several threads.
+    """
+
+    def __init__(self, calls, queues=()):
+        self.calls = calls
+
+        # {queue name: ({message ID: [body, receipt handle, visible at]}, message IDs by visibility time)}
+        self.queues = {name: ({}, deque()) for name in queues}
+        self.receipts = {}
+        self.lock = threading.Lock()
+
+        self.exceptions = types.SimpleNamespace(QueueDoesNotExist=QueueDoesNotExist)
+
+    def __queue(self, queue_url, operation):
+        name = queue_url.rsplit('/', 1)[-1]
+
+        if name not in self.queues:
+            raise QueueDoesNotExist({'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue', 'Message': name}},
+                                    operation)
+
+        return self.queues[name]
+
+    def get_queue_url(self, QueueName, **kwargs):
+        self.calls.record('sqs', 'GetQueueUrl')
+        self.__queue(QueueName, 'GetQueueUrl')
+
+        return {'QueueUrl': f'https://sqs.us-east-1.amazonaws.com/123456789012/{QueueName}'}
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.calls.record('sqs', 'SendMessage')
+        message_id = str(uuid.uuid4())
+
+        with self.lock:
+            messages, order = self.__queue(QueueUrl, 'SendMessage')
+            messages[message_id] = [MessageBody, None, 0]
+            order.append(message_id)
+
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        self.calls.record('sqs', 'ReceiveMessage')
+
+        if not 1 <= MaxNumberOfMessages <= SQS_MAX_MESSAGES_PER_REQUEST:
+            raise _client_error('InvalidParameterValue', 'ReceiveMessage', f'{MaxNumberOfMessages} messages')
+
+        received = []
+        now = time.monotonic()
+
+        with self.lock:
+            messages, order = self.__queue(QueueUrl, 'ReceiveMessage')
+
+            while order and len(received) < MaxNumberOfMessages:
+                message = messages.get(order[0])
+
+                # Deleted messages are dropped from the order lazily
+                if message is None:
+                    order.popleft()
+                    continue
+
+                if message[2] > now:
+                    break
+
+                message_id = order.popleft()
+                self.receipts.pop(message[1], None)
+                message[1] = str(uuid.uuid4())
+                message[2] = now + VisibilityTimeout
+                self.receipts[message[1]] = message_id
+                order.append(message_id)
+
+                received.append({'MessageId': message_id, 'ReceiptHandle': message[1], 'Body': message[0]})
+
+        return {'Messages': received} if received else {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.calls.record('sqs', 'DeleteMessageBatch')
+
+        if not 1 <= len(Entries) <= SQS_MAX_MESSAGES_PER_REQUEST:
+            raise _client_error('TooManyEntriesInBatchRequest', 'DeleteMessageBatch', f'{len(Entries)} entries')
+
+        successful, failed = [], []
+
+        with self.lock:
+            messages, _ = self.__queue(QueueUrl, 'DeleteMessageBatch')
+
+            for entry in Entries:
+                message_id = self.receipts.pop(entry['ReceiptHandle'], None)
+
+                if message_id is not None and messages.pop(message_id, None) is not None:
+                    successful.append({'Id': entry['Id']})
+                else:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+
+        return {'Successful': successful, 'Failed': failed}
+
+    def visible_messages(self, queue_name):
+        now = time.monotonic()
+        return sum(message[2] <= now for message in self.queues[queue_name][0].values())
+
+
+class FakeS3:
+    """
+    Stand-in of the boto3 S3 client for single and multipart uploads. Multipart uploads are only visible once they are
+    completed, and every part but the last must be at least 5 MiB, like in S3.
+    """
+
+    def __init__(self, calls, buckets=()):
+        self.calls = calls
+        self.objects = {bucket: {} for bucket in buckets}
+
+        # {upload ID: (bucket, key, {part number: data})}
+        self.uploads = {}
+
+    def __bucket(self, bucket, operation):
+        if bucket not in self.objects:
+            raise _client_error('NoSuchBucket', operation, bucket)
+
+        return self.objects[bucket]
+
+    def __upload(self, upload_id, operation):
+        if upload_id not in self.uploads:
+            raise _client_error('NoSuchUpload', operation, upload_id)
+
+        return self.uploads[upload_id]
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.record('s3', 'PutObject')
+        self.__bucket(Bucket, 'PutObject')[Key] = bytes(Body)
+
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.calls.record('s3', 'GetObject')
+        objects = self.__bucket(Bucket, 'GetObject')
+
+        if Key not in objects:
+            raise _client_error('NoSuchKey', 'GetObject', Key)
+
+        return {'Body': io.BytesIO(objects[Key])}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.record('s3', 'CreateMultipartUpload')
+        self.__bucket(Bucket, 'CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = (Bucket, Key, {})
+
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.calls.record('s3', 'UploadPart')
+        _, _, parts = self.__upload(UploadId, 'UploadPart')
+        parts[PartNumber] = bytes(Body)
+
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.calls.record('s3', 'CompleteMultipartUpload')
+        _, _, parts = self.__upload(UploadId, 'CompleteMultipartUpload')
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+
+        if not numbers or any(len(parts[number]) < S3_MIN_PART_SIZE for number in numbers[:-1]):
+            raise _client_error('EntityTooSmall', 'CompleteMultipartUpload')
+
+        self.objects[Bucket][Key] = b''.join(parts[number] for number in numbers)
+        del self.uploads[UploadId]
+
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.calls.record('s3', 'AbortMultipartUpload')
+        self.__upload(UploadId, 'AbortMultipartUpload')
+        del self.uploads[UploadId]
+
+        return {}
@@ -0,0 +1,452 @@
+"""
+@Description: end-to-end benchmark of the event handlers. A generated event stream is replayed against the
+processBatchEvents, processTaskStateEvents and processContainerInstanceEvents handlers, running on in-memory stand-ins
+of DynamoDB and CloudWatch Logs, either one event per invocation (direct ingestion mode) or in SQS batches (sqs
+ingestion mode). Jobs left tracked by lost completion events can then be reconciled with the reconcileStaleJobs
+function, resolving their state from an in-memory AWS Batch. Array jobs count as one job, whatever their size. It
+reports the throughput, the latency percentiles of each handler and the AWS API calls made per job, and fails when they
+regress compared to a baseline. Usage:
+
+python -m benchmarks.harness --jobs 5000 --mode sqs --save-baseline benchmarks/baseline.json
+python -m benchmarks.harness --jobs 5000 --mode sqs --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+from .events import EventStream
+from .fakes import ApiCalls, FakeBatch, FakeDynamoDB, FakeLogs
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(PROJECT_DIR, 'assets', 'lambda')
+LAYER_DIR = os.path.join(LAMBDA_DIR, 'layer_common', 'python')
+
+if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+
+from batch_insights import arrays, jobs, runtime
+
+JOBS_LOG_GROUP = '/aws-batch-insights/jobs'
+JOBS_LOG_STREAM = 'Jobs'
+DURATION_SKETCHES_TABLE = 'JobDurationSketches'
+STATE_GAUGES_TABLE = 'JobStateGauges'
+EVENT_LEDGER_TABLE = 'ProcessedEvents'
+RUNTIME_BASELINES_TABLE = 'RuntimeBaselines'
+
+TABLES = {
+    'BatchJobsTracking': ('JobId',),
+    'ContainerInstanceTracking': ('ContainerInstanceArn',),
+    DURATION_SKETCHES_TABLE: ('SketchKey', 'Bucket'),
+    STATE_GAUGES_TABLE: ('Gauge',),
+    EVENT_LEDGER_TABLE: ('EventKey',),
+    RUNTIME_BASELINES_TABLE: ('Baseline',)
+}
+
+ENVIRONMENT = {
+    'JOBS_LOG_GROUP': JOBS_LOG_GROUP,
+    'JOBS_LOG_STREAM': JOBS_LOG_STREAM,
+    'JOBS_TRACKING_TABLE': 'BatchJobsTracking',
+    'CONTAINER_INSTANCE_TRACKING_TABLE': 'ContainerInstanceTracking',
+    'EMIT_JOB_METRICS': 'false'
+}
+
+# {detail type: (handler name, function directory, delivered through SQS in sqs mode)}
+HANDLERS = {
+    'Batch Job State Change': ('processBatchEvents', 'func_process_batch_events', True),
+    'ECS Task State Change': ('processTaskStateEvents', 'func_process_task_state_events', True),
+    'ECS Container Instance State Change': ('processContainerInstanceEvents',
+                                            'func_process_container_instance_events', False)
+}
+
+RECONCILE_HANDLER = ('reconcileStaleJobs', 'func_reconcile_stale_jobs')
+
+INGESTION_MODES = ['direct', 'sqs']
+SQS_BATCH_SIZE = 100
+SQS_MAX_BATCHING_WINDOW_MS = 5000
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# Latency changes smaller than this are considered noise, whatever the tolerance
+MIN_LATENCY_REGRESSION_MS = 0.05
+
+
+class Environment:
+    """
+    Fresh copies of the handler modules bound to in-memory services, as in a newly started Lambda execution
+    environment.
+    """
+
+    def __init__(self, api_latency_ms=0, environment=None, batch_jobs=None):
+        self.calls = ApiCalls(api_latency_ms)
+        self.dynamodb = FakeDynamoDB(self.calls, TABLES)
+        self.logs = FakeLogs(self.calls, [(JOBS_LOG_GROUP, JOBS_LOG_STREAM)])
+        self.batch = FakeBatch(self.calls, batch_jobs)
+        self.handlers = {}
+
+        variables = dict(ENVIRONMENT, **(environment or {}))
+
+        with self.__patched(variables):
+            functions = [(name, directory) for name, directory, _ in HANDLERS.values()] + [RECONCILE_HANDLER]
+
+            for name, directory in functions:
+                self.handlers[name] = self.__load(name, directory)
+
+    def activate(self):
+        # The handlers of an environment share the clients of the runtime, which are replaced before every replay
+        runtime.reset()
+        runtime.set_client('dynamodb', self.dynamodb)
+        runtime.set_client('logs', self.logs)
+        runtime.set_client('batch', self.batch)
+
+    @contextlib.contextmanager
+    def __patched(self, variables):
+        original_environ = dict(os.environ)
+        os.environ.update(variables)
+
+        try:
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(original_environ)
+
+    @staticmethod
+    def __load(name, directory):
+        path = os.path.join(LAMBDA_DIR, directory, 'index.py')
+        spec = importlib.util.spec_from_file_location(f'benchmark_{name}', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        return module.handler
+
+
+class _Stats:
+    def __init__(self):
+        self.latencies_ms = []
+        self.events = 0
+        self.errors = 0
+        self.failed_records = 0
+
+
+def _sqs_records(events):
+    return {'Records': [
+        {'messageId': f'{i}', 'body': json.dumps(event)} for i, event in enumerate(events)
+    ]}
+
+
+def replay(stream, mode='direct', api_latency_ms=0, batch_size=SQS_BATCH_SIZE,
+           max_batching_window_ms=SQS_MAX_BATCHING_WINDOW_MS, environment=None, reconcile=False):
+    """
+    Replays an event stream and returns the raw results of the run. In sqs mode, the events of each queue are delivered
+    once the batch is full or its oldest event has waited for the batching window, in stream time. With reconcile, the
+    jobs still tracked at the end of the stream are reconciled, regardless of how long ago they were updated.
+    """
+
+    env = Environment(api_latency_ms, environment, batch_jobs=stream.job_details)
+    env.activate()
+    stats = {name: _Stats() for name, _, _ in HANDLERS.values()}
+
+    if reconcile:
+        stats[RECONCILE_HANDLER[0]] = _Stats()
+
+    buffers = {name: [] for name, _, queued in HANDLERS.values() if queued}
+    sink = io.StringIO()
+    elapsed_ns = 0
+
+    def invoke(name, payload, n_events):
+        nonlocal elapsed_ns
+
+        start = time.perf_counter_ns()
+
+        try:
+            response = env.handlers[name](payload, None)
+        except Exception:
+            response = None
+            stats[name].errors += 1
+
+        duration = time.perf_counter_ns() - start
+        elapsed_ns += duration
+
+        stats[name].latencies_ms.append(duration / 1e6)
+        stats[name].events += n_events
+
+        if isinstance(response, dict):
+            stats[name].failed_records += len(response.get('batchItemFailures', []))
+
+        # Handler logs are discarded as they are produced, so that they don't accumulate in memory
+        sink.seek(0)
+        sink.truncate()
+
+    def deliver(name):
+        events = [event for _, event in buffers[name]]
+        buffers[name].clear()
+        invoke(name, _sqs_records(events), len(events))
+
+    # Handler logs are discarded so that printing them to a terminal doesn't skew the measurements
+    with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+        for delivered_at, event in stream:
+            name, _, queued = HANDLERS[event['detail-type']]
+
+            if mode == 'sqs':
+                for buffered_name, buffer in buffers.items():
+                    if buffer and delivered_at - buffer[0][0] >= max_batching_window_ms:
+                        deliver(buffered_name)
+
+            if mode == 'sqs' and queued:
+                buffers[name].append((delivered_at, event))
+
+                if len(buffers[name]) >= batch_size:
+                    deliver(name)
+            else:
+                invoke(name, event, 1)
+
+        for name, buffer in buffers.items():
+            if buffer:
+                deliver(name)
+
+        if reconcile:
+            invoke(RECONCILE_HANDLER[0], {'staleAfterHours': 0}, 0)
+
+    return env, stats, elapsed_ns
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))]
+
+
+def summarize(env, stats, elapsed_ns, n_jobs):
+    total_events = sum(s.events for s in stats.values())
+    logged_records = [json.loads(message) for message in env.logs.logged_messages()]
+
+    # Array children logged on their own are reported apart, so that the counts of jobs are comparable with and without
+    # them
+    logged_jobs = [job for job in logged_records if arrays.parent_job_id(job['JobId']) is None]
+    distinct_job_ids = {job['JobId'] for job in logged_jobs}
+
+    return {
+        'Jobs': n_jobs,
+        'Events': total_events,
+        'EventsPerSecond': round(total_events / (elapsed_ns / 1e9), 1) if elapsed_ns else None,
+        'LoggedJobs': len(logged_jobs),
+        'MissingJobs': n_jobs - len(distinct_job_ids),
+        'DuplicatedJobs': len(logged_jobs) - len(distinct_job_ids),
+        'HydratedJobs': len({
+            job['JobId'] for job in logged_jobs if 'InstanceType' in job or 'ChildInstanceTypes' in job
+        }),
+        'AbandonedJobs': sum(job['Status'] == 'ABANDONED' for job in logged_jobs),
+        'ArrayJobs': sum('ArraySize' in job for job in logged_jobs),
+        'SummarizedChildJobs': sum(job.get('ChildJobs', 0) for job in logged_jobs),
+        'LoggedChildJobs': len(logged_records) - len(logged_jobs),
+        # Logged jobs leave a tombstone rather than their tracking item
+        'TrackedJobs': sum(
+            jobs.COMPLETED_STATUS_ATTRIBUTE not in item
+            for item in env.dynamodb.tables[ENVIRONMENT['JOBS_TRACKING_TABLE']].items.values()
+        ),
+        # Jobs still counted in a status of the state gauges, which is 0 once every job has completed
+        'GaugedJobs': sum(
+            count for item in env.dynamodb.tables[STATE_GAUGES_TABLE].items.values()
+            for name, count in item.items() if name != 'Gauge'
+        ),
+        'ApiCalls': env.calls.total(),
+        'ApiCallsPerJob': round(env.calls.total() / n_jobs, 4) if n_jobs else None,
+        'ApiCallsPerJobByOperation': {
+            operation: round(count / n_jobs, 4) for operation, count in sorted(env.calls.counts.items())
+        } if n_jobs else {},
+        'Handlers': {
+            name: dict(
+                {
+                    'Invocations': len(s.latencies_ms),
+                    'Events': s.events,
+                    'Errors': s.errors,
+                    'FailedRecords': s.failed_records,
+                    'MeanLatencyMs': round(statistics.fmean(s.latencies_ms), 4) if s.latencies_ms else None
+                },
+                **{f'p{p}LatencyMs': _percentile(s.latencies_ms, p) for p in LATENCY_PERCENTILES}
+            )
+            for name, s in stats.items()
+        }
+    }
+
+
+def run(n_jobs, mode='direct', repeat=3, api_latency_ms=0, stream_options=None, environment=None, reconcile=False):
+    """
+    Runs the benchmark several times, each time on a fresh environment, and keeps the median of the timings. Counts
+    are deterministic for a given stream, so they are taken from the first run.
+    """
+
+    runs = []
+
+    for _ in range(repeat):
+        stream = EventStream(n_jobs, **(stream_options or {}))
+        runs.append(summarize(*replay(stream, mode, api_latency_ms, environment=environment, reconcile=reconcile),
+                              n_jobs))
+
+    result = runs[0]
+    result['Settings'] = {
+        'Mode': mode, 'ApiLatencyMs': api_latency_ms, 'StreamOptions': stream_options or {},
+        'Environment': environment or {}, 'Reconcile': reconcile
+    }
+    result['EventsPerSecond'] = statistics.median(r['EventsPerSecond'] for r in runs)
+
+    for name, handler in result['Handlers'].items():
+        for key in ['MeanLatencyMs'] + [f'p{p}LatencyMs' for p in LATENCY_PERCENTILES]:
+            values = [r['Handlers'][name][key] for r in runs if r['Handlers'][name][key] is not None]
+            handler[key] = round(statistics.median(values), 4) if values else None
+
+    return result
+
+
+def compare(result, baseline, tolerance=0.2):
+    """
+    Returns the list of regressions of a result compared to a baseline. Timings regress when they are worse than the
+    baseline by more than the relative tolerance, whereas API calls, errors and missing jobs regress on any increase,
+    as they don't depend on the machine.
+    """
+
+    if result['Jobs'] != baseline.get('Jobs') or result['Settings'] != baseline.get('Settings'):
+        raise ValueError(f'The baseline was generated with different settings: {baseline.get("Settings")} and '
+                         f'{baseline.get("Jobs")} jobs')
+
+    regressions = []
+
+    def check(path, value, reference, higher_is_better=False, exact=False, min_margin=0.0):
+        if value is None or reference is None:
+            return
+
+        margin = 1e-9 if exact else max(tolerance * abs(reference), min_margin)
+
+        if (value < reference - margin) if higher_is_better else (value > reference + margin):
+            regressions.append(f'{path}: {value} (baseline {reference})')
+
+    check('EventsPerSecond', result['EventsPerSecond'], baseline.get('EventsPerSecond'), higher_is_better=True)
+    check('ApiCallsPerJob', result['ApiCallsPerJob'], baseline.get('ApiCallsPerJob'), exact=True)
+    check('MissingJobs', result['MissingJobs'], baseline.get('MissingJobs'), exact=True)
+    check('DuplicatedJobs', result['DuplicatedJobs'], baseline.get('DuplicatedJobs'), exact=True)
+    check('HydratedJobs', result['HydratedJobs'], baseline.get('HydratedJobs'), higher_is_better=True, exact=True)
+
+    for operation, value in result['ApiCallsPerJobByOperation'].items():
+        check(f'ApiCallsPerJobByOperation.{operation}', value,
+              baseline.get('ApiCallsPerJobByOperation', {}).get(operation, 0), exact=True)
+
+    for name, handler in result['Handlers'].items():
+        reference = baseline.get('Handlers', {}).get(name, {})
+
+        for key in ('Errors', 'FailedRecords'):
+            check(f'Handlers.{name}.{key}', handler[key], reference.get(key), exact=True)
+
+        for p in LATENCY_PERCENTILES:
+            key = f'p{p}LatencyMs'
+            check(f'Handlers.{name}.{key}', handler[key], reference.get(key), min_margin=MIN_LATENCY_REGRESSION_MS)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the event handlers against in-memory AWS services')
+    parser.add_argument('--jobs', type=int, default=2000, help='Number of jobs to simulate')
+    parser.add_argument('--instances', type=int, default=50, help='Number of container instances')
+    parser.add_argument('--mode', choices=INGESTION_MODES, default='direct', help='Ingestion mode to simulate')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the median timings are reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the event stream')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Fraction of events delivered twice')
+    parser.add_argument('--max-delivery-delay-ms', type=int, default=0, help='Maximum random delivery delay of events')
+    parser.add_argument('--lost-completion-rate', type=float, default=0.0,
+                        help='Fraction of jobs whose completion event is never delivered')
+    parser.add_argument('--array-job-rate', type=float, default=0.0, help='Fraction of jobs submitted as array jobs')
+    parser.add_argument('--array-size', type=int, default=10, help='Number of children of every array job')
+    parser.add_argument('--array-child-detail', action='store_true',
+                        help='Tracks and logs array children on their own as well')
+    parser.add_argument('--pipeline-concurrency', type=int, default=1,
+                        help='Number of threads processing the events of a batch in the sqs mode')
+    parser.add_argument('--duration-sketches', action='store_true',
+                        help='Keeps quantile sketches of the durations of the completed jobs')
+    parser.add_argument('--state-gauges', action='store_true', help='Counts the jobs in each status of every job queue')
+    parser.add_argument('--event-ledger', action='store_true',
+                        help='Claims every event in a DynamoDB ledger shared by all the execution environments')
+    parser.add_argument('--regression-detector', action='store_true',
+                        help='Updates the runtime baselines of the job definitions with every completed job')
+    parser.add_argument('--reconcile', action='store_true', help='Reconciles the jobs left tracked at the end')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='Latency added to every AWS API call')
+    parser.add_argument('--log-stream-shards', type=int, default=1, help='Number of shards of the jobs log stream')
+    parser.add_argument('--output', help='Writes the results to a JSON file')
+    parser.add_argument('--baseline', help='Fails when the results regress compared to this JSON file')
+    parser.add_argument('--save-baseline', help='Writes the results to a JSON file to be used as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative tolerance of the timings')
+    args = parser.parse_args(argv)
+
+    environment = {}
+
+    if args.log_stream_shards > 1:
+        environment['JOBS_LOG_STREAM_SHARDS'] = str(args.log_stream_shards)
+
+    if args.array_child_detail:
+        environment['ARRAY_CHILD_DETAIL'] = 'true'
+
+    if args.duration_sketches:
+        environment['DURATION_SKETCHES_TABLE'] = DURATION_SKETCHES_TABLE
+
+    if args.state_gauges:
+        environment['STATE_GAUGES_TABLE'] = STATE_GAUGES_TABLE
+
+    if args.event_ledger:
+        environment['EVENT_LEDGER_TABLE'] = EVENT_LEDGER_TABLE
+
+    if args.regression_detector:
+        environment['RUNTIME_BASELINES_TABLE'] = RUNTIME_BASELINES_TABLE
+
+    if args.pipeline_concurrency > 1:
+        environment['PIPELINE_CONCURRENCY'] = str(args.pipeline_concurrency)
+
+    result = run(
+        args.jobs, args.mode, args.repeat, args.api_latency_ms,
+        stream_options={
+            'n_instances': args.instances,
+            'seed': args.seed,
+            'duplicate_rate': args.duplicate_rate,
+            'max_delivery_delay_ms': args.max_delivery_delay_ms,
+            'lost_completion_rate': args.lost_completion_rate,
+            'array_job_rate': args.array_job_rate,
+            'array_size': args.array_size
+        },
+        environment=environment or None,
+        reconcile=args.reconcile
+    )
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(result, f, indent=2)
+
+    print(json.dumps(result, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        try:
+            regressions = compare(result, baseline, args.tolerance)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
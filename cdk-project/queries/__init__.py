@@ -0,0 +1,4 @@
+"""
+@Description: builders of the CloudWatch Logs Insights queries of the dashboard. They only depend on the standard
+library, so that the stacks and the offline analysis tools share them without the latter importing the CDK.
+"""
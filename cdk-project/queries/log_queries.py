@@ -0,0 +1,167 @@
+import json
+
+
+JOB_LOG_HISTORY = \
+'''
+fields @timestamp, JobId, JobName, JobQueue, JobDefinition, Status, TotalSubmittedSeconds, TotalPendingSeconds, TotalRunnableSeconds, TotalStartingSeconds, TotalRunningSeconds, AvailabilityZone, InstanceType, Architecture, ArraySize, ChildJobs, ChildSuccessRate
+| sort @timestamp desc
+'''
+
+DEFAULT_TIME_RANGE = '-P12M'
+FILTER_OPERATORS = {'=', '!=', 'in'}
+
+# Field index policies are limited to 20 fields
+MAX_INDEXED_FIELDS = 20
+
+# Jobs logged by the reconciler after AWS Batch forgot them only have their tracked fields, with no name, definition or
+# final status, so they are left out of every aggregation. The job log history still lists them
+ABANDONED_STATUS = 'ABANDONED'
+AGGREGATED_JOBS_FILTER = ('Status', '!=', ABANDONED_STATUS)
+
+# Aggregations that analysis sections can select, by the name of their output column
+JOB_METRICS = {
+    'Jobs': 'count(*)',
+    'SucceededRate': 'sum(Status="SUCCEEDED") / count(*) * 100',
+    'AvgRunnableMinutes': 'avg(TotalRunnableSeconds) / 60',
+    'AvgStartingMinutes': 'avg(TotalStartingSeconds) / 60',
+    'AvgRunningMinutes': 'avg(TotalRunningSeconds) / 60'
+}
+
+# Every job metric as a (numerator, denominator, scale) ratio of partial aggregations, which are sums and counts: the
+# partials computed over separate days are merged by adding them, which can't be done with averages and rates
+PARTIAL_AGGREGATIONS = {
+    'Jobs': 'count(*)',
+    'Succeeded': 'sum(Status="SUCCEEDED")',
+    'RunnableSeconds': 'sum(TotalRunnableSeconds)',
+    'RunnableJobs': 'count(TotalRunnableSeconds)',
+    'StartingSeconds': 'sum(TotalStartingSeconds)',
+    'StartingJobs': 'count(TotalStartingSeconds)',
+    'RunningSeconds': 'sum(TotalRunningSeconds)',
+    'RunningJobs': 'count(TotalRunningSeconds)'
+}
+
+MERGEABLE_JOB_METRICS = {
+    'Jobs': ('Jobs', None, 1),
+    'SucceededRate': ('Succeeded', 'Jobs', 100),
+    'AvgRunnableMinutes': ('RunnableSeconds', 'RunnableJobs', 1 / 60),
+    'AvgStartingMinutes': ('StartingSeconds', 'StartingJobs', 1 / 60),
+    'AvgRunningMinutes': ('RunningSeconds', 'RunningJobs', 1 / 60)
+}
+
+# Snapshots hold the partials of a query per day
+SNAPSHOT_BIN = '1d'
+
+# Every analysis section is compiled to a single query that computes all its metrics per value of its dimension, so
+# the logged jobs are scanned once per section instead of once per metric. Sections can also restrict the jobs they
+# analyse with (field, operator, value) filters, which run before the aggregation, and set their own time range as an
+# ISO 8601 duration
+ANALYSIS_SECTIONS = [
+    {'Dimension': 'Architecture', 'Label': 'CPU architecture', 'Metrics': list(JOB_METRICS)},
+    {'Dimension': 'JobDefinition', 'Label': 'job definition', 'Metrics': list(JOB_METRICS)},
+    {'Dimension': 'JobQueue', 'Label': 'job queue', 'Metrics': list(JOB_METRICS)}
+]
+
+
+def build_count_query(by_field, label='Count'):
+    return f'''
+filter {compile_filter(*AGGREGATED_JOBS_FILTER)}
+| stats count(*) as {label} by {by_field}
+'''
+
+
+def compile_filter(field, operator, value):
+    if operator not in FILTER_OPERATORS:
+        raise ValueError(f'Invalid filter operator "{operator}", expected one of {sorted(FILTER_OPERATORS)}')
+
+    if operator == 'in':
+        return f'{field} in [{", ".join(json.dumps(v) for v in value)}]'
+
+    return f'{field} {operator} {json.dumps(value)}'
+
+
+def compile_section_query(section):
+    """
+    Compiles an analysis section into a Logs Insights query. Filters are placed before the stats command, so that the
+    jobs they discard are never aggregated and indexed fields can skip the log events that don't match them.
+    """
+
+    unknown_metrics = set(section['Metrics']) - set(JOB_METRICS)
+
+    if unknown_metrics:
+        raise ValueError(f'Unknown metrics {sorted(unknown_metrics)}, expected any of {sorted(JOB_METRICS)}')
+
+    filters = [AGGREGATED_JOBS_FILTER] + list(section.get('Filters', []))
+    commands = [f'filter {compile_filter(*f)}' for f in filters]
+    commands.append(
+        f'stats {", ".join(f"{JOB_METRICS[m]} as {m}" for m in section["Metrics"])} by {section["Dimension"]}'
+    )
+
+    return '\n| '.join(commands)
+
+
+def build_snapshot(snapshot_id, dimension, metrics, filters=()):
+    """
+    Builds the definition of a dashboard snapshot, given the job metrics to compute by the name of their output column.
+    Its query computes the partial aggregations the metrics need per day and value of the dimension.
+    """
+
+    formulas = {name: MERGEABLE_JOB_METRICS[metric] for name, metric in metrics.items()}
+    partials = sorted({p for numerator, denominator, _ in formulas.values() for p in (numerator, denominator) if p})
+
+    commands = [f'filter {compile_filter(*f)}' for f in [AGGREGATED_JOBS_FILTER] + list(filters)]
+    commands.append(
+        f'stats {", ".join(f"{PARTIAL_AGGREGATIONS[p]} as {p}" for p in partials)} '
+        f'by bin({SNAPSHOT_BIN}), {dimension}'
+    )
+
+    return {
+        'Id': snapshot_id,
+        'Dimension': dimension,
+        'Query': '\n| '.join(commands),
+        'Partials': partials,
+        'Metrics': {name: list(formula) for name, formula in formulas.items()}
+    }
+
+
+def build_count_snapshot(by_field, label='Count'):
+    # Counterpart of build_count_query
+    return build_snapshot(f'Count-{by_field}', by_field, {label: 'Jobs'})
+
+
+def compile_section_snapshot(section):
+    unknown_metrics = set(section['Metrics']) - set(MERGEABLE_JOB_METRICS)
+
+    if unknown_metrics:
+        raise ValueError(f'Unknown metrics {sorted(unknown_metrics)}, expected any of {sorted(MERGEABLE_JOB_METRICS)}')
+
+    return build_snapshot(f'Section-{section["Dimension"]}', section['Dimension'],
+                          {metric: metric for metric in section['Metrics']}, section.get('Filters', []))
+
+
+def section_time_range(section):
+    return section.get('TimeRange', DEFAULT_TIME_RANGE)
+
+
+def find_section(dimension, sections=ANALYSIS_SECTIONS):
+    for section in sections:
+        if section['Dimension'] == dimension:
+            return section
+
+    raise KeyError(f'No analysis section for dimension "{dimension}"')
+
+
+def indexed_fields(sections=ANALYSIS_SECTIONS):
+    """
+    Returns the fields worth indexing in the jobs log group: the dimensions of the sections and the fields they filter
+    on.
+    """
+
+    fields = sorted(
+        {section['Dimension'] for section in sections} |
+        {f[0] for section in sections for f in section.get('Filters', [])}
+    )
+
+    if len(fields) > MAX_INDEXED_FIELDS:
+        raise ValueError(f'{len(fields)} fields to index, at most {MAX_INDEXED_FIELDS} are supported')
+
+    return fields
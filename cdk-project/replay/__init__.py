@@ -0,0 +1,5 @@
+"""
+@Description: operational tools that replay the events stranded in the dead-letter queues of the application. They run
+from an operator's machine with the credentials of the account, are not deployed as part of the CDK app and require
+the packages listed in requirements-dev.txt.
+"""
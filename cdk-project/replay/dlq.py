@@ -0,0 +1,565 @@
+"""
+@Description: bulk replay of the events stranded in the dead-letter queues of the EventBridge rules. The replay runs in
+two steps, so that it can be interrupted and resumed at any time:
+
+1. Drain: messages are received from the dead-letter queues by several threads, appended to one spool file per queue
+   and deleted from the queue once the spool has been written to disk.
+2. Replay: the spooled events are grouped by job (array children with their parent) or container instance and sorted
+   by event time. A pool of workers replays the groups concurrently, each group by a single worker and in order, so
+   the events of a job are never processed out of order or in parallel. Consecutive events of a group handled by the
+   same function are sent in one invocation as SQS records, which makes the function report the events that failed.
+   The message IDs of the replayed events are appended to a progress file, and a group stops at its first failure so
+   that the next run resumes it from there.
+
+Container instances are replayed before the jobs, as tasks can only be associated with tracked container instances.
+Invocations are rate limited to protect the DynamoDB tables and the concurrency of the account. With --dry-run, the
+queues are read without deleting any message (they become visible again after DRY_RUN_VISIBILITY_TIMEOUT seconds) and
+the replay plan is printed without invoking any function. With --local, a file of events is replayed through in-memory
+stand-ins of SQS, DynamoDB and CloudWatch Logs, to rehearse a replay without an AWS account. Usage:
+
+python -m replay.dlq --spool dlq-spool --dry-run
+python -m replay.dlq --spool dlq-spool --workers 16 --max-invocations-per-second 20
+python -m replay.dlq --spool /tmp/dlq-spool --local events.jsonl
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIR = os.path.join(PROJECT_DIR, 'assets', 'lambda', 'layer_common', 'python')
+
+if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+
+from batch_insights import arrays, jobs, runtime
+
+
+# {detail type: (dead-letter queue, function, whether the function accepts SQS records)}
+EVENT_TYPES = {
+    'Batch Job State Change': ('BatchEventsDeadLetterQueue', 'processBatchEvents', True),
+    'ECS Task State Change': ('TaskStateEventsDeadLetterQueue', 'processTaskStateEvents', True),
+    'ECS Container Instance State Change': ('ContainerInstanceEventsDeadLetterQueue',
+                                            'processContainerInstanceEvents', False)
+}
+
+DEAD_LETTER_QUEUES = [queue for queue, _, _ in EVENT_TYPES.values()]
+BATCHED_FUNCTIONS = {function_name for _, function_name, batched in EVENT_TYPES.values() if batched}
+
+RECEIVE_MAX_MESSAGES = 10
+RECEIVE_WAIT_SECONDS = 2
+DRAIN_VISIBILITY_TIMEOUT = 300
+DRY_RUN_VISIBILITY_TIMEOUT = 900
+
+# The queue is considered drained after this many consecutive empty receives, as SQS may return no messages while some
+# are still available
+EMPTY_RECEIVES_TO_STOP = 3
+
+# The functions process SQS batches of up to 100 records
+MAX_RECORDS_PER_INVOCATION = 100
+
+# Synchronous invocations wait for functions that can run for up to a minute
+INVOKE_READ_TIMEOUT = 90
+
+PROGRESS_FILE = 'replayed.jsonl'
+PROGRESS_INTERVAL_SECONDS = 10
+
+# Task state events are emitted when the job is STARTING, and are replayed after the transition of the same second
+_TASK_STATUS_RANK = jobs.STATUS_ORDER.index('STARTING') + 0.5
+
+
+class ReplayError(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the workers. Callers reserve a token and sleep outside of the lock until it is available, so
+    waiting workers don't block each other. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Spool:
+    """
+    Local copy of the drained messages, with one JSON lines file per queue, and the progress of the replay. Every write
+    is flushed to disk before it returns, so a message is never deleted from its queue before it is spooled, and an
+    event is never replayed twice by runs that resume the replay.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def __append(self, name, lines):
+        with self.lock:
+            with open(os.path.join(self.directory, name), 'a', encoding='utf-8') as f:
+                f.writelines(f'{line}\n' for line in lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def __read(self, name):
+        path = os.path.join(self.directory, name)
+
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # A line cut by an interrupted write is ignored, its message was not deleted from the queue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def append_messages(self, queue_name, messages):
+        self.__append(f'{queue_name}.jsonl', [
+            json.dumps({'MessageId': message['MessageId'], 'Body': message['Body']}) for message in messages
+        ])
+
+    def messages(self):
+        """
+        Yields the (message ID, body) of the spooled messages. Messages spooled twice, when their deletion failed and
+        they were received again, are yielded once.
+        """
+
+        seen = set()
+
+        for queue_name in DEAD_LETTER_QUEUES:
+            for message in self.__read(f'{queue_name}.jsonl'):
+                if message['MessageId'] not in seen:
+                    seen.add(message['MessageId'])
+                    yield message['MessageId'], message['Body']
+
+    def mark_replayed(self, message_ids):
+        if message_ids:
+            self.__append(PROGRESS_FILE, [json.dumps(list(message_ids))])
+
+    def replayed(self):
+        return {message_id for message_ids in self.__read(PROGRESS_FILE) for message_id in message_ids}
+
+
+class LambdaInvoker:
+    def __init__(self, client):
+        self.client = client
+
+    def invoke(self, function_name, payload):
+        response = self.client.invoke(
+            FunctionName=function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(payload).encode('utf-8')
+        )
+        result = response['Payload'].read()
+
+        if 'FunctionError' in response:
+            raise ReplayError(f'{function_name} failed: {result[:1000].decode("utf-8", "replace")}')
+
+        return json.loads(result) if result else None
+
+
+class LocalInvoker:
+    """
+    Invokes handlers loaded in the current process. The in-memory services they run on are not thread-safe, so
+    invocations are serialised.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.lock = threading.Lock()
+
+    def invoke(self, function_name, payload):
+        with self.lock:
+            return self.handlers[function_name](payload, None)
+
+
+def drain_queue(sqs_client, queue_name, spool, receivers=4, dry_run=False):
+    """
+    Moves the messages of a queue to the spool with several concurrent receivers and returns their number. In dry run
+    mode, the received messages are returned instead and left in the queue.
+    """
+
+    queue_url = sqs_client.get_queue_url(QueueName=queue_name)['QueueUrl']
+    received = {}
+    counts = {'Messages': 0}
+    lock = threading.Lock()
+
+    def receive():
+        empty_receives = 0
+
+        while empty_receives < EMPTY_RECEIVES_TO_STOP:
+            messages = sqs_client.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=RECEIVE_MAX_MESSAGES,
+                WaitTimeSeconds=RECEIVE_WAIT_SECONDS,
+                VisibilityTimeout=DRY_RUN_VISIBILITY_TIMEOUT if dry_run else DRAIN_VISIBILITY_TIMEOUT
+            ).get('Messages', [])
+
+            if not messages:
+                empty_receives += 1
+                continue
+
+            empty_receives = 0
+
+            if dry_run:
+                with lock:
+                    received.update((message['MessageId'], message['Body']) for message in messages)
+
+                continue
+
+            spool.append_messages(queue_name, messages)
+
+            # Messages that can't be deleted are received again and deduplicated when the spool is read
+            response = sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=[
+                {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(messages)
+            ])
+
+            if response.get('Failed'):
+                print(f'Could not delete {len(response["Failed"])} messages from {queue_name}', file=sys.stderr)
+
+            with lock:
+                counts['Messages'] += len(messages)
+
+    with ThreadPoolExecutor(receivers) as executor:
+        for future in [executor.submit(receive) for _ in range(receivers)]:
+            future.result()
+
+    return received if dry_run else counts['Messages']
+
+
+def _task_job_id(event):
+    for override in event['detail']['overrides']['containerOverrides'][0]['environment']:
+        if override['name'] == 'AWS_BATCH_JOB_ID':
+            return override['value']
+
+    return None
+
+
+def group_key(event):
+    """
+    Returns the key of the group an event is replayed with, or None when no function would process it. The events of
+    array children are replayed with their parent, as the children are aggregated in its tracking item.
+    """
+
+    detail_type = event.get('detail-type')
+
+    if detail_type == 'ECS Container Instance State Change':
+        return f'instance:{event["detail"]["containerInstanceArn"]}'
+
+    if detail_type == 'Batch Job State Change':
+        job_id = event['detail']['jobId']
+    elif detail_type == 'ECS Task State Change':
+        job_id = _task_job_id(event)
+    else:
+        return None
+
+    if job_id is None:
+        return None
+
+    return f'job:{arrays.parent_job_id(job_id) or job_id}'
+
+
+def event_sort_key(event):
+    if event['detail-type'] == 'ECS Task State Change':
+        rank = _TASK_STATUS_RANK
+    else:
+        status = event['detail'].get('status')
+        rank = jobs.STATUS_ORDER.index(status) if status in jobs.STATUS_ORDER else len(jobs.STATUS_ORDER)
+
+    return jobs.parse_event_time(event['time']), rank
+
+
+def build_groups(messages, replayed=frozenset()):
+    """
+    Groups the events that haven't been replayed yet and sorts every group by event time. Returns the groups of
+    container instances and jobs separately, with the number of messages that were skipped because they can't be
+    parsed or aren't processed by any function.
+    """
+
+    groups = {}
+    skipped = 0
+
+    for message_id, body in messages:
+        if message_id in replayed:
+            continue
+
+        try:
+            event = json.loads(body)
+            key = group_key(event)
+            sort_key = event_sort_key(event) if key is not None else None
+        except (ValueError, KeyError, IndexError, TypeError):
+            key = None
+
+        if key is None:
+            skipped += 1
+            continue
+
+        groups.setdefault(key, []).append((sort_key, message_id, event))
+
+    instance_groups, job_groups = {}, {}
+
+    for key, events in groups.items():
+        events.sort(key=lambda e: e[0])
+        (instance_groups if key.startswith('instance:') else job_groups)[key] = [(m, e) for _, m, e in events]
+
+    return instance_groups, job_groups, skipped
+
+
+def build_invocations(events):
+    """
+    Splits the sorted events of a group into the invocations that replay them, as (function, [(message ID, event)])
+    tuples. Consecutive events handled by the same function share an invocation when the function accepts SQS records.
+    """
+
+    invocations = []
+
+    for message_id, event in events:
+        _, function_name, batched = EVENT_TYPES[event['detail-type']]
+
+        if (batched and invocations and invocations[-1][0] == function_name
+                and len(invocations[-1][1]) < MAX_RECORDS_PER_INVOCATION):
+            invocations[-1][1].append((message_id, event))
+        else:
+            invocations.append((function_name, [(message_id, event)]))
+
+    return invocations
+
+
+class Replayer:
+    def __init__(self, invoker, spool, workers=8, rate_limiter=None):
+        self.invoker = invoker
+        self.spool = spool
+        self.workers = workers
+        self.rate_limiter = rate_limiter or RateLimiter(0)
+
+        self.counts = {'Groups': 0, 'FailedGroups': 0, 'Invocations': 0, 'ReplayedEvents': 0, 'FailedEvents': 0}
+        self.lock = threading.Lock()
+        self.last_progress = time.monotonic()
+
+    def __count(self, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                self.counts[name] += value
+
+            if time.monotonic() - self.last_progress >= PROGRESS_INTERVAL_SECONDS:
+                self.last_progress = time.monotonic()
+                print(json.dumps({'Progress': self.counts}), file=sys.stderr)
+
+    def __invoke(self, function_name, events):
+        """
+        Returns the message IDs of the events that were processed. Functions that accept SQS records report the ones
+        that failed, and the whole invocation fails otherwise.
+        """
+
+        self.rate_limiter.acquire()
+
+        if function_name not in BATCHED_FUNCTIONS:
+            self.invoker.invoke(function_name, events[0][1])
+            return [events[0][0]]
+
+        response = self.invoker.invoke(function_name, {
+            'Records': [{'messageId': message_id, 'body': json.dumps(event)} for message_id, event in events]
+        })
+        failed_ids = {f['itemIdentifier'] for f in (response or {}).get('batchItemFailures', [])}
+
+        return [message_id for message_id, _ in events if message_id not in failed_ids]
+
+    def replay_group(self, key, events):
+        for function_name, invocation_events in build_invocations(events):
+            try:
+                replayed_ids = self.__invoke(function_name, invocation_events)
+            except Exception:
+                traceback.print_exc()
+                replayed_ids = []
+
+            self.spool.mark_replayed(replayed_ids)
+            failed = len(invocation_events) - len(replayed_ids)
+            self.__count(Invocations=1, ReplayedEvents=len(replayed_ids), FailedEvents=failed)
+
+            # The rest of the group waits for the next run, so that its events are never replayed out of order
+            if failed:
+                print(f'Stopping the replay of {key} after {failed} failed events', file=sys.stderr)
+                self.__count(Groups=1, FailedGroups=1)
+                return False
+
+        self.__count(Groups=1)
+        return True
+
+    def replay(self, groups):
+        with ThreadPoolExecutor(self.workers) as executor:
+            for future in [executor.submit(self.replay_group, key, events) for key, events in groups.items()]:
+                future.result()
+
+
+def plan(instance_groups, job_groups):
+    groups = list(instance_groups.values()) + list(job_groups.values())
+    invocations = [invocation for events in groups for invocation in build_invocations(events)]
+    events_by_function = {}
+
+    for function_name, events in invocations:
+        events_by_function[function_name] = events_by_function.get(function_name, 0) + len(events)
+
+    return {
+        'ContainerInstanceGroups': len(instance_groups),
+        'JobGroups': len(job_groups),
+        'Invocations': len(invocations),
+        'EventsByFunction': events_by_function
+    }
+
+
+def run(sqs_client, invoker, spool, queues=DEAD_LETTER_QUEUES, receivers=4, workers=8, max_invocations_per_second=0,
+        dry_run=False, drain=True):
+    """
+    Drains the queues into the spool and replays every spooled event that hasn't been replayed yet. Returns a summary
+    of the run.
+    """
+
+    summary = {'DrainedMessages': {}}
+    dry_run_messages = {}
+
+    if drain:
+        for queue_name in queues:
+            result = drain_queue(sqs_client, queue_name, spool, receivers, dry_run)
+
+            if dry_run:
+                dry_run_messages.update(result)
+                result = len(result)
+
+            summary['DrainedMessages'][queue_name] = result
+
+    replayed = spool.replayed()
+    messages = list(spool.messages())
+    spooled_ids = {message_id for message_id, _ in messages}
+    messages.extend((m, b) for m, b in dry_run_messages.items() if m not in spooled_ids)
+
+    instance_groups, job_groups, skipped = build_groups(messages, replayed)
+
+    summary.update({
+        'SpooledMessages': len(spooled_ids),
+        'AlreadyReplayed': len(replayed & spooled_ids),
+        'SkippedMessages': skipped,
+        'Plan': plan(instance_groups, job_groups)
+    })
+
+    if dry_run:
+        return summary
+
+    replayer = Replayer(invoker, spool, workers, RateLimiter(max_invocations_per_second))
+    start = time.monotonic()
+
+    # Tasks are associated with the container instances tracked when they are replayed
+    replayer.replay(instance_groups)
+    replayer.replay(job_groups)
+
+    summary['Replay'] = dict(replayer.counts, DurationSeconds=round(time.monotonic() - start, 3))
+
+    return summary
+
+
+def run_local(events_path, spool, **kwargs):
+    """
+    Sends the events of a JSON lines file to in-memory dead-letter queues and replays them against the handlers running
+    on in-memory AWS services.
+    """
+
+    from benchmarks.fakes import FakeSQS
+    from benchmarks.harness import Environment
+
+    env = Environment()
+    sqs_client = FakeSQS(env.calls, DEAD_LETTER_QUEUES)
+
+    with open(events_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                queue_name = EVENT_TYPES[event['detail-type']][0]
+                sqs_client.send_message(QueueUrl=queue_name, MessageBody=json.dumps(event))
+
+    env.activate()
+
+    # The logs of the handlers are kept apart from the summary
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = run(sqs_client, LocalInvoker(env.handlers), spool, **kwargs)
+
+    summary['LoggedJobs'] = len(env.logs.logged_messages())
+    summary['TrackedJobs'] = len(env.dynamodb.tables['BatchJobsTracking'])
+
+    return summary
+
+
+def create_clients():
+    from botocore.config import Config
+
+    sqs_client = runtime.client('sqs')
+    lambda_client = runtime.session().create_client(
+        'lambda', config=runtime.config().merge(Config(read_timeout=INVOKE_READ_TIMEOUT))
+    )
+
+    return sqs_client, LambdaInvoker(lambda_client)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replays the events of the dead-letter queues')
+    parser.add_argument('--spool', required=True, help='Directory of the spooled messages and the replay progress')
+    parser.add_argument('--queues', nargs='+', default=DEAD_LETTER_QUEUES, choices=DEAD_LETTER_QUEUES,
+                        help='Dead-letter queues to drain')
+    parser.add_argument('--no-drain', action='store_true', help='Only replays the events already spooled')
+    parser.add_argument('--receivers', type=int, default=4, help='Number of concurrent receivers per queue')
+    parser.add_argument('--workers', type=int, default=8, help='Number of groups replayed concurrently')
+    parser.add_argument('--max-invocations-per-second', type=float, default=10,
+                        help='Maximum rate of function invocations, 0 for no limit')
+    parser.add_argument('--dry-run', action='store_true', help='Prints the replay plan without changing anything')
+    parser.add_argument('--local', help='Replays a JSON lines file of events against in-memory AWS services')
+    args = parser.parse_args(argv)
+
+    spool = Spool(args.spool)
+    options = {
+        'queues': args.queues,
+        'receivers': args.receivers,
+        'workers': args.workers,
+        'max_invocations_per_second': args.max_invocations_per_second,
+        'dry_run': args.dry_run,
+        'drain': not args.no_drain
+    }
+
+    if args.local:
+        summary = run_local(args.local, spool, **options)
+    else:
+        sqs_client, invoker = create_clients()
+        summary = run(sqs_client, invoker, spool, **options)
+
+    print(json.dumps(summary, indent=2))
+
+    return 1 if summary.get('Replay', {}).get('FailedEvents') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,10 +6,72 @@ from .nested import *
 
 
 class MainStack(Stack):
+    __INGESTION_MODES = {'direct', 'sqs'}
+    __INSTRUMENTATION_SINKS = {'none', 'stdout', 'emf'}
+    __MAX_LOG_STREAM_SHARDS = 1000
+
+    def __get_ingestion_mode(self):
+        ingestion_mode = self.node.try_get_context('ingestionMode') or 'direct'
+
+        if ingestion_mode not in self.__INGESTION_MODES:
+            raise ValueError(
+                f'Invalid ingestionMode "{ingestion_mode}", expected one of {sorted(self.__INGESTION_MODES)}'
+            )
+
+        return ingestion_mode
+
+    def __get_instrumentation_sink(self):
+        sink = self.node.try_get_context('instrumentationSink') or 'none'
+
+        if sink not in self.__INSTRUMENTATION_SINKS:
+            raise ValueError(
+                f'Invalid instrumentationSink "{sink}", expected one of {sorted(self.__INSTRUMENTATION_SINKS)}'
+            )
+
+        return sink
+
+    def __get_log_stream_shards(self):
+        shards = self.node.try_get_context('logStreamShards') or 1
+
+        try:
+            shards = int(shards)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid logStreamShards "{shards}", expected an integer')
+
+        if not 1 <= shards <= self.__MAX_LOG_STREAM_SHARDS:
+            raise ValueError(f'Invalid logStreamShards {shards}, expected a value between 1 and '
+                             f'{self.__MAX_LOG_STREAM_SHARDS}')
+
+        return shards
+
+    def __get_bool_context(self, key, default=False):
+        value = self.node.try_get_context(key)
+
+        if value is None:
+            return default
+
+        # Values passed with -c in the command line are always strings
+        return value if isinstance(value, bool) else str(value).lower() == 'true'
+
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
-        ddb_stack = DynamoDBStack(self, 'DynamoDBStack')
-        cloudwatch_stack = CloudWatchStack(self, 'CloudWatchStack')
-        lambda_stack = LambdaStack(self, 'LambdaStack', cloudwatch_stack, ddb_stack)
-        EventBridgeStack(self, 'EventBridgeStack', lambda_stack)
+        metrics_dashboard = self.__get_bool_context('metricsDashboard')
+        job_archive = self.__get_bool_context('jobArchive')
+        state_gauges = self.__get_bool_context('stateGauges')
+        dashboard_snapshots = self.__get_bool_context('dashboardSnapshots')
+
+        ddb_stack = DynamoDBStack(self, 'DynamoDBStack', state_gauges,
+                                  event_ledger=self.__get_bool_context('eventLedger'),
+                                  dashboard_snapshots=dashboard_snapshots,
+                                  runtime_baselines=self.__get_bool_context('regressionDetector'),
+                                  duration_sketches=self.__get_bool_context('durationSketches'))
+        cloudwatch_stack = CloudWatchStack(self, 'CloudWatchStack', metrics_dashboard,
+                                           log_stream_shards=self.__get_log_stream_shards(), state_gauges=state_gauges,
+                                           dashboard_snapshots=dashboard_snapshots)
+        storage_stack = StorageStack(self, 'StorageStack') if job_archive else None
+        lambda_stack = LambdaStack(self, 'LambdaStack', cloudwatch_stack, ddb_stack, storage_stack,
+                                   emit_job_metrics=metrics_dashboard,
+                                   instrumentation_sink=self.__get_instrumentation_sink(),
+                                   array_child_detail=self.__get_bool_context('arrayChildDetail'))
+        EventBridgeStack(self, 'EventBridgeStack', lambda_stack, self.__get_ingestion_mode())
@@ -1,4 +1,5 @@
 from .dynamo import DynamoDBStack
 from .cloudwatch import CloudWatchStack
+from .storage import StorageStack
 from .lambda_ import LambdaStack
 from .event_bridge import EventBridgeStack
@@ -1,58 +1,113 @@
 from aws_cdk import (
+    ArnFormat,
+    Duration,
     NestedStack,
     RemovalPolicy,
     aws_logs as logs,
     aws_cloudwatch as cloudwatch,
 )
 from constructs import Construct
-from .. import log_queries
+from queries import log_queries
 
 
 class CloudWatchStack(NestedStack):
     __LOG_GROUP_RETENTION_PERIOD = logs.RetentionDays.ONE_YEAR
+    __JOBS_LOG_STREAM_NAME = 'Jobs'
+    __METRICS_NAMESPACE = 'AWSBatchInsights'
+    __METRICS_PERIOD = Duration.hours(1)
+    __STATE_GAUGES_PERIOD = Duration.minutes(1)
+    __STATE_GAUGE_STATUSES = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING']
+    __SNAPSHOT_WIDGET_FUNCTION_NAME = 'renderDashboardSnapshot'
 
     # -------------------- WIDGET HELPER METHODS -------------------- #
 
-    def __build_succeeded_rate_widget(self, by_field):
-        return cloudwatch.LogQueryWidget(
-            log_group_names=[self.jobs_log_group.log_group_name],
-            height=6,
-            width=12,
-            query_string=log_queries.build_succeeded_rate_query(by_field),
-            title='Succeeded rate',
-            view=cloudwatch.LogQueryVisualizationType.BAR
+    def __build_snapshot_widget(self, snapshot, title, width, height=6):
+        # The function is referenced by name, as it is created by the Lambda stack once the log group exists
+        self.dashboard_snapshots[snapshot['Id']] = snapshot
+
+        return cloudwatch.CustomWidget(
+            function_arn=self.format_arn(
+                service='lambda', resource='function', resource_name=self.snapshot_widget_function_name,
+                arn_format=ArnFormat.COLON_RESOURCE_NAME
+            ),
+            title=title,
+            width=width,
+            height=height,
+            params={'snapshot': snapshot['Id']},
+            update_on_refresh=True,
+            update_on_resize=False,
+            update_on_time_range_change=True
         )
 
-    def __build_avg_running_widget(self, by_field):
+    def __build_count_widget(self, by_field, label, title, width, view):
+        if self.dashboard_snapshots is not None:
+            return self.__build_snapshot_widget(log_queries.build_count_snapshot(by_field, label), title, width)
+
         return cloudwatch.LogQueryWidget(
             log_group_names=[self.jobs_log_group.log_group_name],
             height=6,
-            width=12,
-            query_string=log_queries.build_avg_running_query(by_field),
-            title='Average RUNNING duration (minutes)',
-            view=cloudwatch.LogQueryVisualizationType.BAR
+            width=width,
+            query_string=log_queries.build_count_query(by_field, label),
+            title=title,
+            view=view
         )
 
-    def __build_avg_runnable_widget(self, by_field):
+    def __build_section_widget(self, section):
+        title = f'Jobs, succeeded rate (%) and average durations (minutes) per {section["Label"]}'
+
+        if self.dashboard_snapshots is not None:
+            return self.__build_snapshot_widget(log_queries.compile_section_snapshot(section), title, 24)
+
         return cloudwatch.LogQueryWidget(
             log_group_names=[self.jobs_log_group.log_group_name],
             height=6,
-            width=12,
-            query_string=log_queries.build_avg_runnable_query(by_field),
-            title='Average RUNNABLE duration (minutes)',
-            view=cloudwatch.LogQueryVisualizationType.BAR
+            width=24,
+            query_string=log_queries.compile_section_query(section),
+            title=title,
+            view=cloudwatch.LogQueryVisualizationType.TABLE
         )
 
-    def __build_avg_starting_widget(self, by_field):
-        return cloudwatch.LogQueryWidget(
-            log_group_names=[self.jobs_log_group.log_group_name],
+    def __build_metric_search(self, by_field, metric_name, stat, expression_suffix='', period=None):
+        period = period or self.__METRICS_PERIOD
+
+        return cloudwatch.MathExpression(
+            expression=f"SEARCH('{{{self.__METRICS_NAMESPACE},{by_field}}} MetricName=\"{metric_name}\"', "
+                       f"'{stat}', {int(period.to_seconds())}){expression_suffix}",
+            label='',
+            using_metrics={},
+            period=period
+        )
+
+    def __build_metric_widget(self, title, metric, view=cloudwatch.GraphWidgetView.BAR, width=12):
+        return cloudwatch.GraphWidget(
             height=6,
-            width=12,
-            query_string=log_queries.build_avg_starting_query(by_field),
-            title='Average STARTING duration (minutes)',
-            view=cloudwatch.LogQueryVisualizationType.BAR
+            width=width,
+            title=title,
+            left=[metric],
+            view=view,
+            set_period_to_time_range=True,
+            legend_position=cloudwatch.LegendPosition.RIGHT
         )
 
+    def __build_metric_analysis_widgets(self, by_field):
+        return [
+            self.__build_metric_widget(
+                'Succeeded rate', self.__build_metric_search(by_field, 'Succeeded', 'Average', ' * 100')
+            ),
+            self.__build_metric_widget(
+                'Average RUNNABLE duration (minutes)',
+                self.__build_metric_search(by_field, 'RunnableSeconds', 'Average', ' / 60')
+            ),
+            self.__build_metric_widget(
+                'Average STARTING duration (minutes)',
+                self.__build_metric_search(by_field, 'StartingSeconds', 'Average', ' / 60')
+            ),
+            self.__build_metric_widget(
+                'Average RUNNING duration (minutes)',
+                self.__build_metric_search(by_field, 'RunningSeconds', 'Average', ' / 60')
+            )
+        ]
+
     # -------------------- /WIDGET HELPER METHODS -------------------- #
 
     def __create_jobs_log_group(self):
@@ -63,14 +118,31 @@ class CloudWatchStack(NestedStack):
             removal_policy=RemovalPolicy.DESTROY
         )
 
-        log_stream = logs.LogStream(
-            self, 'BatchJobsLogStream',
-            log_group=log_group,
-            log_stream_name='Jobs',
-            removal_policy=RemovalPolicy.DESTROY
+        # The dimensions the analysis sections group and filter by are indexed, so that queries filtering on them only
+        # scan the matching log events
+        log_group.node.default_child.add_property_override(
+            'FieldIndexPolicies', [{'Fields': log_queries.indexed_fields()}]
         )
 
-        return log_group, log_stream
+        # A single log stream keeps its original name. When it is sharded, the shards are named Jobs-000, Jobs-001...
+        # as the event processing function expects. Dashboard queries target the log group, so they read all the shards
+        if self.jobs_log_stream_shards == 1:
+            log_stream_names = {'BatchJobsLogStream': self.__JOBS_LOG_STREAM_NAME}
+        else:
+            log_stream_names = {
+                f'BatchJobsLogStream{i}': f'{self.__JOBS_LOG_STREAM_NAME}-{i:03d}'
+                for i in range(self.jobs_log_stream_shards)
+            }
+
+        for construct_id, log_stream_name in log_stream_names.items():
+            logs.LogStream(
+                self, construct_id,
+                log_group=log_group,
+                log_stream_name=log_stream_name,
+                removal_policy=RemovalPolicy.DESTROY
+            )
+
+        return log_group
 
     def __create_job_analysis_widgets(self):
         title = cloudwatch.TextWidget(
@@ -80,13 +152,8 @@ class CloudWatchStack(NestedStack):
             width=24
         )
 
-        job_status_overview = cloudwatch.LogQueryWidget(
-            log_group_names=[self.jobs_log_group.log_group_name],
-            height=6,
-            width=7,
-            query_string=log_queries.build_count_query('Status', 'Job_Status'),
-            title='Succeeded / Failed ratio',
-            view=cloudwatch.LogQueryVisualizationType.PIE
+        job_status_overview = self.__build_count_widget(
+            'Status', 'Job_Status', 'Succeeded / Failed ratio', 7, cloudwatch.LogQueryVisualizationType.PIE
         )
 
         job_log_history = cloudwatch.LogQueryWidget(
@@ -100,40 +167,6 @@ class CloudWatchStack(NestedStack):
 
         return [title, job_status_overview, job_log_history]
 
-    def __create_queue_analysis_widgets(self):
-        by_field = 'JobQueue'
-
-        title = cloudwatch.TextWidget(
-            markdown='# Job queue analysis\nThe widgets in this section show how your jobs have performed at the **job queue** level.',
-            background=cloudwatch.TextWidgetBackground.TRANSPARENT,
-            height=2,
-            width=24
-        )
-
-        succeeded_rate = self.__build_succeeded_rate_widget(by_field)
-        avg_runtime = self.__build_avg_running_widget(by_field)
-        avg_runnable = self.__build_avg_runnable_widget(by_field)
-        avg_starting = self.__build_avg_starting_widget(by_field)
-
-        return [title, succeeded_rate, avg_runnable, avg_starting, avg_runtime]
-
-    def __create_job_definition_analysis_widgets(self):
-        by_field = 'JobDefinition'
-
-        title = cloudwatch.TextWidget(
-            markdown='# Job definition analysis\nThe widgets in this section show how your jobs have performed at the **job definition** level.',
-            background=cloudwatch.TextWidgetBackground.TRANSPARENT,
-            height=2,
-            width=24
-        )
-
-        succeeded_rate = self.__build_succeeded_rate_widget(by_field)
-        avg_runtime = self.__build_avg_running_widget(by_field)
-        avg_runnable = self.__build_avg_runnable_widget(by_field)
-        avg_starting = self.__build_avg_starting_widget(by_field)
-
-        return [title, succeeded_rate, avg_runnable, avg_starting, avg_runtime]
-
     def __create_job_placement_analysis_widgets(self):
         title = cloudwatch.TextWidget(
             markdown='# Job placement analysis\nThe widgets in this section show where your jobs have run.',
@@ -142,68 +175,152 @@ class CloudWatchStack(NestedStack):
             width=24
         )
 
-        instance_placement = cloudwatch.LogQueryWidget(
-            log_group_names=[self.jobs_log_group.log_group_name],
-            height=6,
-            width=title.width,
-            query_string=log_queries.build_count_query('InstanceType'),
-            title='Jobs run per Instance type',
-            view=cloudwatch.LogQueryVisualizationType.BAR
+        instance_placement = self.__build_count_widget(
+            'InstanceType', 'Count', 'Jobs run per Instance type', title.width, cloudwatch.LogQueryVisualizationType.BAR
         )
 
-        az_placement = cloudwatch.LogQueryWidget(
-            log_group_names=[self.jobs_log_group.log_group_name],
-            height=instance_placement.height,
-            width=title.width / 2,
-            query_string=log_queries.build_count_query('AvailabilityZone', 'AZ'),
-            title='Jobs run per Availability Zone',
-            view=cloudwatch.LogQueryVisualizationType.PIE
+        az_placement = self.__build_count_widget(
+            'AvailabilityZone', 'AZ', 'Jobs run per Availability Zone', title.width / 2,
+            cloudwatch.LogQueryVisualizationType.PIE
         )
 
-        arch_placement = cloudwatch.LogQueryWidget(
-            log_group_names=[self.jobs_log_group.log_group_name],
-            height=instance_placement.height,
-            width=az_placement.width,
-            query_string=log_queries.build_count_query('Architecture', 'CPU_Arch'),
-            title='Jobs run per CPU architecture',
-            view=cloudwatch.LogQueryVisualizationType.PIE
+        arch_placement = self.__build_count_widget(
+            'Architecture', 'CPU_Arch', 'Jobs run per CPU architecture', az_placement.width,
+            cloudwatch.LogQueryVisualizationType.PIE
         )
 
         return [title, instance_placement, az_placement, arch_placement]
 
-    def __create_arch_analysis_widgets(self):
-        by_field = 'Architecture'
+    def __create_section_widgets(self, section):
+        label = section['Label']
 
         title = cloudwatch.TextWidget(
-            markdown='# CPU architecture analysis\nThe widgets in this section show how your jobs have performed at the **CPU architecture** level.',
+            markdown=f'# {label[0].upper() + label[1:]} analysis\nThe widgets in this section show how your jobs have '
+                     f'performed at the **{label}** level.',
             background=cloudwatch.TextWidgetBackground.TRANSPARENT,
             height=2,
             width=24
         )
 
-        succeeded_rate = self.__build_succeeded_rate_widget(by_field)
-        avg_runtime = self.__build_avg_running_widget(by_field)
-        avg_runnable = self.__build_avg_runnable_widget(by_field)
-        avg_starting = self.__build_avg_starting_widget(by_field)
-
-        return [title, succeeded_rate, avg_runnable, avg_starting, avg_runtime]
+        return [title, self.__build_section_widget(section)]
 
     def __create_dashboard(self):
+        widgets = self.__create_job_analysis_widgets() + self.__create_job_placement_analysis_widgets()
+        sections = {}
+
+        for section in log_queries.ANALYSIS_SECTIONS:
+            sections.setdefault(log_queries.section_time_range(section), []).append(section)
+
+        # Log query widgets always use the time range of their dashboard, so the sections with a different time range
+        # get a dashboard of their own
+        for time_range, time_range_sections in sections.items():
+            section_widgets = [w for section in time_range_sections for w in self.__create_section_widgets(section)]
+
+            if time_range == log_queries.DEFAULT_TIME_RANGE:
+                widgets.extend(section_widgets)
+                continue
+
+            cloudwatch.Dashboard(
+                self, f'AWSBatchJobsDashboard{time_range.lstrip("-")}',
+                dashboard_name=f'AWS_Batch_Insights_{time_range.lstrip("-")}',
+                start=time_range,
+                widgets=[section_widgets]
+            )
+
         cloudwatch.Dashboard(
             self, 'AWSBatchJobsDashboard',
             dashboard_name='AWS_Batch_Insights',
+            start=log_queries.DEFAULT_TIME_RANGE,
+            widgets=[widgets]
+        )
+
+    def __create_metrics_dashboard(self):
+        widgets = [
+            cloudwatch.TextWidget(
+                markdown='# Batch jobs overview\nThe widgets in this dashboard are built from the metrics published by '
+                         'the application for every completed job, so their load time doesn\'t depend on the number '
+                         'of jobs.',
+                background=cloudwatch.TextWidgetBackground.TRANSPARENT,
+                height=2,
+                width=24
+            ),
+            self.__build_metric_widget(
+                'Jobs run per Job queue', self.__build_metric_search('JobQueue', 'Jobs', 'Sum'),
+                view=cloudwatch.GraphWidgetView.PIE, width=8
+            ),
+            self.__build_metric_widget(
+                'Jobs run per Availability Zone', self.__build_metric_search('AvailabilityZone', 'Jobs', 'Sum'),
+                view=cloudwatch.GraphWidgetView.PIE, width=8
+            ),
+            self.__build_metric_widget(
+                'Jobs run per CPU architecture', self.__build_metric_search('Architecture', 'Jobs', 'Sum'),
+                view=cloudwatch.GraphWidgetView.PIE, width=8
+            ),
+            self.__build_metric_widget(
+                'Jobs run per Instance type', self.__build_metric_search('InstanceType', 'Jobs', 'Sum'), width=24
+            )
+        ]
+
+        for by_field, label in [('Architecture', 'CPU architecture'), ('JobDefinition', 'job definition'),
+                                ('JobQueue', 'job queue')]:
+            widgets.append(cloudwatch.TextWidget(
+                markdown=f'# {label[0].upper() + label[1:]} analysis\nThe widgets in this section show how your jobs '
+                         f'have performed at the **{label}** level.',
+                background=cloudwatch.TextWidgetBackground.TRANSPARENT,
+                height=2,
+                width=24
+            ))
+            widgets.extend(self.__build_metric_analysis_widgets(by_field))
+
+        cloudwatch.Dashboard(
+            self, 'AWSBatchJobsMetricsDashboard',
+            dashboard_name='AWS_Batch_Insights_Metrics',
             start='-P12M',
-            widgets=[
-                self.__create_job_analysis_widgets() +
-                self.__create_job_placement_analysis_widgets() +
-                self.__create_arch_analysis_widgets() +
-                self.__create_job_definition_analysis_widgets() +
-                self.__create_queue_analysis_widgets()
-            ]
+            widgets=[widgets]
         )
 
-    def __init__(self, scope: Construct, construct_id: str) -> None:
+    def __create_state_gauges_dashboard(self):
+        widgets = [
+            cloudwatch.TextWidget(
+                markdown='# Jobs right now\nThe widgets in this dashboard show how many jobs are in each status of '
+                         'every job queue, published every minute.',
+                background=cloudwatch.TextWidgetBackground.TRANSPARENT,
+                height=2,
+                width=24
+            )
+        ]
+
+        for status in self.__STATE_GAUGE_STATUSES:
+            widgets.append(self.__build_metric_widget(
+                f'{status} jobs per Job queue',
+                self.__build_metric_search('JobQueue', f'{status.capitalize()}Jobs', 'Average',
+                                           period=self.__STATE_GAUGES_PERIOD),
+                view=cloudwatch.GraphWidgetView.TIME_SERIES,
+                width=24 if status == 'RUNNABLE' else 12
+            ))
+
+        cloudwatch.Dashboard(
+            self, 'AWSBatchJobsStateGaugesDashboard',
+            dashboard_name='AWS_Batch_Insights_Live',
+            start='-PT3H',
+            widgets=[widgets]
+        )
+
+    def __init__(self, scope: Construct, construct_id: str, metrics_dashboard=False, log_stream_shards=1,
+                 state_gauges=False, dashboard_snapshots=False) -> None:
         super().__init__(scope, construct_id)
 
-        self.jobs_log_group, self.jobs_log_stream = self.__create_jobs_log_group()
+        # The aggregations of the dashboards are rendered from snapshots instead of querying the logs, {ID: definition}
+        self.dashboard_snapshots = {} if dashboard_snapshots else None
+        self.snapshot_widget_function_name = self.__SNAPSHOT_WIDGET_FUNCTION_NAME
+
+        self.jobs_log_stream_name = self.__JOBS_LOG_STREAM_NAME
+        self.jobs_log_stream_shards = log_stream_shards
+        self.jobs_log_group = self.__create_jobs_log_group()
         self.__create_dashboard()
+
+        if metrics_dashboard:
+            self.__create_metrics_dashboard()
+
+        if state_gauges:
+            self.__create_state_gauges_dashboard()
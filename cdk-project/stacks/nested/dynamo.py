@@ -7,11 +7,15 @@ from constructs import Construct
 
 
 class DynamoDBStack(NestedStack):
+    # Tracking items are deleted by DynamoDB once the epoch seconds of this attribute have passed
+    __TTL_ATTRIBUTE = 'ExpiresAt'
+
     def __create_job_tracking_table(self):
         return ddb.Table(
             self, 'BatchJobsTrackingTable',
             table_name='BatchJobsTracking',
             partition_key=ddb.Attribute(name='JobId', type=ddb.AttributeType.STRING),
+            time_to_live_attribute=self.__TTL_ATTRIBUTE,
             removal_policy=RemovalPolicy.DESTROY,
             billing_mode=ddb.BillingMode.PAY_PER_REQUEST
         )
@@ -21,12 +25,73 @@ class DynamoDBStack(NestedStack):
             self, 'ContainerInstanceTrackingTable',
             table_name='ContainerInstanceTracking',
             partition_key=ddb.Attribute(name='ContainerInstanceArn', type=ddb.AttributeType.STRING),
+            time_to_live_attribute=self.__TTL_ATTRIBUTE,
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST
+        )
+
+    def __create_duration_sketches_table(self):
+        return ddb.Table(
+            self, 'JobDurationSketchesTable',
+            table_name='JobDurationSketches',
+            partition_key=ddb.Attribute(name='SketchKey', type=ddb.AttributeType.STRING),
+            sort_key=ddb.Attribute(name='Bucket', type=ddb.AttributeType.NUMBER),
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST
+        )
+
+    def __create_job_state_gauges_table(self):
+        # Every job queue has one item per shard, <job queue>#<shard>
+        return ddb.Table(
+            self, 'JobStateGaugesTable',
+            table_name='JobStateGauges',
+            partition_key=ddb.Attribute(name='Gauge', type=ddb.AttributeType.STRING),
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST
+        )
+
+    def __create_event_ledger_table(self):
+        # Claims of the processed events, job#<job ID>#<status>, task#<task ARN> or event#<event ID>, expire once they
+        # can't be retried
+        return ddb.Table(
+            self, 'EventLedgerTable',
+            table_name='ProcessedEvents',
+            partition_key=ddb.Attribute(name='EventKey', type=ddb.AttributeType.STRING),
+            time_to_live_attribute=self.__TTL_ATTRIBUTE,
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST
+        )
+
+    def __create_dashboard_snapshots_table(self):
+        # Every snapshot has one item per day, and its state on day 0
+        return ddb.Table(
+            self, 'DashboardSnapshotsTable',
+            table_name='DashboardSnapshots',
+            partition_key=ddb.Attribute(name='Snapshot', type=ddb.AttributeType.STRING),
+            sort_key=ddb.Attribute(name='Day', type=ddb.AttributeType.NUMBER),
+            time_to_live_attribute=self.__TTL_ATTRIBUTE,
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST
+        )
+
+    def __create_runtime_baselines_table(self):
+        # Every job definition name has one item per instance type and status, <name>#<instance type>#<status>
+        return ddb.Table(
+            self, 'RuntimeBaselinesTable',
+            table_name='RuntimeBaselines',
+            partition_key=ddb.Attribute(name='Baseline', type=ddb.AttributeType.STRING),
             removal_policy=RemovalPolicy.DESTROY,
             billing_mode=ddb.BillingMode.PAY_PER_REQUEST
         )
 
-    def __init__(self, scope: Construct, construct_id: str) -> None:
+    def __init__(self, scope: Construct, construct_id: str, state_gauges=False, event_ledger=False,
+                 dashboard_snapshots=False, runtime_baselines=False, duration_sketches=False) -> None:
         super().__init__(scope, construct_id)
 
         self.job_tracking_table = self.__create_job_tracking_table()
         self.container_instance_tracking_table = self.__create_container_instance_tracking_table()
+        self.duration_sketches_table = self.__create_duration_sketches_table() if duration_sketches else None
+        self.job_state_gauges_table = self.__create_job_state_gauges_table() if state_gauges else None
+        self.event_ledger_table = self.__create_event_ledger_table() if event_ledger else None
+        self.dashboard_snapshots_table = self.__create_dashboard_snapshots_table() if dashboard_snapshots else None
+        self.runtime_baselines_table = self.__create_runtime_baselines_table() if runtime_baselines else None
@@ -5,12 +5,47 @@ from aws_cdk import (
     Duration,
     aws_events as events,
     aws_events_targets as targets,
+    aws_lambda_event_sources as event_sources,
 )
 from constructs import Construct
 
 
 class EventBridgeStack(NestedStack):
-    def __create_batch_events_rule(self, target_func):
+    __INGESTION_QUEUE_VISIBILITY_TIMEOUT = Duration.minutes(6)
+    __INGESTION_QUEUE_MAX_RECEIVE_COUNT = 3
+    __INGESTION_BATCH_SIZE = 100
+    __INGESTION_MAX_BATCHING_WINDOW = Duration.seconds(5)
+    __DASHBOARD_SNAPSHOT_REFRESH_RATE = Duration.minutes(15)
+
+    def __create_ingestion_queue_target(self, queue_name, target_func, dead_letter_queue):
+        queue = sqs.Queue(
+            self, queue_name,
+            queue_name=queue_name,
+            visibility_timeout=self.__INGESTION_QUEUE_VISIBILITY_TIMEOUT,
+            dead_letter_queue=sqs.DeadLetterQueue(
+                queue=dead_letter_queue,
+                max_receive_count=self.__INGESTION_QUEUE_MAX_RECEIVE_COUNT
+            ),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        target_func.add_event_source(
+            event_sources.SqsEventSource(
+                queue,
+                batch_size=self.__INGESTION_BATCH_SIZE,
+                max_batching_window=self.__INGESTION_MAX_BATCHING_WINDOW,
+                report_batch_item_failures=True
+            )
+        )
+
+        return targets.SqsQueue(
+            queue,
+            dead_letter_queue=dead_letter_queue,
+            max_event_age=Duration.hours(24),
+            retry_attempts=2
+        )
+
+    def __create_batch_events_rule(self, target_func, ingestion_mode):
         dead_letter_queue = sqs.Queue(
             self, 'BatchEventsDeadLetterQueue',
             queue_name='BatchEventsDeadLetterQueue',
@@ -26,14 +61,17 @@ class EventBridgeStack(NestedStack):
             )
         )
 
-        rule.add_target(
-            targets.LambdaFunction(
-                target_func,
-                dead_letter_queue=dead_letter_queue,
-                max_event_age=Duration.hours(24),
-                retry_attempts=2
+        if ingestion_mode == 'sqs':
+            rule.add_target(self.__create_ingestion_queue_target('BatchEventsQueue', target_func, dead_letter_queue))
+        else:
+            rule.add_target(
+                targets.LambdaFunction(
+                    target_func,
+                    dead_letter_queue=dead_letter_queue,
+                    max_event_age=Duration.hours(24),
+                    retry_attempts=2
+                )
             )
-        )
 
         return rule
 
@@ -64,7 +102,7 @@ class EventBridgeStack(NestedStack):
 
         return rule
 
-    def __create_task_state_events_rule(self, target_func):
+    def __create_task_state_events_rule(self, target_func, ingestion_mode):
         dead_letter_queue = sqs.Queue(
             self, 'TaskStateEventsDeadLetterQueue',
             queue_name='TaskStateEventsDeadLetterQueue',
@@ -84,20 +122,86 @@ class EventBridgeStack(NestedStack):
             )
         )
 
-        rule.add_target(
-            targets.LambdaFunction(
-                target_func,
-                dead_letter_queue=dead_letter_queue,
-                max_event_age=Duration.hours(24),
-                retry_attempts=2
+        if ingestion_mode == 'sqs':
+            rule.add_target(
+                self.__create_ingestion_queue_target('TaskStateEventsQueue', target_func, dead_letter_queue)
             )
+        else:
+            rule.add_target(
+                targets.LambdaFunction(
+                    target_func,
+                    dead_letter_queue=dead_letter_queue,
+                    max_event_age=Duration.hours(24),
+                    retry_attempts=2
+                )
+            )
+
+        return rule
+
+    def __create_archive_jobs_rule(self, state_machine):
+        rule = events.Rule(
+            self, 'ArchiveJobsRule',
+            rule_name='ArchiveJobsRule',
+            schedule=events.Schedule.cron(minute='0', hour='1')
         )
 
+        rule.add_target(targets.SfnStateMachine(state_machine, retry_attempts=2))
+
         return rule
 
-    def __init__(self, scope: Construct, construct_id: str, lambda_stack) -> None:
+    def __create_reconcile_stale_jobs_rule(self, target_func):
+        rule = events.Rule(
+            self, 'ReconcileStaleJobsRule',
+            rule_name='ReconcileStaleJobsRule',
+            schedule=events.Schedule.rate(Duration.hours(1))
+        )
+
+        rule.add_target(targets.LambdaFunction(target_func, retry_attempts=2))
+
+        return rule
+
+    def __create_publish_job_state_gauges_rule(self, target_func):
+        rule = events.Rule(
+            self, 'PublishJobStateGaugesRule',
+            rule_name='PublishJobStateGaugesRule',
+            schedule=events.Schedule.rate(Duration.minutes(1))
+        )
+
+        rule.add_target(targets.LambdaFunction(target_func, retry_attempts=0))
+
+        return rule
+
+    def __create_refresh_dashboard_snapshots_rule(self, target_func, snapshots):
+        rule = events.Rule(
+            self, 'RefreshDashboardSnapshotsRule',
+            rule_name='RefreshDashboardSnapshotsRule',
+            schedule=events.Schedule.rate(self.__DASHBOARD_SNAPSHOT_REFRESH_RATE)
+        )
+
+        # The definitions of the snapshots are built with the dashboards, and passed to every refresh
+        rule.add_target(targets.LambdaFunction(
+            target_func,
+            event=events.RuleTargetInput.from_object({'Snapshots': list(snapshots.values())}),
+            retry_attempts=0
+        ))
+
+        return rule
+
+    def __init__(self, scope: Construct, construct_id: str, lambda_stack, ingestion_mode='direct') -> None:
         super().__init__(scope, construct_id)
 
-        self.__create_batch_events_rule(lambda_stack.batch_events_processing_func)
+        self.__create_batch_events_rule(lambda_stack.batch_events_processing_func, ingestion_mode)
         self.__create_container_instance_events_rule(lambda_stack.container_instance_events_processing_func)
-        self.__create_task_state_events_rule(lambda_stack.task_state_events_processing_func)
+        self.__create_task_state_events_rule(lambda_stack.task_state_events_processing_func, ingestion_mode)
+        self.__create_reconcile_stale_jobs_rule(lambda_stack.reconcile_stale_jobs_func)
+
+        if lambda_stack.publish_job_state_gauges_func is not None:
+            self.__create_publish_job_state_gauges_rule(lambda_stack.publish_job_state_gauges_func)
+
+        if lambda_stack.refresh_dashboard_snapshots_func is not None:
+            self.__create_refresh_dashboard_snapshots_rule(
+                lambda_stack.refresh_dashboard_snapshots_func, lambda_stack.dashboard_snapshots
+            )
+
+        if lambda_stack.archive_jobs_state_machine is not None:
+            self.__create_archive_jobs_rule(lambda_stack.archive_jobs_state_machine)
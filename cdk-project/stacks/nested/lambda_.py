@@ -1,7 +1,11 @@
 from aws_cdk import (
+    BundlingOptions,
     Duration,
     NestedStack,
-    aws_lambda as _lambda
+    aws_iam as iam,
+    aws_lambda as _lambda,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as tasks
 )
 
 from constructs import Construct
@@ -10,8 +14,43 @@ from constructs import Construct
 class LambdaStack(NestedStack):
     __LAMBDA_RUNTIME = _lambda.Runtime.PYTHON_3_12
     __LAMBDA_ARCH = _lambda.Architecture.ARM_64
+    __CONTAINER_INSTANCE_CACHE_SIZE = 1024
+    __CONTAINER_INSTANCE_CACHE_TTL_SECONDS = 900
+    __PIPELINE_CONCURRENCY = 16
+    __STATE_GAUGE_SHARDS = 10
+    # Claims of events outlive the timeout of the functions, so that only crashed invocations have theirs taken over
+    __EVENT_LEASE_SECONDS = 120
+    __ARCHIVE_MEMORY_SIZE = 1024
+    # Hours of the day archived at the same time, each by its own invocation
+    __ARCHIVE_CONCURRENCY = 4
+    # Snapshots are refreshed every 15 minutes, so a few missed refreshes flag them as stale
+    __SNAPSHOT_STALE_AFTER_MINUTES = 60
+    __STALE_JOB_HOURS = 24
+    # Events delivered directly by EventBridge whose processing fails, e.g. while another invocation holds the claim of
+    # the event, are retried by Lambda after 1 and 2 minutes. Events delivered through SQS are retried by the queue
+    __EVENT_RETRY_ATTEMPTS = 2
 
-    def __create_batch_events_processing_func(self, log_group, log_stream, table):
+    def __create_common_layer(self):
+        return _lambda.LayerVersion(
+            self, 'CommonLayer',
+            layer_version_name='batchInsightsCommon',
+            code=_lambda.Code.from_asset('assets/lambda/layer_common'),
+            compatible_runtimes=[self.__LAMBDA_RUNTIME],
+            compatible_architectures=[self.__LAMBDA_ARCH]
+        )
+
+    def __add_state_gauges(self, function, gauges_table):
+        function.add_environment('STATE_GAUGES_TABLE', gauges_table.table_name)
+        function.add_environment('STATE_GAUGE_SHARDS', str(self.__STATE_GAUGE_SHARDS))
+        gauges_table.grant_write_data(function)
+
+    def __add_event_ledger(self, function, ledger_table):
+        function.add_environment('EVENT_LEDGER_TABLE', ledger_table.table_name)
+        function.add_environment('EVENT_LEASE_SECONDS', str(self.__EVENT_LEASE_SECONDS))
+        ledger_table.grant_read_write_data(function)
+
+    def __create_batch_events_processing_func(self, log_group, log_stream_name, log_stream_shards, table,
+                                              emit_job_metrics):
         function = _lambda.Function(
             self, 'BatchEventsProcessingFunc',
             function_name='processBatchEvents',
@@ -19,12 +58,18 @@ class LambdaStack(NestedStack):
             architecture=self.__LAMBDA_ARCH,
             handler='index.handler',
             code=_lambda.Code.from_asset('assets/lambda/func_process_batch_events'),
+            layers=[self.common_layer],
             timeout=Duration.minutes(1),
-            retry_attempts=0,
+            retry_attempts=self.__EVENT_RETRY_ATTEMPTS,
             environment={
                 'JOBS_LOG_GROUP': log_group.log_group_name,
-                'JOBS_LOG_STREAM': log_stream.log_stream_name,
-                'JOBS_TRACKING_TABLE': table.table_name
+                'JOBS_LOG_STREAM': log_stream_name,
+                'JOBS_LOG_STREAM_SHARDS': str(log_stream_shards),
+                'JOBS_TRACKING_TABLE': table.table_name,
+                'EMIT_JOB_METRICS': str(emit_job_metrics).lower(),
+                'ARRAY_CHILD_DETAIL': str(self.array_child_detail).lower(),
+                'PIPELINE_CONCURRENCY': str(self.__PIPELINE_CONCURRENCY),
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
             }
         )
 
@@ -41,10 +86,12 @@ class LambdaStack(NestedStack):
             architecture=self.__LAMBDA_ARCH,
             handler='index.handler',
             code=_lambda.Code.from_asset('assets/lambda/func_process_container_instance_events'),
+            layers=[self.common_layer],
             timeout=Duration.minutes(1),
-            retry_attempts=0,
+            retry_attempts=self.__EVENT_RETRY_ATTEMPTS,
             environment={
-                'CONTAINER_INSTANCE_TRACKING_TABLE': table.table_name
+                'CONTAINER_INSTANCE_TRACKING_TABLE': table.table_name,
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
             }
         )
 
@@ -60,11 +107,16 @@ class LambdaStack(NestedStack):
             architecture=self.__LAMBDA_ARCH,
             handler='index.handler',
             code=_lambda.Code.from_asset('assets/lambda/func_process_task_state_events'),
+            layers=[self.common_layer],
             timeout=Duration.minutes(1),
-            retry_attempts=0,
+            retry_attempts=self.__EVENT_RETRY_ATTEMPTS,
             environment={
                 'CONTAINER_INSTANCE_TRACKING_TABLE': container_instance_table.table_name,
-                'JOBS_TRACKING_TABLE': jobs_table.table_name
+                'JOBS_TRACKING_TABLE': jobs_table.table_name,
+                'CONTAINER_INSTANCE_CACHE_SIZE': str(self.__CONTAINER_INSTANCE_CACHE_SIZE),
+                'CONTAINER_INSTANCE_CACHE_TTL_SECONDS': str(self.__CONTAINER_INSTANCE_CACHE_TTL_SECONDS),
+                'ARRAY_CHILD_DETAIL': str(self.array_child_detail).lower(),
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
             }
         )
 
@@ -73,11 +125,177 @@ class LambdaStack(NestedStack):
 
         return function
 
-    def __init__(self, scope: Construct, construct_id: str, cloudwatch_stack, ddb_stack) -> None:
+    def __create_archive_jobs_func(self, log_group, bucket):
+        # pyarrow is too large for the common layer, it is bundled with the function for its runtime and architecture
+        function = _lambda.Function(
+            self, 'ArchiveJobsFunc',
+            function_name='archiveJobs',
+            runtime=self.__LAMBDA_RUNTIME,
+            architecture=self.__LAMBDA_ARCH,
+            handler='index.handler',
+            code=_lambda.Code.from_asset(
+                'assets/lambda/func_archive_jobs',
+                bundling=BundlingOptions(
+                    image=self.__LAMBDA_RUNTIME.bundling_image,
+                    command=[
+                        'bash', '-c',
+                        'pip install -r requirements.txt -t /asset-output --platform manylinux2014_aarch64 '
+                        '--only-binary=:all: --python-version 3.12 && cp -au . /asset-output'
+                    ]
+                )
+            ),
+            layers=[self.common_layer],
+            memory_size=self.__ARCHIVE_MEMORY_SIZE,
+            timeout=Duration.minutes(15),
+            retry_attempts=0,
+            environment={
+                'JOBS_LOG_GROUP': log_group.log_group_name,
+                'ARCHIVE_BUCKET': bucket.bucket_name
+            }
+        )
+
+        log_group.grant(function, 'logs:FilterLogEvents')
+        bucket.grant_write(function)
+
+        return function
+
+    def __create_archive_jobs_state_machine(self, function):
+        # The function returns the hours of the day to archive, which are then archived by separate invocations
+        plan = tasks.LambdaInvoke(self, 'PlanArchive', lambda_function=function, payload_response_only=True)
+
+        archive_hour = tasks.LambdaInvoke(self, 'ArchiveHour', lambda_function=function, payload_response_only=True)
+        archive_hour.add_retry(errors=['States.TaskFailed'], interval=Duration.minutes(1), max_attempts=2,
+                               backoff_rate=2)
+
+        archive_hours = sfn.Map(
+            self, 'ArchiveHours',
+            items_path='$.hours',
+            item_selector={'date.$': '$.date', 'hour.$': '$$.Map.Item.Value'},
+            max_concurrency=self.__ARCHIVE_CONCURRENCY
+        )
+        archive_hours.item_processor(archive_hour)
+
+        return sfn.StateMachine(
+            self, 'ArchiveJobsStateMachine',
+            state_machine_name='archiveJobs',
+            definition_body=sfn.DefinitionBody.from_chainable(plan.next(archive_hours)),
+            timeout=Duration.hours(6)
+        )
+
+    def __create_reconcile_stale_jobs_func(self, log_group, log_stream_name, log_stream_shards, table):
+        function = _lambda.Function(
+            self, 'ReconcileStaleJobsFunc',
+            function_name='reconcileStaleJobs',
+            runtime=self.__LAMBDA_RUNTIME,
+            architecture=self.__LAMBDA_ARCH,
+            handler='index.handler',
+            code=_lambda.Code.from_asset('assets/lambda/func_reconcile_stale_jobs'),
+            layers=[self.common_layer],
+            timeout=Duration.minutes(15),
+            retry_attempts=0,
+            environment={
+                'JOBS_LOG_GROUP': log_group.log_group_name,
+                'JOBS_LOG_STREAM': log_stream_name,
+                'JOBS_LOG_STREAM_SHARDS': str(log_stream_shards),
+                'JOBS_TRACKING_TABLE': table.table_name,
+                'STALE_AFTER_HOURS': str(self.__STALE_JOB_HOURS),
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
+            }
+        )
+
+        log_group.grant_write(function)
+        table.grant_read_write_data(function)
+
+        # DescribeJobs doesn't support resource-level permissions
+        function.add_to_role_policy(iam.PolicyStatement(actions=['batch:DescribeJobs'], resources=['*']))
+
+        return function
+
+    def __create_publish_job_state_gauges_func(self, gauges_table):
+        function = _lambda.Function(
+            self, 'PublishJobStateGaugesFunc',
+            function_name='publishJobStateGauges',
+            runtime=self.__LAMBDA_RUNTIME,
+            architecture=self.__LAMBDA_ARCH,
+            handler='index.handler',
+            code=_lambda.Code.from_asset('assets/lambda/func_publish_job_state_gauges'),
+            layers=[self.common_layer],
+            timeout=Duration.minutes(1),
+            retry_attempts=0,
+            environment={
+                'STATE_GAUGES_TABLE': gauges_table.table_name,
+                'STATE_GAUGE_SHARDS': str(self.__STATE_GAUGE_SHARDS),
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
+            }
+        )
+
+        gauges_table.grant_read_data(function)
+
+        # DescribeJobQueues doesn't support resource-level permissions
+        function.add_to_role_policy(iam.PolicyStatement(actions=['batch:DescribeJobQueues'], resources=['*']))
+
+        return function
+
+    def __create_refresh_dashboard_snapshots_func(self, log_group, snapshots_table):
+        function = _lambda.Function(
+            self, 'RefreshDashboardSnapshotsFunc',
+            function_name='refreshDashboardSnapshots',
+            runtime=self.__LAMBDA_RUNTIME,
+            architecture=self.__LAMBDA_ARCH,
+            handler='index.handler',
+            code=_lambda.Code.from_asset('assets/lambda/func_refresh_dashboard_snapshots'),
+            layers=[self.common_layer],
+            timeout=Duration.minutes(15),
+            retry_attempts=0,
+            environment={
+                'JOBS_LOG_GROUP': log_group.log_group_name,
+                'DASHBOARD_SNAPSHOTS_TABLE': snapshots_table.table_name,
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
+            }
+        )
+
+        log_group.grant(function, 'logs:StartQuery')
+        snapshots_table.grant_read_write_data(function)
+
+        # Query results are read by query ID, which doesn't support resource-level permissions
+        function.add_to_role_policy(iam.PolicyStatement(actions=['logs:GetQueryResults'], resources=['*']))
+
+        return function
+
+    def __create_render_dashboard_snapshot_func(self, function_name, snapshots_table):
+        function = _lambda.Function(
+            self, 'RenderDashboardSnapshotFunc',
+            function_name=function_name,
+            runtime=self.__LAMBDA_RUNTIME,
+            architecture=self.__LAMBDA_ARCH,
+            handler='index.handler',
+            code=_lambda.Code.from_asset('assets/lambda/func_render_dashboard_snapshot'),
+            layers=[self.common_layer],
+            timeout=Duration.seconds(30),
+            retry_attempts=0,
+            environment={
+                'DASHBOARD_SNAPSHOTS_TABLE': snapshots_table.table_name,
+                'SNAPSHOT_STALE_AFTER_MINUTES': str(self.__SNAPSHOT_STALE_AFTER_MINUTES),
+                'INSTRUMENTATION_SINK': self.instrumentation_sink
+            }
+        )
+
+        snapshots_table.grant_read_data(function)
+
+        return function
+
+    def __init__(self, scope: Construct, construct_id: str, cloudwatch_stack, ddb_stack, storage_stack=None,
+                 emit_job_metrics=False, instrumentation_sink='none', array_child_detail=False) -> None:
         super().__init__(scope, construct_id)
 
+        self.instrumentation_sink = instrumentation_sink
+        self.array_child_detail = array_child_detail
+
+        self.common_layer = self.__create_common_layer()
+
         self.batch_events_processing_func = self.__create_batch_events_processing_func(
-            cloudwatch_stack.jobs_log_group, cloudwatch_stack.jobs_log_stream, ddb_stack.job_tracking_table
+            cloudwatch_stack.jobs_log_group, cloudwatch_stack.jobs_log_stream_name,
+            cloudwatch_stack.jobs_log_stream_shards, ddb_stack.job_tracking_table, emit_job_metrics
         )
 
         self.container_instance_events_processing_func = self.__create_container_instance_events_processing_func(
@@ -87,3 +305,54 @@ class LambdaStack(NestedStack):
         self.task_state_events_processing_func = self.__create_task_state_events_processing_func(
             ddb_stack.container_instance_tracking_table, ddb_stack.job_tracking_table
         )
+
+        self.reconcile_stale_jobs_func = self.__create_reconcile_stale_jobs_func(
+            cloudwatch_stack.jobs_log_group, cloudwatch_stack.jobs_log_stream_name,
+            cloudwatch_stack.jobs_log_stream_shards, ddb_stack.job_tracking_table
+        )
+
+        if ddb_stack.event_ledger_table is not None:
+            for function in (self.batch_events_processing_func, self.task_state_events_processing_func,
+                             self.container_instance_events_processing_func):
+                self.__add_event_ledger(function, ddb_stack.event_ledger_table)
+
+        if ddb_stack.duration_sketches_table is not None:
+            self.batch_events_processing_func.add_environment('DURATION_SKETCHES_TABLE',
+                                                              ddb_stack.duration_sketches_table.table_name)
+            ddb_stack.duration_sketches_table.grant_write_data(self.batch_events_processing_func)
+
+        if ddb_stack.runtime_baselines_table is not None:
+            self.batch_events_processing_func.add_environment('RUNTIME_BASELINES_TABLE',
+                                                              ddb_stack.runtime_baselines_table.table_name)
+            ddb_stack.runtime_baselines_table.grant_read_write_data(self.batch_events_processing_func)
+
+        self.publish_job_state_gauges_func = None
+
+        if ddb_stack.job_state_gauges_table is not None:
+            for function in (self.batch_events_processing_func, self.reconcile_stale_jobs_func):
+                self.__add_state_gauges(function, ddb_stack.job_state_gauges_table)
+
+            self.publish_job_state_gauges_func = self.__create_publish_job_state_gauges_func(
+                ddb_stack.job_state_gauges_table
+            )
+
+        self.refresh_dashboard_snapshots_func = None
+        self.dashboard_snapshots = cloudwatch_stack.dashboard_snapshots
+
+        if ddb_stack.dashboard_snapshots_table is not None:
+            self.refresh_dashboard_snapshots_func = self.__create_refresh_dashboard_snapshots_func(
+                cloudwatch_stack.jobs_log_group, ddb_stack.dashboard_snapshots_table
+            )
+
+            # Custom widgets invoke the function with the credentials of the dashboard viewer
+            self.__create_render_dashboard_snapshot_func(
+                cloudwatch_stack.snapshot_widget_function_name, ddb_stack.dashboard_snapshots_table
+            )
+
+        self.archive_jobs_state_machine = None
+
+        if storage_stack is not None:
+            archive_jobs_func = self.__create_archive_jobs_func(
+                cloudwatch_stack.jobs_log_group, storage_stack.archive_bucket
+            )
+            self.archive_jobs_state_machine = self.__create_archive_jobs_state_machine(archive_jobs_func)
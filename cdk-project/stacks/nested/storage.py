@@ -0,0 +1,23 @@
+from aws_cdk import (
+    NestedStack,
+    RemovalPolicy,
+    aws_s3 as s3
+)
+from constructs import Construct
+
+
+class StorageStack(NestedStack):
+    def __create_archive_bucket(self):
+        return s3.Bucket(
+            self, 'JobsArchiveBucket',
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            enforce_ssl=True,
+            removal_policy=RemovalPolicy.DESTROY,
+            auto_delete_objects=True
+        )
+
+    def __init__(self, scope: Construct, construct_id: str) -> None:
+        super().__init__(scope, construct_id)
+
+        self.archive_bucket = self.__create_archive_bucket()
@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(PROJECT_DIR, 'assets', 'lambda')
+LAYER_DIR = os.path.join(LAMBDA_DIR, 'layer_common', 'python')
+
+for path in (PROJECT_DIR, LAYER_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def load_function(monkeypatch):
+    """
+    Loads a fresh copy of the index module of a Lambda function, which reads its environment variables on import.
+    """
+
+    def load(directory, **environment):
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+
+        path = os.path.join(LAMBDA_DIR, directory, 'index.py')
+        spec = importlib.util.spec_from_file_location(f'test_{directory}', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        return module
+
+    return load
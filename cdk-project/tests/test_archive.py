@@ -0,0 +1,161 @@
+import datetime
+import random
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from batch_insights import archive, runtime
+
+from benchmarks.fakes import S3_MIN_PART_SIZE, ApiCalls, FakeS3
+
+
+ARCHIVE_BUCKET = 'archive'
+JOBS_LOG_GROUP = '/aws-batch-insights/jobs'
+
+# 2024-01-01T00:00:00Z
+DAY_START_MS = 1704067200000
+
+
+@pytest.fixture
+def s3():
+    return FakeS3(ApiCalls(), [ARCHIVE_BUCKET])
+
+
+def job(i, queue='high', timestamp_ms=DAY_START_MS, generator=None):
+    record = {'JobId': f'job-{i:06d}', 'JobQueue': queue, 'Status': 'SUCCEEDED', 'TotalRunningSeconds': i,
+              'Timestamp': timestamp_ms + i}
+
+    if generator is not None:
+        # Random identifiers don't compress, so that the files reach the size of several parts
+        record.update({name: '%064x' % generator.getrandbits(256)
+                       for name in ('JobName', 'JobDefinition', 'InstanceId', 'ContainerInstanceArn')})
+
+    return record
+
+
+def row_groups(backend, key):
+    pa = archive._pyarrow()
+    return pa.parquet.ParquetFile(pa.BufferReader(backend.read(key))).metadata.num_row_groups
+
+
+def test_small_files_are_uploaded_at_once(s3):
+    backend = archive.S3Backend(s3, ARCHIVE_BUCKET)
+    writer = archive.ArchiveWriter(backend, row_group_size=4)
+    records = [job(i) for i in range(6)] + [job(i, queue='low/spot') for i in range(6, 9)]
+
+    keys = writer.write(records, part_name='part')
+
+    assert keys == ['jobs/date=2024-01-01/queue=high/part.parquet',
+                    'jobs/date=2024-01-01/queue=low%2Fspot/part.parquet']
+    assert s3.calls.counts['s3.PutObject'] == 2
+    assert 's3.CreateMultipartUpload' not in s3.calls.counts
+
+    table = archive.read_file(backend, keys[0])
+    assert table.column('JobId').to_pylist() == [f'job-{i:06d}' for i in range(6)]
+    assert row_groups(backend, keys[0]) == 2
+
+
+def test_large_files_are_uploaded_in_parts_as_they_are_written(s3):
+    backend = archive.S3Backend(s3, ARCHIVE_BUCKET, part_size=S3_MIN_PART_SIZE)
+    writer = archive.ArchiveWriter(backend, row_group_size=10000)
+    generator = random.Random(0)
+    uploaded_parts = []
+
+    def records():
+        for i in range(60000):
+            # The parts of the row groups already written are uploaded while the next ones are read
+            if i % 10000 == 0:
+                uploaded_parts.append(s3.calls.counts['s3.UploadPart'])
+
+            yield job(i, generator=generator)
+
+    key, = writer.write(records(), part_name='part')
+
+    assert uploaded_parts[-1] > 0
+    assert s3.calls.counts['s3.UploadPart'] > uploaded_parts[-1]
+    assert s3.calls.counts['s3.CompleteMultipartUpload'] == 1
+    assert s3.uploads == {}
+
+    assert archive.read_file(backend, key).num_rows == 60000
+    assert row_groups(backend, key) == 6
+
+
+def test_failed_writes_abort_their_uploads(s3):
+    backend = archive.S3Backend(s3, ARCHIVE_BUCKET, part_size=S3_MIN_PART_SIZE)
+    writer = archive.ArchiveWriter(backend, row_group_size=10000)
+    generator = random.Random(0)
+
+    def records():
+        for i in range(50000):
+            yield job(i, generator=generator)
+
+        raise RuntimeError('The logs could not be read')
+
+    with pytest.raises(RuntimeError):
+        writer.write(records(), part_name='part')
+
+    assert s3.calls.counts['s3.AbortMultipartUpload'] == 1
+    assert s3.uploads == {}
+    assert s3.objects[ARCHIVE_BUCKET] == {}
+
+
+def test_local_backend(tmp_path):
+    backend = archive.LocalBackend(str(tmp_path))
+    writer = archive.ArchiveWriter(backend, row_group_size=2)
+    next_day_ms = DAY_START_MS + 24 * 60 * 60 * 1000
+
+    writer.write([job(i) for i in range(3)] + [job(i, timestamp_ms=next_day_ms) for i in range(3, 5)], part_name='a')
+
+    table = archive.read_partitions(backend, datetime.date(2024, 1, 1), datetime.date(2024, 1, 2), queues=['high'],
+                                    columns=['JobId'])
+    assert table.column('JobId').to_pylist() == [f'job-{i:06d}' for i in range(5)]
+
+    # Files that were not completed are dropped
+    with pytest.raises(ZeroDivisionError):
+        writer.write((job(i) if i < 2 else 1 / 0 for i in range(3)), part_name='b')
+
+    assert backend.list('jobs/date=2024-01-01/') == ['jobs/date=2024-01-01/queue=high/a.parquet']
+
+
+@pytest.fixture
+def archive_jobs(load_function, s3, monkeypatch):
+    runtime.reset()
+    runtime.set_client('s3', s3)
+    module = load_function('func_archive_jobs', JOBS_LOG_GROUP=JOBS_LOG_GROUP, ARCHIVE_BUCKET=ARCHIVE_BUCKET)
+    windows = []
+
+    def read_logged_jobs(start_ms, end_ms):
+        windows.append((start_ms, end_ms))
+        return [job(i, timestamp_ms=start_ms) for i in range(3)]
+
+    monkeypatch.setattr(module, 'read_logged_jobs', read_logged_jobs)
+
+    yield module, windows
+
+    runtime.reset()
+
+
+def test_handler_plans_the_hours_of_the_day(archive_jobs):
+    module, windows = archive_jobs
+
+    assert module.handler({'date': '2024-01-01'}, None) == {'date': '2024-01-01', 'hours': list(range(24))}
+
+    yesterday = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+    assert module.handler({}, None)['date'] == yesterday.isoformat()
+    assert windows == []
+
+
+def test_handler_archives_one_hour(archive_jobs, s3):
+    module, windows = archive_jobs
+
+    response = module.handler({'date': '2024-01-01', 'hour': 23}, None)
+
+    assert windows == [(DAY_START_MS + 23 * 3600 * 1000, DAY_START_MS + 24 * 3600 * 1000)]
+    assert response == {'date': '2024-01-01', 'hour': 23,
+                        'files': ['jobs/date=2024-01-01/queue=high/jobs-2024-01-01-23.parquet']}
+    assert list(s3.objects[ARCHIVE_BUCKET]) == response['files']
+
+    with pytest.raises(ValueError):
+        module.handler({'date': '2024-01-01', 'hour': 24}, None)
+
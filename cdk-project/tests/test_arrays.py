@@ -0,0 +1,231 @@
+import pytest
+
+from batch_insights import arrays, jobs, runtime
+
+from benchmarks.fakes import ApiCalls, FakeDynamoDB
+
+
+JOBS_TRACKING_TABLE = 'BatchJobsTracking'
+PARENT_ID = 'parent'
+
+
+class RecordingDynamoDB(FakeDynamoDB):
+    """
+    Records the child indices of every update, and runs a callback before the first one, e.g. to complete the parent
+    while a flush is in progress.
+    """
+
+    def __init__(self, calls, tables, before_update=None):
+        super().__init__(calls, tables)
+        self.before_update = before_update
+        self.updated_indices = []
+
+    def update_item(self, **kwargs):
+        if self.before_update is not None:
+            before_update, self.before_update = self.before_update, None
+            before_update(self)
+
+        values = kwargs['ExpressionAttributeValues']
+        self.updated_indices.append(sorted(int(index) for index in values.get(':i', {}).get('NS', [])))
+
+        return super().update_item(**kwargs)
+
+
+@pytest.fixture
+def dynamodb():
+    return RecordingDynamoDB(ApiCalls(), {JOBS_TRACKING_TABLE: ('JobId',)})
+
+
+def track_parent(dynamodb, **attributes):
+    dynamodb.put_item(TableName=JOBS_TRACKING_TABLE,
+                      Item=runtime.serialize_item(dict({'JobId': PARENT_ID, 'RUNNABLE': 1000}, **attributes)))
+
+
+def parent_item(dynamodb):
+    return dynamodb.tables[JOBS_TRACKING_TABLE].items.get((PARENT_ID,))
+
+
+def child_detail(index, status='SUCCEEDED', running_seconds=60):
+    return {'jobId': f'{PARENT_ID}:{index}', 'status': status, 'createdAt': 0, 'startedAt': 30000,
+            'stoppedAt': 30000 + running_seconds * 1000}
+
+
+def record_children(aggregator, indices, **kwargs):
+    for index in indices:
+        aggregator.record_completion(child_detail(index, **kwargs))
+
+
+@pytest.mark.parametrize('job_id, expected', [
+    ('parent:0', 'parent'), ('a1b2-c3:17', 'a1b2-c3'), ('parent', None), ('parent:', None), ('parent:x', None)
+])
+def test_parent_job_id(job_id, expected):
+    assert arrays.parent_job_id(job_id) == expected
+
+
+def test_duplicated_children_within_a_batch_are_counted_once(dynamodb):
+    track_parent(dynamodb)
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+
+    record_children(aggregator, [0, 1, 1, 2])
+
+    assert aggregator.flush() == set()
+    assert parent_item(dynamodb)['ChildSucceeded'] == 3
+    assert dynamodb.updated_indices == [[0, 1, 2]]
+
+
+def test_duplicated_children_across_flushes_are_counted_once(dynamodb):
+    track_parent(dynamodb)
+    first = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(first, [0, 1])
+    first.flush()
+
+    # The completion of child 1 is delivered again, along with a new child, to another batch
+    second = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(second, [1, 2], status='FAILED')
+
+    assert second.flush() == set()
+
+    item = parent_item(dynamodb)
+    assert (item['ChildSucceeded'], item['ChildFailed']) == (2, 1)
+    assert item[arrays.CHILD_INDICES_ATTRIBUTE] == {0, 1, 2}
+
+    # The conditional update of both children fails, the parent is read again and only child 2 is retried
+    assert dynamodb.updated_indices == [[0, 1], [1, 2], [2]]
+    assert dynamodb.calls.counts['dynamodb.GetItem'] == 1
+
+
+def test_children_are_written_in_chunks(dynamodb):
+    track_parent(dynamodb)
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(aggregator, range(60))
+
+    aggregator.flush()
+
+    assert [len(indices) for indices in dynamodb.updated_indices] == [25, 25, 10]
+    assert parent_item(dynamodb)['ChildSucceeded'] == 60
+
+    # A chunk retried after a duplicate only leaves out the children already counted
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(aggregator, range(55, 90))
+    dynamodb.updated_indices.clear()
+
+    aggregator.flush()
+
+    assert dynamodb.updated_indices == [list(range(55, 80)), list(range(60, 80)), list(range(80, 90))]
+    assert parent_item(dynamodb)['ChildSucceeded'] == 90
+
+
+def test_instance_types_are_written_in_chunks(dynamodb):
+    track_parent(dynamodb)
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+
+    for i in range(arrays.MAX_OPERANDS_PER_UPDATE + 20):
+        aggregator.record_instance_type(f'{PARENT_ID}:{i}', f'type-{i}')
+
+    aggregator.record_instance_type(f'{PARENT_ID}:0', 'type-0')
+    aggregator.flush()
+
+    item = parent_item(dynamodb)
+    assert dynamodb.calls.counts['dynamodb.UpdateItem'] == 2
+    assert (item[arrays.INSTANCE_TYPE_PREFIX + 'type-0'], item[arrays.INSTANCE_TYPE_PREFIX + 'type-1']) == (2, 1)
+
+
+def test_children_of_untracked_parents_are_dropped(dynamodb):
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(aggregator, [0, 1])
+    aggregator.record_instance_type(f'{PARENT_ID}:0', 'c5.xlarge')
+
+    # Dropped counts are not failures, retrying them would not find the parent either
+    assert aggregator.flush() == set()
+    assert parent_item(dynamodb) is None
+
+
+@pytest.mark.parametrize('complete_parent', [
+    lambda dynamodb: dynamodb.delete_item(TableName=JOBS_TRACKING_TABLE, Key={'JobId': {'S': PARENT_ID}}),
+    lambda dynamodb: dynamodb.put_item(TableName=JOBS_TRACKING_TABLE, Item=jobs.tombstone(PARENT_ID, 'SUCCEEDED'))
+], ids=['deleted', 'tombstoned'])
+def test_parent_completed_during_the_flush(complete_parent):
+    dynamodb = RecordingDynamoDB(ApiCalls(), {JOBS_TRACKING_TABLE: ('JobId',)}, before_update=complete_parent)
+    track_parent(dynamodb)
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(aggregator, range(30))
+
+    assert aggregator.flush() == set()
+
+    # The first chunk is found to have no parent to add to, and the rest of the children are not attempted
+    assert dynamodb.updated_indices == [list(range(25))]
+
+    item = parent_item(dynamodb)
+    assert item is None or set(item) == {'JobId', jobs.COMPLETED_STATUS_ATTRIBUTE, jobs.EXPIRES_AT_ATTRIBUTE}
+
+
+def test_failed_updates_are_reported(dynamodb, monkeypatch):
+    def update_item(**kwargs):
+        raise RuntimeError('Throttled')
+
+    track_parent(dynamodb)
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+    record_children(aggregator, [0])
+    monkeypatch.setattr(dynamodb, 'update_item', update_item)
+
+    assert aggregator.flush() == {PARENT_ID}
+
+
+def test_merge_into():
+    aggregator = arrays.ChildAggregator(None, JOBS_TRACKING_TABLE)
+    record_children(aggregator, [1, 2, 3])
+    aggregator.record_instance_type(f'{PARENT_ID}:3', 'c5.xlarge')
+
+    # Child 1 was written to the tracking item by a previous batch
+    tracking_data = {'JobId': PARENT_ID, 'ChildSucceeded': 1, arrays.CHILD_INDICES_ATTRIBUTE: {1},
+                     arrays.INSTANCE_TYPE_PREFIX + 'c5.xlarge': 1}
+
+    aggregator.merge_into(PARENT_ID, tracking_data)
+
+    assert tracking_data['ChildSucceeded'] == 3
+    assert tracking_data[arrays.CHILD_INDICES_ATTRIBUTE] == {1, 2, 3}
+    assert tracking_data[arrays.INSTANCE_TYPE_PREFIX + 'c5.xlarge'] == 2
+
+    # Nothing is left to flush for the parent
+    assert aggregator.flush() == set()
+
+
+def test_merge_into_without_children():
+    aggregator = arrays.ChildAggregator(None, JOBS_TRACKING_TABLE)
+    tracking_data = {'JobId': PARENT_ID}
+
+    aggregator.merge_into(PARENT_ID, tracking_data)
+
+    assert tracking_data == {'JobId': PARENT_ID}
+
+
+def test_summarize_array(dynamodb):
+    track_parent(dynamodb)
+    aggregator = arrays.ChildAggregator(dynamodb, JOBS_TRACKING_TABLE)
+
+    for index in range(100):
+        aggregator.record_completion(child_detail(index, status='FAILED' if index < 10 else 'SUCCEEDED',
+                                                  running_seconds=index + 1))
+        aggregator.record_instance_type(f'{PARENT_ID}:{index}', 'c5.xlarge' if index % 4 else 'm5.2xlarge')
+
+    aggregator.flush()
+    tracking_data = runtime.deserialize_item(runtime.serialize_item(parent_item(dynamodb)))
+
+    summary = arrays.summarize_array({'arrayProperties': {'size': 100}}, tracking_data)
+
+    assert (summary['ArraySize'], summary['ChildJobs'], summary['ChildSucceeded'], summary['ChildFailed'],
+            summary['ChildSuccessRate']) == (100, 100, 90, 10, 90.0)
+    assert summary['ChildInstanceTypes'] == {'c5.xlarge': 75, 'm5.2xlarge': 25}
+    assert summary['ChildMaxRunningSeconds'] == pytest.approx(100, rel=0.01)
+    assert summary['ChildP50RunningSeconds'] == pytest.approx(50, rel=0.01)
+    assert summary['ChildMinQueuedSeconds'] == summary['ChildMaxQueuedSeconds'] == pytest.approx(30, rel=0.01)
+
+    # Only the fields of the parent are left in its tracking data
+    assert set(tracking_data) == {'JobId', 'RUNNABLE', jobs.EXPIRES_AT_ATTRIBUTE}
+
+
+def test_summarize_jobs_that_are_not_arrays():
+    tracking_data = {'JobId': 'job', 'RUNNABLE': 1000}
+
+    assert arrays.summarize_array({}, tracking_data) == {}
+    assert tracking_data == {'JobId': 'job', 'RUNNABLE': 1000}
@@ -0,0 +1,247 @@
+import json
+
+import pytest
+
+from replay import dlq
+
+from benchmarks.events import EventStream, container_instance_event, job_state_event, task_state_event
+from benchmarks.fakes import SQS_MAX_MESSAGES_PER_REQUEST, ApiCalls, FakeSQS
+
+
+BATCH_QUEUE = 'BatchEventsDeadLetterQueue'
+INSTANCE_QUEUE = 'ContainerInstanceEventsDeadLetterQueue'
+CONTAINER_INSTANCE_ARN = 'arn:aws:ecs:us-east-1:123456789012:container-instance/default/instance-1'
+JOB = {'JobId': 'job-1', 'JobName': 'render', 'JobQueue': 'HighPriority', 'JobDefinition': 'Render'}
+
+# 2024-01-01T00:00:00Z
+START_MS = 1704067200000
+
+
+class RecordingSQS(FakeSQS):
+    """
+    Records the number of messages of every request, and can fail the deletion of the next batch, like SQS does when
+    the receipt handles expired.
+    """
+
+    def __init__(self, calls, queues=()):
+        super().__init__(calls, queues)
+        self.fail_next_delete = False
+        self.received = []
+        self.deleted = []
+
+    def receive_message(self, **kwargs):
+        response = super().receive_message(**kwargs)
+        self.received.append(len(response.get('Messages', [])))
+
+        return response
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.deleted.append(len(Entries))
+
+        if self.fail_next_delete:
+            self.fail_next_delete = False
+            return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid'}
+                                                 for entry in Entries]}
+
+        return super().delete_message_batch(QueueUrl, Entries, **kwargs)
+
+    def expire_visibility_timeouts(self, queue_name):
+        for message in self.queues[queue_name][0].values():
+            message[2] = 0
+
+
+class RecordingInvoker:
+    """
+    Records every invocation, and reports the events of failing_ids as failed the first time they are replayed.
+    """
+
+    def __init__(self, failing_ids=()):
+        self.failing_ids = set(failing_ids)
+        self.invocations = []
+
+    def invoke(self, function_name, payload):
+        records = payload.get('Records')
+        message_ids = [record['messageId'] for record in records] if records else \
+            [payload['detail']['containerInstanceArn']]
+        self.invocations.append((function_name, message_ids))
+
+        failed_ids = self.failing_ids & set(message_ids)
+        self.failing_ids -= failed_ids
+
+        if records is None:
+            return None
+
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed_ids)]}
+
+
+@pytest.fixture
+def sqs():
+    return RecordingSQS(ApiCalls(), dlq.DEAD_LETTER_QUEUES)
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return dlq.Spool(str(tmp_path / 'spool'))
+
+
+def transition(status, second, job=JOB):
+    return job_state_event(START_MS + second * 1000, job, status)
+
+
+def send(sqs, queue_name, events):
+    for event in events:
+        sqs.send_message(QueueUrl=queue_name, MessageBody=json.dumps(event))
+
+
+def test_drain_moves_the_messages_to_the_spool(sqs, spool):
+    send(sqs, BATCH_QUEUE, [transition('RUNNABLE', i) for i in range(25)])
+
+    assert dlq.drain_queue(sqs, BATCH_QUEUE, spool, receivers=2) == 25
+
+    assert len(list(spool.messages())) == 25
+    assert sqs.queues[BATCH_QUEUE][0] == {}
+
+    # Every request stays within the SQS limit of 10 messages
+    assert max(sqs.received) == max(sqs.deleted) == SQS_MAX_MESSAGES_PER_REQUEST
+    assert sum(sqs.deleted) == 25
+
+
+def test_messages_that_could_not_be_deleted_are_spooled_once(sqs, spool):
+    send(sqs, BATCH_QUEUE, [transition('RUNNABLE', i) for i in range(15)])
+    sqs.fail_next_delete = True
+
+    assert dlq.drain_queue(sqs, BATCH_QUEUE, spool) == 15
+    assert len(sqs.queues[BATCH_QUEUE][0]) == SQS_MAX_MESSAGES_PER_REQUEST
+
+    # The messages of the failed deletion are received and spooled again once their visibility timeout expires
+    sqs.expire_visibility_timeouts(BATCH_QUEUE)
+
+    assert dlq.drain_queue(sqs, BATCH_QUEUE, spool) == SQS_MAX_MESSAGES_PER_REQUEST
+    assert sqs.queues[BATCH_QUEUE][0] == {}
+
+    assert sorted(body for _, body in spool.messages()) == \
+        sorted(json.dumps(transition('RUNNABLE', i)) for i in range(15))
+
+
+def test_dry_run_leaves_the_messages_in_the_queue(sqs, spool):
+    send(sqs, BATCH_QUEUE, [transition('RUNNABLE', i) for i in range(12)])
+
+    received = dlq.drain_queue(sqs, BATCH_QUEUE, spool, dry_run=True)
+
+    assert len(received) == 12
+    assert list(spool.messages()) == []
+    assert len(sqs.queues[BATCH_QUEUE][0]) == 12
+    assert sqs.deleted == []
+
+
+def test_build_groups():
+    child = dict(JOB, JobId='job-1:3')
+    task = task_state_event(START_MS + 2000, 'job-1', CONTAINER_INSTANCE_ARN)
+    task_without_job = task_state_event(START_MS, 'job-2', CONTAINER_INSTANCE_ARN)
+    task_without_job['detail']['overrides']['containerOverrides'][0]['environment'] = []
+
+    messages = [
+        ('running', json.dumps(transition('RUNNING', 3))),
+        ('task', json.dumps(task)),
+        ('starting', json.dumps(transition('STARTING', 2))),
+        ('child', json.dumps(transition('SUCCEEDED', 1, job=child))),
+        ('runnable', json.dumps(transition('RUNNABLE', 0))),
+        ('instance', json.dumps(container_instance_event(START_MS, CONTAINER_INSTANCE_ARN, 'i-1', 'c5.xlarge',
+                                                         'x86_64', 'us-east-1a'))),
+        ('replayed', json.dumps(transition('SUBMITTED', 0))),
+        ('unparsable', '{"detail-type": '),
+        ('unknown', json.dumps({'detail-type': 'EC2 Instance State-change Notification', 'detail': {}})),
+        ('task-without-job', json.dumps(task_without_job))
+    ]
+
+    instance_groups, job_groups, skipped = dlq.build_groups(messages, replayed={'replayed'})
+
+    assert list(instance_groups) == [f'instance:{CONTAINER_INSTANCE_ARN}']
+    assert skipped == 3
+
+    # Children are replayed with their parent, and the task after the transition of the same second
+    assert {key: [message_id for message_id, _ in events] for key, events in job_groups.items()} == {
+        'job:job-1': ['runnable', 'child', 'starting', 'task', 'running']
+    }
+
+
+def test_build_invocations():
+    events = [(f'runnable-{i}', transition('RUNNABLE', i)) for i in range(250)]
+    events.insert(120, ('task', task_state_event(START_MS, 'job-1', CONTAINER_INSTANCE_ARN)))
+
+    invocations = dlq.build_invocations(events)
+
+    # Consecutive events of a function are sent together, up to the 100 SQS records a function processes at once
+    assert [(function_name, len(events)) for function_name, events in invocations] == [
+        ('processBatchEvents', 100), ('processBatchEvents', 20), ('processTaskStateEvents', 1),
+        ('processBatchEvents', 100), ('processBatchEvents', 30)
+    ]
+    assert [message_id for _, events in invocations for message_id, _ in events] == \
+        [message_id for message_id, _ in events]
+
+    instance = container_instance_event(START_MS, CONTAINER_INSTANCE_ARN, 'i-1', 'c5.xlarge', 'x86_64', 'us-east-1a')
+
+    # Container instance events are not sent as SQS records, one invocation per event
+    assert [len(events) for _, events in dlq.build_invocations([('a', instance), ('b', instance)])] == [1, 1]
+
+
+def test_dry_run_plans_the_replay(sqs, spool):
+    send(sqs, BATCH_QUEUE, [transition(status, i) for i, status in enumerate(['RUNNABLE', 'STARTING', 'RUNNING'])])
+    send(sqs, BATCH_QUEUE, [transition('RUNNABLE', 0, job=dict(JOB, JobId='job-2'))])
+    send(sqs, INSTANCE_QUEUE, [container_instance_event(START_MS, CONTAINER_INSTANCE_ARN, 'i-1', 'c5.xlarge', 'x86_64',
+                                                        'us-east-1a')])
+    invoker = RecordingInvoker()
+
+    summary = dlq.run(sqs, invoker, spool, dry_run=True)
+
+    assert summary['DrainedMessages'] == {BATCH_QUEUE: 4, 'TaskStateEventsDeadLetterQueue': 0, INSTANCE_QUEUE: 1}
+    assert summary['Plan'] == {'ContainerInstanceGroups': 1, 'JobGroups': 2, 'Invocations': 3,
+                               'EventsByFunction': {'processContainerInstanceEvents': 1, 'processBatchEvents': 4}}
+    assert 'Replay' not in summary
+    assert invoker.invocations == []
+
+
+def test_failed_events_stop_their_group_until_the_next_run(sqs, spool):
+    events = {
+        'instance': container_instance_event(START_MS, CONTAINER_INSTANCE_ARN, 'i-1', 'c5.xlarge', 'x86_64',
+                                             'us-east-1a'),
+        'runnable': transition('RUNNABLE', 0),
+        'starting': transition('STARTING', 1),
+        'task': task_state_event(START_MS + 1000, JOB['JobId'], CONTAINER_INSTANCE_ARN),
+        'running': transition('RUNNING', 2),
+        'other': transition('RUNNABLE', 0, job=dict(JOB, JobId='job-2'))
+    }
+    spool.append_messages(BATCH_QUEUE, [{'MessageId': message_id, 'Body': json.dumps(event)}
+                                        for message_id, event in events.items()])
+
+    invoker = RecordingInvoker(failing_ids={'starting'})
+    summary = dlq.run(sqs, invoker, spool, workers=1, drain=False)
+
+    # The container instance is replayed first, and the events of job-1 after the failed one wait for the next run
+    assert invoker.invocations[0] == ('processContainerInstanceEvents', [CONTAINER_INSTANCE_ARN])
+    assert sorted(invoker.invocations[1:]) == [('processBatchEvents', ['other']),
+                                               ('processBatchEvents', ['runnable', 'starting'])]
+    assert spool.replayed() == {'instance', 'runnable', 'other'}
+    assert summary['Replay']['FailedGroups'] == summary['Replay']['FailedEvents'] == 1
+
+    invoker = RecordingInvoker()
+    summary = dlq.run(sqs, invoker, spool, workers=1, drain=False)
+
+    assert invoker.invocations == [('processBatchEvents', ['starting']), ('processTaskStateEvents', ['task']),
+                                   ('processBatchEvents', ['running'])]
+    assert summary['AlreadyReplayed'] == 3
+    assert (summary['Replay']['ReplayedEvents'], summary['Replay']['FailedEvents']) == (3, 0)
+    assert spool.replayed() == set(events)
+
+
+def test_run_local(tmp_path, spool):
+    stream = EventStream(20, n_instances=5, array_job_rate=0.2, array_size=3, seed=1)
+    path = tmp_path / 'events.jsonl'
+    path.write_text(''.join(json.dumps(event) + '\n' for _, event in stream))
+
+    summary = dlq.run_local(str(path), spool, workers=4, max_invocations_per_second=0)
+
+    assert summary['Replay']['FailedEvents'] == 0
+    assert summary['Replay']['ReplayedEvents'] == sum(summary['DrainedMessages'].values())
+    assert summary['Plan']['ContainerInstanceGroups'] == 5
+    assert summary['LoggedJobs'] == 20
@@ -0,0 +1,204 @@
+import zlib
+
+import pytest
+
+from batch_insights import gauges, runtime
+from batch_insights.gauges import StateGauges
+
+from benchmarks.events import job_state_event
+from benchmarks.fakes import ApiCalls, FakeDynamoDB, FakeLogs
+
+
+STATE_GAUGES_TABLE = 'JobStateGauges'
+JOBS_TRACKING_TABLE = 'BatchJobsTracking'
+CONTAINER_INSTANCE_TRACKING_TABLE = 'ContainerInstanceTracking'
+JOBS_LOG_GROUP = '/aws-batch-insights/jobs'
+JOBS_LOG_STREAM = 'Jobs'
+SHARDS = 4
+
+# 2024-01-01T00:00:00Z
+START_MS = 1704067200000
+
+
+class UnprocessedDynamoDB(FakeDynamoDB):
+    """
+    Leaves the second half of the keys of the first BatchGetItem unprocessed, like DynamoDB does when it is throttled.
+    """
+
+    def __init__(self, calls, tables):
+        super().__init__(calls, tables)
+        self.throttled = True
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        if not self.throttled:
+            return super().batch_get_item(RequestItems, **kwargs)
+
+        self.throttled = False
+        name, request = next(iter(RequestItems.items()))
+        half = len(request['Keys']) // 2
+        response = super().batch_get_item({name: {'Keys': request['Keys'][:half]}}, **kwargs)
+
+        return dict(response, UnprocessedKeys={name: {'Keys': request['Keys'][half:]}})
+
+
+@pytest.fixture
+def dynamodb():
+    return FakeDynamoDB(ApiCalls(), {STATE_GAUGES_TABLE: ('Gauge',)})
+
+
+def counters(dynamodb):
+    return {key: {status: count for status, count in item.items() if status != 'Gauge'}
+            for (key,), item in dynamodb.tables[STATE_GAUGES_TABLE].items.items()}
+
+
+def test_job_shard():
+    assert gauges.job_shard('job-1', SHARDS) == zlib.crc32(b'job-1') % SHARDS
+    assert {gauges.job_shard(f'job-{i}', SHARDS) for i in range(100)} == set(range(SHARDS))
+
+
+@pytest.mark.parametrize('tracking_data, status, expected', [
+    # Jobs tracked before the gauges were enabled, or by their first transition, are not taken out of any status
+    ({}, 'SUBMITTED', (None, 'SUBMITTED')),
+    ({'RUNNABLE': 1000}, 'RUNNING', (None, 'RUNNING')),
+    ({'JobQueue': 'high', 'RUNNABLE': 1000}, 'RUNNING', ('RUNNABLE', 'RUNNING')),
+    ({'JobQueue': 'high', 'RUNNABLE': 1000, 'STARTING': 2000}, 'RUNNING', ('STARTING', 'RUNNING')),
+    # Transitions delivered twice or late don't move the job
+    ({'JobQueue': 'high', 'RUNNABLE': 1000}, 'RUNNABLE', None),
+    ({'JobQueue': 'high', 'RUNNING': 3000}, 'STARTING', None)
+])
+def test_transition(tracking_data, status, expected):
+    assert gauges.transition(tracking_data, status) == expected
+
+
+def test_moves_are_written_once_per_shard(dynamodb):
+    state_gauges = StateGauges(dynamodb, STATE_GAUGES_TABLE, SHARDS)
+
+    for i in range(20):
+        state_gauges.move('high', f'job-{i}', None, 'RUNNABLE')
+
+    state_gauges.move('low', 'job-0', None, 'RUNNABLE')
+    state_gauges.flush()
+
+    expected = {}
+
+    for i in range(20):
+        key = gauges.gauge_key('high', zlib.crc32(f'job-{i}'.encode('utf-8')) % SHARDS)
+        expected[key] = {'RUNNABLE': expected.get(key, {}).get('RUNNABLE', 0) + 1}
+
+    expected[gauges.gauge_key('low', gauges.job_shard('job-0', SHARDS))] = {'RUNNABLE': 1}
+
+    assert counters(dynamodb) == expected
+    assert dynamodb.calls.counts['dynamodb.UpdateItem'] == len(expected)
+
+    # Nothing is left to write
+    state_gauges.flush()
+
+    assert dynamodb.calls.counts['dynamodb.UpdateItem'] == len(expected)
+
+
+def test_moves_of_a_flush_are_netted(dynamodb):
+    state_gauges = StateGauges(dynamodb, STATE_GAUGES_TABLE, SHARDS)
+    state_gauges.move('high', 'job-1', None, 'RUNNABLE')
+    state_gauges.flush()
+
+    # The job goes through STARTING to RUNNING within a flush, and moves to its own status are ignored
+    state_gauges.move('high', 'job-1', 'RUNNABLE', 'STARTING')
+    state_gauges.move('high', 'job-1', 'STARTING', 'RUNNING')
+    state_gauges.move('high', 'job-1', 'RUNNING', 'RUNNING')
+    state_gauges.flush()
+
+    assert counters(dynamodb) == {gauges.gauge_key('high', gauges.job_shard('job-1', SHARDS)):
+                                  {'RUNNABLE': 0, 'RUNNING': 1}}
+    assert dynamodb.calls.counts['dynamodb.UpdateItem'] == 2
+
+    # Completed jobs leave the counter of their last status
+    state_gauges.move('high', 'job-1', 'RUNNING', None)
+    state_gauges.flush()
+
+    assert gauges.read_gauges(dynamodb, STATE_GAUGES_TABLE, ['high'], SHARDS)['high']['RUNNING'] == 0
+
+
+def test_read_gauges_sums_the_shards(dynamodb):
+    state_gauges = StateGauges(dynamodb, STATE_GAUGES_TABLE, SHARDS)
+
+    for i in range(30):
+        state_gauges.move('high', f'job-{i}', None, 'RUNNING' if i % 3 else 'RUNNABLE')
+
+    for i in range(10):
+        state_gauges.move('high', f'job-{i}', 'RUNNING' if i % 3 else 'RUNNABLE', None)
+
+    state_gauges.flush()
+
+    result = gauges.read_gauges(dynamodb, STATE_GAUGES_TABLE, ['high', 'idle'], SHARDS)
+
+    assert result == {
+        'high': {'SUBMITTED': 0, 'PENDING': 0, 'RUNNABLE': 6, 'STARTING': 0, 'RUNNING': 14},
+        'idle': dict.fromkeys(gauges.GAUGE_STATUSES, 0)
+    }
+
+
+def test_read_gauges_in_batches_of_100_keys():
+    dynamodb = UnprocessedDynamoDB(ApiCalls(), {STATE_GAUGES_TABLE: ('Gauge',)})
+    job_queues = [f'queue-{i}' for i in range(30)]
+    state_gauges = StateGauges(dynamodb, STATE_GAUGES_TABLE, SHARDS)
+
+    for job_queue in job_queues:
+        for i in range(10):
+            state_gauges.move(job_queue, f'job-{i}', None, 'RUNNING')
+
+    state_gauges.flush()
+
+    # 30 job queues of 4 shards are read in 2 requests, and the unprocessed keys of the first one are read again
+    result = gauges.read_gauges(dynamodb, STATE_GAUGES_TABLE, job_queues, SHARDS)
+
+    assert all(counts['RUNNING'] == 10 for counts in result.values())
+    assert dynamodb.calls.counts['dynamodb.BatchGetItem'] == 3
+
+
+@pytest.fixture
+def process_batch_event(load_function):
+    calls = ApiCalls()
+    services = {
+        'dynamodb': FakeDynamoDB(calls, {
+            JOBS_TRACKING_TABLE: ('JobId',),
+            CONTAINER_INSTANCE_TRACKING_TABLE: ('ContainerInstanceArn',),
+            STATE_GAUGES_TABLE: ('Gauge',)
+        }),
+        'logs': FakeLogs(calls, [(JOBS_LOG_GROUP, JOBS_LOG_STREAM)])
+    }
+
+    runtime.reset()
+
+    for name, client in services.items():
+        runtime.set_client(name, client)
+
+    yield services['dynamodb'], load_function(
+        'func_process_batch_events', JOBS_LOG_GROUP=JOBS_LOG_GROUP, JOBS_LOG_STREAM=JOBS_LOG_STREAM,
+        JOBS_TRACKING_TABLE=JOBS_TRACKING_TABLE, CONTAINER_INSTANCE_TRACKING_TABLE=CONTAINER_INSTANCE_TRACKING_TABLE,
+        STATE_GAUGES_TABLE=STATE_GAUGES_TABLE, STATE_GAUGE_SHARDS=str(SHARDS)
+    ).handler
+
+    runtime.reset()
+
+
+def test_gauges_follow_the_job_events(process_batch_event):
+    dynamodb, handler = process_batch_event
+    job = {'JobName': 'render', 'JobQueue': 'HighPriority', 'JobDefinition': 'Render'}
+
+    def transition(job_id, status, second, **kwargs):
+        handler(job_state_event(START_MS + second * 1000, dict(job, JobId=job_id), status, **kwargs), None)
+
+    for i in range(6):
+        transition(f'job-{i}', 'RUNNABLE', 0)
+
+    for i in range(4):
+        transition(f'job-{i}', 'RUNNING', 60, started_at=START_MS + 60000)
+
+    # A duplicated transition, a late one and a completion
+    transition('job-0', 'RUNNING', 60, started_at=START_MS + 60000)
+    transition('job-1', 'STARTING', 30)
+    transition('job-2', 'SUCCEEDED', 120, started_at=START_MS + 60000, stopped_at=START_MS + 120000)
+
+    result = gauges.read_gauges(dynamodb, STATE_GAUGES_TABLE, ['HighPriority'], SHARDS)['HighPriority']
+
+    assert (result['RUNNABLE'], result['STARTING'], result['RUNNING']) == (2, 0, 3)
@@ -0,0 +1,212 @@
+import json
+import time
+
+import pytest
+
+from batch_insights import idempotency, runtime
+
+from benchmarks import harness
+from benchmarks.events import container_instance_event, job_state_event
+from benchmarks.fakes import ApiCalls, FakeDynamoDB, FakeLogs
+
+
+LEDGER_TABLE = 'ProcessedEvents'
+LEASE_SECONDS = 120
+
+JOB = {'JobName': 'render', 'JobId': 'job-1', 'JobQueue': 'high', 'JobDefinition': 'render'}
+
+
+@pytest.fixture
+def dynamodb():
+    return FakeDynamoDB(ApiCalls(), {LEDGER_TABLE: ('EventKey',)})
+
+
+def create_ledger(dynamodb, table_name=LEDGER_TABLE):
+    # Every ledger has its own window, like a separate execution environment
+    return idempotency.EventLedger(dynamodb, table_name, idempotency.create_window(), LEASE_SECONDS)
+
+
+def ledger_status(dynamodb, key):
+    item = dynamodb.tables[LEDGER_TABLE].items.get((key,))
+    return item['Status'] if item else None
+
+
+def test_window_only():
+    ledger = idempotency.EventLedger(None, None, idempotency.create_window())
+
+    assert ledger.claim(['a', 'a', 'b']) == {'a': idempotency.CLAIMED, 'b': idempotency.CLAIMED}
+
+    ledger.complete(['a'])
+    ledger.release(['b'])
+
+    assert ledger.claim(['a', 'b']) == {'a': idempotency.COMPLETED, 'b': idempotency.CLAIMED}
+
+
+def test_claim_one(dynamodb):
+    ledger, other_ledger = create_ledger(dynamodb), create_ledger(dynamodb)
+
+    assert ledger.claim(['a']) == {'a': idempotency.CLAIMED}
+    assert other_ledger.claim(['a']) == {'a': idempotency.IN_PROGRESS}
+
+    ledger.complete(['a'])
+
+    assert ledger_status(dynamodb, 'a') == idempotency.COMPLETED
+    assert other_ledger.claim(['a']) == {'a': idempotency.COMPLETED}
+    assert dynamodb.calls.counts['dynamodb.PutItem'] == 3
+
+
+def test_claim_many_takes_out_the_keys_claimed_elsewhere(dynamodb):
+    other_ledger = create_ledger(dynamodb)
+    other_ledger.claim(['b'])
+    other_ledger.claim(['c'])
+    other_ledger.complete(['c'])
+
+    outcomes = create_ledger(dynamodb).claim(['a', 'b', 'c', 'd'])
+
+    assert outcomes == {'a': idempotency.CLAIMED, 'b': idempotency.IN_PROGRESS, 'c': idempotency.COMPLETED,
+                        'd': idempotency.CLAIMED}
+    assert [ledger_status(dynamodb, key) for key in 'abcd'] == [idempotency.IN_PROGRESS, idempotency.IN_PROGRESS,
+                                                                idempotency.COMPLETED, idempotency.IN_PROGRESS]
+    # The cancelled transaction is followed by one with the remaining keys
+    assert dynamodb.calls.counts['dynamodb.TransactWriteItems'] == 2
+
+
+def test_claims_are_taken_over_once_their_lease_expires(dynamodb, monkeypatch):
+    now = time.time()
+    create_ledger(dynamodb).claim(['a', 'b', 'c'])
+    ledger = create_ledger(dynamodb)
+
+    assert set(ledger.claim(['a', 'b']).values()) == {idempotency.IN_PROGRESS}
+
+    monkeypatch.setattr(time, 'time', lambda: now + LEASE_SECONDS + 1)
+
+    assert ledger.claim(['a']) == {'a': idempotency.CLAIMED}
+    assert ledger.claim(['b', 'c']) == {'b': idempotency.CLAIMED, 'c': idempotency.CLAIMED}
+
+
+def test_completed_claims_are_never_taken_over(dynamodb, monkeypatch):
+    now = time.time()
+    ledger = create_ledger(dynamodb)
+    ledger.claim(['a'])
+    ledger.complete(['a'])
+
+    monkeypatch.setattr(time, 'time', lambda: now + LEASE_SECONDS + 1)
+
+    assert create_ledger(dynamodb).claim(['a']) == {'a': idempotency.COMPLETED}
+
+
+def test_release(dynamodb):
+    ledger = create_ledger(dynamodb)
+    ledger.claim(['a', 'b'])
+    ledger.release(['a', 'b', 'a'])
+
+    assert ledger_status(dynamodb, 'a') is None
+    assert create_ledger(dynamodb).claim(['a']) == {'a': idempotency.CLAIMED}
+
+
+def test_unreachable_ledger(dynamodb):
+    ledger = create_ledger(dynamodb, table_name='MissingTable')
+
+    # The keys are only claimed in the window, and completing them doesn't fail
+    assert ledger.claim(['a', 'b']) == {'a': idempotency.CLAIMED, 'b': idempotency.CLAIMED}
+
+    ledger.complete(['a'])
+
+    assert ledger.claim(['a']) == {'a': idempotency.COMPLETED}
+
+
+@pytest.fixture
+def process_batch_events(load_function):
+    calls = ApiCalls()
+    dynamodb = FakeDynamoDB(calls, harness.TABLES)
+    runtime.reset()
+    runtime.set_client('dynamodb', dynamodb)
+    runtime.set_client('logs', FakeLogs(calls, [(harness.JOBS_LOG_GROUP, harness.JOBS_LOG_STREAM)]))
+
+    module = load_function('func_process_batch_events', **harness.ENVIRONMENT,
+                           EVENT_LEDGER_TABLE=harness.EVENT_LEDGER_TABLE)
+
+    yield module, dynamodb
+
+    runtime.reset()
+
+
+def sqs_record(message_id, event):
+    return {'messageId': message_id, 'body': json.dumps(event)}
+
+
+def test_events_in_progress_are_retried(process_batch_events):
+    module, dynamodb = process_batch_events
+    runnable = job_state_event(1704067200000, JOB, 'RUNNABLE')
+    starting = job_state_event(1704067260000, dict(JOB, JobId='job-2'), 'STARTING')
+
+    # Another execution environment is processing the RUNNABLE event
+    other_ledger = idempotency.EventLedger(dynamodb, harness.EVENT_LEDGER_TABLE, idempotency.create_window())
+    other_ledger.claim([module.event_key(runnable)])
+
+    response = module.handler({'Records': [sqs_record('m-1', runnable), sqs_record('m-2', starting),
+                                           sqs_record('m-3', starting)]}, None)
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm-1'}]}
+
+    ledger = dynamodb.tables[harness.EVENT_LEDGER_TABLE].items
+    # The claim of the other environment is left untouched
+    assert ledger[(module.event_key(runnable),)]['Status'] == idempotency.IN_PROGRESS
+    assert ledger[(module.event_key(starting),)]['Status'] == idempotency.COMPLETED
+    assert list(dynamodb.tables['BatchJobsTracking'].items) == [('job-2',)]
+
+
+def test_direct_events_in_progress_are_retried(process_batch_events):
+    module, dynamodb = process_batch_events
+    runnable = job_state_event(1704067200000, JOB, 'RUNNABLE')
+    other_ledger = idempotency.EventLedger(dynamodb, harness.EVENT_LEDGER_TABLE, idempotency.create_window())
+    other_ledger.claim([module.event_key(runnable)])
+
+    # The invocation fails, so that Lambda delivers the event again later
+    with pytest.raises(RuntimeError):
+        module.handler(runnable, None)
+
+    assert ledger_status(dynamodb, module.event_key(runnable)) == idempotency.IN_PROGRESS
+    assert dynamodb.tables['BatchJobsTracking'].items == {}
+
+    # Once the other invocation completes it, the retry is dropped as a duplicate
+    other_ledger.complete([module.event_key(runnable)])
+
+    assert module.handler(runnable, None) is None
+    assert dynamodb.tables['BatchJobsTracking'].items == {}
+
+
+def test_container_instance_events_are_processed_once_across_environments(load_function, monkeypatch):
+    calls = ApiCalls()
+    dynamodb = FakeDynamoDB(calls, harness.TABLES)
+    runtime.reset()
+    runtime.set_client('dynamodb', dynamodb)
+    arn = 'arn:aws:ecs:us-east-1:123456789012:container-instance/default/instance-1'
+    registered = dict(container_instance_event(1704067200000, arn, 'i-1', 'c5.xlarge', 'x86_64', 'us-east-1a'),
+                      id='e-1')
+    deregistered = dict(registered, id='e-2', detail=dict(registered['detail'], status='INACTIVE'))
+
+    def load():
+        return load_function('func_process_container_instance_events', **harness.ENVIRONMENT,
+                             EVENT_LEDGER_TABLE=harness.EVENT_LEDGER_TABLE)
+
+    load().handler(registered, None)
+    load().handler(deregistered, None)
+
+    # The registration is delivered again to a third environment after the instance was deregistered
+    load().handler(registered, None)
+
+    # Without the ledger, the third environment would track the deregistered instance again
+    assert dynamodb.tables['ContainerInstanceTracking'].items == {}
+    assert ledger_status(dynamodb, 'event#e-1') == idempotency.COMPLETED
+
+    # A failed event releases its claim, so that its retry is processed
+    module = load()
+    monkeypatch.setattr(module, 'process_event', lambda event: 1 / 0)
+
+    with pytest.raises(ZeroDivisionError):
+        module.handler(dict(registered, id='e-3'), None)
+
+    assert ledger_status(dynamodb, 'event#e-3') is None
+
+    runtime.reset()
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from botocore.awsrequest import AWSResponse
+
+from batch_insights import instrumentation, runtime
+
+
+class _Raw:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def respond(*responses):
+    # Replies to the requests of a client with the given (status code, body) responses, in order
+    remaining = list(responses)
+
+    def before_send(request, **kwargs):
+        status_code, body = remaining.pop(0)
+        return AWSResponse(request.url, status_code, {}, _Raw(json.dumps(body).encode('utf-8')))
+
+    return before_send
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_MAX_ATTEMPTS', '3')
+
+    runtime.reset()
+    sink = instrumentation.MemorySink()
+    instrumentation.set_sink(sink)
+
+    yield sink
+
+    instrumentation.set_sink(None)
+    runtime.reset()
+
+
+def test_spans_are_aggregated(sink):
+    @instrumentation.instrument_handler('handler')
+    def handler(event, context):
+        for _ in range(3):
+            with instrumentation.span('Process'):
+                pass
+
+        with instrumentation.span('Flush'):
+            pass
+
+        instrumentation.annotate('Cache', {'Hits': 2, 'Misses': 1})
+        return 'done'
+
+    assert handler({}, None) == 'done'
+
+    record, = sink.records
+    assert record['Handler'] == 'handler'
+    assert record['Spans']['Process']['Count'] == 3
+    assert record['Spans']['Process']['MaxMs'] <= record['Spans']['Process']['TotalMs']
+    assert record['Spans']['Flush']['Count'] == 1
+    assert record['Cache'] == {'Hits': 2, 'Misses': 1}
+    assert (record['ApiCalls'], record['Retries'], record['Throttles']) == (0, 0, 0)
+
+
+def test_api_calls_retries_and_throttles(sink):
+    throttled = (400, {'__type': 'com.amazonaws.dynamodb.v20120810#ThrottlingException', 'message': 'Rate exceeded'})
+    limits = (200, {'AccountMaxReadCapacityUnits': 80000, 'AccountMaxWriteCapacityUnits': 80000,
+                    'TableMaxReadCapacityUnits': 40000, 'TableMaxWriteCapacityUnits': 40000})
+
+    client = runtime.client('dynamodb')
+    client.meta.events.register('before-send.dynamodb', respond(throttled, limits, limits))
+
+    @instrumentation.instrument_handler('handler')
+    def handler(event, context):
+        client.describe_limits()
+        client.describe_limits()
+
+    handler({}, None)
+
+    record, = sink.records
+    assert record['Spans']['dynamodb.DescribeLimits']['Count'] == 2
+    assert (record['ApiCalls'], record['Retries'], record['Throttles']) == (2, 1, 1)
+
+
+def test_failed_invocations_are_published(sink):
+    @instrumentation.instrument_handler('handler')
+    def handler(event, context):
+        with instrumentation.span('Process'):
+            raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError):
+        handler({}, None)
+
+    record, = sink.records
+    assert record['Spans']['Process']['Count'] == 1
+
+
+def test_disabled_instrumentation_is_a_noop():
+    @instrumentation.instrument_handler('handler')
+    def handler(event, context):
+        with instrumentation.span('Process'):
+            instrumentation.increment('Retries')
+            return 'done'
+
+    assert handler({}, None) == 'done'
@@ -0,0 +1,52 @@
+from batch_insights import jobs
+
+from benchmarks.fakes import ApiCalls, FakeBatch
+
+
+def test_calculate_job_status_durations():
+    tracking_data = {'JobId': 'job-1', 'SUBMITTED': 1000, 'PENDING': 3000, 'RUNNABLE': 5000, 'STARTING': 65000,
+                     'RUNNING': 95000, jobs.EXPIRES_AT_ATTRIBUTE: 1700000000}
+    detail = {'startedAt': 95000, 'stoppedAt': 695500}
+
+    jobs.calculate_job_status_durations(detail, tracking_data)
+
+    assert tracking_data == {
+        'JobId': 'job-1',
+        'SubmittedAt': 1000, 'PendingAt': 3000, 'RunnableAt': 5000, 'StartingAt': 65000, 'RunningAt': 95000,
+        'StoppedAt': 695500,
+        'TotalSubmittedSeconds': 2, 'TotalPendingSeconds': 2, 'TotalRunnableSeconds': 60, 'TotalStartingSeconds': 30,
+        'TotalRunningSeconds': 600
+    }
+
+
+def test_calculate_job_status_durations_with_missing_transitions():
+    # The STARTING event was lost, so neither the RUNNABLE nor the STARTING durations are known
+    tracking_data = {'JobId': 'job-1', 'SUBMITTED': 1000, 'RUNNABLE': 5000, 'RUNNING': 95000}
+
+    jobs.calculate_job_status_durations({}, tracking_data)
+
+    assert tracking_data == {'JobId': 'job-1', 'SubmittedAt': 1000, 'RunnableAt': 5000, 'RunningAt': 95000,
+                             'TotalRunningSeconds': 0}
+
+
+def test_calculate_job_status_durations_with_string_transitions():
+    tracking_data = {'RUNNABLE': '2024-05-01T10:00:00Z', 'STARTING': 1714557630000, 'RUNNING': '2024-05-01T10:01:00Z'}
+
+    jobs.calculate_job_status_durations({'startedAt': 1714557660000, 'stoppedAt': 1714557720000}, tracking_data)
+
+    assert tracking_data['RunnableAt'] == 1714557600000
+    assert tracking_data['RunningAt'] == 1714557660000
+    assert (tracking_data['TotalRunnableSeconds'], tracking_data['TotalStartingSeconds']) == (30, 30)
+    assert tracking_data['TotalRunningSeconds'] == 60
+
+
+def test_batch_job_status_source():
+    calls = ApiCalls()
+    details = {f'job-{i}': {'jobId': f'job-{i}', 'status': 'RUNNING'} for i in range(150)}
+    source = jobs.BatchJobStatusSource(FakeBatch(calls, details))
+
+    # Jobs unknown to AWS Batch are not returned
+    found = source.describe([f'job-{i}' for i in range(160)])
+
+    assert found == details
+    assert calls.counts['batch.DescribeJobs'] == 2
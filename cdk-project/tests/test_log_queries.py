@@ -0,0 +1,66 @@
+import pytest
+
+from queries import log_queries
+
+
+def test_build_count_query():
+    assert log_queries.build_count_query('JobQueue', 'Jobs') == \
+        '\nfilter Status != "ABANDONED"\n| stats count(*) as Jobs by JobQueue\n'
+
+
+@pytest.mark.parametrize('operator, value, expected', [
+    ('=', 'SUCCEEDED', 'Status = "SUCCEEDED"'),
+    ('!=', 'FAILED', 'Status != "FAILED"'),
+    ('in', ['SUCCEEDED', 'FAILED'], 'Status in ["SUCCEEDED", "FAILED"]')
+])
+def test_compile_filter(operator, value, expected):
+    assert log_queries.compile_filter('Status', operator, value) == expected
+
+
+def test_compile_filter_rejects_unknown_operators():
+    with pytest.raises(ValueError):
+        log_queries.compile_filter('Status', 'like', 'SUCCEEDED')
+
+
+def test_compile_section_query():
+    section = {
+        'Dimension': 'JobQueue',
+        'Metrics': ['Jobs', 'AvgRunningMinutes'],
+        'Filters': [('Architecture', '=', 'arm64'), ('Status', 'in', ['SUCCEEDED', 'FAILED'])]
+    }
+
+    assert log_queries.compile_section_query(section) == (
+        'filter Status != "ABANDONED"\n'
+        '| filter Architecture = "arm64"\n'
+        '| filter Status in ["SUCCEEDED", "FAILED"]\n'
+        '| stats count(*) as Jobs, avg(TotalRunningSeconds) / 60 as AvgRunningMinutes by JobQueue'
+    )
+
+
+def test_compile_section_query_rejects_unknown_metrics():
+    with pytest.raises(ValueError):
+        log_queries.compile_section_query({'Dimension': 'JobQueue', 'Metrics': ['MedianRunningMinutes']})
+
+
+def test_build_snapshot():
+    snapshot = log_queries.build_snapshot('Section-JobQueue', 'JobQueue',
+                                          {'Jobs': 'Jobs', 'SucceededRate': 'SucceededRate'},
+                                          [('Architecture', '=', 'x86_64')])
+
+    assert snapshot == {
+        'Id': 'Section-JobQueue',
+        'Dimension': 'JobQueue',
+        'Query': 'filter Status != "ABANDONED"\n'
+                 '| filter Architecture = "x86_64"\n'
+                 '| stats count(*) as Jobs, sum(Status="SUCCEEDED") as Succeeded by bin(1d), JobQueue',
+        'Partials': ['Jobs', 'Succeeded'],
+        'Metrics': {'Jobs': ['Jobs', None, 1], 'SucceededRate': ['Succeeded', 'Jobs', 100]}
+    }
+
+
+def test_build_count_snapshot():
+    snapshot = log_queries.build_count_snapshot('InstanceType')
+
+    assert snapshot['Id'] == 'Count-InstanceType'
+    assert snapshot['Query'] == 'filter Status != "ABANDONED"\n| stats count(*) as Jobs by bin(1d), InstanceType'
+    assert snapshot['Metrics'] == {'Count': ['Jobs', None, 1]}
@@ -0,0 +1,184 @@
+import json
+import zlib
+
+import pytest
+
+from batch_insights import logs_writer
+from batch_insights.logs_writer import LogsWriter, ShardedLogsWriter
+
+from benchmarks.fakes import (PUT_LOG_EVENTS_MAX_BYTES, PUT_LOG_EVENTS_MAX_EVENTS, PUT_LOG_EVENTS_MAX_SPAN_MS,
+                              ApiCalls, FakeLogs)
+
+
+JOBS_LOG_GROUP = '/aws-batch-insights/jobs'
+JOBS_LOG_STREAM = 'Jobs'
+
+# 2024-01-01T00:00:00Z
+START_MS = 1704067200000
+
+# Messages of this length fill a batch with exactly 8 events once the overhead of every event is counted
+EIGHTH_OF_A_BATCH = PUT_LOG_EVENTS_MAX_BYTES // 8 - logs_writer.EVENT_OVERHEAD_BYTES
+
+
+class RecordingLogs(FakeLogs):
+    """
+    Records the events of every PutLogEvents request, and fails the requests to the streams of failing_streams.
+    """
+
+    def __init__(self, calls, streams=(), failing_streams=()):
+        super().__init__(calls, streams)
+        self.failing_streams = set(failing_streams)
+        self.batches = []
+
+    def put_log_events(self, logGroupName, logStreamName, logEvents, **kwargs):
+        if logStreamName in self.failing_streams:
+            raise RuntimeError('Throttled')
+
+        response = super().put_log_events(logGroupName, logStreamName, logEvents, **kwargs)
+        self.batches.append((logStreamName, [event['message'] for event in logEvents]))
+
+        return response
+
+
+@pytest.fixture
+def logs():
+    return RecordingLogs(ApiCalls(), [(JOBS_LOG_GROUP, JOBS_LOG_STREAM)])
+
+
+def batch_sizes(logs):
+    return [len(messages) for _, messages in logs.batches]
+
+
+def test_batches_are_limited_to_10000_events(logs):
+    with LogsWriter(logs, JOBS_LOG_GROUP, JOBS_LOG_STREAM) as writer:
+        for i in range(25000):
+            writer.add({'JobId': i}, START_MS)
+
+    assert batch_sizes(logs) == [PUT_LOG_EVENTS_MAX_EVENTS, PUT_LOG_EVENTS_MAX_EVENTS, 5000]
+    assert [json.loads(message)['JobId'] for message in logs.logged_messages()] == list(range(25000))
+
+
+@pytest.mark.parametrize('length, expected', [
+    (EIGHTH_OF_A_BATCH, [8, 8]),
+    # One byte more per event only fits if the overhead is left out
+    (EIGHTH_OF_A_BATCH + 1, [7, 7, 2])
+])
+def test_batches_are_limited_to_1_mib_including_the_overhead_of_every_event(logs, length, expected):
+    with LogsWriter(logs, JOBS_LOG_GROUP, JOBS_LOG_STREAM) as writer:
+        for i in range(16):
+            writer.add(str(i % 10) * length, START_MS)
+
+    assert batch_sizes(logs) == expected
+
+
+def test_batches_span_at_most_24_hours(logs):
+    writer = LogsWriter(logs, JOBS_LOG_GROUP, JOBS_LOG_STREAM)
+    timestamps = [START_MS, START_MS + PUT_LOG_EVENTS_MAX_SPAN_MS, START_MS + PUT_LOG_EVENTS_MAX_SPAN_MS + 1,
+                  START_MS + 2 * PUT_LOG_EVENTS_MAX_SPAN_MS + 1, START_MS + 3 * PUT_LOG_EVENTS_MAX_SPAN_MS]
+
+    for timestamp in timestamps:
+        writer.add(str(timestamp), timestamp)
+
+    assert writer.flush() == 5
+    assert batch_sizes(logs) == [2, 2, 1]
+
+
+def test_events_are_sent_in_chronological_order(logs):
+    writer = LogsWriter(logs, JOBS_LOG_GROUP, JOBS_LOG_STREAM)
+
+    for message, timestamp in (('c', 3000), ('a', 1000), ('b1', 2000), ('b2', 2000), ('d', 4000), ('b3', 2000)):
+        writer.add(message, START_MS + timestamp)
+
+    writer.flush()
+
+    # Events of the same millisecond keep the order they were added in
+    assert logs.logged_messages() == ['a', 'b1', 'b2', 'b3', 'c', 'd']
+
+
+def test_events_over_256_kib_are_rejected(logs):
+    writer = LogsWriter(logs, JOBS_LOG_GROUP, JOBS_LOG_STREAM)
+    writer.add('x' * (logs_writer.MAX_EVENT_BYTES - logs_writer.EVENT_OVERHEAD_BYTES))
+
+    with pytest.raises(ValueError):
+        writer.add('x' * (logs_writer.MAX_EVENT_BYTES - logs_writer.EVENT_OVERHEAD_BYTES + 1))
+
+    assert len(writer) == 1
+
+
+def test_unwritten_events_remain_buffered(logs):
+    writer = LogsWriter(logs, JOBS_LOG_GROUP, 'Missing')
+
+    for i in range(3):
+        writer.add(f'job-{i}', START_MS + i, key=f'job-{i}')
+
+    with pytest.raises(logs.exceptions.ResourceNotFoundException):
+        writer.flush()
+
+    assert (len(writer), writer.pending_keys()) == (3, {'job-0', 'job-1', 'job-2'})
+
+    # Missing streams are created when the writer is allowed to
+    writer.create_log_stream = True
+
+    assert writer.flush() == 3
+    assert (len(writer), writer.pending_keys()) == (0, set())
+    assert logs.calls.counts['logs.CreateLogStream'] == 1
+
+
+def test_streams_created_concurrently(logs, monkeypatch):
+    writer = LogsWriter(logs, JOBS_LOG_GROUP, 'Jobs-001', create_log_stream=True)
+    writer.add('job', START_MS)
+
+    def create_log_stream(**kwargs):
+        # Another writer creates the stream after this one found it missing
+        FakeLogs.create_log_stream(logs, **kwargs)
+        return FakeLogs.create_log_stream(logs, **kwargs)
+
+    monkeypatch.setattr(logs, 'create_log_stream', create_log_stream)
+
+    assert writer.flush() == 1
+    assert logs.events[(JOBS_LOG_GROUP, 'Jobs-001')][0]['message'] == 'job'
+
+
+def test_shard_stream_names():
+    assert logs_writer.shard_stream_names(JOBS_LOG_STREAM, 1) == [JOBS_LOG_STREAM]
+    assert logs_writer.shard_stream_names(JOBS_LOG_STREAM, 3) == ['Jobs-000', 'Jobs-001', 'Jobs-002']
+
+
+def test_sharded_events_are_routed_by_the_crc32_of_their_key(logs):
+    stream_names = logs_writer.shard_stream_names(JOBS_LOG_STREAM, 4)
+    keys = [f'{i:032x}' for i in range(400)]
+
+    with ShardedLogsWriter(logs, JOBS_LOG_GROUP, stream_names) as writer:
+        for key in keys:
+            writer.add(key, START_MS, key=key)
+
+        writer.add('without a key', START_MS)
+
+    # The missing streams are created, and every key is written to the same stream by any writer
+    for key in keys:
+        stream_name = stream_names[zlib.crc32(key.encode('utf-8')) % 4]
+        assert key in [event['message'] for event in logs.events[(JOBS_LOG_GROUP, stream_name)]]
+
+    assert ShardedLogsWriter(logs, JOBS_LOG_GROUP, stream_names).stream_index(keys[0]) == writer.stream_index(keys[0])
+    assert logs.events[(JOBS_LOG_GROUP, stream_names[0])][-1]['message'] == 'without a key'
+    assert all(len(logs.events[(JOBS_LOG_GROUP, stream_name)]) > 50 for stream_name in stream_names)
+
+
+def test_sharded_flush_continues_after_a_failed_stream():
+    stream_names = logs_writer.shard_stream_names(JOBS_LOG_STREAM, 2)
+    logs = RecordingLogs(ApiCalls(), failing_streams=[stream_names[1]])
+    writer = ShardedLogsWriter(logs, JOBS_LOG_GROUP, stream_names)
+    keys = [f'job-{i}' for i in range(20)]
+
+    for key in keys:
+        writer.add(key, START_MS, key=key)
+
+    with pytest.raises(RuntimeError):
+        writer.flush()
+
+    # Only the events of the failed stream remain buffered
+    failed_keys = {key for key in keys if writer.stream_index(key) == 1}
+
+    assert writer.pending_keys() == failed_keys
+    assert len(writer) == len(failed_keys)
+    assert sorted(logs.logged_messages()) == sorted(set(keys) - failed_keys)
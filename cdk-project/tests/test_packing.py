@@ -0,0 +1,146 @@
+import gzip
+import json
+import random
+
+import numpy as np
+import pytest
+
+from analysis import packing
+from analysis.packing import IntervalSet, analyse, main, sweep
+
+
+# 2024-01-01T00:00:00Z
+START_MS = 1704067200000
+
+
+def job(instance_id, start_second, end_second, instance_type='c5.xlarge', availability_zone='us-east-1a'):
+    return {'InstanceId': instance_id, 'InstanceType': instance_type, 'AvailabilityZone': availability_zone,
+            'Architecture': 'x86_64', 'RunningAt': START_MS + start_second * 1000,
+            'StoppedAt': START_MS + end_second * 1000}
+
+
+def naive_stats(intervals):
+    """
+    Plain Python counterpart of the sweep for the intervals of one instance, second by second.
+    """
+
+    first, last = min(start for start, _ in intervals), max(end for _, end in intervals)
+    concurrency = [sum(start <= t < end for start, end in intervals) for t in range(first, last)]
+
+    return {'observed': last - first, 'busy': sum(level > 0 for level in concurrency), 'job': sum(concurrency),
+            'peak': max(concurrency, default=0)}
+
+
+@pytest.mark.parametrize('record, expected', [
+    ({'RunningAt': 1000, 'StoppedAt': 5000}, (1000, 5000)),
+    # RunningAt is missing from the jobs that were not hydrated, the start is derived from the duration
+    ({'TotalRunningSeconds': 4, 'StoppedAt': 5000}, (1000, 5000)),
+    ({'RunningAt': 6000, 'StoppedAt': 5000}, (5000, 5000)),
+    ({'RunningAt': 1000}, None),
+    ({'StoppedAt': 5000}, None),
+    ({'RunningAt': '1970-01-01T00:00:01Z', 'StoppedAt': 5000}, None)
+])
+def test_job_interval(record, expected):
+    assert packing.job_interval(record) == expected
+
+
+def test_sweep():
+    # Jobs of instance 0 overlap from 5 to 10, and one starts at 15 as another one stops. Instance 2 ran no job
+    instance_indices = np.array([0, 0, 0, 0, 1], dtype=np.int32)
+    starts = np.array([0, 5, 15, 30, 100], dtype=np.int64) * 1000
+    ends = np.array([10, 15, 20, 40, 200], dtype=np.int64) * 1000
+
+    jobs, observed, busy, job_ms, peak = sweep(instance_indices, starts, ends, 3)
+
+    assert jobs.tolist() == [4, 1, 0]
+    assert observed.tolist() == [40000, 100000, 0]
+    assert busy.tolist() == [30000, 100000, 0]
+    assert job_ms.tolist() == [35000, 100000, 0]
+    assert peak.tolist() == [2, 1, 0]
+
+
+def test_sweep_without_intervals():
+    empty = np.empty(0, dtype=np.int64)
+
+    assert [values.tolist() for values in sweep(empty.astype(np.int32), empty, empty, 2)] == [[0, 0]] * 5
+
+
+def test_sweep_matches_a_naive_count():
+    generator = random.Random(0)
+    intervals = {index: [] for index in range(20)}
+
+    for index in intervals:
+        for _ in range(generator.randint(1, 30)):
+            start = generator.randint(0, 500)
+            intervals[index].append((start, start + generator.randint(0, 60)))
+
+    instance_indices = np.array([index for index, values in intervals.items() for _ in values], dtype=np.int32)
+    starts = np.array([start for values in intervals.values() for start, _ in values], dtype=np.int64)
+    ends = np.array([end for values in intervals.values() for _, end in values], dtype=np.int64)
+
+    jobs, observed, busy, job_ms, peak = sweep(instance_indices, starts, ends, len(intervals))
+
+    for index, values in intervals.items():
+        expected = naive_stats(values)
+
+        assert (jobs[index], observed[index], busy[index], job_ms[index], peak[index]) == \
+            (len(values), expected['observed'], expected['busy'], expected['job'], expected['peak'])
+
+
+def test_analyse():
+    intervals = IntervalSet()
+    intervals.add_records([
+        job('i-1', 0, 100), job('i-1', 50, 150), job('i-1', 150, 200),
+        job('i-2', 0, 100), job('i-2', 300, 400),
+        job('i-3', 0, 60, instance_type='m5.large'),
+        {'InstanceId': 'i-4', 'StoppedAt': START_MS},
+        dict(job('i-5', 0, 10), InstanceId=None)
+    ])
+
+    assert intervals.skipped == 2
+
+    c5, m5 = analyse(intervals, group_by=('InstanceType',))
+
+    # i-1 is busy all of its 200 seconds, i-2 for 200 of its 400 seconds
+    assert c5 == {'InstanceType': 'c5.xlarge', 'Instances': 2, 'Jobs': 5, 'ObservedSeconds': 600.0,
+                  'BusySeconds': 400.0, 'IdleSeconds': 200.0, 'Utilization': 66.67, 'PeakConcurrentJobs': 2,
+                  'AvgConcurrentJobs': 0.75, 'AvgBusyConcurrentJobs': 1.125}
+    assert (m5['InstanceType'], m5['Utilization'], m5['AvgConcurrentJobs']) == ('m5.large', 100.0, 1.0)
+
+    rows = analyse(intervals, group_by=())
+
+    assert [(row['InstanceId'], row['Utilization']) for row in rows] == [('i-2', 50.0), ('i-1', 100.0),
+                                                                          ('i-3', 100.0)]
+
+
+def test_jobs_without_a_duration_are_not_running():
+    intervals = IntervalSet()
+    intervals.add_records([job('i-1', 0, 0), job('i-2', 0, 10)])
+
+    rows = analyse(intervals, group_by=())
+
+    # Rows without an observed time are listed last
+    assert [(row['InstanceId'], row['Utilization'], row['AvgConcurrentJobs']) for row in rows] == \
+        [('i-2', 100.0, 1.0), ('i-1', None, None)]
+    assert (rows[1]['Jobs'], rows[1]['PeakConcurrentJobs']) == (1, 0)
+
+
+def test_main(tmp_path, capsys):
+    path = tmp_path / 'export.jsonl.gz'
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for record in (job('i-1', 0, 100), job('i-2', 0, 50, availability_zone='us-east-1b'), {'JobId': 'job'}):
+            f.write(json.dumps(record) + '\n')
+
+    main(['--by', 'AvailabilityZone', str(path)])
+
+    output = capsys.readouterr()
+    rows = [json.loads(line) for line in output.out.splitlines()]
+
+    assert [(row['AvailabilityZone'], row['Jobs']) for row in rows] == [('us-east-1a', 1), ('us-east-1b', 1)]
+    assert '1 records' in output.err
+
+    with pytest.raises(SystemExit) as e:
+        main(['--by', 'JobQueue', str(path)])
+
+    assert e.value.code == 2
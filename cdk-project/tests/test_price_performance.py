@@ -0,0 +1,190 @@
+import json
+
+import numpy as np
+import pytest
+
+from analysis import price_performance
+from analysis.price_performance import JobSet, bootstrap_means, compare, main
+
+
+ARCHITECTURES = ('x86_64', 'arm64')
+
+# $ per vCPU-hour: 0.0425 on c5, 0.034 on c6g
+PRICES = {'c5.xlarge': (0.17, 4), 'c5.2xlarge': (0.34, 8), 'c6g.2xlarge': (0.272, 8)}
+
+
+def job(job_definition, architecture, instance_type, seconds, status='SUCCEEDED'):
+    return {'JobDefinition': job_definition, 'Architecture': architecture, 'InstanceType': instance_type,
+            'TotalRunningSeconds': seconds, 'Status': status}
+
+
+def jobs_around(job_definition, architecture, instance_type, mean_seconds, count):
+    # Alternate 20% below and above the mean, so that the resamples vary
+    return [job(job_definition, architecture, instance_type, mean_seconds * (0.8 if i % 2 else 1.2))
+            for i in range(count)]
+
+
+def job_set(records, merge_revisions=False):
+    jobs = JobSet(ARCHITECTURES, merge_revisions)
+    jobs.add_records(records)
+
+    return jobs
+
+
+@pytest.mark.parametrize('instance_type, expected', [
+    ('m6g.medium', 1), ('c5.large', 2), ('c5.xlarge', 4), ('c5.2xlarge', 8), ('m5.24xlarge', 96), ('c5.metal', None),
+    ('t3.nano', None)
+])
+def test_instance_vcpus(instance_type, expected):
+    assert price_performance.instance_vcpus(instance_type) == expected
+
+
+def test_load_price_table(tmp_path):
+    path = tmp_path / 'prices.json'
+    path.write_text(json.dumps({'c5.2xlarge': 0.34, 't3.large': {'HourlyPrice': 0.0832, 'vCPUs': 2},
+                                'c5.metal': 4.08}))
+
+    assert price_performance.load_price_table(str(path)) == {'c5.2xlarge': (0.34, 8), 't3.large': (0.0832, 2),
+                                                             'c5.metal': (4.08, None)}
+
+
+def test_job_set_skips_the_jobs_that_are_not_compared():
+    jobs = job_set([
+        job('Render:1', 'x86_64', 'c5.xlarge', 60),
+        job('Render:2', 'arm64', 'c6g.2xlarge', 60),
+        job('Render:1', 'x86_64', 'c5.xlarge', 60, status='FAILED'),
+        job('Render:1', 'riscv64', 'c5.xlarge', 60),
+        job('Render:1', 'x86_64', None, 60),
+        job('Render:1', 'x86_64', 'c5.xlarge', None)
+    ], merge_revisions=True)
+
+    group_indices, architectures, instance_type_indices, seconds = jobs.arrays()
+
+    assert jobs.skipped == 4
+    assert jobs.groups == ['Render']
+    assert (group_indices.tolist(), architectures.tolist(), seconds.tolist()) == ([0, 0], [0, 1], [60, 60])
+    assert [jobs.instance_types[index] for index in instance_type_indices] == ['c5.xlarge', 'c6g.2xlarge']
+
+
+def test_compress():
+    values = np.array([[60, 1], [30, 2], [60, 1], [60, 1], [30, 2]], dtype=np.float64)
+    segments = np.array([1, 0, 1, 0, 0])
+
+    distinct, counts, distinct_segments = price_performance.compress(values, segments)
+
+    assert distinct.tolist() == [[30, 2], [60, 1], [60, 1]]
+    assert counts.tolist() == [2, 1, 2]
+    assert distinct_segments.tolist() == [0, 0, 1]
+
+
+def test_compare():
+    records = (jobs_around('Render', 'x86_64', 'c5.2xlarge', 3600, 40) +
+               jobs_around('Render', 'arm64', 'c6g.2xlarge', 3960, 40) +
+               jobs_around('Encode', 'x86_64', 'c5.2xlarge', 600, 40) +
+               jobs_around('Encode', 'arm64', 'c6g.2xlarge', 450, 40) +
+               # Train has too few jobs on arm64, and Simulate none
+               jobs_around('Train', 'x86_64', 'c5.2xlarge', 600, 40) +
+               jobs_around('Train', 'arm64', 'c6g.2xlarge', 600, 10) +
+               jobs_around('Simulate', 'x86_64', 'c5.2xlarge', 600, 40))
+
+    encode, render = compare(job_set(records), PRICES)
+
+    # Render runs 10% longer on arm64 but at 80% of the price, so it costs 12% less. Encode saves more
+    assert {name: render[name] for name in ('JobDefinition', 'Baseline', 'Candidate', 'BaselineJobs', 'CandidateJobs',
+                                            'BaselineMeanRunningSeconds', 'CandidateMeanRunningSeconds',
+                                            'RuntimeRatio', 'BaselineMeanVcpuCost', 'CandidateMeanVcpuCost',
+                                            'CostRatio')} == {
+        'JobDefinition': 'Render', 'Baseline': 'x86_64', 'Candidate': 'arm64', 'BaselineJobs': 40, 'CandidateJobs': 40,
+        'BaselineMeanRunningSeconds': 3600.0, 'CandidateMeanRunningSeconds': 3960.0, 'RuntimeRatio': 1.1,
+        'BaselineMeanVcpuCost': 0.0425, 'CandidateMeanVcpuCost': 0.03740, 'CostRatio': 0.88
+    }
+    assert (encode['JobDefinition'], encode['RuntimeRatio'], encode['CostRatio']) == ('Encode', 0.75, 0.6)
+
+    for row in (render, encode):
+        assert row['RuntimeRatioLow'] < row['RuntimeRatio'] < row['RuntimeRatioHigh']
+        assert row['CostRatioLow'] < row['CostRatio'] < row['CostRatioHigh']
+
+
+def test_compare_without_prices():
+    records = (jobs_around('Render', 'x86_64', 'c5.2xlarge', 3600, 40) +
+               jobs_around('Render', 'arm64', 'c6g.2xlarge', 3960, 40))
+
+    row, = compare(job_set(records), min_jobs=40)
+
+    assert row['RuntimeRatio'] == 1.1
+    assert 'CostRatio' not in row
+
+    assert compare(job_set(records), min_jobs=41) == []
+
+
+def test_compare_leaves_out_the_jobs_without_a_price():
+    records = (jobs_around('Render', 'x86_64', 'c5.2xlarge', 3600, 40) +
+               jobs_around('Render', 'x86_64', 'c5.xlarge', 3600, 40) +
+               jobs_around('Render', 'x86_64', 'm5.2xlarge', 7200, 40) +
+               jobs_around('Render', 'arm64', 'c6g.2xlarge', 3960, 40))
+
+    row, = compare(job_set(records), PRICES)
+
+    # Jobs on instances of different sizes cost the same per vCPU, and the jobs on m5 are left out of both ratios
+    assert (row['BaselineJobs'], row['BaselineMeanRunningSeconds'], row['BaselineMeanVcpuCost']) == (80, 3600.0, 0.0425)
+
+
+def test_confidence_intervals_narrow_with_more_jobs():
+    def interval(count, confidence=0.95):
+        records = (jobs_around('Render', 'x86_64', 'c5.2xlarge', 3600, count) +
+                   jobs_around('Render', 'arm64', 'c6g.2xlarge', 3960, count))
+        row, = compare(job_set(records), confidence=confidence)
+
+        return row['RuntimeRatioHigh'] - row['RuntimeRatioLow']
+
+    assert interval(1000) < interval(100) < interval(30)
+    assert interval(100, confidence=0.5) < interval(100)
+
+
+@pytest.mark.parametrize('distinct, n', [
+    # Jobs drawn one by one, with a multinomial over few distinct values and from the normal approximation
+    (200, 200), (4, 5000), (200, 20000)
+])
+def test_bootstrap_means(distinct, n):
+    rng = np.random.default_rng(0)
+    values = np.column_stack([np.linspace(100, 300, distinct), np.linspace(1, 2, distinct)])
+    counts = np.full(distinct, n // distinct)
+    n = int(counts.sum())
+
+    means = bootstrap_means(values, counts, 2000, rng)
+
+    mean = counts @ values / n
+    sd = np.sqrt(counts @ (values - mean) ** 2 / n)
+
+    # The means of the resamples are centered on the mean of the jobs, with the standard error of the mean
+    assert means.shape == (2000, 2)
+    assert means.mean(axis=0) == pytest.approx(mean, rel=0.01)
+    assert means.std(axis=0) == pytest.approx(sd / np.sqrt(n), rel=0.1)
+
+    # Both columns are resampled from the same jobs
+    assert np.corrcoef(means.T)[0, 1] > 0.99
+
+
+def test_main(tmp_path, capsys):
+    prices = tmp_path / 'prices.json'
+    prices.write_text(json.dumps({'c5.2xlarge': 0.34, 'c6g.2xlarge': 0.272}))
+    path = tmp_path / 'export.jsonl'
+    records = (jobs_around('Render:1', 'x86_64', 'c5.2xlarge', 3600, 20) +
+               jobs_around('Render:2', 'arm64', 'c6g.2xlarge', 3960, 20) +
+               jobs_around('Render:2', 'arm64', 'm6g.2xlarge', 3960, 5) +
+               [job('Render:1', 'x86_64', 'c5.2xlarge', 60, status='FAILED')])
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+    main(['--prices', str(prices), '--merge-revisions', '--min-jobs', '20', str(path)])
+
+    output = capsys.readouterr()
+    row, = [json.loads(line) for line in output.out.splitlines()]
+
+    assert (row['JobDefinition'], row['CandidateJobs'], row['CostRatio']) == ('Render', 20, 0.88)
+    assert '1 records' in output.err
+    assert '5 jobs were left out, as the price or vCPUs of m6g.2xlarge are unknown' in output.err
+
+    with pytest.raises(SystemExit) as e:
+        main(['--baseline', 'arm64', '--candidate', 'arm64', str(path)])
+
+    assert e.value.code == 2
@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from batch_insights import jobs, runtime
+
+from benchmarks.events import container_instance_event, job_state_event, task_state_event
+from benchmarks.fakes import ApiCalls, FakeDynamoDB, FakeLogs
+
+
+JOBS_TRACKING_TABLE = 'BatchJobsTracking'
+CONTAINER_INSTANCE_TRACKING_TABLE = 'ContainerInstanceTracking'
+JOBS_LOG_GROUP = '/aws-batch-insights/jobs'
+JOBS_LOG_STREAM = 'Jobs'
+
+CONTAINER_INSTANCE_ARN = 'arn:aws:ecs:us-east-1:123456789012:container-instance/default/instance-1'
+JOB = {'JobId': 'job-1', 'JobName': 'render', 'JobQueue': 'HighPriority', 'JobDefinition': 'Render'}
+
+
+@pytest.fixture
+def services():
+    calls = ApiCalls()
+    services = {
+        'dynamodb': FakeDynamoDB(calls, {
+            JOBS_TRACKING_TABLE: ('JobId',),
+            CONTAINER_INSTANCE_TRACKING_TABLE: ('ContainerInstanceArn',)
+        }),
+        'logs': FakeLogs(calls, [(JOBS_LOG_GROUP, JOBS_LOG_STREAM)])
+    }
+
+    runtime.reset()
+
+    for name, client in services.items():
+        runtime.set_client(name, client)
+
+    yield services
+
+    runtime.reset()
+
+
+@pytest.fixture
+def load_handlers(load_function):
+    """
+    Loads the handlers of a new execution environment, which doesn't remember the events processed by the others.
+    """
+
+    def load(directory):
+        return load_function(directory, JOBS_LOG_GROUP=JOBS_LOG_GROUP, JOBS_LOG_STREAM=JOBS_LOG_STREAM,
+                             JOBS_TRACKING_TABLE=JOBS_TRACKING_TABLE,
+                             CONTAINER_INSTANCE_TRACKING_TABLE=CONTAINER_INSTANCE_TRACKING_TABLE).handler
+
+    return load
+
+
+def transition(status, timestamp_ms, **kwargs):
+    return job_state_event(timestamp_ms, JOB, status, **kwargs)
+
+
+def logged_jobs(logs):
+    return [json.loads(message) for message in logs.logged_messages()]
+
+
+def tracking_item(dynamodb):
+    return dynamodb.tables[JOBS_TRACKING_TABLE].items.get((JOB['JobId'],))
+
+
+def test_completion_leaves_a_tombstone(services, load_handlers):
+    process_batch_event = load_handlers('func_process_batch_events')
+
+    process_batch_event(transition('RUNNABLE', 1000), None)
+    process_batch_event(transition('SUCCEEDED', 400000, started_at=100000, stopped_at=400000), None)
+
+    assert [job['Status'] for job in logged_jobs(services['logs'])] == ['SUCCEEDED']
+
+    item = tracking_item(services['dynamodb'])
+    assert item[jobs.COMPLETED_STATUS_ATTRIBUTE] == 'SUCCEEDED'
+    assert 'RUNNABLE' not in item
+
+
+def test_late_transitions_after_the_completion_are_dropped(services, load_handlers):
+    process_batch_event = load_handlers('func_process_batch_events')
+
+    process_batch_event(transition('RUNNABLE', 1000), None)
+    process_batch_event(transition('SUCCEEDED', 400000, started_at=100000, stopped_at=400000), None)
+
+    # The transitions delayed past the completion, and the completion replayed from a dead-letter queue to another
+    # execution environment
+    process_batch_event(transition('STARTING', 60000), None)
+    process_batch_event(transition('RUNNING', 100000, started_at=100000), None)
+    load_handlers('func_process_batch_events')(
+        transition('SUCCEEDED', 400000, started_at=100000, stopped_at=400000), None
+    )
+
+    assert len(logged_jobs(services['logs'])) == 1
+
+    item = tracking_item(services['dynamodb'])
+    assert item[jobs.COMPLETED_STATUS_ATTRIBUTE] == 'SUCCEEDED'
+    assert 'STARTING' not in item and 'RUNNING' not in item
+
+
+def test_late_container_instances_after_the_completion_are_dropped(services, load_handlers):
+    load_handlers('func_process_container_instance_events')(container_instance_event(
+        0, CONTAINER_INSTANCE_ARN, 'i-1', 'c5.xlarge', 'x86_64', 'us-east-1a'
+    ), None)
+    process_batch_event = load_handlers('func_process_batch_events')
+    process_task_state_event = load_handlers('func_process_task_state_events')
+
+    process_batch_event(transition('RUNNABLE', 1000), None)
+    process_batch_event(transition('SUCCEEDED', 400000, started_at=100000, stopped_at=400000), None)
+    process_task_state_event(task_state_event(100000, JOB['JobId'], CONTAINER_INSTANCE_ARN), None)
+
+    assert 'InstanceType' not in logged_jobs(services['logs'])[0]
+
+    item = tracking_item(services['dynamodb'])
+    assert item[jobs.COMPLETED_STATUS_ATTRIBUTE] == 'SUCCEEDED'
+    assert 'InstanceType' not in item
+
+
+def test_container_instances_before_the_first_transition_are_kept(services, load_handlers):
+    load_handlers('func_process_container_instance_events')(container_instance_event(
+        0, CONTAINER_INSTANCE_ARN, 'i-1', 'c5.xlarge', 'x86_64', 'us-east-1a'
+    ), None)
+    process_batch_event = load_handlers('func_process_batch_events')
+    process_task_state_event = load_handlers('func_process_task_state_events')
+
+    process_task_state_event(task_state_event(100000, JOB['JobId'], CONTAINER_INSTANCE_ARN), None)
+    process_batch_event(transition('RUNNABLE', 1000), None)
+    process_batch_event(transition('SUCCEEDED', 400000, started_at=100000, stopped_at=400000), None)
+
+    job, = logged_jobs(services['logs'])
+    assert (job['Status'], job['InstanceType']) == ('SUCCEEDED', 'c5.xlarge')
@@ -0,0 +1,122 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from analysis.query_engine import main, run_query
+from queries import log_queries
+
+
+RECORDS = [
+    {'JobQueue': 'high', 'Status': 'SUCCEEDED', 'TotalRunnableSeconds': 30, 'TotalStartingSeconds': 60,
+     'TotalRunningSeconds': 600},
+    {'JobQueue': 'high', 'Status': 'FAILED', 'TotalRunnableSeconds': 90, 'TotalStartingSeconds': 120},
+    {'JobQueue': 'high', 'Status': 'SUCCEEDED', 'TotalRunnableSeconds': 150, 'TotalStartingSeconds': 30,
+     'TotalRunningSeconds': 1200},
+    {'JobQueue': 'low', 'Status': 'SUCCEEDED', 'TotalRunnableSeconds': 3600, 'TotalStartingSeconds': 90,
+     'TotalRunningSeconds': 300},
+    {'JobQueue': 'low', 'Status': 'FAILED', 'TotalRunnableSeconds': 1800},
+    {'JobQueue': 'spot', 'Status': 'FAILED', 'TotalRunnableSeconds': 60, 'TotalStartingSeconds': 45,
+     'TotalRunningSeconds': 30},
+    {'JobQueue': 'high', 'Status': 'ABANDONED', 'TotalRunnableSeconds': 7200}
+]
+
+
+def aggregate(records, dimension):
+    # Plain Python counterpart of the section query, which leaves the abandoned jobs out
+    records = [record for record in records if record['Status'] != log_queries.ABANDONED_STATUS]
+    rows = {}
+
+    for value in sorted({record[dimension] for record in records}):
+        jobs = [record for record in records if record[dimension] == value]
+        row = {dimension: value, 'Jobs': len(jobs),
+               'SucceededRate': sum(job['Status'] == 'SUCCEEDED' for job in jobs) / len(jobs) * 100}
+
+        for metric, field in (('AvgRunnableMinutes', 'TotalRunnableSeconds'),
+                              ('AvgStartingMinutes', 'TotalStartingSeconds'),
+                              ('AvgRunningMinutes', 'TotalRunningSeconds')):
+            values = [job[field] for job in jobs if field in job]
+            row[metric] = sum(values) / len(values) / 60 if values else None
+
+        rows[value] = row
+
+    return rows
+
+
+@pytest.fixture
+def paths(tmp_path):
+    # Two files, so that the aggregation can be split across workers
+    paths = []
+
+    for i, records in enumerate((RECORDS[::2], RECORDS[1::2])):
+        path = tmp_path / f'export-{i}.jsonl'
+        path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+        paths.append(str(path))
+
+    return paths
+
+
+def assert_rows_match(rows, expected, dimension):
+    assert len(rows) == len(expected)
+
+    for row in rows:
+        assert row == pytest.approx(expected[row[dimension]])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_section_query(paths, workers):
+    query = log_queries.compile_section_query(log_queries.find_section('JobQueue'))
+
+    rows = run_query(query, paths, chunk_size=2, workers=workers)
+
+    assert_rows_match(rows, aggregate(RECORDS, 'JobQueue'), 'JobQueue')
+
+
+def test_filtered_count_query(paths):
+    query = log_queries.build_count_query('JobQueue', 'Jobs').replace('| stats', '| filter Status = "FAILED"\n| stats')
+
+    rows = run_query(query, paths)
+
+    assert sorted((row['JobQueue'], row['Jobs']) for row in rows) == [('high', 1), ('low', 1), ('spot', 1)]
+
+
+def test_main_section(paths, capsys):
+    main(['--section', 'JobQueue', '--workers', '2'] + paths)
+
+    rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    assert_rows_match(rows, aggregate(RECORDS, 'JobQueue'), 'JobQueue')
+
+
+def test_main_runs_without_the_cdk(paths):
+    # The offline tools are installed from requirements-dev.txt, without the CDK or jsii
+    script = ("import sys; sys.modules.update(dict.fromkeys(['aws_cdk', 'constructs', 'jsii']));"
+              "from analysis.query_engine import main; main(sys.argv[1:])")
+    project = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    output = subprocess.run([sys.executable, '-c', script, '--section', 'JobQueue'] + paths, cwd=project,
+                            capture_output=True, text=True, check=True).stdout
+
+    assert_rows_match([json.loads(line) for line in output.splitlines()], aggregate(RECORDS, 'JobQueue'), 'JobQueue')
+
+
+def test_main_count_builder(paths, capsys):
+    main(['--builder', 'build_count_query', '--by', 'Status'] + paths)
+
+    rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    assert sorted((row['Status'], row['Count']) for row in rows) == [('FAILED', 3), ('SUCCEEDED', 3)]
+
+
+@pytest.mark.parametrize('argv', [
+    ['--builder', 'build_succeeded_rate_query', '--by', 'JobQueue'],
+    ['--builder', 'build_count_query'],
+    ['--section', 'InstanceType']
+])
+def test_main_rejects_invalid_queries(paths, argv):
+    with pytest.raises(SystemExit) as e:
+        main(argv + paths)
+
+    assert e.value.code == 2
@@ -0,0 +1,193 @@
+import json
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from batch_insights import jobs, runtime
+
+from benchmarks.fakes import ApiCalls, FakeBatch, FakeDynamoDB, FakeLogs
+
+
+JOBS_TRACKING_TABLE = 'BatchJobsTracking'
+JOBS_LOG_GROUP = '/aws-batch-insights/jobs'
+JOBS_LOG_STREAM = 'Jobs'
+
+
+def job_detail(job_id, status, **kwargs):
+    return dict({
+        'jobId': job_id,
+        'jobName': f'name-{job_id}',
+        'jobQueue': 'arn:aws:batch:us-east-1:123456789012:job-queue/high',
+        'jobDefinition': 'arn:aws:batch:us-east-1:123456789012:job-definition/render:3',
+        'status': status
+    }, **kwargs)
+
+
+class UnreliableDynamoDB(FakeDynamoDB):
+    """
+    Leaves the last request of the first BatchWriteItem calls unprocessed, like DynamoDB does when it is throttled.
+    """
+
+    def __init__(self, calls, tables, failures):
+        super().__init__(calls, tables)
+        self.failures = failures
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            (name, requests), = RequestItems.items()
+            super().batch_write_item({name: requests[:-1]})
+
+            return {'UnprocessedItems': {name: requests[-1:]}}
+
+        return super().batch_write_item(RequestItems)
+
+
+@pytest.fixture
+def services():
+    calls = ApiCalls()
+    services = {
+        'dynamodb': FakeDynamoDB(calls, {JOBS_TRACKING_TABLE: ('JobId',)}),
+        'logs': FakeLogs(calls, [(JOBS_LOG_GROUP, JOBS_LOG_STREAM)]),
+        'batch': FakeBatch(calls)
+    }
+
+    runtime.reset()
+
+    for name, client in services.items():
+        runtime.set_client(name, client)
+
+    yield services
+
+    runtime.reset()
+
+
+@pytest.fixture
+def reconcile(load_function, monkeypatch):
+    module = load_function('func_reconcile_stale_jobs', JOBS_LOG_GROUP=JOBS_LOG_GROUP, JOBS_LOG_STREAM=JOBS_LOG_STREAM,
+                           JOBS_TRACKING_TABLE=JOBS_TRACKING_TABLE)
+    monkeypatch.setattr(module.time, 'sleep', lambda seconds: None)
+
+    return module
+
+
+def track(dynamodb, *tracking_items):
+    for tracking_data in tracking_items:
+        dynamodb.put_item(TableName=JOBS_TRACKING_TABLE, Item=runtime.serialize_item(tracking_data))
+
+
+def tracked_job_ids(dynamodb):
+    items = dynamodb.tables[JOBS_TRACKING_TABLE].items
+    return sorted(job_id for (job_id,), item in items.items() if jobs.COMPLETED_STATUS_ATTRIBUTE not in item)
+
+
+def tombstones(dynamodb):
+    items = dynamodb.tables[JOBS_TRACKING_TABLE].items.values()
+    return {item['JobId']: item[jobs.COMPLETED_STATUS_ATTRIBUTE] for item in items
+            if jobs.COMPLETED_STATUS_ATTRIBUTE in item}
+
+
+def test_reconcile_page(services, reconcile):
+    tracking_items = [
+        {'JobId': 'completed', 'RUNNABLE': 1000, 'STARTING': 61000, 'RUNNING': 91000, jobs.EXPIRES_AT_ATTRIBUTE: 1},
+        {'JobId': 'abandoned', 'RUNNABLE': 1000, jobs.EXPIRES_AT_ATTRIBUTE: 1},
+        {'JobId': 'active', 'RUNNABLE': 1000, 'RUNNING': 31000, jobs.EXPIRES_AT_ATTRIBUTE: 1}
+    ]
+    track(services['dynamodb'], *tracking_items)
+    services['batch'].jobs.update({
+        'completed': job_detail('completed', 'SUCCEEDED', startedAt=91000, stoppedAt=391000),
+        'active': job_detail('active', 'RUNNING', startedAt=31000)
+    })
+    counts = {'Completed': 0, 'Abandoned': 0, 'Active': 0, 'Failed': 0}
+
+    reconcile.reconcile_page(tracking_items, jobs.BatchJobStatusSource(services['batch']), counts)
+
+    assert counts == {'Completed': 1, 'Abandoned': 1, 'Active': 1, 'Failed': 0}
+
+    logged = {job['JobId']: job for job in map(json.loads, services['logs'].logged_messages())}
+    assert sorted(logged) == ['abandoned', 'completed']
+
+    assert logged['completed']['Status'] == 'SUCCEEDED'
+    assert logged['completed']['JobQueue'] == 'high'
+    assert logged['completed']['StoppedAt'] == 391000
+    assert (logged['completed']['TotalRunnableSeconds'], logged['completed']['TotalStartingSeconds'],
+            logged['completed']['TotalRunningSeconds']) == (60, 30, 300)
+
+    assert logged['abandoned']['Status'] == jobs.ABANDONED_STATUS
+    assert logged['abandoned']['RunnableAt'] == 1000
+    assert 'TotalRunningSeconds' not in logged['abandoned']
+
+    # The logged jobs are replaced by their tombstone, and the active one expires later
+    assert tracked_job_ids(services['dynamodb']) == ['active']
+    assert tombstones(services['dynamodb']) == {'completed': 'SUCCEEDED', 'abandoned': jobs.ABANDONED_STATUS}
+    assert services['dynamodb'].tables[JOBS_TRACKING_TABLE].items[('active',)][jobs.EXPIRES_AT_ATTRIBUTE] > 1
+
+
+def test_reconcile_page_keeps_the_jobs_that_were_not_logged(services, reconcile, monkeypatch):
+    def put_log_events(**kwargs):
+        raise ClientError({'Error': {'Code': 'ServiceUnavailableException', 'Message': ''}}, 'PutLogEvents')
+
+    tracking_items = [{'JobId': 'abandoned', 'RUNNABLE': 1000}]
+    track(services['dynamodb'], *tracking_items)
+    monkeypatch.setattr(services['logs'], 'put_log_events', put_log_events)
+    counts = {'Completed': 0, 'Abandoned': 0, 'Active': 0, 'Failed': 0}
+
+    reconcile.reconcile_page(tracking_items, jobs.BatchJobStatusSource(services['batch']), counts)
+
+    assert counts == {'Completed': 0, 'Abandoned': 1, 'Active': 0, 'Failed': 1}
+    assert tracked_job_ids(services['dynamodb']) == ['abandoned']
+    assert tombstones(services['dynamodb']) == {}
+
+
+def test_postpone_expiration(services, reconcile):
+    track(services['dynamodb'], {'JobId': 'active', jobs.EXPIRES_AT_ATTRIBUTE: 1})
+
+    reconcile.postpone_expiration('active')
+
+    item = services['dynamodb'].tables[JOBS_TRACKING_TABLE].items[('active',)]
+    assert item[jobs.EXPIRES_AT_ATTRIBUTE] >= jobs.expiration() - 60
+
+
+def test_postpone_expiration_of_completed_jobs(services, reconcile):
+    # The job completed since it was scanned, its item must not be created again
+    services['dynamodb'].put_item(TableName=JOBS_TRACKING_TABLE, Item=jobs.tombstone('logged', 'FAILED'))
+
+    reconcile.postpone_expiration('completed')
+    reconcile.postpone_expiration('logged')
+
+    assert tracked_job_ids(services['dynamodb']) == []
+    assert tombstones(services['dynamodb']) == {'logged': 'FAILED'}
+
+
+def test_scan_stale_jobs_skips_tombstones(services, reconcile):
+    track(services['dynamodb'], {'JobId': 'stale', jobs.EXPIRES_AT_ATTRIBUTE: 1}, {'JobId': 'untimed'},
+          {'JobId': 'fresh', jobs.EXPIRES_AT_ATTRIBUTE: jobs.expiration()})
+    services['dynamodb'].put_item(TableName=JOBS_TRACKING_TABLE, Item=jobs.tombstone('logged', 'SUCCEEDED'))
+
+    pages = list(reconcile.scan_stale_jobs(3600))
+
+    assert sorted(item['JobId'] for page in pages for item in page) == ['stale', 'untimed']
+
+
+def test_tombstone_jobs_retries_unprocessed_items(services, reconcile):
+    dynamodb = UnreliableDynamoDB(ApiCalls(), {JOBS_TRACKING_TABLE: ('JobId',)}, failures=2)
+    runtime.set_client('dynamodb', dynamodb)
+    job_ids = [f'job-{i:02d}' for i in range(30)]
+    track(dynamodb, *({'JobId': job_id} for job_id in job_ids + ['active']))
+
+    reconcile.tombstone_jobs([{'JobId': job_id, 'Status': 'SUCCEEDED'} for job_id in job_ids])
+
+    assert tracked_job_ids(dynamodb) == ['active']
+    assert sorted(tombstones(dynamodb)) == job_ids
+    # Two batches, the first of them retried twice
+    assert dynamodb.calls.counts['dynamodb.BatchWriteItem'] == 4
+
+
+def test_tombstone_jobs_gives_up(services, reconcile):
+    dynamodb = UnreliableDynamoDB(ApiCalls(), {JOBS_TRACKING_TABLE: ('JobId',)},
+                                  failures=reconcile.BATCH_WRITE_MAX_RETRIES + 1)
+    runtime.set_client('dynamodb', dynamodb)
+
+    with pytest.raises(RuntimeError):
+        reconcile.tombstone_jobs([{'JobId': 'job-1', 'Status': 'FAILED'}, {'JobId': 'job-2', 'Status': 'FAILED'}])
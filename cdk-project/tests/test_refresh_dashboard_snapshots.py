@@ -0,0 +1,146 @@
+import datetime
+import types
+
+import pytest
+
+from batch_insights import runtime
+from batch_insights.snapshots import DAY_SECONDS, STATE_DAY
+
+from benchmarks.fakes import ApiCalls, FakeDynamoDB
+from queries import log_queries
+
+
+DASHBOARD_SNAPSHOTS_TABLE = 'DashboardSnapshots'
+RETENTION_DAYS = 45
+
+
+class FakeInsights:
+    """
+    Logs Insights queries that complete on their first poll, with one job per day of their time range. Queries of the
+    given query strings fail.
+    """
+
+    def __init__(self, dynamodb, failing_queries=()):
+        self.dynamodb = dynamodb
+        self.failing_queries = set(failing_queries)
+        self.queries = {}
+        self.started = []
+
+        self.exceptions = types.SimpleNamespace(LimitExceededException=type('LimitExceededException', (Exception,), {}))
+
+    def refreshed_snapshots(self):
+        items = self.dynamodb.tables[DASHBOARD_SNAPSHOTS_TABLE].items
+        return sorted(snapshot for snapshot, day in items if day == STATE_DAY)
+
+    def start_query(self, logGroupName, startTime, endTime, queryString, limit):
+        query_id = str(len(self.queries))
+        self.queries[query_id] = (queryString, startTime, endTime, limit)
+        # The snapshots already written when every query starts
+        self.started.append((queryString, startTime, self.refreshed_snapshots()))
+
+        return {'queryId': query_id}
+
+    def get_query_results(self, queryId):
+        query_string, start, end, limit = self.queries[queryId]
+
+        if query_string in self.failing_queries:
+            return {'status': 'Failed', 'results': []}
+
+        days = range(start // DAY_SECONDS * DAY_SECONDS, end + 1, DAY_SECONDS)
+        results = [
+            [{'field': 'bin(1d)',
+              'value': datetime.datetime.fromtimestamp(day, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S.000')},
+             {'field': 'JobQueue', 'value': 'high'},
+             {'field': 'Jobs', 'value': '1'}]
+            for day in days
+        ]
+
+        return {'status': 'Complete', 'results': results[:limit]}
+
+
+class Context:
+    def __init__(self, remaining_time_ms):
+        self.remaining_time_ms = list(remaining_time_ms)
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_ms.pop(0) if len(self.remaining_time_ms) > 1 else self.remaining_time_ms[0]
+
+
+SNAPSHOTS = [log_queries.build_count_snapshot('JobQueue'), log_queries.build_count_snapshot('InstanceType')]
+
+
+@pytest.fixture
+def refresh(load_function, monkeypatch):
+    dynamodb = FakeDynamoDB(ApiCalls(), {DASHBOARD_SNAPSHOTS_TABLE: ('Snapshot', 'Day')})
+    runtime.reset()
+    runtime.set_client('dynamodb', dynamodb)
+
+    module = load_function('func_refresh_dashboard_snapshots', JOBS_LOG_GROUP='/aws-batch-insights/jobs',
+                           DASHBOARD_SNAPSHOTS_TABLE=DASHBOARD_SNAPSHOTS_TABLE,
+                           SNAPSHOT_RETENTION_DAYS=str(RETENTION_DAYS), MAX_CONCURRENT_QUERIES='1')
+    monkeypatch.setattr(module.time, 'sleep', lambda seconds: None)
+
+    yield module, dynamodb
+
+    runtime.reset()
+
+
+def use_insights(insights):
+    runtime.set_client('logs', insights)
+    return insights
+
+
+def snapshot_days(dynamodb, snapshot_id):
+    items = dynamodb.tables[DASHBOARD_SNAPSHOTS_TABLE].items
+    return {day: item['Rows'] for (snapshot, day), item in items.items()
+            if snapshot == snapshot_id and day != STATE_DAY}
+
+
+def test_snapshots_are_written_as_soon_as_their_queries_complete(refresh):
+    module, dynamodb = refresh
+    insights = use_insights(FakeInsights(dynamodb))
+
+    refreshed = module.handler({'Snapshots': SNAPSHOTS}, None)
+
+    assert refreshed == {snapshot['Id']: RETENTION_DAYS for snapshot in SNAPSHOTS}
+    # Every day holds the job of its query
+    assert set(snapshot_days(dynamodb, SNAPSHOTS[0]['Id']).values()) == {'[["high",1]]'}
+
+    first_queries = [written for query_string, _, written in insights.started if query_string == SNAPSHOTS[1]['Query']]
+    assert first_queries[0] == [SNAPSHOTS[0]['Id']]
+
+
+def test_truncated_queries_are_split(refresh, monkeypatch):
+    module, dynamodb = refresh
+    monkeypatch.setattr(module, 'QUERY_RESULTS_LIMIT', 4)
+    use_insights(FakeInsights(dynamodb))
+
+    module.handler({'Snapshots': SNAPSHOTS[:1]}, None)
+
+    days = snapshot_days(dynamodb, SNAPSHOTS[0]['Id'])
+    assert len(days) == RETENTION_DAYS
+    assert set(days.values()) == {'[["high",1]]'}
+
+
+def test_queries_stop_before_the_function_times_out(refresh):
+    module, dynamodb = refresh
+    insights = use_insights(FakeInsights(dynamodb))
+
+    # Time runs low once the first query of the second snapshot has started
+    refreshed = module.handler({'Snapshots': SNAPSHOTS}, Context([120000, 120000, 120000, 1000]))
+
+    assert refreshed == {SNAPSHOTS[0]['Id']: RETENTION_DAYS}
+    assert insights.refreshed_snapshots() == [SNAPSHOTS[0]['Id']]
+    assert [query_string for query_string, _, _ in insights.started].count(SNAPSHOTS[1]['Query']) == 1
+
+
+def test_failed_snapshots(refresh):
+    module, dynamodb = refresh
+    insights = use_insights(FakeInsights(dynamodb, failing_queries=[SNAPSHOTS[0]['Query']]))
+
+    with pytest.raises(RuntimeError):
+        module.handler({'Snapshots': SNAPSHOTS}, None)
+
+    assert insights.refreshed_snapshots() == [SNAPSHOTS[1]['Id']]
+    # The other queries of the failed snapshot are not run
+    assert [query_string for query_string, _, _ in insights.started].count(SNAPSHOTS[0]['Query']) == 1
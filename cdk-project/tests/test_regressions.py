@@ -0,0 +1,299 @@
+import math
+
+import pytest
+
+from batch_insights import regressions
+from batch_insights.regressions import DRIFT, REVISION, WARMUP_SAMPLES, Baseline, RegressionDetector
+
+from analysis.regressions import SampleSet, backtest
+from benchmarks.fakes import ApiCalls, FakeDynamoDB
+
+
+RUNTIME_BASELINES_TABLE = 'RuntimeBaselines'
+KEY = regressions.baseline_key('Render', 'c5.xlarge', 'RUNNING')
+MINUTE_MS = 60 * 1000
+
+# 2024-01-01T00:00:00Z
+START_MS = 1704067200000
+
+
+class ConcurrentDynamoDB(FakeDynamoDB):
+    """
+    Runs a callback before the first put, e.g. to update a baseline from another invocation between the read and the
+    write of a flush.
+    """
+
+    def __init__(self, calls, tables, before_put=None):
+        super().__init__(calls, tables)
+        self.before_put = before_put
+
+    def put_item(self, **kwargs):
+        if self.before_put is not None:
+            before_put, self.before_put = self.before_put, None
+            before_put(self)
+
+        return super().put_item(**kwargs)
+
+
+@pytest.fixture
+def dynamodb():
+    return FakeDynamoDB(ApiCalls(), {RUNTIME_BASELINES_TABLE: ('Baseline',)})
+
+
+def durations(seconds, count, spread=0.05):
+    # Alternate around the duration, so that the log durations have a standard deviation of spread
+    return [seconds * math.exp(spread if i % 2 else -spread) for i in range(count)]
+
+
+def add_durations(baseline, revision, seconds, count, start_ms=START_MS, spread=0.05):
+    """
+    Adds a duration every minute from start_ms and returns the regressions detected, and the time of the next one.
+    """
+
+    found = []
+
+    for i, duration in enumerate(durations(seconds, count, spread)):
+        now_ms = start_ms + i * MINUTE_MS
+        baseline.add(revision, regressions.log_duration(duration))
+        found.extend(baseline.detect(now_ms))
+
+    return found, start_ms + count * MINUTE_MS
+
+
+def job(revision, seconds, minute, status='SUCCEEDED', instance_type='c5.xlarge'):
+    return {'JobDefinition': f'Render:{revision}', 'InstanceType': instance_type, 'Status': status,
+            'TotalRunningSeconds': seconds, 'TotalRunnableSeconds': 30, 'StoppedAt': START_MS + minute * MINUTE_MS}
+
+
+def revision_jobs(slowdown):
+    jobs = [job(1, seconds, i) for i, seconds in enumerate(durations(600, 200))]
+
+    return jobs + [job(2, seconds, 200 + i) for i, seconds in enumerate(durations(600 * slowdown, 100))]
+
+
+@pytest.mark.parametrize('job_definition, expected', [
+    ('Render:2', ('Render', 2)),
+    ('Render', ('Render', 0)),
+    ('arn:aws:batch:us-east-1:123456789012:job-definition/Render:13',
+     ('arn:aws:batch:us-east-1:123456789012:job-definition/Render', 13)),
+    ('Render:latest', ('Render:latest', 0))
+])
+def test_parse_job_definition(job_definition, expected):
+    assert regressions.parse_job_definition(job_definition) == expected
+
+
+def test_job_samples():
+    assert regressions.job_samples(job(2, 600, 0)) == [
+        ('Render#c5.xlarge#RUNNING', 2, math.log(600)), ('Render#c5.xlarge#RUNNABLE', 2, math.log(30))
+    ]
+
+    # Failed jobs are cut short, only their time in the queue is measured
+    assert [key for key, _, _ in regressions.job_samples(job(2, 600, 0, status='FAILED'))] == \
+        ['Render#c5.xlarge#RUNNABLE']
+
+    # Jobs shorter than a second are measured as one second
+    assert regressions.job_samples(job(2, 0.2, 0))[0][2] == 0.0
+
+    assert regressions.job_samples(dict(job(2, 600, 0), InstanceType=None)) == []
+
+
+def test_effective_samples():
+    assert regressions.effective_samples(50) == 50
+    assert regressions.effective_samples(10000) == 2 / regressions.SLOW_ALPHA - 1
+
+
+def test_nothing_is_detected_during_the_warmup():
+    baseline = Baseline(KEY)
+    add_durations(baseline, 1, 600, 200)
+
+    # The new revision is twice slower, but doesn't have enough samples to be compared yet
+    found, _ = add_durations(baseline, 2, 1200, WARMUP_SAMPLES - 1, start_ms=START_MS + 200 * MINUTE_MS)
+
+    assert found == []
+    assert baseline.track['N'] == WARMUP_SAMPLES - 1
+
+
+def test_revisions_without_a_baseline_are_not_compared():
+    baseline = Baseline(KEY)
+
+    # The previous revision ran too few jobs to be a baseline
+    add_durations(baseline, 1, 600, WARMUP_SAMPLES - 1)
+    found, _ = add_durations(baseline, 2, 1200, 100, start_ms=START_MS + WARMUP_SAMPLES * MINUTE_MS)
+
+    assert found == []
+    assert (baseline.previous_revision, baseline.previous['N']) == (1, WARMUP_SAMPLES - 1)
+
+
+def test_revision_regression():
+    baseline = Baseline(KEY)
+    add_durations(baseline, 1, 600, 200)
+
+    found, next_ms = add_durations(baseline, 2, 720, 100, start_ms=START_MS + 200 * MINUTE_MS)
+
+    # Reported as soon as the new revision has enough samples, then not again within the alert interval
+    regression, = found
+    assert regression['DetectedAt'] == START_MS + (200 + WARMUP_SAMPLES - 1) * MINUTE_MS
+    assert (regression['Kind'], regression['JobDefinition'], regression['BaselineJobDefinition'],
+            regression['InstanceType'], regression['Status'], regression['Jobs']) == \
+        (REVISION, 'Render:2', 'Render:1', 'c5.xlarge', 'RUNNING', WARMUP_SAMPLES)
+    assert regression['SlowdownPercent'] == pytest.approx(20, abs=0.1)
+    assert regression['BaselineSeconds'] == pytest.approx(600, rel=0.01)
+    assert regression['ZScore'] >= regressions.Z_THRESHOLD
+
+    later_ms = regression['DetectedAt'] + regressions.ALERT_INTERVAL_SECONDS * 1000
+    found, _ = add_durations(baseline, 2, 720, 1, start_ms=max(next_ms, later_ms))
+
+    assert [regression['Kind'] for regression in found] == [REVISION]
+
+
+def test_samples_of_older_revisions():
+    baseline = Baseline(KEY)
+    add_durations(baseline, 2, 600, 10)
+    add_durations(baseline, 1, 6000, 10)
+
+    assert (baseline.revision, baseline.previous) == (2, None)
+
+    # The previous revision keeps being updated after a new one shows up, older ones are ignored
+    add_durations(baseline, 3, 600, 10)
+    add_durations(baseline, 2, 600, 5)
+    add_durations(baseline, 1, 600, 5)
+
+    assert (baseline.revision, baseline.track['N']) == (3, 10)
+    assert (baseline.previous_revision, baseline.previous['N']) == (2, 15)
+
+
+@pytest.mark.parametrize('slowdown, min_slowdown, detected', [
+    (1.05, regressions.MIN_SLOWDOWN, False),
+    (1.05, 0.04, True),
+    (1.2, regressions.MIN_SLOWDOWN, True),
+    # Faster revisions are not regressions
+    (0.5, regressions.MIN_SLOWDOWN, False)
+])
+def test_min_slowdown(slowdown, min_slowdown, detected):
+    baseline = Baseline(KEY, min_slowdown=min_slowdown)
+    add_durations(baseline, 1, 600, 200, spread=0.01)
+
+    found, _ = add_durations(baseline, 2, 600 * slowdown, 100, start_ms=START_MS + 200 * MINUTE_MS, spread=0.01)
+
+    assert [regression['Kind'] for regression in found] == ([REVISION] if detected else [])
+
+
+@pytest.mark.parametrize('z_threshold, detected', [(regressions.Z_THRESHOLD, False), (1.5, True)])
+def test_z_threshold(z_threshold, detected):
+    baseline = Baseline(KEY, z_threshold=z_threshold)
+    add_durations(baseline, 1, 600, 200, spread=0.5)
+
+    # A slowdown of 20% within durations that vary by 65% has a z-score of about 2 after 30 jobs
+    found, _ = add_durations(baseline, 2, 720, WARMUP_SAMPLES, start_ms=START_MS + 200 * MINUTE_MS, spread=0.5)
+
+    assert [regression['Kind'] for regression in found] == ([REVISION] if detected else [])
+
+
+def test_drift():
+    baseline = Baseline(KEY)
+    found, next_ms = add_durations(baseline, 1, 600, 300, spread=0.1)
+
+    assert found == []
+
+    # The jobs of the same revision slow down: the fast EWMA moves away from the slow one
+    found, _ = add_durations(baseline, 1, 900, 100, start_ms=next_ms, spread=0.1)
+
+    regression, = found
+    assert (regression['Kind'], regression['JobDefinition'], regression['BaselineJobDefinition']) == \
+        (DRIFT, 'Render:1', 'Render:1')
+    assert regression['SlowdownPercent'] >= regressions.MIN_SLOWDOWN * 100
+
+
+def test_stable_durations_are_not_regressions():
+    baseline = Baseline(KEY)
+    add_durations(baseline, 1, 600, 200, spread=0.3)
+
+    found, _ = add_durations(baseline, 2, 600, 1000, start_ms=START_MS + 200 * MINUTE_MS, spread=0.3)
+
+    assert found == []
+
+
+def test_item_round_trip():
+    baseline = Baseline(KEY)
+    add_durations(baseline, 1, 600, 200)
+    found, _ = add_durations(baseline, 2, 720, 50, start_ms=START_MS + 200 * MINUTE_MS)
+
+    loaded = Baseline.from_item(baseline.to_item())
+
+    assert found
+    assert (loaded.key, loaded.revision, loaded.previous_revision, loaded.version) == (KEY, 2, 1, 1)
+    assert loaded.track == pytest.approx(baseline.track)
+    assert loaded.previous == pytest.approx(baseline.previous)
+    assert loaded.alerted_at == {REVISION: found[0]['DetectedAt']}
+
+
+def test_detector_creates_and_updates_the_baselines(dynamodb):
+    detector = RegressionDetector(dynamodb, RUNTIME_BASELINES_TABLE)
+
+    for i, seconds in enumerate(durations(600, 10)):
+        detector.record(job(1, seconds, i), START_MS + i * MINUTE_MS)
+
+    assert detector.flush() == []
+
+    items = dynamodb.tables[RUNTIME_BASELINES_TABLE].items
+    assert sorted(items) == [('Render#c5.xlarge#RUNNABLE',), ('Render#c5.xlarge#RUNNING',)]
+    assert (items[(KEY,)]['N'], items[(KEY,)]['Version']) == (10, 1)
+
+    # Nothing is left to flush, and the next jobs update the stored baselines
+    assert detector.flush() == []
+    detector.record(job(1, 600, 10), START_MS + 10 * MINUTE_MS)
+    detector.flush()
+
+    assert (items[(KEY,)]['N'], items[(KEY,)]['Version']) == (11, 2)
+    assert dynamodb.calls.counts['dynamodb.PutItem'] == 4
+
+
+def test_detector_reports_the_regressions_of_the_flushed_jobs(dynamodb):
+    detector = RegressionDetector(dynamodb, RUNTIME_BASELINES_TABLE)
+
+    for record in revision_jobs(1.2):
+        detector.record(record, record['StoppedAt'])
+
+    found = detector.flush()
+
+    assert [(regression['Kind'], regression['Status']) for regression in found] == [(REVISION, 'RUNNING')]
+
+
+def test_concurrent_updates_are_retried_on_top_of_each_other():
+    def update_concurrently(dynamodb):
+        other = RegressionDetector(dynamodb, RUNTIME_BASELINES_TABLE)
+        other.record(job(1, 600, 0), START_MS)
+        other.flush()
+
+    dynamodb = ConcurrentDynamoDB(ApiCalls(), {RUNTIME_BASELINES_TABLE: ('Baseline',)},
+                                  before_put=update_concurrently)
+    detector = RegressionDetector(dynamodb, RUNTIME_BASELINES_TABLE)
+    detector.record(dict(job(1, 600, 0), TotalRunnableSeconds=None), START_MS)
+    detector.record(dict(job(1, 600, 1), TotalRunnableSeconds=None), START_MS + MINUTE_MS)
+
+    detector.flush()
+
+    item = dynamodb.tables[RUNTIME_BASELINES_TABLE].items[(KEY,)]
+    assert (item['N'], item['Version']) == (3, 2)
+    assert dynamodb.calls.counts['dynamodb.GetItem'] == 1
+
+
+@pytest.mark.parametrize('slowdown', [1.05, 1.2, 1.5])
+def test_backtest_matches_the_detector(dynamodb, slowdown):
+    records = revision_jobs(slowdown) + [job(3, 900, 300 + i, instance_type='m5.large') for i in range(50)]
+    detector = RegressionDetector(dynamodb, RUNTIME_BASELINES_TABLE)
+    samples = SampleSet()
+
+    for record in records:
+        detector.record(record, record['StoppedAt'])
+
+    samples.add_records(records)
+
+    expected = sorted(detector.flush(), key=lambda regression: (regression['DetectedAt'], regression['JobDefinition'],
+                                                                regression['InstanceType'], regression['Status']))
+    found = backtest(samples)
+
+    assert len(found) == len(expected)
+
+    for regression, expected_regression in zip(found, expected):
+        assert regression == pytest.approx(expected_regression)
@@ -0,0 +1,209 @@
+import math
+import random
+
+import pytest
+
+from batch_insights import sketches
+from batch_insights.sketches import DDSketch, SketchStore
+
+from benchmarks.fakes import ApiCalls, FakeDynamoDB
+
+
+DURATION_SKETCHES_TABLE = 'JobDurationSketches'
+HOUR_MS = 3600 * 1000
+
+
+class PagedDynamoDB(FakeDynamoDB):
+    """
+    Returns the items of a query one page at a time, like DynamoDB does once a page reaches 1 MB, and records the
+    number of operands of every update.
+    """
+
+    def __init__(self, calls, tables):
+        super().__init__(calls, tables)
+        self.update_operands = []
+
+    def update_item(self, **kwargs):
+        self.update_operands.append(len(kwargs['ExpressionAttributeNames']))
+        return super().update_item(**kwargs)
+
+    def query(self, ExclusiveStartKey=None, **kwargs):
+        items = super().query(**kwargs)['Items']
+
+        if ExclusiveStartKey is not None:
+            items = items[items.index(next(i for i in items if i['Bucket'] == ExclusiveStartKey['Bucket'])) + 1:]
+
+        response = {'Items': items[:1], 'Count': len(items[:1])}
+
+        if len(items) > 1:
+            response['LastEvaluatedKey'] = {'SketchKey': items[0]['SketchKey'], 'Bucket': items[0]['Bucket']}
+
+        return response
+
+
+@pytest.fixture
+def dynamodb():
+    return PagedDynamoDB(ApiCalls(), {DURATION_SKETCHES_TABLE: ('SketchKey', 'Bucket')})
+
+
+def exact_quantile(values, q):
+    # Same rank as the sketch, the value below which a fraction q of the other values lie
+    return sorted(values)[math.floor(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize('value', [1e-6, 0.5, 1, 3.7, 600, 86400 * 14])
+def test_key_and_value(value):
+    sketch = DDSketch()
+
+    # Every value belongs to the bin (gamma^(key-1), gamma^key], which is represented within the relative accuracy
+    key = sketch.key(value)
+    assert sketch.gamma ** (key - 1) < value <= sketch.gamma ** key * (1 + 1e-12)
+    assert sketch.value(key) == pytest.approx(value, rel=sketch.relative_accuracy)
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.05])
+def test_quantiles_are_within_the_relative_accuracy(relative_accuracy):
+    generator = random.Random(0)
+    values = [generator.lognormvariate(5, 2) for _ in range(10000)]
+    sketch = DDSketch(relative_accuracy)
+
+    for value in values:
+        sketch.add(value)
+
+    assert sketch.count == len(values)
+
+    for q in (0, 0.1, 0.5, 0.9, 0.95, 0.99, 1):
+        assert sketch.quantile(q) == pytest.approx(exact_quantile(values, q), rel=relative_accuracy)
+
+
+def test_zero_values():
+    sketch = DDSketch()
+
+    for value in (0, 0, 0, 10, 20):
+        sketch.add(value)
+
+    assert (sketch.zero_count, sketch.count) == (3, 5)
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == pytest.approx(20, rel=sketch.relative_accuracy)
+
+
+def test_invalid_values():
+    sketch = DDSketch()
+
+    assert sketch.quantile(0.5) is None
+
+    with pytest.raises(ValueError):
+        sketch.add(-1)
+
+    with pytest.raises(ValueError):
+        sketch.quantile(1.5)
+
+
+def test_collapse_merges_the_lowest_bins():
+    sketch = DDSketch(max_bins=10)
+    values = [sketch.gamma ** key for key in range(1, 101)]
+
+    for value in values:
+        sketch.add(value)
+
+    assert len(sketch.bins) == 10
+    assert sketch.count == sum(sketch.bins.values()) == 100
+
+    # The 91 lowest values are counted in the lowest remaining bin, the highest quantiles are unaffected
+    assert sketch.bins[min(sketch.bins)] == 91
+    assert sketch.quantile(1) == pytest.approx(values[-1], rel=sketch.relative_accuracy)
+    assert sketch.quantile(0.95) == pytest.approx(exact_quantile(values, 0.95), rel=sketch.relative_accuracy)
+
+
+def test_merge():
+    generator = random.Random(1)
+    first, second = ([generator.expovariate(1 / 300) for _ in range(500)] + [0] for _ in range(2))
+    merged, combined, other = DDSketch(), DDSketch(), DDSketch()
+
+    for value in first:
+        merged.add(value)
+        combined.add(value)
+
+    for value in second:
+        other.add(value)
+        combined.add(value)
+
+    merged.merge(other)
+
+    assert (merged.bins, merged.zero_count, merged.count) == (combined.bins, combined.zero_count, combined.count)
+
+    with pytest.raises(ValueError):
+        merged.merge(DDSketch(0.05))
+
+
+def test_flush_aggregates_the_jobs_per_dimension_value_and_bucket(dynamodb):
+    store = SketchStore(dynamodb, DURATION_SKETCHES_TABLE)
+    key = store._sketch.key
+
+    store.record({'JobQueue': 'high', 'InstanceType': 'c5.xlarge', 'TotalRunningSeconds': 60,
+                  'TotalStartingSeconds': 0}, 1000)
+    store.record({'JobQueue': 'high', 'TotalRunningSeconds': 60}, 2000)
+    store.record({'JobQueue': 'high', 'TotalRunningSeconds': 60}, HOUR_MS + 1000)
+    store.flush()
+
+    items = dynamodb.tables[DURATION_SKETCHES_TABLE].items
+    assert sorted(items) == [('InstanceType#c5.xlarge', 0), ('JobQueue#high', 0), ('JobQueue#high', 3600)]
+    assert items[('JobQueue#high', 0)] == {'SketchKey': 'JobQueue#high', 'Bucket': 0, f'R{key(60)}': 2,
+                                           'S' + sketches.ZERO_BIN: 1}
+    assert dynamodb.update_operands == [2, 2, 1]
+
+    # Flushing twice doesn't count the jobs again
+    store.flush()
+
+    assert len(dynamodb.update_operands) == 3
+
+
+def test_flush_splits_the_bins_in_updates_of_at_most_100_operands(dynamodb):
+    store = SketchStore(dynamodb, DURATION_SKETCHES_TABLE)
+    gamma = store._sketch.gamma
+
+    for i in range(250):
+        store.record({'JobQueue': 'high', 'TotalRunningSeconds': gamma ** (i + 0.5)}, 1000)
+
+    store.flush()
+
+    assert dynamodb.update_operands == [100, 100, 50]
+
+    sketch = store.load('JobQueue', 'high', 0, HOUR_MS)['RUNNING']
+    assert (sketch.count, len(sketch.bins)) == (250, 250)
+
+
+def test_load_merges_the_buckets_of_all_the_pages(dynamodb):
+    store = SketchStore(dynamodb, DURATION_SKETCHES_TABLE)
+    durations = [0, 30, 60, 120, 600]
+
+    for hour, duration in enumerate(durations):
+        store.record({'JobQueue': 'high', 'TotalRunningSeconds': duration, 'TotalRunnableSeconds': 5},
+                     hour * HOUR_MS + 1000)
+
+    store.record({'JobQueue': 'low', 'TotalRunningSeconds': 3600}, 1000)
+    store.flush()
+
+    # The bucket of the last hour is left out of the time range
+    loaded = store.load('JobQueue', 'high', 0, 3 * HOUR_MS + 1)
+
+    assert dynamodb.calls.counts['dynamodb.Query'] == 4
+    assert (loaded['RUNNING'].count, loaded['RUNNING'].zero_count) == (4, 1)
+    assert loaded['RUNNABLE'].count == 4
+    assert loaded['STARTING'].count == 0
+    assert loaded['RUNNING'].quantile(1) == pytest.approx(120, rel=sketches.DEFAULT_RELATIVE_ACCURACY)
+
+
+def test_percentiles(dynamodb):
+    store = SketchStore(dynamodb, DURATION_SKETCHES_TABLE)
+
+    for duration in range(1, 101):
+        store.record({'JobDefinition': 'render', 'TotalRunningSeconds': duration}, 1000)
+
+    store.flush()
+
+    running = store.percentiles('JobDefinition', 'render', 0, HOUR_MS, quantiles=(0.5, 0.99))['RUNNING']
+
+    assert running['Count'] == 100
+    assert running['p50'] == pytest.approx(50, rel=sketches.DEFAULT_RELATIVE_ACCURACY)
+    assert running['p99'] == pytest.approx(99, rel=sketches.DEFAULT_RELATIVE_ACCURACY)